@@ -2,6 +2,7 @@
 # You should have received a copy of the GPL along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from contextvars import ContextVar
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
 from flask import Flask, request, current_app, session
@@ -52,6 +53,35 @@ if not Config.SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
     _engine_options['max_overflow'] = Config.DB_MAX_OVERFLOW
 db = SQLAlchemy(session_options={"autoflush": False}, engine_options=_engine_options)
 make_searchable(db.metadata)
+
+# The session of the Celery task running in this context, see patch_db_session(). A context variable rather than a
+# swapped global so that tasks running side by side in threads or greenlets each get their own.
+current_task_session = ContextVar('current_task_session', default=None)
+
+
+class TaskSessionRegistry:
+    """Wraps the registry of db.session so that db.session is the task session while there is one, and otherwise the
+    usual session of the app context. remove() leaves the task session alone - the task closes it."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def __call__(self):
+        session = current_task_session.get()
+        return session if session is not None else self.registry()
+
+    def has(self):
+        return current_task_session.get() is None and self.registry.has()
+
+    def set(self, session):
+        self.registry.set(session)
+
+    def clear(self):
+        if current_task_session.get() is None:
+            self.registry.clear()
+
+
+db.session.registry = TaskSessionRegistry(db.session.registry)
 migrate = Migrate()
 login = LoginManager()
 login.login_view = 'auth.login'
@@ -181,17 +211,9 @@ def create_app(config_class=Config):
     app_bcrypt.init_app(app)
     celery.conf.update(app.config)
 
-    celery.conf.update(CELERY_ROUTES={
-        'app.shared.tasks.users.check_user_application': {'queue': 'background'},
-        'app.user.utils.purge_user_then_delete_task': {'queue': 'background'},
-        'app.community.util.retrieve_mods_and_backfill': {'queue': 'background'},
-        'app.community.util.send_to_remote_instance_task': {'queue': 'send'},
-        'app.activitypub.signature.post_request': {'queue': 'send'},
-        # Maintenance tasks - all go to background queue
-        'app.shared.tasks.maintenance.*': {'queue': 'background'},
-        'app.admin.routes.*': {'queue': 'background'},
-        'app.admin.util.*': {'queue': 'background'},
-    })
+    from app.task_lanes import celery_routes, LaneRateLimits, parse_rate_limits
+    celery.conf.update(CELERY_ROUTES=celery_routes(),
+                       CELERY_ANNOTATIONS=LaneRateLimits(parse_rate_limits(app.config.get('CELERY_LANE_RATE_LIMITS', ''))))
 
     # Initialize redis_client
     global redis_client
@@ -2,7 +2,6 @@ from __future__ import annotations
 
 import time
 from datetime import timedelta
-from random import randint
 
 import httpx
 from flask import current_app
@@ -19,7 +18,7 @@ from app.activitypub.util import (
     extract_domain_and_actor,
     normalise_actor_string,
 )
-from app.models import User, Community, Feed, Site
+from app.models import User, Community, Feed, Site, ActorUrl
 from app.utils import (
     utcnow,
     get_setting,
@@ -30,6 +29,15 @@ from app.utils import (
     instance_allowed,
 )
 
+ACTOR_TYPES = {"User": User, "Community": Community, "Feed": Feed}
+UNRESOLVABLE_ACTORS_KEY = "unresolvable_actors"
+GONE_STATUSES = (404, 410)
+
+
+class UnresolvableActor(Exception):
+    """The actor's server says there is no such actor, or sent something that isn't one. Unlike a timeout or a busy
+    server, trying again soon won't give a different answer."""
+
 
 def find_local_community(actor_url: str) -> Community:
     """Find a local community by URL."""
@@ -84,69 +92,67 @@ def validate_remote_actor(actor_url, actor=None, allow_banned=False):
     return True
 
 
-def find_remote_actor(actor_url):
-    """Find a remote actor in the database."""
-    # Check URL patterns to optimize database queries
-    if "/u/" in actor_url:
-        # URL contains /u/ - likely a user
-        actor = db.session.query(User).filter(User.ap_profile_id == actor_url).first()
-        if actor:
-            return actor
-    elif ("/c/" in actor_url and "/p/" not in actor_url) or (
-        "/m/" in actor_url and "/t/" not in actor_url
-    ):
-        # URL contains /c/ - likely a community
-        actor = (
-            db.session.query(Community)
-            .filter(Community.ap_profile_id == actor_url)
-            .first()
-        )
-        if actor and actor.banned:
-            # Try to find a non-banned copy of the community
-            unbanned_actor = (
-                db.session.query(Community)
-                .filter(Community.ap_profile_id == actor_url, Community.banned == False)
-                .first()
-            )
-            if unbanned_actor is None:
-                return None
-            actor = unbanned_actor
-        if actor:
-            return actor
-    elif "/f/" in actor_url:
-        # URL contains /f/ - likely a feed
-        actor = db.session.query(Feed).filter(Feed.ap_profile_id == actor_url).first()
-        if actor:
+def find_registered_actor(actor_url) -> User | Community | Feed | None:
+    """Look up an actor of any type by its ap_profile_id, via the actor_url index. If the index doesn't have it (or has
+    it wrong) each table is tried in turn instead."""
+    registered = db.session.get(ActorUrl, actor_url)
+    if registered is not None:
+        model = ACTOR_TYPES.get(registered.actor_type)
+        actor = db.session.get(model, registered.actor_id) if model else None
+        if actor is not None and actor.ap_profile_id == actor_url:
             return actor
 
-    # Fallback to trying everything
-    actor = db.session.query(User).filter(User.ap_profile_id == actor_url).first()
+    actor = find_actor_in_tables(actor_url)
+    if registered is not None or actor is not None:
+        # the index is out of step, because of something that bypasses the ORM. Put it right outside of this lookup.
+        from app.shared.tasks.maintenance import repair_actor_url
 
-    # Look for a remote community if not found as user
-    if actor is None:
+        if current_app.debug:
+            repair_actor_url(actor_url)
+        else:
+            repair_actor_url.delay(actor_url)
+    return actor
+
+
+def find_actor_in_tables(actor_url) -> User | Community | Feed | None:
+    for model in ACTOR_TYPES.values():
         actor = (
-            db.session.query(Community)
-            .filter(Community.ap_profile_id == actor_url)
+            db.session.query(model)
+            .filter(model.ap_profile_id == actor_url)
+            .order_by(model.banned)  # an unbanned copy of a community, if there is one
             .first()
         )
-        if actor and actor.banned:
-            # Try to find a non-banned copy of the community
-            unbanned_actor = (
-                db.session.query(Community)
-                .filter(Community.ap_profile_id == actor_url, Community.banned == False)
-                .first()
-            )
-            if unbanned_actor is None:
-                return None
-            actor = unbanned_actor
+        if actor is not None:
+            return actor
+    return None
 
-    # Look for a remote feed if not found as user or community
-    if actor is None:
-        actor = db.session.query(Feed).filter(Feed.ap_profile_id == actor_url).first()
 
+def find_remote_actor(actor_url):
+    """Find a remote actor in the database."""
+    actor = find_registered_actor(actor_url)
+    if isinstance(actor, Community) and actor.banned:
+        return None
     return actor
 
 
+def actor_recently_unresolvable(actor_url: str) -> bool:
+    """True if fetching this actor failed recently, so there is no point trying again yet"""
+    from app import redis_client
+    expires = redis_client.zscore(UNRESOLVABLE_ACTORS_KEY, actor_url)
+    return expires is not None and expires > time.time()
+
+
+def remember_unresolvable_actor(actor_url: str):
+    """Add to the negative cache. It is one sorted set (url -> expiry time), trimmed to the newest entries."""
+    from app import redis_client
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.zadd(UNRESOLVABLE_ACTORS_KEY, {actor_url: now + current_app.config["ACTOR_NEGATIVE_CACHE_TTL"]})
+    pipe.zremrangebyscore(UNRESOLVABLE_ACTORS_KEY, "-inf", now)
+    pipe.zremrangebyrank(UNRESOLVABLE_ACTORS_KEY, 0, -current_app.config["ACTOR_NEGATIVE_CACHE_SIZE"] - 1)
+    pipe.execute()
+
+
 def schedule_actor_refresh(actor, override=False):
     """Schedule an async refresh of actor data if needed."""
     if not actor.is_local() and (
@@ -176,7 +182,7 @@ def fetch_remote_actor_data(url: str, retry_count=1):
                 try:
                     return response.json()
                 except ValueError:
-                    return None
+                    raise UnresolvableActor(url)
 
             elif response.status_code == 401:
                 signed_response = None
@@ -187,37 +193,30 @@ def fetch_remote_actor_data(url: str, retry_count=1):
                         site.private_key,
                         f"{current_app.config['SERVER_URL']}/actor#main-key",
                     )
+                    if signed_response.status_code in GONE_STATUSES:
+                        raise UnresolvableActor(url)
                     try:
                         return signed_response.json()
                     except ValueError:
-                        return None
+                        raise UnresolvableActor(url)
+                except UnresolvableActor:
+                    raise
                 except Exception:
                     return None
                 finally:
                     if signed_response is not None:
                         signed_response.close()
 
-            elif response.status_code in (429, 502, 503, 504):
-                # Retryable server errors
-                if attempt < retry_count:
-                    time.sleep(randint(3, 10))
-                    continue
-                else:
-                    return None
+            elif response.status_code in GONE_STATUSES:
+                raise UnresolvableActor(url)
 
-            # Any other status code → give up
+            # Any other status code → give up. Overloaded servers (429, 5xx) are not retried straight away, the
+            # circuit breaker in get_request() keeps us away from them for a while instead.
             return None
 
-        # These exceptions usually mean "server is overloaded", so retry
-        except (
-            httpx.ReadTimeout,
-            httpx.ConnectTimeout,
-            httpx.WriteTimeout,
-            httpx.ReadError,
-            httpx.RemoteProtocolError,
-        ):
+        # The connection was dropped, try again on a new one
+        except (httpx.ReadError, httpx.RemoteProtocolError):
             if attempt < retry_count:
-                time.sleep(randint(3, 10))
                 continue
             else:
                 return None
@@ -241,7 +240,6 @@ def fetch_actor_from_webfinger(address: str, server: str):
             params={"resource": f"acct:{address}@{server}"},
         )
     except httpx.HTTPError:
-        time.sleep(randint(3, 10))
         try:
             webfinger_data = get_request(
                 f"https://{server}/.well-known/webfinger",
@@ -250,9 +248,16 @@ def fetch_actor_from_webfinger(address: str, server: str):
         except Exception:
             return None
 
-    if webfinger_data.status_code == 200:
-        webfinger_json = webfinger_data.json()
+    if webfinger_data.status_code in GONE_STATUSES:
         webfinger_data.close()
+        raise UnresolvableActor(address)
+    if webfinger_data.status_code == 200:
+        try:
+            webfinger_json = webfinger_data.json()
+        except ValueError:
+            raise UnresolvableActor(address)
+        finally:
+            webfinger_data.close()
 
         for link in webfinger_json.get("links", []):
             if link.get("rel") == "self":
@@ -262,7 +267,6 @@ def fetch_actor_from_webfinger(address: str, server: str):
                         link["href"], headers={"Accept": type_header}
                     )
                 except httpx.HTTPError:
-                    time.sleep(randint(3, 10))
                     try:
                         actor_data = get_request(
                             link["href"], headers={"Accept": type_header}
@@ -284,19 +288,27 @@ def fetch_actor_from_webfinger(address: str, server: str):
 def create_actor_from_remote(
     actor_address: str, community_only=False, feed_only=False
 ) -> User | Community | Feed | None:
-    """Create a new actor from remote data."""
-    if actor_address.startswith("https://") or actor_address.startswith("http://"):
-        server, address = extract_domain_and_actor(actor_address)
-        actor_json = fetch_remote_actor_data(actor_address)
-    else:
-        # Try webfinger
-        address, server = normalise_actor_string(actor_address)
-        if not address:
-            return None
-        actor_json = fetch_actor_from_webfinger(address, server)
+    """Create a new actor from remote data. Actors that definitely can't be resolved are added to the negative cache,
+    ones that failed for reasons that may not last (timeouts, busy servers, the circuit breaker) are not."""
+    try:
+        if actor_address.startswith("https://") or actor_address.startswith("http://"):
+            server, address = extract_domain_and_actor(actor_address)
+            actor_json = fetch_remote_actor_data(actor_address)
+        else:
+            # Try webfinger
+            address, server = normalise_actor_string(actor_address)
+            if not address:
+                return None
+            actor_json = fetch_actor_from_webfinger(address, server)
+    except UnresolvableActor:
+        remember_unresolvable_actor(actor_address)
+        return None
 
     if actor_json:
         actor_model = actor_json_to_model(actor_json, address, server)
+        if actor_model is None:
+            remember_unresolvable_actor(actor_address)
+            return None
 
         if community_only and not isinstance(actor_model, Community):
             return None
@@ -1,3 +1,5 @@
+from random import randint
+
 import werkzeug.exceptions
 from flask import request, current_app, abort, jsonify, json, g, url_for, redirect, make_response, flash
 from flask_babel import _
@@ -20,17 +22,18 @@ from app.activitypub.util import users_total, active_half_year, active_month, lo
     log_incoming_ap, find_community, site_ban_remove_data, community_ban_remove_data, verify_object_from_source, \
     post_replies_for_ap, is_vote, find_instance_id, resolve_remote_post_from_search, proactively_delete_content, \
     process_quote_boost, object_has_missing_fields
-from app.community.routes import show_community
 from app.community.util import send_to_remote_instance, send_to_remote_instance_fast
 from app.constants import *
-from app.feed.routes import show_feed
 from app.models import User, Community, CommunityJoinRequest, CommunityMember, CommunityBan, ActivityPubLog, Post, \
     PostReply, Instance, AllowedInstances, BannedInstances, utcnow, Site, Notification, \
     ChatMessage, Conversation, UserFollower, UserBlock, Poll, PollChoice, Feed, FeedItem, FeedMember, FeedJoinRequest, \
-    IpBan, ActivityBatch, InstanceBan
-from app.post.routes import continue_discussion, show_post
+    IpBan, InstanceBan
+from app.shared.activity_batch import queue_batched_activity
+from app.shared.activity_dedupe import is_duplicate, release_activity, remember_activity
+from app.remote_fetch import fetch_refused, reset_fetch_refused
 from app.shared.tasks import task_selector
-from app.user.routes import show_profile
+from app.task_lanes import federation_shed_level, should_shed, admit_activity, intake_domain, intake_done, \
+    intake_weight, SHED_NONE, SHED_PAUSED
 from app.utils import gibberish, get_setting, community_membership, ap_datetime, ip_address, can_downvote, \
     can_upvote, can_create_post, awaken_dormant_instance, shorten_string, can_create_post_reply, sha256_digest, \
     community_moderators, html_to_text, add_to_modlog, instance_banned, get_redis_connection, \
@@ -436,6 +439,7 @@ def user_profile(actor):
                              f'<https://{current_app.config["SERVER_NAME"]}/u/{actor}>; rel="alternate"; type="text/html"')
             return resp
         else:
+            from app.user.routes import show_profile
             return show_profile(user)
     else:
         abort(404)
@@ -549,6 +553,7 @@ def community_profile(actor):
                              f'<https://{current_app.config["SERVER_NAME"]}/c/{actor}>; rel="alternate"; type="text/html"')
             return resp
         else:  # browser request - return html
+            from app.community.routes import show_community
             return show_community(community)
     else:
         if is_activitypub_request():
@@ -586,10 +591,7 @@ def shared_inbox():
         log_incoming_ap('', APLOG_NOTYPE, APLOG_FAILURE, None, 'Empty JSON body ' + str(request.user_agent))
         return "", 400
 
-    pause_federation = redis_client.get('pause_federation')
-    if pause_federation == '1': # temporary pause as this instance is overloaded
-        return '', 429
-    elif pause_federation == '666':
+    if redis_client.get('pause_federation') == '666':
         return '', 410 # this instance has been permanently closed down, everyone should stop sending to it.
 
     g.site = Site.query.get(1)  # g.site is not initialized by @app.before_request when request.path == '/inbox'
@@ -600,6 +602,16 @@ def shared_inbox():
         log_incoming_ap('', APLOG_NOTYPE, APLOG_FAILURE, saved_json, 'Missing minimum expected fields in JSON')
         return '', 200
 
+    # When the inbound lane is backed up, drop votes on old content and then, if it gets worse, all votes. Instances
+    # sending more than their share are asked to retry later, further down. See app/task_lanes.py
+    shed_level = federation_shed_level()
+    if shed_level != SHED_NONE:
+        if should_shed(request_json, shed_level):
+            log_incoming_ap(request_json['id'], APLOG_LIKE, APLOG_IGNORED, saved_json, 'Vote dropped to reduce load')
+            return '', 200
+        if shed_level == SHED_PAUSED:
+            return '', 429, {'Retry-After': '300'}
+
     id = request_json['id']
     if request_json['type'] == 'Announce' and isinstance(request_json['object'], dict):
         object = request_json['object']
@@ -620,10 +632,9 @@ def shared_inbox():
         id = object['id']
 
 
-    if redis_client.exists(id):  # Something is sending same activity multiple times
+    if is_duplicate(id):  # Something is sending same activity multiple times
         log_incoming_ap(id, APLOG_DUPLICATE, APLOG_IGNORED, saved_json, 'Already aware of this activity')
         return '', 200
-    redis_client.set(id, 1, ex=90)  # Save the activity ID into redis, to avoid duplicate activities
 
     # Ignore unutilised PeerTube activity
     if isinstance(request_json['actor'], str) and request_json['actor'].endswith('accounts/peertube'):
@@ -644,6 +655,10 @@ def shared_inbox():
 
     if not actor:
         actor_name = request_json['actor']
+        if fetch_refused():     # their server is busy, ask for the activity again later
+            release_activity(id)
+            log_incoming_ap(id, APLOG_NOTYPE, APLOG_IGNORED, saved_json, f'Server of {actor_name} is busy, asked to retry')
+            return '', 429, {'Retry-After': str(randint(30, 120))}
         log_incoming_ap(id, APLOG_NOTYPE, APLOG_FAILURE, saved_json, f'Actor could not be found 1 - : {actor_name}, actor object: {actor}')
         return '', 200
 
@@ -677,7 +692,9 @@ def shared_inbox():
             log_incoming_ap(id, APLOG_NOTYPE, APLOG_FAILURE, saved_json, 'Could not verify HTTP signature: ' + str(e))
             return '', 400
 
+    weight = 1.0
     if actor.instance_id:
+        weight = intake_weight(actor.instance)
         actor.instance.last_seen = utcnow()
         actor.instance.dormant = False
         actor.instance.gone_forever = False
@@ -688,16 +705,26 @@ def shared_inbox():
     # When a user is deleted, the only way to be fairly sure they get deleted everywhere is to tell the whole fediverse.
     # Earlier check means this is only for users that already exist, processing it here means that http signature will have been verified
     if account_deletion == True:
+        remember_activity(id)
         if current_app.debug:
             process_delete_request(request_json, store_ap_json)
         else:
             process_delete_request.delay(request_json, store_ap_json)
         return ''
 
+    domain = intake_domain(request_json) if actor.instance_id else None
+    if domain:
+        retry_after = admit_activity(domain, weight, shed_level)
+        if retry_after:
+            release_activity(id)     # so that the retry isn't ignored as a duplicate
+            log_incoming_ap(id, APLOG_NOTYPE, APLOG_IGNORED, saved_json, f'{domain} is sending more than its share')
+            return '', 429, {'Retry-After': str(retry_after)}
+
+    remember_activity(id)
     if current_app.debug:
-        process_inbox_request(request_json, store_ap_json)
+        process_inbox_request(request_json, store_ap_json, domain)
     else:
-        process_inbox_request.delay(request_json, store_ap_json)
+        process_inbox_request.delay(request_json, store_ap_json, domain)
 
     return ''
 
@@ -717,7 +744,9 @@ def community_inbox(actor):
     return shared_inbox()
 
 
-def replay_inbox_request(request_json):
+def replay_inbox_request(request_json, force=False):
+    """Process a logged activity again. Unless forced, not if it was accepted recently - replaying it would apply it
+    twice."""
     if not 'id' in request_json or not 'type' in request_json or not 'actor' in request_json or not 'object' in request_json:
         log_incoming_ap('', APLOG_NOTYPE, APLOG_FAILURE, request_json, 'REPLAY: Missing minimum expected fields in JSON')
         return
@@ -737,6 +766,12 @@ def replay_inbox_request(request_json):
             log_incoming_ap(id, APLOG_DUPLICATE, APLOG_IGNORED, request_json, 'REPLAY: Activity about local content which is already present')
             return
 
+        id = object['id']
+
+    if is_duplicate(id) and not force:
+        log_incoming_ap(id, APLOG_DUPLICATE, APLOG_IGNORED, request_json, 'REPLAY: Already aware of this activity')
+        return
+
     # Ignore unutilised PeerTube activity
     if 'actor' in request_json and isinstance(request_json['actor'], str) and request_json['actor'].endswith('accounts/peertube'):
         log_incoming_ap(id, APLOG_PT_VIEW, APLOG_IGNORED, request_json, 'REPLAY: PeerTube View or CacheFile activity')
@@ -764,6 +799,8 @@ def replay_inbox_request(request_json):
         log_incoming_ap(id, APLOG_NOTYPE, APLOG_FAILURE, request_json, 'REPLAY: ActivityPub activity from a local actor')
         return
 
+    remember_activity(id)
+
     # When a user is deleted, the only way to be fairly sure they get deleted everywhere is to tell the whole fediverse.
     if account_deletion == True:
         process_delete_request(request_json, True)
@@ -774,9 +811,25 @@ def replay_inbox_request(request_json):
     return
 
 
+INBOX_RETRIES = 3   # times an activity is tried again when a server it needed something from was busy
+
+
+def retry_inbox_request(request_json, store_ap_json, attempt) -> bool:
+    """Try the activity again a little later if a remote fetch it needed was refused because the server was busy.
+    Returns whether it will be."""
+    if current_app.debug or attempt >= INBOX_RETRIES or not fetch_refused():
+        return False
+    process_inbox_request.apply_async(args=(request_json, store_ap_json), kwargs={'attempt': attempt + 1},
+                                      countdown=randint(30, 60) * (attempt + 1))
+    return True
+
+
 @celery.task
-def process_inbox_request(request_json, store_ap_json):
+def process_inbox_request(request_json, store_ap_json, sender_domain=None, attempt=0):
     with current_app.app_context():
+        if sender_domain:   # counted as waiting in the inbound lane by shared_inbox()
+            intake_done(sender_domain)
+        reset_fetch_refused()
         session = get_task_session()
         try:
             # patch_db_session makes all db.session.whatever() use the session created with get_task_session, to guarantee proper connection clean-up at the end of the task.
@@ -822,6 +875,9 @@ def process_inbox_request(request_json, store_ap_json):
                         else:
                             log_incoming_ap(id, APLOG_NOTYPE, APLOG_FAILURE, saved_json, 'Unexpected activity from Group')
                             return
+                    elif actor is None and retry_inbox_request(request_json, store_ap_json, attempt):
+                        log_incoming_ap(id, APLOG_NOTYPE, APLOG_IGNORED, saved_json, 'Server of actor is busy, trying again later')
+                        return
                     else:
                         log_incoming_ap(id, APLOG_NOTYPE, APLOG_FAILURE, saved_json, 'Actor was not a user or a community')
                         return
@@ -835,6 +891,8 @@ def process_inbox_request(request_json, store_ap_json):
                         post = resolve_remote_post(request_json['object'], community, id, store_ap_json)
                         if post:
                             log_incoming_ap(id, APLOG_ANNOUNCE, APLOG_SUCCESS, request_json)
+                        elif retry_inbox_request(request_json, store_ap_json, attempt):
+                            log_incoming_ap(id, APLOG_ANNOUNCE, APLOG_IGNORED, saved_json, 'Server of post is busy, trying again later')
                         else:
                             log_incoming_ap(id, APLOG_ANNOUNCE, APLOG_FAILURE, request_json, 'Could not resolve post')
                         return
@@ -857,6 +915,9 @@ def process_inbox_request(request_json, store_ap_json):
                             if user.banned:
                                 log_incoming_ap(id, APLOG_ANNOUNCE, APLOG_FAILURE, saved_json, f'{user.ap_id} is banned')
                                 return
+                        elif user is None and retry_inbox_request(request_json, store_ap_json, attempt):
+                            log_incoming_ap(id, APLOG_ANNOUNCE, APLOG_IGNORED, saved_json, 'Server of Announce object actor is busy, trying again later')
+                            return
                         else:
                             log_incoming_ap(id, APLOG_ANNOUNCE, APLOG_FAILURE, saved_json, 'Blocked or unfound user for Announce object actor ' + str(request_json['object']['actor']))
                             return
@@ -1837,24 +1898,18 @@ def announce_activity_to_followers(community: Community, creator: User, activity
         if instance and instance.online() and instance.inbox and not instance_banned(instance.inbox):
             if creator.instance_id != instance.id:  # don't send it to the instance that hosts the creator as presumably they already have the content
                 if can_batch and instance.software == 'piefed':
-                    db.session.add(ActivityBatch(instance_id=instance.id, community_id=community.id,
-                                                 payload=activity))
-                    db.session.commit()
+                    queue_batched_activity(db.session, instance.id, community.id, activity)
                 else:
-                    if current_app.config['NOTIF_SERVER'] and is_vote(announce_activity):   # Votes make up a very high percentage of activities, so it is more efficient to send them via piefed_notifs. However piefed_notifs does not retry failed sends. For votes this is acceptable.
-                        send_async.append(HttpSignature.signed_request(instance.inbox, announce_activity,
-                                                                       community.private_key,
-                                                                       community.ap_profile_id + '#main-key',
-                                                                       send_via_async=True))
+                    if current_app.config['NOTIF_SERVER']:   # Sending via piefed_notifs is much more efficient than a celery task per instance
+                        send_async.append(instance.inbox)
                     else:
                         send_to_remote_instance_fast(instance.inbox, community.private_key, community.ap_profile_id, announce_activity)
 
     if len(send_async):
-        from app import redis_client
-        # send announce_activity via redis pub/sub to piefed_notifs service
-        redis_client.publish("http_posts:activity", json.dumps({'urls': [url[0] for url in send_async],
-                                                                'headers': [url[1] for url in send_async],
-                                                                'data': send_async[0][2].decode('utf-8')}))
+        from app.shared.delivery import send_async as send_via_notifs_server
+        # votes make up a very high percentage of activities and are not worth retrying if they fail
+        send_via_notifs_server(send_async, announce_activity, community.private_key,
+                               community.ap_profile_id + '#main-key', retry=not is_vote(announce_activity))
 
 
 @bp.route('/c/<actor>/outbox', methods=['GET'])
@@ -2005,6 +2060,7 @@ def comment_ap(comment_id):
                          f'<https://{current_app.config["SERVER_NAME"]}/comment/{reply.id}>; rel="alternate"; type="text/html"')
         return resp
     else:
+        from app.post.routes import continue_discussion
         return continue_discussion(reply.post.id, comment_id)
 
 
@@ -2040,6 +2096,7 @@ def post_ap(post_id):
             return redirect(post.ap_id, code=301)
     else:
         block_honey_pot()
+        from app.post.routes import show_post
         return show_post(post_id,
                          low_bandwidth=request.cookies.get('low_bandwidth', '0') == '1',
                          sort=request.args.get('sort', 'hot' if current_user.is_anonymous else current_user.default_comment_sort or 'hot'),
@@ -2538,6 +2595,7 @@ def feed_profile(actor, feed_owner=None):
                              f'<https://{current_app.config["SERVER_NAME"]}/f/{actor}>; rel="alternate"; type="text/html"')
             return resp
         else:  # browser request - return html
+            from app.feed.routes import show_feed
             return show_feed(feed)
     else:
         abort(404)
@@ -32,7 +32,9 @@ from __future__ import annotations
 import base64
 import hashlib
 import json
+import threading
 import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from email.utils import formatdate
 from typing import Literal, TypedDict, cast
@@ -51,7 +53,7 @@ from sqlalchemy import text
 
 from app import db, celery, httpx_client
 from app.constants import DATETIME_MS_FORMAT
-from app.models import utcnow, ActivityPubLog, Community, Instance, CommunityMember, User, SendQueue
+from app.models import utcnow, ActivityPubLog, Community, Instance, CommunityMember, User, SendQueue, Feed
 from app.utils import get_task_session
 
 
@@ -160,8 +162,10 @@ def post_request(uri: str, body: dict | None, private_key: str, key_id: str,
                     # Calculate retry delay with exponential backoff. 1 min, 2 mins, 4 mins, 8 mins, up to 4h
                     backoff = 60 * (2 ** retries)
                     backoff = min(backoff, 15360)
+                    # keys of local actors can be looked up again when it's time to retry, avoid storing them
+                    stored_key = None if local_actor_private_key(key_id, session) == private_key else private_key
                     session.add(SendQueue(destination=uri, destination_domain=furl(uri).host, actor=key_id,
-                                             private_key=private_key, payload=json.dumps(body), retries=retries,
+                                             private_key=stored_key, payload=json.dumps(body), retries=retries,
                                              retry_reason=log.exception_message,
                                              send_after=datetime.utcnow() + timedelta(seconds=backoff)))
                     session.commit()
@@ -174,6 +178,21 @@ def post_request(uri: str, body: dict | None, private_key: str, key_id: str,
         session.close()
 
 
+def local_actor_private_key(key_id: str, session) -> str | None:
+    """The private key of the local community, user, feed or instance actor that key_id belongs to"""
+    actor_url = key_id.split('#')[0].lower()
+    if not actor_url.startswith(current_app.config['SERVER_URL'].lower() + '/'):
+        return None
+    if actor_url == current_app.config['SERVER_URL'].lower() + '/actor':
+        return session.execute(text('SELECT private_key FROM "site" WHERE id = 1')).scalar()
+    for model in (Community, User, Feed):
+        private_key = session.query(model.private_key).filter(model.ap_profile_id == actor_url,
+                                                              model.ap_id == None).scalar()
+        if private_key:
+            return private_key
+    return None
+
+
 def signed_get_request(uri: str, private_key: str, key_id: str, content_type: str = "application/activity+json",
                        method: Literal["get", "post"] = "get", timeout: int = 10, ):
     result = HttpSignature.signed_request(uri, None, private_key, key_id, content_type, method, timeout)
@@ -233,68 +252,78 @@ def signature_part(signature, key):
     return ''
 
 
+class KeyCache:
+    """
+    A thread-safe LRU of deserialized RSA keys. Keyed by a hash of the PEM so the large strings are not kept twice.
+    """
+
+    def __init__(self, loader, max_size: int = 1000):
+        self.loader = loader
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, pem: str):
+        key_hash = hashlib.sha256(pem.encode()).digest()
+        with self._lock:
+            if key_hash in self._keys:
+                self._keys.move_to_end(key_hash)
+                return self._keys[key_hash]
+        key = self.loader(pem)      # slow (~1ms for a private key) so do it outside the lock
+        with self._lock:
+            self._keys[key_hash] = key
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        return key
+
+    def __len__(self):
+        return len(self._keys)
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
 class HttpSignature:
     """
     Allows for calculation and verification of HTTP signatures
     """
 
-    # Class-level cache for deserialized private keys
-    _private_key_cache = {}  # key: hash of private_key, value: RSAPrivateKey instance
-    _public_key_cache = {}  # key: hash of public_key, value: RSAPublicKey instance
-    _cache_max_size = 1000  # Limit to prevent unbounded growth
+    # Deserialized keys, kept for the life of the process (see warm_key_cache)
+    _private_key_cache = KeyCache(lambda pem: cast(rsa.RSAPrivateKey,
+                                                   serialization.load_pem_private_key(pem.encode("ascii"),
+                                                                                      password=None)))
+    _public_key_cache = KeyCache(lambda pem: cast(rsa.RSAPublicKey,
+                                                  serialization.load_pem_public_key(pem.encode("ascii"))))
 
     @classmethod
     def _get_private_key_instance(cls, private_key: str) -> rsa.RSAPrivateKey:
-        """
-        Get a deserialized private key instance from cache, or load and cache it.
-        Uses SHA-256 hash of the private key as the cache key to avoid storing large strings.
-        """
-        # Use hash of private key as cache key (shorter than full PEM string)
-        key_hash = hashlib.sha256(private_key.encode()).hexdigest()
-
-        if key_hash not in cls._private_key_cache:
-            # Simple size limit: clear oldest half when full
-            if len(cls._private_key_cache) >= cls._cache_max_size:
-                # Remove first half
-                keys_to_remove = list(cls._private_key_cache.keys())[:cls._cache_max_size // 2]
-                for k in keys_to_remove:
-                    del cls._private_key_cache[k]
-
-            # Deserialize and cache
-            cls._private_key_cache[key_hash] = cast(
-                rsa.RSAPrivateKey,
-                serialization.load_pem_private_key(
-                    private_key.encode("ascii"),
-                    password=None,
-                ),
-            )
-
-        return cls._private_key_cache[key_hash]
+        return cls._private_key_cache.get(private_key)
 
     @classmethod
     def _get_public_key_instance(cls, public_key: str) -> rsa.RSAPublicKey:
+        return cls._public_key_cache.get(public_key)
+
+    @classmethod
+    def warm_key_cache(cls, session, limit: int = 500):
         """
-        Get a deserialized public key instance from cache, or load and cache it.
-        Uses SHA-256 hash of the public key as the cache key to avoid storing large strings.
+        Load the private keys most likely to be needed soon - those of local communities with remote followers and
+        of recently active local users - so the first deliveries after a worker starts don't each pay for a
+        PEM parse.
         """
-        # Use hash of public key as cache key (shorter than full PEM string)
-        key_hash = hashlib.sha256(public_key.encode()).hexdigest()
-
-        if key_hash not in cls._public_key_cache:
-            # Simple size limit: clear oldest half when full
-            if len(cls._public_key_cache) >= cls._cache_max_size:
-                # Remove first half
-                keys_to_remove = list(cls._public_key_cache.keys())[:cls._cache_max_size // 2]
-                for k in keys_to_remove:
-                    del cls._public_key_cache[k]
-
-            # Deserialize and cache
-            cls._public_key_cache[key_hash] = cast(
-                rsa.RSAPublicKey,
-                serialization.load_pem_public_key(public_key.encode("ascii")),
-            )
-
-        return cls._public_key_cache[key_hash]
+        pems = session.execute(text("""SELECT private_key FROM "community"
+                                       WHERE ap_id is null AND private_key is not null AND banned is false
+                                       ORDER BY total_subscriptions_count DESC LIMIT :limit"""),
+                               {'limit': limit // 2}).scalars().all()
+        pems += session.execute(text("""SELECT private_key FROM "user"
+                                        WHERE ap_id is null AND private_key is not null AND deleted is false
+                                        ORDER BY last_seen DESC LIMIT :limit"""),
+                                {'limit': limit // 2}).scalars().all()
+        for pem in pems:
+            try:
+                cls._private_key_cache.get(pem)
+            except ValueError:  # malformed key
+                pass
 
     @classmethod
     def calculate_digest(cls, data, algorithm="sha-256") -> str:
@@ -418,50 +447,25 @@ class HttpSignature:
         return True
 
     @classmethod
-    def signed_request(
-            cls,
-            uri: str,
-            body: dict | None,
-            private_key: str,
-            key_id: str,
-            content_type: str = "application/activity+json",
-            method: Literal["get", "post"] = "post",
-            timeout: int = 5,
-            send_via_async=False
-    ):
+    def _sign(cls, uri: str, method: str, date_string: str, base_headers: dict, private_key_instance,
+              key_id: str) -> dict:
         """
-        Performs a request to the given path, with a document, signed
-        as an identity.
+        Headers for one request. base_headers holds everything that doesn't depend on the destination (digest,
+        content type, etc) so it can be shared between many destinations.
         """
         if "://" not in uri:
             raise ValueError("URI does not contain a scheme")
-        # Create the core header field set
         uri_parts = urlparse(uri)
-        date_string = http_date()
         headers = {
             "(request-target)": f"{method} {uri_parts.path}",
             "Host": uri_parts.hostname,
             "Date": date_string,
+            **base_headers,
         }
-        # If we have a body, add a digest and content type
-        if body is not None:
-            if '@context' not in body:  # add a default json-ld context if necessary
-                body['@context'] = default_context()
-            body_bytes = json.dumps(body).encode("utf8")
-            headers["Digest"] = cls.calculate_digest(body_bytes)
-            headers["Content-Type"] = content_type
-        else:
-            body_bytes = b""
-        # GET requests get implicit accept headers added
-        if method == "get":
-            headers["Accept"] = "application/ld+json"
-        # Sign the headers
         signed_string = "\n".join(
             f"{name.lower()}: {value}" for name, value in headers.items()
         )
 
-        private_key_instance = cls._get_private_key_instance(private_key)
-
         # RSA signature generation
         signature = private_key_instance.sign(
             signed_string.encode("ascii"),
@@ -481,6 +485,66 @@ class HttpSignature:
 
         # Send the request with all those headers except the pseudo one
         del headers["(request-target)"]
+        return headers
+
+    @classmethod
+    def _body_headers(cls, body: dict | None, content_type: str, method: str) -> tuple[bytes, dict]:
+        base_headers = {}
+        # If we have a body, add a digest and content type
+        if body is not None:
+            if '@context' not in body:  # add a default json-ld context if necessary
+                body['@context'] = default_context()
+            body_bytes = json.dumps(body).encode("utf8")
+            base_headers["Digest"] = cls.calculate_digest(body_bytes)
+            base_headers["Content-Type"] = content_type
+        else:
+            body_bytes = b""
+        # GET requests get implicit accept headers added
+        if method == "get":
+            base_headers["Accept"] = "application/ld+json"
+        return body_bytes, base_headers
+
+    @classmethod
+    def signed_requests(
+            cls,
+            uris: list[str],
+            body: dict,
+            private_key: str,
+            key_id: str,
+            content_type: str = "application/activity+json",
+    ) -> list[tuple[str, dict, bytes]]:
+        """
+        Sign the same POST to many inboxes. The body is serialized, hashed and the key loaded just once; only the
+        signature itself is done per inbox. Returns (uri, headers, body_bytes) for each uri, like
+        signed_request(send_via_async=True) does.
+        """
+        body_bytes, base_headers = cls._body_headers(body, content_type, "post")
+        private_key_instance = cls._get_private_key_instance(private_key)
+        date_string = http_date()
+        return [(uri, cls._sign(uri, "post", date_string, base_headers, private_key_instance, key_id), body_bytes)
+                for uri in uris]
+
+    @classmethod
+    def signed_request(
+            cls,
+            uri: str,
+            body: dict | None,
+            private_key: str,
+            key_id: str,
+            content_type: str = "application/activity+json",
+            method: Literal["get", "post"] = "post",
+            timeout: int = 5,
+            send_via_async=False
+    ):
+        """
+        Performs a request to the given path, with a document, signed
+        as an identity.
+        """
+        if "://" not in uri:
+            raise ValueError("URI does not contain a scheme")
+        body_bytes, base_headers = cls._body_headers(body, content_type, method)
+        headers = cls._sign(uri, method, http_date(), base_headers, cls._get_private_key_instance(private_key), key_id)
+
         if send_via_async:  # 'async' sending involves passing the data through to the piefed_notifs service. See announce_activity_to_followers().
             return uri, headers, body_bytes
         else:
@@ -572,13 +636,7 @@ class LDSignature:
         # Get the normalised hash of each document
         final_hash = cls.normalized_hash(options) + cls.normalized_hash(document)
         # Create the signature
-        private_key_instance: rsa.RSAPrivateKey = cast(
-            rsa.RSAPrivateKey,
-            serialization.load_pem_private_key(
-                private_key.encode("ascii"),
-                password=None,
-            ),
-        )
+        private_key_instance = HttpSignature._get_private_key_instance(private_key)
         signature = base64.b64encode(
             private_key_instance.sign(
                 final_hash,
@@ -639,6 +697,8 @@ def default_context():
 
 
 def fix_local_community_membership(uri: str, private_key: str, session):
+    from app.shared import api_context
+
     community = session.query(Community).filter_by(private_key=private_key).first()
     parsed_url = urlparse(uri)
     instance_domain = parsed_url.netloc
@@ -652,3 +712,4 @@ def fix_local_community_membership(uri: str, private_key: str, session):
             session.execute(
                 text('DELETE FROM "community_member" WHERE user_id = :user_id AND community_id = :community_id'),
                 {'user_id': f.user_id, 'community_id': community.id})
+            api_context.changed(session, f.user_id)
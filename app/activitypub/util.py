@@ -3,6 +3,7 @@ from __future__ import annotations
 import os
 import sys
 import time
+from collections import Counter
 from datetime import datetime, timezone, timedelta
 from io import BytesIO
 from json import JSONDecodeError
@@ -63,6 +64,7 @@ from app.models import (
     Event,
     InstanceBan,
     Emoji,
+    CrossPostGroup,
 )
 from app.utils import (
     get_request,
@@ -412,9 +414,11 @@ def find_actor_or_create(
         schedule_actor_refresh(actor_obj)
         return actor_obj
     elif create_if_not_found:
-        # Create the actor from remote data
-        from app.activitypub.actor import create_actor_from_remote
+        # Create the actor from remote data, unless that was tried and failed recently
+        from app.activitypub.actor import create_actor_from_remote, actor_recently_unresolvable
 
+        if actor_recently_unresolvable(actor_url):
+            return None
         return create_actor_from_remote(actor_url, community_only, feed_only)
     else:
         return None
@@ -548,7 +552,7 @@ def find_hashtag_or_create(hashtag: str) -> Tag:
     if existing_tag:
         return existing_tag
     else:
-        new_tag = Tag(name=hashtag.lower(), display_as=hashtag, post_count=1)
+        new_tag = Tag(name=hashtag.lower(), display_as=hashtag, post_count=0)    # counted when added to a post
         db.session.add(new_tag)
         return new_tag
 
@@ -783,7 +787,6 @@ def refresh_user_profile_task(user_id):
                         headers={"Accept": "application/activity+json"},
                     )
                 except httpx.HTTPError:
-                    time.sleep(randint(3, 10))
                     try:
                         actor_data = get_request(
                             user.ap_public_url,
@@ -989,7 +992,6 @@ def refresh_community_profile_task(community_id, activity_json):
                             headers={"Accept": "application/activity+json"},
                         )
                     except httpx.HTTPError:
-                        time.sleep(randint(3, 10))
                         try:
                             actor_data = get_request(
                                 community.ap_public_url,
@@ -1212,7 +1214,6 @@ def refresh_community_profile_task(community_id, activity_json):
                                 and "orderedItems" in mods_data
                             ):
                                 for actor in mods_data["orderedItems"]:
-                                    time.sleep(0.5)
                                     user = find_actor_or_create(actor)
                                     if user:
                                         existing_membership = (
@@ -1334,7 +1335,6 @@ def refresh_feed_profile_task(feed_id):
                         headers={"Accept": "application/activity+json"},
                     )
                 except httpx.HTTPError:
-                    time.sleep(randint(3, 10))
                     try:
                         actor_data = get_request(
                             feed.ap_public_url,
@@ -1459,7 +1459,6 @@ def refresh_feed_profile_task(feed_id):
                                 and "orderedItems" in owners_data
                             ):
                                 for actor in owners_data["orderedItems"]:
-                                    time.sleep(0.5)
                                     user = find_actor_or_create(actor)
                                     if user:
                                         existing_membership = (
@@ -2780,7 +2779,6 @@ def new_instance_profile_task(instance_id: int):
                             )
                         ):  # Lemmy v0.19.4+ (no 2.0 back-compat provided here)
                             try:
-                                time.sleep(0.1)
                                 node = get_request(links["href"], headers=headers)
                                 if node.status_code == 200:
                                     node_json = node.json()
@@ -2812,6 +2810,7 @@ def is_activitypub_request():
 
 
 def delete_post_or_comment(deletor, to_delete, store_ap_json, request_json, reason):
+    from app.shared import counters
     from app import redis_client
 
     saved_json = request_json if store_ap_json else None
@@ -2833,17 +2832,10 @@ def delete_post_or_comment(deletor, to_delete, store_ap_json, request_json, reas
                 to_delete.deleted = True
                 to_delete.deleted_by = deletor.id
                 db.session.commit()
-                if to_delete.url and to_delete.cross_posts is not None:
+                if to_delete.cross_post_group_id is not None:
                     to_delete.calculate_cross_posts(delete_only=True)
-            with redis_client.lock(
-                f"lock:community:{community.id}", timeout=10, blocking_timeout=6
-            ):
-                community.post_count -= 1
-            with redis_client.lock(
-                f"lock:user:{to_delete.user_id}", timeout=10, blocking_timeout=6
-            ):
-                to_delete.author.post_count -= 1
-                db.session.commit()
+            counters.increment(Community, community.id, post_count=-1)
+            counters.increment(User, to_delete.user_id, post_count=-1)
             if to_delete.author.id != deletor.id:
                 add_to_modlog(
                     "delete_post",
@@ -2882,22 +2874,10 @@ def delete_post_or_comment(deletor, to_delete, store_ap_json, request_json, reas
                         {"parents": tuple(to_delete.path[:-1])},
                     )
                 db.session.commit()
-            with redis_client.lock(
-                f"lock:user:{to_delete.user_id}", timeout=10, blocking_timeout=6
-            ):
-                to_delete.author.post_reply_count -= 1
-                db.session.commit()
-                if not to_delete.author.bot:
-                    with redis_client.lock(
-                        f"lock:post:{to_delete.id}", timeout=10, blocking_timeout=6
-                    ):
-                        to_delete.post.reply_count -= 1
-                        db.session.commit()
-            with redis_client.lock(
-                f"lock:community:{community.id}", timeout=10, blocking_timeout=6
-            ):
-                community.post_reply_count -= 1
-                db.session.commit()
+            counters.increment(User, to_delete.user_id, post_reply_count=-1)
+            if not to_delete.author.bot:
+                to_delete.post.count_replies(-1)
+            counters.increment(Community, community.id, post_reply_count=-1)
 
             if to_delete.author.id != deletor.id:
                 add_to_modlog(
@@ -2923,6 +2903,7 @@ def delete_post_or_comment(deletor, to_delete, store_ap_json, request_json, reas
 
 
 def restore_post_or_comment(restorer, to_restore, store_ap_json, request_json, reason):
+    from app.shared import counters
     saved_json = request_json if store_ap_json else None
     id = request_json["id"]
     community = to_restore.community
@@ -2938,11 +2919,11 @@ def restore_post_or_comment(restorer, to_restore, store_ap_json, request_json, r
         if isinstance(to_restore, Post):
             to_restore.deleted = False
             to_restore.deleted_by = None
-            community.post_count += 1
-            to_restore.author.post_count += 1
             if to_restore.url:
                 to_restore.calculate_cross_posts()
             db.session.commit()
+            counters.increment(Community, community.id, post_count=1)
+            counters.increment(User, to_restore.user_id, post_count=1)
             if to_restore.author.id != restorer.id:
                 add_to_modlog(
                     "restore_post",
@@ -2958,9 +2939,6 @@ def restore_post_or_comment(restorer, to_restore, store_ap_json, request_json, r
         elif isinstance(to_restore, PostReply):
             to_restore.deleted = False
             to_restore.deleted_by = None
-            if not to_restore.author.bot:
-                to_restore.post.reply_count += 1
-            to_restore.author.post_reply_count += 1
             if to_restore.path:
                 db.session.execute(
                     text(
@@ -2969,6 +2947,9 @@ def restore_post_or_comment(restorer, to_restore, store_ap_json, request_json, r
                     {"parents": tuple(to_restore.path[:-1])},
                 )
             db.session.commit()
+            if not to_restore.author.bot:
+                to_restore.post.count_replies(1)
+            counters.increment(User, to_restore.user_id, post_reply_count=1)
             if to_restore.author.id != restorer.id:
                 add_to_modlog(
                     "restore_post_reply",
@@ -2993,13 +2974,18 @@ def restore_post_or_comment(restorer, to_restore, store_ap_json, request_json, r
 
 
 def site_ban_remove_data(blocker_id, blocked):
+    from app.shared import counters
+
     replies = db.session.query(PostReply).filter_by(user_id=blocked.id, deleted=False)
+    post_replies, group_replies, community_replies = Counter(), Counter(), Counter()
     for reply in replies:
         reply.deleted = True
         reply.deleted_by = blocker_id
         if not blocked.bot:
-            reply.post.reply_count -= 1
-        reply.community.post_reply_count -= 1
+            post_replies[reply.post_id] -= 1
+            if reply.post.cross_post_group_id is not None:
+                group_replies[reply.post.cross_post_group_id] -= 1
+        community_replies[reply.community_id] -= 1
         if reply.path:
             db.session.execute(
                 text(
@@ -3007,18 +2993,23 @@ def site_ban_remove_data(blocker_id, blocked):
                 ),
                 {"parents": tuple(reply.path[:-1])},
             )
-    blocked.reply_count = 0
     db.session.commit()
+    counters.increment_each(Post, "reply_count", post_replies)
+    counters.increment_each(CrossPostGroup, "reply_count", group_replies)
+    counters.increment_each(Community, "post_reply_count", community_replies)
+    counters.increment(User, blocked.id, post_reply_count=sum(community_replies.values()))
 
     posts = db.session.query(Post).filter_by(user_id=blocked.id, deleted=False)
+    community_posts = Counter()
     for post in posts:
         post.deleted = True
         post.deleted_by = blocker_id
-        post.community.post_count -= 1
-        if post.url and post.cross_posts is not None:
+        community_posts[post.community_id] -= 1
+        if post.cross_post_group_id is not None:
             post.calculate_cross_posts(delete_only=True)
-    blocked.post_count = 0
     db.session.commit()
+    counters.increment_each(Community, "post_count", community_posts)
+    counters.increment(User, blocked.id, post_count=sum(community_posts.values()))
 
     # Delete all their images to save moderators from having to see disgusting stuff.
     # Images attached to posts can't be restored, but site ban reversals don't have a 'removeData' field anyway.
@@ -3037,16 +3028,21 @@ def site_ban_remove_data(blocker_id, blocked):
 
 
 def community_ban_remove_data(blocker_id, community_id, blocked):
+    from app.shared import counters
+
     replies = PostReply.query.filter_by(
         user_id=blocked.id, deleted=False, community_id=community_id
     )
+    post_replies, group_replies = Counter(), Counter()
+    removed_replies = 0
     for reply in replies:
         reply.deleted = True
         reply.deleted_by = blocker_id
         if not blocked.bot:
-            reply.post.reply_count -= 1
-        reply.community.post_reply_count -= 1
-        blocked.post_reply_count -= 1
+            post_replies[reply.post_id] -= 1
+            if reply.post.cross_post_group_id is not None:
+                group_replies[reply.post.cross_post_group_id] -= 1
+        removed_replies += 1
         if reply.path:
             db.session.execute(
                 text(
@@ -3055,18 +3051,24 @@ def community_ban_remove_data(blocker_id, community_id, blocked):
                 {"parents": tuple(reply.path[:-1])},
             )
     db.session.commit()
+    counters.increment_each(Post, "reply_count", post_replies)
+    counters.increment_each(CrossPostGroup, "reply_count", group_replies)
+    counters.increment(Community, community_id, post_reply_count=-removed_replies)
+    counters.increment(User, blocked.id, post_reply_count=-removed_replies)
 
     posts = Post.query.filter_by(
         user_id=blocked.id, deleted=False, community_id=community_id
     )
+    removed_posts = 0
     for post in posts:
         post.deleted = True
         post.deleted_by = blocker_id
-        post.community.post_count -= 1
-        if post.url and post.cross_posts is not None:
+        if post.cross_post_group_id is not None:
             post.calculate_cross_posts(delete_only=True)
-        blocked.post_count -= 1
+        removed_posts += 1
     db.session.commit()
+    counters.increment(Community, community_id, post_count=-removed_posts)
+    counters.increment(User, blocked.id, post_count=-removed_posts)
 
     # Delete attached images to save moderators from having to see disgusting stuff.
     files = (
@@ -4186,6 +4188,7 @@ def update_post_reply_from_activity(reply: PostReply, request_json: dict):
 
 def update_post_from_activity(post: Post, request_json: dict):
     from app import redis_client
+    from app.shared import counters
 
     with redis_client.lock(f"lock:post:{post.id}", timeout=30, blocking_timeout=6):
         # redo body without checking if it's changed
@@ -4377,7 +4380,6 @@ def update_post_from_activity(post: Post, request_json: dict):
                             headers={"Accept": "application/activity+json"},
                         )
                     except httpx.HTTPError:
-                        time.sleep(3)
                         try:
                             object_request = get_request(
                                 request_json["object"][endpoint],
@@ -4398,10 +4400,7 @@ def update_post_from_activity(post: Post, request_json: dict):
                             if endpoint == "dislikes":
                                 downvotes += object["totalItems"]
 
-            multiplier = 1.0
-            post.up_votes = upvotes * multiplier
-            post.down_votes = downvotes
-            post.score = upvotes - downvotes
+            counters.apply_totals(post, up_votes=upvotes, down_votes=downvotes, score=upvotes - downvotes)
             post.ranking = post.post_ranking(
                 post.score + post.reply_count, post.posted_at
             )
@@ -4655,14 +4654,13 @@ def update_post_from_activity(post: Post, request_json: dict):
                     post.domain = new_domain
 
                 # Fix-up cross posts (Posts which link to the same url as other posts)
-                if post.cross_posts is not None:
-                    post.calculate_cross_posts(url_changed=True)
+                post.calculate_cross_posts(url_changed=True)
 
             else:
                 post.type = POST_TYPE_ARTICLE
                 post.url = ""
                 post.image_id = None
-                if post.cross_posts is not None:  # unlikely, but not impossible
+                if post.cross_post_group_id is not None:  # unlikely, but not impossible
                     post.calculate_cross_posts(delete_only=True)
 
         db.session.commit()
@@ -4673,12 +4671,12 @@ def update_post_from_activity(post: Post, request_json: dict):
 
 def undo_vote(comment, post, target_ap_id, user):
     from app import redis_client
-    from app.utils import wilson_confidence_lower_bound
+    from app.shared import counters
 
     voted_on = find_liked_object(target_ap_id)
     if isinstance(voted_on, Post):
         post = voted_on
-        with redis_client.lock(f"lock:post:{post.id}", timeout=30, blocking_timeout=6):
+        with redis_client.lock(f"lock:vote:post:{post.id}:{user.id}", timeout=30, blocking_timeout=6):
             try:
                 db.session.refresh(post)
             except Exception:
@@ -4692,30 +4690,20 @@ def undo_vote(comment, post, target_ap_id, user):
                     db.session.delete(existing_vote)
                     db.session.commit()
                     return post
-                db.session.execute(
-                    text(
-                        'UPDATE "user" SET reputation = reputation - :effect WHERE id = :user_id'
-                    ),
-                    {"effect": prior_effect, "user_id": post.user_id},
-                )
+                db.session.delete(existing_vote)
+                db.session.commit()
+                counters.increment(User, post.user_id, reputation=-prior_effect)
                 if (
                     prior_effect < 0
                 ):  # Lemmy sends 'like' for upvote and 'dislike' for down votes. Cool! When it undoes an upvote it sends an 'Undo Like'. Fine. When it undoes a downvote it sends an 'Undo Like' - not 'Undo Dislike'?!
-                    post.down_votes -= 1
+                    counters.apply(post, down_votes=-1, score=-prior_effect)
                 else:
-                    post.up_votes -= 1
-                post.score -= prior_effect
-                post.ranking = post.post_ranking(
-                    post.score + post.reply_count, post.created_at
-                )
-                post.ranking_scaled = int(post.ranking + post.community.scale_by())
-                db.session.delete(existing_vote)
-                db.session.commit()
+                    counters.apply(post, up_votes=-1, score=-prior_effect)
         return post
     if isinstance(voted_on, PostReply):
         comment = voted_on
         with redis_client.lock(
-            f"lock:post_reply:{comment.id}", timeout=30, blocking_timeout=6
+            f"lock:vote:post_reply:{comment.id}:{user.id}", timeout=30, blocking_timeout=6
         ):
             try:
                 db.session.refresh(comment)
@@ -4730,24 +4718,15 @@ def undo_vote(comment, post, target_ap_id, user):
                     db.session.delete(existing_vote)
                     db.session.commit()
                     return comment
-                db.session.execute(
-                    text(
-                        'UPDATE "user" SET reputation = reputation - :effect WHERE id = :user_id'
-                    ),
-                    {"effect": prior_effect, "user_id": comment.user_id},
-                )
+                db.session.delete(existing_vote)
+                db.session.commit()
+                counters.increment(User, comment.user_id, reputation=-prior_effect)
                 if (
                     prior_effect < 0
                 ):  # Lemmy sends 'like' for upvote and 'dislike' for down votes. Cool! When it undoes an upvote it sends an 'Undo Like'. Fine. When it undoes a downvote it sends an 'Undo Like' - not 'Undo Dislike'?!
-                    comment.down_votes -= 1
+                    counters.apply(comment, down_votes=-1, score=-prior_effect)
                 else:
-                    comment.up_votes -= 1
-                comment.score -= prior_effect
-                comment.ranking = wilson_confidence_lower_bound(
-                    comment.up_votes, comment.down_votes
-                )
-                db.session.delete(existing_vote)
-                db.session.commit()
+                    counters.apply(comment, up_votes=-1, score=-prior_effect)
         return comment
 
     return None
@@ -5130,7 +5109,6 @@ def remote_object_to_json(uri):
             uri, headers={"Accept": "application/activity+json"}
         )
     except httpx.HTTPError:
-        time.sleep(3)
         try:
             object_request = get_request(
                 uri, headers={"Accept": "application/activity+json"}
@@ -5155,7 +5133,6 @@ def remote_object_to_json(uri):
                 f"{current_app.config['SERVER_URL']}/actor#main-key",
             )
         except httpx.HTTPError:
-            time.sleep(3)
             try:
                 object_request = signed_get_request(
                     uri,
@@ -5459,7 +5436,6 @@ def verify_object_from_source(request_json):
             uri, headers={"Accept": "application/activity+json"}
         )
     except httpx.HTTPError:
-        time.sleep(3)
         try:
             object_request = get_request(
                 uri, headers={"Accept": "application/activity+json"}
@@ -5482,7 +5458,6 @@ def verify_object_from_source(request_json):
                 f"{current_app.config['SERVER_URL']}/actor#main-key",
             )
         except httpx.HTTPError:
-            time.sleep(3)
             try:
                 object_request = signed_get_request(
                     uri,
@@ -5643,6 +5618,8 @@ def normalise_actor_string(actor: str) -> Tuple[str, str]:
 
 
 def process_banned_message(banned_json, instance_domain: str, session):
+    from app.shared import api_context
+
     if banned_person := find_actor_or_create(
         banned_json["message"], create_if_not_found=False
     ):
@@ -5667,6 +5644,7 @@ def process_banned_message(banned_json, instance_domain: str, session):
                     "banned_until": utcnow() + timedelta(days=1),
                 },
             )
+            api_context.changed(session, banned_person.id)
             session.commit()
 
 
@@ -31,13 +31,13 @@ from app.admin.util import unsubscribe_from_everything_then_delete, unsubscribe_
 from app.auth.util import send_email_verification, random_token
 from app.community.util import save_icon_file, save_banner_file, search_for_community, is_bad_name
 from app.community.routes import do_subscribe
-from app.constants import REPORT_STATE_NEW, REPORT_STATE_ESCALATED, POST_STATUS_REVIEWING, ROLE_ADMIN
+from app.constants import REPORT_STATE_NEW, REPORT_STATE_ESCALATED, POST_STATUS_REVIEWING, ROLE_ADMIN, APLOG_SUCCESS
 from app.email import send_registration_approved_email
 from app.models import AllowedInstances, BannedInstances, ActivityPubLog, CronJobLog, utcnow, Site, Community, CommunityMember, \
     User, Instance, File, Report, Topic, UserRegistration, Role, Post, PostReply, Language, RolePermission, Domain, \
-    Tag, DefederationSubscription, BlockedImage, CmsPage, Notification, Emoji
+    Tag, DefederationSubscription, BlockedImage, CmsPage, Notification, Emoji, Broadcast
 from app.shared.tasks import task_selector
-from app.translation import LibreTranslateAPI
+from app.translation import translator
 from app.utils import render_template, permission_required, set_setting, get_setting, gibberish, markdown_to_html, \
     moderating_communities, joined_communities, finalize_user_setup, theme_list, blocked_phrases, blocked_referrers, \
     topic_tree, languages_for_form, menu_topics, ensure_directory_exists, add_to_modlog, get_request, file_get_contents, \
@@ -77,9 +77,7 @@ def admin_home():
     translation_languages = None
     if current_app.config['TRANSLATE_ENDPOINT']:
         try:
-            lt = LibreTranslateAPI(current_app.config['TRANSLATE_ENDPOINT'],
-                                   api_key=current_app.config['TRANSLATE_KEY'])
-            translation_languages = lt.languages()
+            translation_languages = translator().languages()
         except Exception:
             pass
 
@@ -1115,6 +1113,24 @@ def admin_activities():
                            activities=activities)
 
 
+@bp.route('/queues', methods=['GET'])
+@permission_required('change instance settings')
+@login_required
+def admin_queues():
+    from app.task_lanes import LANES, queue_depths, federation_shed_level, intake_stats, intake_weight
+    from app.shared.purge import purges_in_progress
+    broadcasts = Broadcast.query.order_by(desc(Broadcast.id)).limit(20).all()
+    intake = intake_stats()
+    instances = {instance.domain: instance for instance in
+                 Instance.query.filter(Instance.domain.in_([peer['domain'] for peer in intake]))}
+    for peer in intake:
+        peer['weight'] = intake_weight(instances[peer['domain']]) if peer['domain'] in instances else 1.0
+        peer['trusted'] = peer['domain'] in instances and instances[peer['domain']].trusted
+    return render_template('admin/queues.html', title=_('Queues'), lanes=LANES, depths=queue_depths(),
+                           shed_level=federation_shed_level(), broadcasts=broadcasts, purges=purges_in_progress(),
+                           intake=intake)
+
+
 @bp.route('/activity_json/<int:activity_id>')
 @permission_required('change instance settings')
 @login_required
@@ -1150,7 +1166,8 @@ def activity_json(activity_id):
 def activity_replay(activity_id):
     activity = ActivityPubLog.query.get_or_404(activity_id)
     request_json = json.loads(activity.activity_json)
-    replay_inbox_request(request_json)
+    # activities that failed were accepted too, so they need forcing through the duplicate check
+    replay_inbox_request(request_json, force=activity.result != APLOG_SUCCESS[1])
 
     return 'Ok'
 
@@ -1362,9 +1379,9 @@ def unsubscribe_everyone_then_delete_task(community_id):
                     # todo: federate delete of local community out to all following instances
                     ...
 
-                community.delete_dependencies()
-                session.delete(community)  # todo: when a remote community is deleted it will be able to be re-created by using the 'Add remote' function. Not ideal. Consider soft-delete.
-                session.commit()
+                # todo: when a remote community is deleted it will be able to be re-created by using the 'Add remote' function. Not ideal. Consider soft-delete.
+                from app.shared.purge import start_purge
+                start_purge('community', community_id, then='delete_community')
         except Exception:
             session.rollback()
             raise
@@ -11,7 +11,7 @@ from sqlalchemy import text, desc
 from app import db, celery
 from app.activitypub.signature import default_context, send_post_request
 from app.constants import POST_TYPE_IMAGE
-from app.models import User, Community, Instance, CommunityMember, Post
+from app.models import User, Community, CommunityMember, Post
 from app.utils import (
     gibberish,
     topic_tree,
@@ -47,9 +47,6 @@ def unsubscribe_from_everything_then_delete_task(user_id):
 
                     # federate deletion of account
                     if user.is_local():
-                        instances = Instance.query.filter(
-                            Instance.dormant == False, Instance.gone_forever == False
-                        ).all()
                         payload = {
                             "@context": default_context(),
                             "actor": user.public_url(),
@@ -58,18 +55,14 @@ def unsubscribe_from_everything_then_delete_task(user_id):
                             "to": ["https://www.w3.org/ns/activitystreams#Public"],
                             "type": "Delete",
                         }
-                        for instance in instances:
-                            if (
-                                instance.inbox
-                                and instance.online()
-                                and instance.id != 1
-                            ):  # instance id 1 is always the current instance
-                                send_post_request(
-                                    instance.inbox,
-                                    payload,
-                                    user.private_key,
-                                    f"{user.public_url()}#main-key",
-                                )
+                        from app.shared.broadcast import broadcast_to_all_instances
+
+                        broadcast_to_all_instances(
+                            session,
+                            payload,
+                            user.private_key,
+                            f"{user.public_url()}#main-key",
+                        )
 
                 user.banned = True
                 user.deleted = True
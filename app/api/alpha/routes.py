@@ -29,7 +29,7 @@ from app.api.alpha.utils.site import get_site, post_site_block, get_federated_in
     get_site_instance_chooser_search, get_site_version, get_site_metadata
 from app.api.alpha.utils.topic import get_topic_list
 from app.api.alpha.utils.upload import post_upload_image, post_upload_community_image, post_upload_user_image, \
-    post_image_delete
+    post_image_delete, get_upload_image_state
 from app.api.alpha.utils.user import get_user, post_user_block, get_user_unread_count, get_user_replies, \
     post_user_mark_all_as_read, put_user_subscribe, put_user_save_user_settings, \
     get_user_notifications, put_user_notification_state, get_user_notifications_count, \
@@ -1398,6 +1398,19 @@ def post_alpha_upload_user_image(files_data):
         return ImageUploadResponse().load(resp)
 
 
+@upload_bp.route('/upload/state', methods=['GET'])
+@upload_bp.doc(summary="Whether an uploaded image is ready yet.")
+@upload_bp.arguments(ImageStateRequest, location="query")
+@upload_bp.response(200, ImageStateResponse)
+@upload_bp.alt_response(400, schema=DefaultError)
+def get_alpha_upload_state(data):
+    if not enable_api():
+        return abort(400, message="alpha api is not enabled")
+    auth = request.headers.get('Authorization')
+    resp = get_upload_image_state(auth, data)
+    return ImageStateResponse().load(resp)
+
+
 @upload_bp.route('/image/delete', methods=['POST'])
 @upload_bp.doc(summary="Delete a user image.")
 @upload_bp.arguments(ImageDeleteRequest)
@@ -1576,6 +1576,17 @@ class ImageUploadResponse(DefaultSchema):
     q = fields.String()
 
 
+class ImageStateRequest(DefaultSchema):
+    url = fields.String(required=True, metadata={"format": "url"})
+
+
+class ImageStateResponse(DefaultSchema):
+    url = fields.String(required=True, metadata={"format": "url"})
+    state = fields.String(required=True, validate=validate.OneOf(["pending", "ready", "failed"]),
+                          metadata={"description": "Whether the image has been resized and converted yet. Its url "
+                                                   "works once it is ready."})
+
+
 class ImageDeleteRequest(DefaultSchema):
     file = fields.String(required=True)
 
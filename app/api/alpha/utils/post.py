@@ -52,6 +52,7 @@ from app.shared.post import (
 )
 from app.post.util import (
     post_replies,
+    post_reply_page,
     get_comment_branch,
     tags_to_string,
     flair_to_string,
@@ -1533,54 +1534,14 @@ def get_post(auth, data):
     return post_json
 
 
-def get_post_replies(auth, data):
-    sort = data["sort"] if "sort" in data else "New"
-    max_depth = int(data["max_depth"]) if "max_depth" in data else None
-    page_cursor = (
-        data["page"] if "page" in data else None
-    )  # Expects reply ID or None for first page
-    limit = int(data["limit"]) if "limit" in data else 20
-    post_id = data["post_id"] if "post_id" in data else None
-    parent_id = data["parent_id"] if "parent_id" in data else None
-
-    if limit > current_app.config["PAGE_LENGTH"]:
-        limit = current_app.config["PAGE_LENGTH"]
-
-    if auth:
-        user_details = authorise_api_user(auth, return_type="dict")
-        user_id = user_details["id"]
-        # get_comment_branch() is borrowed from the web-ui so needs the full User
-        user = User.query.filter_by(id=user_id).one()
-    else:
-        user_details = {}
-        user_id = None
-        user = None
-
-    if parent_id:
-        parent = PostReply.query.get(parent_id)
-        if post_id is None:
-            post_id = parent.post_id
-        post = Post.query.get(post_id)
-        replies = get_comment_branch(post, parent.id, sort.lower(), user)
+def archived_reply_page(post, sort, user, page_cursor, limit, max_depth, parent):
+    """post_reply_page() for archived posts, whose replies are in the archive rather than the database. The whole
+    tree is loaded and then cut down to a page, with the id of the next top-level reply as the cursor."""
+    if parent:
+        replies = get_comment_branch(post, parent.id, sort, user)
     else:
-        post = Post.query.get(post_id)
-        replies = post_replies(post, sort.lower(), user)
-
-    is_user_banned_from_community = (
-        post.community_id in user_details["user_ban_community_ids"]
-        if user_details
-        else False
-    )
-    is_user_following_community = (
-        post.community_id in user_details["followed_community_ids"]
-        if user_details
-        else False
-    )
-    is_user_moderator = (
-        post.community_id in user_details["moderated_community_ids"]
-        if user_details
-        else False
-    )
+        replies = post_replies(post, sort, user)
+    parent_id = parent.id if parent else None
 
     # Apply max_depth filter to the nested reply tree
     def filter_max_depth(reply_tree, current_depth=0, parent_depth=0):
@@ -1669,8 +1630,57 @@ def get_post_replies(auth, data):
 
         return included_branches, next_cursor
 
-    # Apply pagination
-    replies, next_cursor = paginate_with_cursor(replies, page_cursor, limit)
+    return paginate_with_cursor(replies, page_cursor, limit)
+
+
+def get_post_replies(auth, data):
+    sort = data["sort"] if "sort" in data else "New"
+    max_depth = int(data["max_depth"]) if "max_depth" in data else None
+    page_cursor = (
+        data["page"] if "page" in data else None
+    )  # Expects next_page from the previous page or None for first page
+    limit = int(data["limit"]) if "limit" in data else 20
+    post_id = data["post_id"] if "post_id" in data else None
+    parent_id = data["parent_id"] if "parent_id" in data else None
+
+    if limit > current_app.config["PAGE_LENGTH"]:
+        limit = current_app.config["PAGE_LENGTH"]
+
+    if auth:
+        user_details = authorise_api_user(auth, return_type="dict")
+        user_id = user_details["id"]
+        # get_comment_branch() is borrowed from the web-ui so needs the full User
+        user = User.query.filter_by(id=user_id).one()
+    else:
+        user_details = {}
+        user_id = None
+        user = None
+
+    parent = PostReply.query.get(parent_id) if parent_id else None
+    if parent and post_id is None:
+        post_id = parent.post_id
+    post = Post.query.get(post_id)
+
+    is_user_banned_from_community = (
+        post.community_id in user_details["user_ban_community_ids"]
+        if user_details
+        else False
+    )
+    is_user_following_community = (
+        post.community_id in user_details["followed_community_ids"]
+        if user_details
+        else False
+    )
+    is_user_moderator = (
+        post.community_id in user_details["moderated_community_ids"]
+        if user_details
+        else False
+    )
+
+    if not post.archived:
+        replies, next_cursor = post_reply_page(post, sort.lower(), user, page_cursor, limit, max_depth, parent)
+    else:
+        replies, next_cursor = archived_reply_page(post, sort.lower(), user, page_cursor, limit, max_depth, parent)
 
     inner_post_view = None
     inner_community_view = None
@@ -3,7 +3,8 @@ from flask_login import current_user
 from sqlalchemy import text
 
 from app import db
-from app.shared.upload import process_upload, process_file_delete
+from app.constants import FILE_STATE_NAMES
+from app.shared.upload import process_upload, process_file_delete, get_upload_state
 from app.utils import authorise_api_user
 
 
@@ -43,6 +44,19 @@ def post_upload_user_image(auth, image_file=None):
     return {"url": url}
 
 
+def get_upload_image_state(auth, data):
+    try:
+        authorise_api_user(auth)
+    except Exception:
+        if not current_user.is_authenticated:
+            raise Exception("incorrect_login")
+
+    state = get_upload_state(data["url"])
+    if state is None:
+        raise Exception("file_not_found")
+    return {"url": data["url"], "state": FILE_STATE_NAMES[state]}
+
+
 def post_image_delete(auth, data):
     try:
         user_id = authorise_api_user(auth)
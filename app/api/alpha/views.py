@@ -140,13 +140,14 @@ def post_view(
                     v1["small_thumbnail_url"] = valid_url
                 if post.image.alt_text:
                     v1["alt_text"] = post.image.alt_text
-        if post.cross_posts:
+        cross_post_ids = post.cross_posts if post.cross_post_count else []
+        if cross_post_ids:
             v1["cross_posts"] = []
             cross_post_data = db.session.execute(
                 text(
                     'SELECT p.id, reply_count, c.title FROM "post" as p INNER JOIN "community" as c ON p.community_id = c.id WHERE p.id IN :cross_posts'
                 ),
-                {"cross_posts": tuple(post.cross_posts)},
+                {"cross_posts": tuple(cross_post_ids)},
             ).all()
             for cross_post in cross_post_data:
                 v1["cross_posts"].append(
@@ -183,7 +184,7 @@ def post_view(
             + "Z"
             if post.last_active
             else post.posted_at.isoformat(timespec="microseconds") + "Z",
-            "cross_posts": len(post.cross_posts) if post.cross_posts else 0,
+            "cross_posts": post.cross_post_count,
         }
 
         if user_id:
@@ -416,7 +417,7 @@ def post_view(
             )
 
         xplist = []
-        if post.cross_posts:
+        if post.cross_post_count:
             for xp_id in post.cross_posts:
                 try:
                     entry = post_view(
@@ -953,25 +954,18 @@ def flair_view(flair: CommunityFlair | int):
 # emergency function - shouldn't be called in normal circumstances
 @cache.memoize(timeout=86400)
 def calculate_path(reply):
-    path = [0, reply.id]
-    if reply.depth == 1:
-        path = [0, reply.parent_id, reply.id]
-    elif reply.depth > 1:
-        path = [0]
-        parent_id = reply.parent_id
-        depth = reply.depth - 1
-        path_ids = [reply.id, reply.parent_id]
-        while depth > 0:
-            pid = db.session.execute(
-                text('SELECT parent_id FROM "post_reply" WHERE id = :parent_id'),
-                {"parent_id": parent_id},
-            ).scalar()
-            path_ids.append(pid)
-            parent_id = pid
-            depth -= 1
-        for pid in path_ids[::-1]:
-            path.append(pid)
-    reply.path = path
+    # the reply and its ancestors up to the top-level reply, in one query however deep it is
+    ancestor_ids = db.session.execute(
+        text('''WITH RECURSIVE ancestors(id, parent_id, depth) AS (
+                    SELECT id, parent_id, 0 FROM "post_reply" WHERE id = :reply_id
+                    UNION ALL
+                    SELECT p.id, p.parent_id, a.depth + 1 FROM "post_reply" p JOIN ancestors a ON p.id = a.parent_id
+                    WHERE a.depth < :max_depth
+                 )
+                 SELECT id FROM ancestors ORDER BY depth DESC'''),
+        {"reply_id": reply.id, "max_depth": (reply.depth or 0) + 1},
+    ).scalars().all()
+    reply.path = [0] + ancestor_ids
     db.session.commit()
 
 
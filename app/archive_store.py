@@ -0,0 +1,262 @@
+# Archive segments - many archived posts packed into one file, each one independently readable.
+#
+# Segment layout:
+#   MAGIC | dictionary length (4 bytes, big endian) | dictionary | record | record | ...
+#
+# Each record is a header frame followed by one frame per top-level reply branch. Every frame is raw deflate
+# compressed using the segment's preset dictionary, so any single frame can be inflated on its own. The header frame
+# holds the post body and the location of each branch frame, which lets us show a post (or one comment branch)
+# by reading a few KB out of the middle of the segment using mmap or a HTTP range request.
+#
+# Where a record is lives in post.archived, as 'seg:<segment name>:<offset>:<header length>:<record length>'.
+
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import Counter
+from functools import lru_cache
+
+import boto3
+import orjson
+from flask import current_app
+
+from app.utils import get_request
+
+MAGIC = b'PFAR1\n'
+DICTIONARY_SIZE = 32768     # the most zlib will use
+SEGMENT_POSTS = 500         # posts per segment, at most
+LOCATOR_PREFIX = 'seg:'
+LOCAL_DIRECTORY = 'app/static/media/archived/segments'
+S3_DIRECTORY = 'archived/segments'
+
+# Strings that make up most of every archived record. These go at the front of the dictionary so they are kept even
+# when the samples don't contain them.
+_SKELETON = b''.join([b'"%s":' % key for key in [
+    b'id', b'body', b'body_html', b'posted_at', b'edited_at', b'score', b'ranking', b'parent_id', b'distinguished',
+    b'deleted', b'deleted_by', b'user_id', b'depth', b'language_id', b'replies_enabled', b'community_id', b'up_votes',
+    b'down_votes', b'child_count', b'path', b'author_name', b'author_id', b'author_indexable', b'author_deleted',
+    b'author_user_name', b'author_ap_id', b'author_ap_profile_id', b'author_reputation', b'author_created',
+    b'author_ap_domain', b'author_bot', b'author_banned', b'replies']]) + b'false,true,null,[],<p></p>\n'
+
+
+def is_segment_locator(archived: str) -> bool:
+    return archived is not None and archived.startswith(LOCATOR_PREFIX)
+
+
+def make_locator(segment_name: str, offset: int, header_length: int, record_length: int) -> str:
+    return f'{LOCATOR_PREFIX}{segment_name}:{offset}:{header_length}:{record_length}'
+
+
+def parse_locator(archived: str):
+    segment_name, offset, header_length, record_length = archived[len(LOCATOR_PREFIX):].split(':')
+    return segment_name, int(offset), int(header_length), int(record_length)
+
+
+def train_dictionary(samples: list, size: int = DICTIONARY_SIZE) -> bytes:
+    """Build a preset dictionary out of the substrings that recur most across the samples (serialized records).
+    deflate back-references to nearby data are cheaper so the most common substrings go at the end."""
+    counts = Counter()
+    for sample in samples:
+        counts.update(set(re.findall(rb'"[a-z_]+":|https?://[a-z0-9.\-]+/[a-z]*/?|</?[a-z0-9]+>| ?[A-Za-z][A-Za-z0-9]{2,}', sample)))
+    # only substrings that recur across posts - the dictionary is kept for as long as the segment, so it must not hold
+    # anything that would survive one post being deleted from it (see blank_records())
+    common = b''.join(reversed([substring for substring, count in counts.most_common(2000) if count > 1]))
+    # fill whatever room is left with the shape of the samples - their JSON with every string value emptied
+    room = max(size - len(_SKELETON) - len(common), 0)
+    shapes = b''.join(orjson.dumps(_emptied(orjson.loads(sample)))[:1024] for sample in samples)[:room]
+    return (_SKELETON + shapes + common)[-size:]
+
+
+def _emptied(data):
+    if isinstance(data, dict):
+        return {key: _emptied(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_emptied(value) for value in data]
+    return '' if isinstance(data, str) else data
+
+
+class SegmentWriter:
+    """Packs archived posts into one segment. Usage:
+
+    writer = SegmentWriter(dictionary)
+    position = writer.add(post_data)
+    ...
+    data = writer.getvalue()
+    """
+
+    def __init__(self, dictionary: bytes):
+        self.dictionary = dictionary
+        self.chunks = [MAGIC, struct.pack('>I', len(dictionary)), dictionary]
+        self.length = sum(len(chunk) for chunk in self.chunks)
+
+    def _compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(level=9, wbits=-15, zdict=self.dictionary)
+        return compressor.compress(data) + compressor.flush()
+
+    def add(self, post_data: dict) -> tuple:
+        """Append a post (in the dict format built by archive_post) and return (offset, header length, record length)"""
+        branch_frames = []
+        branches = []
+        for reply in post_data.get('replies', []):
+            frame = self._compress(orjson.dumps(reply))
+            branches.append([sum(len(f) for f in branch_frames), len(frame), _reply_ids(reply)])
+            branch_frames.append(frame)
+
+        header = {key: value for key, value in post_data.items() if key != 'replies'}
+        header['version'] = 2
+        header['branches'] = branches
+        header_frame = self._compress(orjson.dumps(header))
+
+        offset = self.length
+        record = [header_frame] + branch_frames
+        record_length = sum(len(frame) for frame in record)
+        self.chunks.extend(record)
+        self.length += record_length
+        return offset, len(header_frame), record_length
+
+    def getvalue(self) -> bytes:
+        return b''.join(self.chunks)
+
+
+def _reply_ids(reply: dict) -> list:
+    result = [reply['id']]
+    for child in reply.get('replies', []):
+        result.extend(_reply_ids(child))
+    return result
+
+
+def _inflate(dictionary: bytes, frame: bytes) -> dict:
+    decompressor = zlib.decompressobj(wbits=-15, zdict=dictionary)
+    return orjson.loads(decompressor.decompress(frame) + decompressor.flush())
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Storage
+
+def segment_path(segment_name: str) -> str:
+    return f'{LOCAL_DIRECTORY}/{segment_name}.seg'
+
+
+def segment_url(segment_name: str) -> str:
+    return f"https://{current_app.config['S3_PUBLIC_URL']}/{S3_DIRECTORY}/{segment_name}.seg"
+
+
+def write_segment(segment_name: str, data: bytes, in_s3: bool):
+    if in_s3:
+        boto3_session = boto3.session.Session()
+        s3 = boto3_session.client(
+            service_name='s3',
+            region_name=current_app.config['S3_REGION'],
+            endpoint_url=current_app.config['S3_ENDPOINT'],
+            aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
+            aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
+        )
+        s3.put_object(
+            Bucket=current_app.config['S3_BUCKET'],
+            Key=f'{S3_DIRECTORY}/{segment_name}.seg',
+            Body=data,
+            ContentType='application/octet-stream'
+        )
+        s3.close()
+    else:
+        os.makedirs(LOCAL_DIRECTORY, exist_ok=True)
+        tmp_path = segment_path(segment_name) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, segment_path(segment_name))
+
+
+def blank_records(segment_name: str, records: list):
+    """Overwrite the records (offset, record length) of deleted posts with zeros. Everything else in the segment keeps
+    its offset so the locators of the other posts in it stay valid."""
+    local_path = segment_path(segment_name)
+    if os.path.isfile(local_path):
+        with open(local_path, 'r+b') as f:
+            for offset, record_length in records:
+                f.seek(offset)
+                f.write(bytes(record_length))
+        return
+
+    boto3_session = boto3.session.Session()
+    s3 = boto3_session.client(
+        service_name='s3',
+        region_name=current_app.config['S3_REGION'],
+        endpoint_url=current_app.config['S3_ENDPOINT'],
+        aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
+        aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
+    )
+    key = f'{S3_DIRECTORY}/{segment_name}.seg'
+    data = bytearray(s3.get_object(Bucket=current_app.config['S3_BUCKET'], Key=key)['Body'].read())
+    for offset, record_length in records:
+        data[offset:offset + record_length] = bytes(record_length)
+    s3.put_object(
+        Bucket=current_app.config['S3_BUCKET'],
+        Key=key,
+        Body=bytes(data),
+        ContentType='application/octet-stream'
+    )
+    s3.close()
+
+
+def read_range(segment_name: str, start: int, length: int) -> bytes:
+    """Read part of a segment - via mmap if it is on local disk, otherwise with a http range request"""
+    local_path = segment_path(segment_name)
+    if os.path.isfile(local_path):
+        with open(local_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return m[start:start + length]
+
+    response = get_request(segment_url(segment_name), headers={'Range': f'bytes={start}-{start + length - 1}'})
+    try:
+        if response.status_code == 206:
+            return response.content
+        elif response.status_code == 200:   # server ignored the Range header
+            return response.content[start:start + length]
+        raise IOError(f'Could not read archive segment {segment_name}: {response.status_code}')
+    finally:
+        response.close()
+
+
+@lru_cache(maxsize=64)
+def segment_dictionary(segment_name: str) -> bytes:
+    # segments never change once written so the dictionary can be kept for the life of the process
+    preamble = read_range(segment_name, 0, len(MAGIC) + 4)
+    if preamble[:len(MAGIC)] != MAGIC:
+        raise IOError(f'{segment_name} is not an archive segment')
+    dictionary_length = struct.unpack('>I', preamble[len(MAGIC):])[0]
+    return read_range(segment_name, len(MAGIC) + 4, dictionary_length)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Reading
+
+def read_header(archived: str) -> dict:
+    """The post body and branch directory, without any replies"""
+    segment_name, offset, header_length, record_length = parse_locator(archived)
+    return _inflate(segment_dictionary(segment_name), read_range(segment_name, offset, header_length))
+
+
+def read_post(archived: str) -> dict:
+    """Everything - in the same shape as the version 1 (one gzip file per post) format"""
+    segment_name, offset, header_length, record_length = parse_locator(archived)
+    dictionary = segment_dictionary(segment_name)
+    record = read_range(segment_name, offset, record_length)
+    result = _inflate(dictionary, record[:header_length])
+    replies = []
+    for branch_offset, branch_length, reply_ids in result.pop('branches'):
+        start = header_length + branch_offset
+        replies.append(_inflate(dictionary, record[start:start + branch_length]))
+    result['replies'] = replies
+    return result
+
+
+def read_branch(archived: str, comment_id: int) -> dict | None:
+    """The top-level reply branch that contains comment_id, or None"""
+    segment_name, offset, header_length, record_length = parse_locator(archived)
+    header = read_header(archived)
+    for branch_offset, branch_length, reply_ids in header['branches']:
+        if comment_id in reply_ids:
+            frame = read_range(segment_name, offset + header_length + branch_offset, branch_length)
+            return _inflate(segment_dictionary(segment_name), frame)
+    return None
@@ -23,7 +23,7 @@ from sqlalchemy import or_, desc, text
 from sqlalchemy.dialects.postgresql import insert
 
 from app import db, plugins
-from app.activitypub.signature import RsaKeys, send_post_request, default_context
+from app.activitypub.signature import RsaKeys, send_post_request, default_context, local_actor_private_key
 from app.activitypub.util import extract_domain_and_actor, notify_about_post
 from app.auth.util import random_token
 from app.community.util import is_bad_name
@@ -33,7 +33,8 @@ from app.email import send_email
 from app.models import CronJobLog, Settings, BannedInstances, Role, User, RolePermission, Domain, ActivityPubLog, \
     utcnow, Site, Instance, File, Notification, Post, CommunityMember, NotificationSubscription, PostReply, Language, \
     Community, SendQueue, _store_files_in_s3, PostVote, Poll, \
-    ActivityBatch, Reminder
+    Reminder
+from app.shared.activity_batch import sweep_activity_batches
 from app.shared.tasks import task_selector
 from app.shared.tasks.maintenance import add_remote_communities, remove_old_bot_content
 from app.utils import retrieve_block_list, blocked_domains, retrieve_peertube_block_list, \
@@ -510,12 +511,17 @@ def register(app):
                             if not current_app.debug:
                                 sleep(uniform(0, 10))  # Cron jobs are not very granular so there is a danger all instances will send in the same instant. A random delay avoids this.
 
+                            # instance health and retries from the deliveries made by the notifs service
+                            from app.shared.delivery import record_delivery_results
+                            record_delivery_results(session)
+
                             to_be_deleted = []
                             # Send all waiting Activities that are due to be sent
                             for to_send in session.query(SendQueue).filter(SendQueue.send_after < utcnow()):
                                 if instance_online(to_send.destination_domain):
-                                    if to_send.retries <= to_send.max_retries:
-                                        send_post_request(to_send.destination, json.loads(to_send.payload), to_send.private_key,
+                                    private_key = to_send.private_key or local_actor_private_key(to_send.actor, session)
+                                    if to_send.retries <= to_send.max_retries and private_key:
+                                        send_post_request(to_send.destination, json.loads(to_send.payload), private_key,
                                                           to_send.actor,
                                                           retries=to_send.retries + 1)
                                     to_be_deleted.append(to_send.id)
@@ -533,6 +539,18 @@ def register(app):
 
                             reminders()
 
+                            from app.user.settings_import import resume_stalled_imports
+                            resume_stalled_imports()
+                            from app.shared.purge import resume_stalled_purges
+                            resume_stalled_purges()
+                            from app.shared.broadcast import resume_stalled_broadcasts
+                            resume_stalled_broadcasts(session)
+                            from app.shared.syndication import rebuild_sitemap
+                            rebuild_sitemap()
+                            # in case the flush that was due got lost, e.g. a worker restarted
+                            from app.shared.counters import flush_counters
+                            flush_counters()
+
                             plugins.fire_hook('cron_often')
 
                     except redis.exceptions.LockError:
@@ -587,6 +605,7 @@ def register(app):
                             time_difference = poll.end_poll - post.created_at
                             poll.end_poll += time_difference
                         db.session.commit()
+                        post.calculate_cross_posts()    # scheduled posts are not in a cross post group until now
 
                         # Federate post
                         task_selector('make_post', post_id=post.id)
@@ -607,8 +626,11 @@ def register(app):
                         scheduled_post.edited_at = None
                         scheduled_post.status = POST_STATUS_PUBLISHED
                         scheduled_post.title = render_from_tpl(scheduled_post.title)
+                        scheduled_post.cross_post_group_id = None
                         db.session.add(scheduled_post)
                         db.session.commit()
+                        if post.type != POST_TYPE_IMAGE:
+                            scheduled_post.calculate_cross_posts()
 
                         scheduled_post.generate_ap_id(scheduled_post.community)
                         # Update the scheduled_for with the next occurrence date
@@ -637,36 +659,29 @@ def register(app):
         send_batched_activities()
 
     def send_batched_activities():
-        instances_and_communities = db.session.execute(text("""SELECT DISTINCT instance_id, community_id
-                                                                FROM "activity_batch"
-                                                                ORDER BY instance_id, community_id""")).fetchall()
-        current_instance = None
-        for instances_and_community in instances_and_communities:
-            if current_instance is None or current_instance.id != instances_and_community[0]:
-                current_instance = Instance.query.get(instances_and_community[0])
-            community = Community.query.get(instances_and_community[1])
-
-            announce_id = f"{current_app.config['SERVER_URL']}/activities/announce/{gibberish(15)}"
-            actor = community.public_url()
-            to = ["https://www.w3.org/ns/activitystreams#Public"]
-            cc = [community.ap_followers_url]
-            announce = {
-                'id': announce_id,
-                'type': 'Announce',
-                'actor': actor,
-                'object': [],
-                '@context': default_context(),
-                'to': to,
-                'cc': cc
-            }
-            payloads = ActivityBatch.query.filter(ActivityBatch.instance_id == current_instance.id, ActivityBatch.community_id == community.id).order_by(ActivityBatch.created)
-            delete_payloads = []
-            for payload in payloads.all():
-                announce['object'].append(payload.payload)
-                delete_payloads.append(payload.id)
-            send_post_request(current_instance.inbox, announce, community.private_key, community.public_url() + '#main-key')
-            ActivityBatch.query.filter(ActivityBatch.id.in_(delete_payloads)).delete()
-            db.session.commit()
+        sweep_activity_batches(db.session)
+
+    @app.cli.command('backfill-community')
+    @click.argument('community')
+    @click.option('--posts', default=500, help='How many posts to fetch.')
+    @click.option('--restart', is_flag=True, help='Start again from the newest posts instead of carrying on.')
+    def backfill_community(community, posts, restart):
+        """Fetch old posts from the outbox of a remote community, e.g. flask backfill-community technology@lemmy.world"""
+        from app.community.backfill import start_backfill, backfill_state
+        if '@' in community:
+            name, ap_domain = community.lstrip('!').split('@', 1)
+            found = Community.query.filter(Community.name == name.lower(), Community.ap_domain == ap_domain.lower()).first()
+        else:
+            found = Community.query.filter(Community.ap_profile_id == community.lower()).first()
+        if found is None or found.is_local() or not found.ap_outbox_url:
+            print(f'{community} is not a remote community with an outbox')
+            return
+        if start_backfill(found.id, posts, restart=restart):
+            print(f'Backfilling up to {posts} posts into {found.link()}')
+        else:
+            state = backfill_state(found.id)
+            remaining = state['remaining'] if state else 0
+            print(f'Carrying on with the backfill of {found.link()}, {remaining} posts to go')
 
     def reminders():
         pending_reminders = Reminder.query.filter(Reminder.remind_at < utcnow()).all()
@@ -0,0 +1,354 @@
+# Backfilling posts (and their comments) from the outbox of a remote community.
+#
+# Each outbox page is processed in three phases so that a page costs a handful of round trips instead of several
+# requests per post, one after another:
+#   1. collect - read the page and work out which posts we don't have yet and which objects are needed for them
+#   2. resolve - fetch the objects and comment collections concurrently, then look up all the authors of the posts and
+#      comments with one query and fetch the ones that are missing
+#   3. insert  - create the posts, then their comments
+#
+# The position in the outbox (the url of the next page) and the number of posts still wanted are kept in redis. After
+# each page a new task is queued for the next one so a large backfill never ties up a worker for long, and running
+# `flask backfill-community` again carries on from where it was if a worker was restarted part way through.
+#
+# If a server refuses some of the requests because it already has as many in progress as it is allowed (see
+# app/remote_fetch.py), nothing from the page is created and the page is done again a little later.
+
+import redis
+from flask import current_app
+from sqlalchemy import desc
+
+from app import celery
+from app.activitypub.util import actor_json_to_model, create_post, extract_domain_and_actor, find_actor_or_create, \
+    find_language_or_create, remote_object_to_json
+from app.models import ActorUrl, Community, CommunityMember, Post, PostReply, User
+from app.remote_fetch import fetch_refused, get_json_many, reset_fetch_refused
+from app.utils import allowlist_html, get_task_session, gibberish, html_to_text, markdown_to_html, patch_db_session
+
+STATE_KEY = 'community_backfill:{}'     # hash of 'cursor' (next page url) and 'remaining' (posts still wanted)
+STATE_TTL = 60 * 60 * 24 * 7
+ACCEPT = 'application/activity+json'
+PAUSE = 60     # seconds before a page that a busy server refused requests for is tried again
+
+
+class BackfillPaused(Exception):
+    """Some of what a page needs could not be requested yet - the page should be done again later"""
+
+
+def start_backfill(community_id: int, posts: int, restart: bool = False) -> bool:
+    """Backfill up to `posts` posts into a community, or carry on with one that was already started.
+    Returns False if there was one in progress already (and restart is False), in which case `posts` is ignored."""
+    from app import redis_client
+    key = STATE_KEY.format(community_id)
+    if restart:
+        redis_client.delete(key)
+    started = bool(redis_client.hsetnx(key, 'remaining', posts))
+    redis_client.expire(key, STATE_TTL)
+    if current_app.debug:
+        backfill_community_page(community_id)
+    else:
+        backfill_community_page.delay(community_id)
+    return started
+
+
+def backfill_state(community_id: int) -> dict | None:
+    from app import redis_client
+    state = redis_client.hgetall(STATE_KEY.format(community_id))
+    if not state:
+        return None
+    return {'cursor': state.get('cursor') or None, 'remaining': int(state.get('remaining', 0))}
+
+
+@celery.task
+def backfill_community_page(community_id: int):
+    session = get_task_session()
+    try:
+        with patch_db_session(session):
+            from app import redis_client
+            try:
+                with redis_client.lock(f'lock:community_backfill:{community_id}', timeout=600, blocking_timeout=0):
+                    more = _backfill_next_page(session, community_id)
+            except redis.exceptions.LockError:   # another page of this community is being done already
+                return
+            except BackfillPaused:
+                session.rollback()
+                if current_app.debug:   # `flask backfill-community` again carries on from this page
+                    current_app.logger.info(f'Backfill of community {community_id} paused, a server is busy')
+                else:
+                    backfill_community_page.apply_async(args=(community_id,), countdown=PAUSE)
+                return
+            if more:
+                if current_app.debug:
+                    backfill_community_page(community_id)
+                else:
+                    backfill_community_page.delay(community_id)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _backfill_next_page(session, community_id: int) -> bool:
+    """Do one page of a backfill. True if there is more to do. Raises BackfillPaused, leaving the cursor where it was,
+    if the page has to be done again later."""
+    from app import redis_client
+    reset_fetch_refused()
+    key = STATE_KEY.format(community_id)
+    state = backfill_state(community_id)
+    community = session.query(Community).get(community_id)
+    if state is None or community is None or community.is_local() or community.banned:
+        redis_client.delete(key)
+        return False
+
+    more = False
+    try:
+        cursor = state['cursor']
+        if cursor is None:
+            cursor = community.ap_outbox_url
+        page = remote_object_to_json(cursor) if cursor else None
+        if page and 'first' in page and 'orderedItems' not in page:     # the collection itself, not a page of it
+            page = page['first'] if isinstance(page['first'], dict) else remote_object_to_json(page['first'])
+        if not page or not isinstance(page.get('orderedItems'), list):
+            if fetch_refused():
+                raise BackfillPaused()
+            redis_client.delete(key)
+            return False
+
+        created = backfill_page(session, community, page['orderedItems'], state['remaining'])
+
+        remaining = state['remaining'] - created
+        next_page = page.get('next')
+        if isinstance(next_page, dict):
+            next_page = next_page.get('id')
+        if remaining <= 0 or not next_page or not page['orderedItems']:
+            redis_client.delete(key)
+            return False
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping={'cursor': next_page, 'remaining': remaining})
+        pipe.expire(key, STATE_TTL)
+        pipe.execute()
+        more = True
+    except BackfillPaused:
+        more = True
+        raise
+    finally:
+        # whatever has been backfilled so far gets its featured posts marked even if this page failed part way
+        if not more:
+            session.rollback()
+            finish_backfill(session, community)
+    return True
+
+
+def finish_backfill(session, community: Community):
+    if community.ap_featured_url:
+        featured_data = remote_object_to_json(community.ap_featured_url)
+        if featured_data and featured_data.get('type') == 'OrderedCollection' and \
+                isinstance(featured_data.get('orderedItems'), list):
+            featured = [item['id'] for item in featured_data['orderedItems'] if isinstance(item, dict) and 'id' in item]
+            if featured:
+                session.query(Post).filter(Post.community_id == community.id, Post.ap_id.in_(featured)).\
+                    update({Post.sticky: True}, synchronize_session=False)
+    session.commit()
+
+
+class _Entry:
+    """One post from an outbox page, as it makes its way through the phases"""
+
+    def __init__(self, announce_id, activity, object_url, request_json):
+        self.announce_id = announce_id
+        self.activity = activity            # the post object. None until fetched, for PeerTube and Guppe.
+        self.object_url = object_url
+        self.request_json = request_json    # what create_post() expects
+        self.author = None
+        self.replies = []                   # the comments in its comment collection
+        self.post = None
+
+
+def backfill_page(session, community: Community, items: list, limit: int) -> int:
+    """Create up to `limit` posts (with comments) from the items of one outbox page. Returns the number created. Raises
+    BackfillPaused, having created nothing, if a server refused requests for some of what they need."""
+    is_peertube = '/video-channels/' in community.ap_profile_id
+    is_guppe = community.ap_profile_id.startswith('https://ovo.st/club')
+
+    # collect
+    entries = []
+    for announce in items:
+        if not isinstance(announce, dict) or not announce.get('object'):
+            continue
+        if is_peertube or is_guppe:
+            object_url = announce['object'] if isinstance(announce['object'], str) else announce['object'].get('id')
+            if object_url:
+                entries.append(_Entry(announce.get('id'), None, object_url, None))
+        elif isinstance(announce['object'], dict) and isinstance(announce['object'].get('object'), dict):
+            activity = announce['object']['object']
+            entries.append(_Entry(announce.get('id'), activity, activity.get('id'), announce['object']))
+        elif announce.get('type') == 'Create' and isinstance(announce['object'], dict):   # WordPress
+            entries.append(_Entry(announce.get('id'), announce['object'], announce['object'].get('id'), announce))
+
+    object_urls = [entry.object_url for entry in entries if entry.object_url]
+    known = {ap_id for ap_id, in session.query(Post.ap_id).filter(Post.ap_id.in_(object_urls))}
+    entries = [entry for entry in entries if entry.object_url and entry.object_url not in known][:limit]
+    if not entries:
+        return 0
+
+    # resolve - all of it before anything is created, so that the page can be done again if some of it is refused
+    objects = fetch_many([entry.object_url for entry in entries if entry.activity is None])
+    for entry in entries:
+        if entry.activity is None and entry.object_url in objects:
+            entry.activity = objects[entry.object_url]
+            entry.request_json = {'id': f"https://{extract_domain_and_actor(community.ap_profile_id)[0]}/activities/"
+                                        f"create/{gibberish(15)}", 'object': entry.activity}
+    entries = [entry for entry in entries if isinstance(entry.activity, dict)]
+
+    collections = fetch_many([entry.activity['replies'] for entry in entries
+                              if isinstance(entry.activity.get('replies'), str)])
+    for entry in entries:
+        collection = collections.get(entry.activity.get('replies')) if isinstance(entry.activity.get('replies'), str) \
+            else None
+        if collection and collection.get('type') == 'OrderedCollection' and \
+                isinstance(collection.get('orderedItems'), list):
+            entry.replies = [reply for reply in collection['orderedItems'] if isinstance(reply, dict) and
+                             reply.get('id') and isinstance(reply.get('attributedTo'), str)]
+
+    author_urls = [reply['attributedTo'] for entry in entries for reply in entry.replies]
+    if is_peertube:     # videos are attributed to the channel, use one of its moderators as the author
+        mod = session.query(User).join(CommunityMember, CommunityMember.user_id == User.id).\
+            filter(CommunityMember.community_id == community.id, CommunityMember.is_moderator == True).first()
+        if mod is None:
+            return 0
+    else:
+        author_urls += [entry.activity['attributedTo'] for entry in entries
+                        if isinstance(entry.activity.get('attributedTo'), str)]
+    authors = resolve_users(session, author_urls)
+    if fetch_refused():
+        raise BackfillPaused()
+    for entry in entries:
+        if is_peertube:
+            entry.author = mod
+        elif isinstance(entry.activity.get('attributedTo'), str):
+            entry.author = authors.get(entry.activity['attributedTo'])
+
+    # insert
+    created = []
+    for entry in entries:
+        if entry.author is None or entry.author.is_local():
+            continue
+        try:
+            entry.post = create_post(True, community, entry.request_json, entry.author, entry.announce_id)
+        except Exception as e:
+            session.rollback()
+            current_app.logger.warning(f'Backfill of {entry.object_url} failed: {e}')
+            continue
+        if entry.post:
+            if 'published' in entry.activity:
+                entry.post.posted_at = entry.activity['published']
+                entry.post.last_active = entry.activity['published']
+            created.append(entry)
+    session.commit()
+
+    backfill_replies(session, created, authors)
+
+    if created:
+        latest = session.query(Post.posted_at).filter(Post.community_id == community.id).\
+            order_by(desc(Post.posted_at)).first()
+        if latest:
+            community.last_active = latest.posted_at
+        session.commit()
+    return len(created)
+
+
+def backfill_replies(session, entries: list, authors: dict):
+    """Create the comments of newly backfilled posts, from their comment collections. authors is {url: User} of the
+    comment authors."""
+    replies_by_post = [(entry.post, entry.replies) for entry in entries if entry.replies]
+    if not replies_by_post:
+        return
+
+    reply_ids = [reply['id'] for post, replies in replies_by_post for reply in replies]
+    parents = {reply.ap_id: reply for reply in session.query(PostReply).filter(PostReply.ap_id.in_(reply_ids))}
+
+    for post, replies in replies_by_post:
+        for reply_data in replies:
+            author = authors.get(reply_data['attributedTo'])
+            if reply_data['id'] in parents or author is None:
+                continue
+            body = body_html = ''
+            if isinstance(reply_data.get('content'), str):
+                if not (reply_data['content'].startswith('<p>') or reply_data['content'].startswith('<blockquote>')):
+                    reply_data['content'] = '<p>' + reply_data['content'] + '</p>'
+                body_html = allowlist_html(reply_data['content'])
+                if isinstance(reply_data.get('source'), dict) and reply_data['source'].get('mediaType') == 'text/markdown':
+                    body = reply_data['source']['content']
+                    body_html = markdown_to_html(body)
+                else:
+                    body = html_to_text(body_html)
+            in_reply_to = None
+            if reply_data.get('inReplyTo') and reply_data['inReplyTo'] != post.ap_id:
+                in_reply_to = parents.get(reply_data['inReplyTo'])
+            language_id = None
+            if isinstance(reply_data.get('language'), dict):
+                language_id = find_language_or_create(reply_data['language']['identifier'],
+                                                      reply_data['language']['name']).id
+            try:
+                reply_data['object'] = {'id': reply_data['id']}
+                post_reply = PostReply.new(author, post, in_reply_to, body, body_html, False, language_id,
+                                           reply_data.get('distinguished', False), reply_data.get('answer', False),
+                                           reply_data, session=session)
+                session.add(post_reply)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                current_app.logger.warning(f"Backfill of comment {reply_data['id']} failed: {e}")
+                continue
+            parents[post_reply.ap_id] = post_reply
+
+
+def resolve_users(session, urls: list) -> dict:
+    """{url: User} for the given actor urls. Urls that can't be resolved to an acceptable remote user are left out."""
+    return resolve_actors(session, urls, User)
+
+
+def resolve_actors(session, urls: list, model=User) -> dict:
+    """{url: actor} for the given actor urls, for actors of one type (User or Community). Known actors are looked up with
+    one query via the actor_url index, the others are all fetched at once. Urls that can't be resolved to an acceptable
+    actor are left out."""
+    from app.activitypub.actor import validate_remote_actor, actor_recently_unresolvable, remember_unresolvable_actor
+    urls = {url.strip() for url in urls if isinstance(url, str) and validate_remote_actor(url.strip())}
+    if not urls:
+        return {}
+
+    registered = dict(session.query(ActorUrl.url, ActorUrl.actor_id).
+                      filter(ActorUrl.url.in_([url.lower() for url in urls]), ActorUrl.actor_type == model.__name__))
+    actors = {actor.id: actor for actor in session.query(model).filter(model.id.in_(list(registered.values())))}
+    result = {}
+    missing = []
+    for url in urls:
+        actor = actors.get(registered.get(url.lower()))
+        if actor is not None:
+            result[url] = actor
+        elif url.lower() not in registered and not actor_recently_unresolvable(url):
+            missing.append(url)
+
+    fetched = fetch_many(missing)
+    for url in missing:
+        if url in fetched:
+            server, address = extract_domain_and_actor(url)
+            actor = actor_json_to_model(fetched[url], address, server)
+            if actor is None:   # not an actor, or not one we accept
+                remember_unresolvable_actor(url)
+        else:   # maybe the server needs signed fetches, try the slow way. That does its own negative caching.
+            actor = find_actor_or_create(url, community_only=model is Community)
+        if isinstance(actor, model):
+            result[url] = actor
+
+    return {url: actor for url, actor in result.items() if validate_remote_actor(url, actor)}
+
+
+def fetch_many(urls: list) -> dict:
+    """Fetch ActivityPub objects concurrently. They usually all come from the same server, so stay within the limit of
+    requests to one host."""
+    urls = list(dict.fromkeys(url for url in urls if isinstance(url, str) and url.startswith('https://')))
+    if not urls:
+        return {}
+    return get_json_many(urls, accept=ACCEPT)
@@ -18,6 +18,7 @@ from app import db
 from app.constants import DOWNVOTE_ACCEPT_ALL, DOWNVOTE_ACCEPT_MEMBERS, DOWNVOTE_ACCEPT_INSTANCE, \
     DOWNVOTE_ACCEPT_TRUSTED, DOWNVOTE_ACCEPT_NONE
 from app.models import Community, Site, utcnow, User, Feed
+from app.shared import counters
 from app.utils import domain_from_url, MultiCheckboxField, get_timezones
 
 
@@ -335,8 +336,7 @@ class CreateImageForm(CreatePostForm):
                         'No.' in image_text or ' N0' in image_text):  # chan posts usually contain the text 'Anonymous' and ' No.12345'
                     self.image_file.errors.append(
                         "This image is an invalid file type.")  # deliberately misleading error message
-                    current_user.reputation -= 1
-                    db.session.commit()
+                    counters.increment(User, current_user.id, reputation=-1)
                     return False
         if uploaded_file.filename.endswith('.gif'):
             max_size_in_mb = 10 * 1024 * 1024  # 10 MB
@@ -156,7 +156,6 @@ from app.utils import (
     moderating_communities,
     moderating_communities_ids,
     blocked_domains,
-    mimetype_from_url,
     blocked_or_banned_instances,
     community_moderators,
     communities_banned_from,
@@ -197,9 +196,9 @@ from app.shared.post import make_post, sticky_post
 from app.shared.tasks import task_selector
 from app.shared.community import leave_community
 from app.shared.feed import leave_feed
+from app.shared.syndication import RSS_CONTENT_TYPE, artifact_response, community_rss, rss_response, strong_etag
 from app.utils import get_recipient_language, subscribed_feeds, feed_membership
-from feedgen.feed import FeedGenerator
-from datetime import timezone, timedelta
+from datetime import timedelta
 
 
 @bp.route("/add_local", methods=["GET", "POST"])
@@ -1063,7 +1062,6 @@ def show_community(community: Community):
 
 # RSS feed of the community
 @bp.route("/<actor>/feed", methods=["GET"])
-@cache.cached(timeout=600, query_string=True)
 def show_community_rss(actor):
     actor = actor.strip()
     if "@" in actor:
@@ -1075,74 +1073,16 @@ def show_community_rss(actor):
             name=actor, banned=False, ap_id=None
         ).first()
     if community is not None:
-        # If nothing has changed since their last visit, return HTTP 304
-        current_etag = f"{community.id}_{hash(community.last_active)}"
-        if request_etag_matches(current_etag):
-            return return_304(current_etag, "application/rss+xml")
-
         if community.private:
             abort(403)
 
         score = request.args.get("score", 0, int)
-
-        posts = Post.query.filter(Post.community_id == community.id).filter(
-            Post.from_bot == False,
-            Post.deleted == False,
-            Post.status > POST_STATUS_REVIEWING,
-        )
         if score:
-            posts = posts.filter(Post.score >= score)
-
-        posts = posts.order_by(desc(Post.created_at)).limit(20).all()
-
-        description = (
-            shorten_string(community.description, 150)
-            if community.description
-            else None
-        )
-        og_image = community.image.source_url if community.image_id else None
-        fg = FeedGenerator()
-        fg.id(f"{current_app.config['SERVER_URL']}/c/{actor}")
-        fg.title(f"{community.title} on {g.site.name}")
-        fg.link(href=f"{current_app.config['SERVER_URL']}/c/{actor}", rel="alternate")
-        if og_image:
-            fg.logo(og_image)
-        else:
-            fg.logo(
-                f"{current_app.config['SERVER_URL']}/static/images/apple-touch-icon.png"
-            )
-        if description:
-            fg.subtitle(description)
-        else:
-            fg.subtitle(" ")
-        fg.link(href=f"{current_app.config['SERVER_URL']}/c/{actor}/feed", rel="self")
-        fg.language("en")
+            # only the unfiltered feed is stored
+            body = community_rss(community, score)
+            return artifact_response(body, strong_etag(body), RSS_CONTENT_TYPE)
 
-        for post in posts:
-            fe = fg.add_entry()
-            fe.title(post.title)
-            if post.slug:
-                fe.link(href=f"{current_app.config['SERVER_URL']}{post.slug}")
-            else:
-                fe.link(href=f"{current_app.config['SERVER_URL']}/post/{post.id}")
-            if post.url:
-                type = mimetype_from_url(post.url)
-                if type and not type.startswith("text/"):
-                    fe.enclosure(post.url, type=type)
-            fe.description(post.body_html)
-            fe.guid(post.profile_id(), permalink=True)
-            fe.author(name=post.author.user_name)
-            fe.pubDate(post.created_at.replace(tzinfo=timezone.utc))
-
-        response = make_response(fg.rss_str())
-        response.headers.set("Content-Type", "application/rss+xml")
-        response.headers.add_header(
-            "ETag", f"{community.id}_{hash(community.last_active)}"
-        )
-        response.headers.add_header(
-            "Cache-Control", "no-cache, max-age=600, must-revalidate"
-        )
-        return response
+        return rss_response("community", community)
     else:
         abort(404)
 
@@ -1971,10 +1911,11 @@ def community_delete(community_id: int):
                 community=community,
             )
 
-            # actually delete the community
-            community.delete_dependencies()
-            db.session.delete(community)
+            # actually delete the community. Until that is finished it is hidden by banning it.
+            community.banned = True
             db.session.commit()
+            from app.shared.purge import start_purge
+            start_purge("community", community.id, then="delete_community")
 
             flash(_("Community deleted"))
             return redirect("/communities")
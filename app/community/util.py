@@ -1,33 +1,27 @@
 from __future__ import annotations
 
 from datetime import datetime, timedelta
-from time import sleep
-from random import randint
 from typing import List
 
 import httpx
-from PIL import Image, ImageOps
 from flask import request, abort, g, current_app, json
 from flask_login import current_user
-from pillow_heif import register_heif_opener
 from psycopg2 import IntegrityError
 from flask_babel import _, lazy_gettext as _l
 
 from app import db, cache, celery
 from app.activitypub.signature import post_request, default_context, send_post_request
 from app.activitypub.util import find_actor_or_create, actor_json_to_model, \
-    find_hashtag_or_create, create_post, remote_object_to_json, find_flair
+    find_hashtag_or_create, remote_object_to_json, find_flair
+from app.community.backfill import start_backfill
 from app.community.forms import CreateLinkForm
 from app.constants import SRC_WEB, POST_TYPE_LINK
 from app.models import Community, File, PostReply, Post, utcnow, CommunityMember, Site, \
     Instance, User, Tag, CommunityFlair, CommunityThemeAllowed
-from app.utils import get_request, gibberish, ensure_directory_exists, ap_datetime, instance_banned, get_task_session, \
-    store_files_in_s3, guess_mime_type, patch_db_session, instance_allowed, get_setting, scale_gif, theme_list
+from app.shared.upload import store_image_with_thumbnail
+from app.utils import get_request, gibberish, ap_datetime, instance_banned, get_task_session, patch_db_session, \
+    instance_allowed, get_setting, theme_list
 from sqlalchemy import func, desc, text
-import os
-
-
-allowed_extensions = ['.gif', '.jpg', '.jpeg', '.png', '.webp', '.heic', '.mpo', '.avif', '.svg']
 
 
 def search_for_community(address: str, allow_fetch: bool = True) -> Community | None:
@@ -55,7 +49,6 @@ def search_for_community(address: str, allow_fetch: bool = True) -> Community |
             webfinger_data = get_request(f"https://{server}/.well-known/webfinger",
                                          params={'resource': f"acct:{address[1:]}"})
         except httpx.HTTPError:
-            sleep(randint(3, 10))
             try:
                 webfinger_data = get_request(f"https://{server}/.well-known/webfinger",
                                             params={'resource': f"acct:{address[1:]}"})
@@ -99,19 +92,13 @@ def retrieve_mods_and_backfill(community_id: int, server, name, community_json=N
                     return
                 site = session.query(Site).get(1)
 
-                is_peertube = is_guppe = is_wordpress = False
-                mod = None
-                if community.ap_profile_id == f"https://{server}/video-channels/{name}":
-                    is_peertube = True
-                elif community.ap_profile_id.startswith('https://ovo.st/club'):
-                    is_guppe = True
+                is_peertube = community.ap_profile_id == f"https://{server}/video-channels/{name}"
 
                 # get mods
                 if community.ap_moderators_url:
                     mods_data = remote_object_to_json(community.ap_moderators_url)
                     if mods_data and mods_data['type'] == 'OrderedCollection' and 'orderedItems' in mods_data:
                         for actor in mods_data['orderedItems']:
-                            sleep(0.5)
                             mod = find_actor_or_create(actor)
                             if mod:
                                 existing_membership = session.query(CommunityMember).filter_by(community_id=community.id, user_id=mod.id).first()
@@ -150,151 +137,9 @@ def retrieve_mods_and_backfill(community_id: int, server, name, community_json=N
                 if (community.nsfw and not site.enable_nsfw) or (community.nsfl and not site.enable_nsfl):
                     return
 
-                # download 50 old posts from unpaginated outboxes or 10 posts from page 1 if outbox is paginated (with Celery, or just 2 without)
+                # posts are fetched a page at a time by separate tasks, see app/community/backfill.py
                 if community.ap_outbox_url:
-                    outbox_data = remote_object_to_json(community.ap_outbox_url)
-                    if not outbox_data or ('totalItems' in outbox_data and outbox_data['totalItems'] == 0):
-                        return
-                    if 'first' in outbox_data:
-                        outbox_data = remote_object_to_json(outbox_data['first'])
-                        if not outbox_data:
-                            return
-                        max = 10
-                    else:
-                        max = 50
-                    if current_app.debug:
-                        max = 2
-                    if 'type' in outbox_data and (outbox_data['type'] == 'OrderedCollection' or outbox_data['type'] == 'OrderedCollectionPage') and 'orderedItems' in outbox_data:
-                        activities_processed = 0
-                        for announce in outbox_data['orderedItems']:
-                            activity = None
-                            if is_peertube or is_guppe:
-                                activity = remote_object_to_json(announce['object'])
-                            elif 'object' in announce and 'object' in announce['object']:
-                                activity = announce['object']['object']
-                            elif 'type' in announce and announce['type'] == 'Create':
-                                activity = announce['object']
-                                is_wordpress = True
-                            if not activity:
-                                return
-                            if is_peertube and mod:
-                                user = mod
-                            elif 'attributedTo' in activity and isinstance(activity['attributedTo'], str):
-                                user = find_actor_or_create(activity['attributedTo'])
-                                if not user:
-                                    continue
-                            else:
-                                continue
-                            if user.is_local():
-                                continue
-                            if is_peertube or is_guppe:
-                                request_json = {'id': f"https://{server}/activities/create/{gibberish(15)}", 'object': activity}
-                            elif is_wordpress:
-                                request_json = announce
-                            else:
-                                request_json = announce['object']
-                            try:
-                                post = create_post(True, community, request_json, user, announce['id'])
-                            except Exception as e:
-                                session.rollback()
-                                # Log the error but continue processing other posts
-                                print(f"Error creating post: {e}")
-                                continue
-                            if post:
-                                if 'published' in activity:
-                                    post.posted_at = activity['published']
-                                    post.last_active = activity['published']
-                                    session.commit()
-
-                                    # create post_replies based on activity['replies'], if it exists
-                                    if 'replies' in activity and isinstance(activity['replies'], str):
-                                        replies = remote_object_to_json(activity['replies'])
-                                        if replies and replies['type'] == 'OrderedCollection' and 'orderedItems' in replies:
-                                            for reply_data in replies['orderedItems']:
-                                                # Skip if reply already exists
-                                                if session.query(PostReply).filter_by(ap_id=reply_data['id']).first():
-                                                    continue
-                                                
-                                                # Find the author of the reply
-                                                reply_author = find_actor_or_create(reply_data['attributedTo'])
-                                                if not reply_author:
-                                                    continue
-                                                
-                                                # Extract reply content
-                                                body = body_html = ''
-                                                if 'content' in reply_data:
-                                                    if not (reply_data['content'].startswith('<p>') or reply_data['content'].startswith('<blockquote>')):
-                                                        reply_data['content'] = '<p>' + reply_data['content'] + '</p>'
-                                                    from app.utils import allowlist_html, markdown_to_html, html_to_text
-                                                    body_html = allowlist_html(reply_data['content'])
-                                                    if 'source' in reply_data and isinstance(reply_data['source'], dict) and \
-                                                            'mediaType' in reply_data['source'] and reply_data['source']['mediaType'] == 'text/markdown':
-                                                        body = reply_data['source']['content']
-                                                        body_html = markdown_to_html(body)
-                                                    else:
-                                                        body = html_to_text(body_html)
-                                                
-                                                # Find parent (post or comment this is replying to)
-                                                in_reply_to = None
-                                                if 'inReplyTo' in reply_data:
-                                                    # Check if replying to the post itself
-                                                    if reply_data['inReplyTo'] == post.ap_id:
-                                                        in_reply_to = None  # Direct reply to post
-                                                    else:
-                                                        # Check if replying to another comment
-                                                        parent_comment = session.query(PostReply).filter_by(ap_id=reply_data['inReplyTo']).first()
-                                                        if parent_comment:
-                                                            in_reply_to = parent_comment
-                                                
-                                                # Get language
-                                                language_id = None
-                                                if 'language' in reply_data and isinstance(reply_data['language'], dict):
-                                                    from app.activitypub.util import find_language_or_create
-                                                    language = find_language_or_create(reply_data['language']['identifier'],
-                                                                                     reply_data['language']['name'])
-                                                    language_id = language.id
-                                                
-                                                # Check if distinguished
-                                                distinguished = reply_data.get('distinguished', False)
-                                                answer = reply_data.get('answer', False)
-
-                                                # Create the reply
-                                                try:
-                                                    reply_data['object'] = {'id': reply_data['id']}
-                                                    post_reply = PostReply.new(reply_author, post, in_reply_to, body, body_html,
-                                                                               False, language_id, distinguished, answer, reply_data, session=session)
-                                                    session.add(post_reply)
-                                                    community.post_reply_count += 1
-                                                    session.commit()
-                                                except Exception as e:
-                                                    session.rollback()
-                                                    # Log the error but continue processing other replies
-                                                    print(f"Error creating post reply: {e}")
-                                                    continue
-                            activities_processed += 1
-                            if activities_processed >= max:
-                                break
-                        if community.post_count > 0:
-                            community.last_active = session.query(Post).filter(Post.community_id == community.id).order_by(desc(Post.posted_at)).first().posted_at
-                            session.commit()
-                if community.ap_featured_url:
-                    featured_data = remote_object_to_json(community.ap_featured_url)
-                    if featured_data and 'type' in featured_data and featured_data['type'] == 'OrderedCollection' and 'orderedItems' in featured_data:
-                        for item in featured_data['orderedItems']:
-                            post = session.query(Post).filter_by(ap_id=item['id']).first()
-                            if post:
-                                post.sticky = True
-                                session.commit()
-            session.execute(text("""UPDATE "post"
-                                  SET reply_count = (
-                                      SELECT COUNT(*)
-                                      FROM post_reply
-                                      WHERE post_reply.post_id = post.id
-                                      AND post_reply.deleted = false
-                                  )
-                                  WHERE post.community_id = :community_id;
-                                 """), {'community_id': community.id})
-            session.commit()
+                    start_backfill(community.id, 2 if current_app.debug else current_app.config['BACKFILL_POSTS'])
         except Exception:
             session.rollback()
             raise
@@ -404,6 +249,8 @@ def delete_post_from_community_task(post_id, user_id):
                 user = session.query(User).get(user_id)
                 post = session.query(Post).get(post_id)
                 community = post.community
+                if post.url:
+                    post.calculate_cross_posts(delete_only=True)
                 post.deleted = True
                 post.deleted_by = user.id
                 session.commit()
@@ -521,270 +368,17 @@ def remove_old_file(file_id):
 
 
 def save_icon_file(icon_file, directory='communities') -> File:
-    # check if this is an allowed type of file
-    file_ext = os.path.splitext(icon_file.filename)[1]
-    if file_ext.lower() not in allowed_extensions:
-        abort(400)
-    new_filename = gibberish(15)
-
-    # set up the storage directory
-    if store_files_in_s3():
-        local_directory = 'app/static/tmp'
-    else:
-        local_directory = f'app/static/media/{directory}/{new_filename[0:2]}/{new_filename[2:4]}'
-    ensure_directory_exists(local_directory)
-
-    # save the file
-    s3_directory = f'{directory}/{new_filename[0:2]}/{new_filename[2:4]}'
-    final_place = os.path.join(local_directory, new_filename + file_ext)
-    final_place_thumbnail = os.path.join(local_directory, new_filename + '_thumbnail.webp')
-    icon_file.save(final_place)
-
-    if file_ext.lower() == '.heic':
-        register_heif_opener()
-    elif file_ext.lower() == '.avif':
-        import pillow_avif  # NOQA
-
-    # resize if necessary or if using MEDIA_IMAGE_FORMAT
-    if file_ext.lower() in allowed_extensions:
-        # Process the image based on file type
-        if file_ext.lower() == '.svg':  # svgs don't need to be resized
-            img_width = None
-            img_height = None
-            thumbnail_width = None
-            thumbnail_height = None
-            final_ext = file_ext.lower()
-            thumbnail_ext = file_ext.lower()
-            final_place_thumbnail = final_place
-        elif file_ext.lower() == '.gif':  # handle animated gifs specially
-            Image.MAX_IMAGE_PIXELS = 89478485
-            img = Image.open(final_place)
-            img_width = img.width
-            img_height = img.height
-
-            # Use scale_gif for resizing animated GIFs
-            if img.width > 250 or img.height > 250:
-                scale_gif(final_place, (250, 250))
-                img = Image.open(final_place)
-                img_width = img.width
-                img_height = img.height
-
-            # Create thumbnail
-            final_ext = file_ext.lower()
-            thumbnail_ext = '.gif'
-            final_place_thumbnail = os.path.join(local_directory, new_filename + '_thumbnail.gif')
-            scale_gif(final_place, (40, 40), final_place_thumbnail)
-            img_thumb = Image.open(final_place_thumbnail)
-            thumbnail_width = img_thumb.width
-            thumbnail_height = img_thumb.height
-        else:  # handle regular images (jpg, png, webp, heic, etc.)
-            Image.MAX_IMAGE_PIXELS = 89478485
-            img = Image.open(final_place)
-            img = ImageOps.exif_transpose(img)
-            img_width = img.width
-            img_height = img.height
-
-            image_format = current_app.config['MEDIA_IMAGE_FORMAT']
-            image_quality = current_app.config['MEDIA_IMAGE_QUALITY']
-            thumbnail_image_format = current_app.config['MEDIA_IMAGE_THUMBNAIL_FORMAT']
-            thumbnail_image_quality = current_app.config['MEDIA_IMAGE_THUMBNAIL_QUALITY']
-
-            final_ext = file_ext.lower()
-            thumbnail_ext = file_ext.lower()
-
-            if image_format == 'AVIF' or thumbnail_image_format == 'AVIF':
-                import pillow_avif  # NOQA
-
-            if img.width > 250 or img.height > 250 or image_format or thumbnail_image_format:
-                img = img.convert('RGB' if (image_format == 'JPEG' or final_ext in ['.jpg', '.jpeg']) else 'RGBA')
-                img.thumbnail((250, 250), resample=Image.LANCZOS)
-
-                kwargs = {}
-                if image_format:
-                    kwargs['format'] = image_format.upper()
-                    final_ext = '.' + image_format.lower()
-                    final_place = os.path.splitext(final_place)[0] + final_ext
-                if image_quality:
-                    kwargs['quality'] = int(image_quality)
-                img.save(final_place, optimize=True, **kwargs)
-
-                img_width = img.width
-                img_height = img.height
-            # save a second, smaller, version as a thumbnail
-            img = img.convert('RGB' if thumbnail_image_format == 'JPEG' else 'RGBA')
-            img.thumbnail((40, 40), resample=Image.LANCZOS)
-
-            kwargs = {}
-            if thumbnail_image_format:
-                kwargs['format'] = thumbnail_image_format.upper()
-                thumbnail_ext = '.' + thumbnail_image_format.lower()
-                final_place_thumbnail = os.path.splitext(final_place_thumbnail)[0] + thumbnail_ext
-            if thumbnail_image_quality:
-                kwargs['quality'] = int(thumbnail_image_quality)
-            img.save(final_place_thumbnail, optimize=True, **kwargs)
-
-            thumbnail_width = img.width
-            thumbnail_height = img.height
-
-        # Create the File object
-        file = File(file_path=final_place, file_name=new_filename + final_ext, alt_text=f'{directory} icon',
-                    width=img_width, height=img_height, thumbnail_width=thumbnail_width,
-                    thumbnail_height=thumbnail_height, thumbnail_path=final_place_thumbnail)
-        db.session.add(file)
-
-        # Move uploaded files to S3 if needed
-        if store_files_in_s3():
-            import boto3
-            session = boto3.session.Session()
-            s3 = session.client(
-                service_name='s3',
-                region_name=current_app.config['S3_REGION'],
-                endpoint_url=current_app.config['S3_ENDPOINT'],
-                aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
-                aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
-            )
-            # Upload main image
-            s3_path = f'{s3_directory}/{new_filename}{final_ext}'
-            extra_args = {'ContentType': guess_mime_type(final_place)}
-            if current_app.config.get('S3_STORAGE_CLASS'):
-                extra_args['StorageClass'] = current_app.config['S3_STORAGE_CLASS']
-            s3.upload_file(final_place, current_app.config['S3_BUCKET'], s3_path, ExtraArgs=extra_args)
-            file.file_path = f"https://{current_app.config['S3_PUBLIC_URL']}/{s3_path}"
-
-            # Upload thumbnail (if different from main image)
-            if final_place_thumbnail != final_place:
-                s3_thumbnail_path = f'{s3_directory}/{new_filename}_thumbnail{thumbnail_ext}'
-                extra_args = {'ContentType': guess_mime_type(final_place_thumbnail)}
-                if current_app.config.get('S3_STORAGE_CLASS'):
-                    extra_args['StorageClass'] = current_app.config['S3_STORAGE_CLASS']
-                s3.upload_file(final_place_thumbnail, current_app.config['S3_BUCKET'], s3_thumbnail_path, ExtraArgs=extra_args)
-                file.thumbnail_path = f"https://{current_app.config['S3_PUBLIC_URL']}/{s3_thumbnail_path}"
-                os.unlink(final_place_thumbnail)
-            else:
-                file.thumbnail_path = file.file_path
-
-            s3.close()
-            os.unlink(final_place)
-
-        return file
-    else:
+    # stored as it is, then resized by the media lane - see app/shared/upload.py
+    try:
+        return store_image_with_thumbnail(icon_file, directory, f'{directory} icon', (250, 250), (40, 40))
+    except Exception:
         abort(400)
 
 
 def save_banner_file(banner_file, directory='communities') -> File:
-    # check if this is an allowed type of file
-    file_ext = os.path.splitext(banner_file.filename)[1]
-    if file_ext.lower() not in allowed_extensions:
-        abort(400)
-    new_filename = gibberish(15)
-
-    # set up the storage directory
-    if store_files_in_s3():
-        local_directory = 'app/static/tmp'
-    else:
-        local_directory = f'app/static/media/{directory}/{new_filename[0:2]}/{new_filename[2:4]}'
-    ensure_directory_exists(local_directory)
-
-    # save the file or if using MEDIA_IMAGE_FORMAT
-    s3_directory = f'{directory}/{new_filename[0:2]}/{new_filename[2:4]}'
-    final_place = os.path.join(local_directory, new_filename + file_ext)
-    final_place_thumbnail = os.path.join(local_directory, new_filename + '_thumbnail.webp')
-    banner_file.save(final_place)
-
-    if file_ext.lower() == '.heic':
-        register_heif_opener()
-    elif file_ext.lower() == '.avif':
-        import pillow_avif  # NOQA
-
-    # resize if necessary
-    Image.MAX_IMAGE_PIXELS = 89478485
-    img = Image.open(final_place)
-    if '.' + img.format.lower() in allowed_extensions:
-        img = ImageOps.exif_transpose(img)
-
-        image_format = current_app.config['MEDIA_IMAGE_FORMAT']
-        image_quality = current_app.config['MEDIA_IMAGE_QUALITY']
-        thumbnail_image_format = current_app.config['MEDIA_IMAGE_THUMBNAIL_FORMAT']
-        thumbnail_image_quality = current_app.config['MEDIA_IMAGE_THUMBNAIL_QUALITY']
-
-        final_ext = file_ext.lower()
-        thumbnail_ext = file_ext.lower()
-        img_width = img.width
-        img_height = img.height
-
-        if image_format == 'AVIF' or thumbnail_image_format == 'AVIF':
-            import pillow_avif  # NOQA
-
-        if img.width > 1600 or img.height > 600 or image_format or thumbnail_image_format:
-            img = img.convert('RGB' if (image_format == 'JPEG' or final_ext in ['.jpg', '.jpeg']) else 'RGBA')
-            img.thumbnail((1600, 600), resample=Image.LANCZOS)
-
-            kwargs = {}
-            if image_format:
-                kwargs['format'] = image_format.upper()
-                final_ext = '.' + image_format.lower()
-                final_place = os.path.splitext(final_place)[0] + final_ext
-            if image_quality:
-                kwargs['quality'] = int(image_quality)
-            img.save(final_place, optimize=True, **kwargs)
-
-            img_width = img.width
-            img_height = img.height
-
-        # save a second, smaller, version as a thumbnail
-        img = img.convert('RGB' if thumbnail_image_format == 'JPEG' else 'RGBA')
-        img.thumbnail((878, 500), resample=Image.LANCZOS)
-
-        kwargs = {}
-        if thumbnail_image_format:
-            kwargs['format'] = thumbnail_image_format.upper()
-            thumbnail_ext = '.' + thumbnail_image_format.lower()
-            final_place_thumbnail = os.path.splitext(final_place_thumbnail)[0] + thumbnail_ext
-        if thumbnail_image_quality:
-            kwargs['quality'] = int(thumbnail_image_quality)
-        img.save(final_place_thumbnail, optimize=True, **kwargs)
-
-        thumbnail_width = img.width
-        thumbnail_height = img.height
-
-        file = File(file_path=final_place, file_name=new_filename + final_ext, alt_text=f'{directory} banner',
-                    width=img_width, height=img_height, thumbnail_path=final_place_thumbnail,
-                    thumbnail_width=thumbnail_width, thumbnail_height=thumbnail_height)
-        db.session.add(file)
-        
-        # Move uploaded files to S3 if needed
-        if store_files_in_s3():
-            import boto3
-            session = boto3.session.Session()
-            s3 = session.client(
-                service_name='s3',
-                region_name=current_app.config['S3_REGION'],
-                endpoint_url=current_app.config['S3_ENDPOINT'],
-                aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
-                aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
-            )
-            # Upload main image
-            s3_path = f'{s3_directory}/{new_filename}{final_ext}'
-            extra_args = {'ContentType': guess_mime_type(final_place)}
-            if current_app.config.get('S3_STORAGE_CLASS'):
-                extra_args['StorageClass'] = current_app.config['S3_STORAGE_CLASS']
-            s3.upload_file(final_place, current_app.config['S3_BUCKET'], s3_path, ExtraArgs=extra_args)
-            file.file_path = f"https://{current_app.config['S3_PUBLIC_URL']}/{s3_path}"
-            
-            # Upload thumbnail
-            s3_thumbnail_path = f'{s3_directory}/{new_filename}_thumbnail{thumbnail_ext}'
-            extra_args = {'ContentType': guess_mime_type(final_place_thumbnail)}
-            if current_app.config.get('S3_STORAGE_CLASS'):
-                extra_args['StorageClass'] = current_app.config['S3_STORAGE_CLASS']
-            s3.upload_file(final_place_thumbnail, current_app.config['S3_BUCKET'], s3_thumbnail_path, ExtraArgs=extra_args)
-            file.thumbnail_path = f"https://{current_app.config['S3_PUBLIC_URL']}/{s3_thumbnail_path}"
-            
-            s3.close()
-            os.unlink(final_place)
-            os.unlink(final_place_thumbnail)
-            
-        return file
-    else:
+    try:
+        return store_image_with_thumbnail(banner_file, directory, f'{directory} banner', (1600, 600), (878, 500))
+    except Exception:
         abort(400)
 
 
@@ -867,38 +461,13 @@ def find_potential_moderators(search: str) -> List[User]:
 
 
 def hashtags_used_in_community(community_id: int, content_filters):
-    tags = db.session.execute(text("""SELECT t.*, COUNT(post.id) AS pc
-    FROM "tag" AS t
-    INNER JOIN post_tag pt ON t.id = pt.tag_id
-    INNER JOIN "post" ON pt.post_id = post.id
-    WHERE post.community_id = :community_id
-      AND t.banned IS FALSE AND post.deleted IS FALSE
-    GROUP BY t.id
-    ORDER BY pc DESC
-    LIMIT 30;"""), {'community_id': community_id}).mappings().all()
-
-    def tag_blocked(tag):
-        for name, keywords in content_filters.items() if content_filters else {}:
-            for keyword in keywords:
-                if keyword in tag['name'].lower():
-                    return True
-        return False
-
-    return normalize_font_size([dict(row) for row in tags if not tag_blocked(row)])
+    return hashtags_used_in_communities([community_id], content_filters)
 
 
 def hashtags_used_in_communities(community_ids: List[int], content_filters):
     if community_ids is None or len(list(community_ids)) == 0:
         return None
-    tags = db.session.execute(text("""SELECT t.*, COUNT(post.id) AS pc
-    FROM "tag" AS t
-    INNER JOIN post_tag pt ON t.id = pt.tag_id
-    INNER JOIN "post" ON pt.post_id = post.id
-    WHERE post.community_id IN :community_ids
-      AND t.banned IS FALSE AND post.deleted IS FALSE
-    GROUP BY t.id
-    ORDER BY pc DESC
-    LIMIT 30;"""), {'community_ids': tuple(community_ids)}).mappings().all()
+    tags = top_tags_in_communities(tuple(sorted(set(community_ids))))
 
     def tag_blocked(tag):
         for name, keywords in content_filters.items() if content_filters else {}:
@@ -910,6 +479,19 @@ def hashtags_used_in_communities(community_ids: List[int], content_filters):
     return normalize_font_size([dict(row) for row in tags if not tag_blocked(row)])
 
 
+@cache.memoize(timeout=300)
+def top_tags_in_communities(community_ids: tuple) -> List[dict]:
+    # from the post counts kept in community_tag by triggers on post_tag and post, rather than counting the posts
+    return [dict(row) for row in db.session.execute(text("""SELECT t.*, CAST(SUM(ct.post_count) AS INTEGER) AS pc
+    FROM "community_tag" AS ct
+    INNER JOIN "tag" AS t ON t.id = ct.tag_id
+    WHERE ct.community_id IN :community_ids
+      AND ct.post_count > 0 AND t.banned IS FALSE
+    GROUP BY t.id
+    ORDER BY pc DESC
+    LIMIT 30;"""), {'community_ids': community_ids}).mappings()]
+
+
 def normalize_font_size(tags: List[dict], min_size=12, max_size=24):
     # Add a font size to each dict, based on the number of times each tag is used (the post count aka 'pc')
     if len(tags) == 0:
@@ -39,6 +39,17 @@ REPORT_STATE_APPEALED = 2
 REPORT_STATE_RESOLVED = 3
 REPORT_STATE_DISCARDED = -1
 
+# uploads are stored as they are, then resized and converted by the media lane - see app/shared/upload.py
+FILE_STATE_FAILED = -1
+FILE_STATE_READY = 0
+FILE_STATE_PENDING = 1
+
+FILE_STATE_NAMES = {
+    FILE_STATE_FAILED: "failed",
+    FILE_STATE_READY: "ready",
+    FILE_STATE_PENDING: "pending",
+}
+
 # different types of content notification that people can have. e.g. when a new post is made by a user or in a community.
 # see NotificationSubscription in models.py
 
@@ -1,16 +1,14 @@
 # ----- imports -----
 from collections import namedtuple
-from datetime import timezone
 from random import randint
 from typing import List
 
-from feedgen.feed import FeedGenerator
 from flask import g, current_app, request, redirect, url_for, flash, abort, make_response
 from markupsafe import Markup
 from flask_babel import _
 from flask_login import current_user
 from slugify import slugify
-from sqlalchemy import desc, or_
+from sqlalchemy import desc, or_, text
 
 from app import db, cache, celery
 from app.activitypub.signature import RsaKeys, default_context, send_post_request
@@ -26,14 +24,15 @@ from app.models import Feed, FeedMember, FeedItem, Community, NotificationSubscr
     CommunityMember, User, FeedJoinRequest, Instance, Topic, CommunityJoinRequest
 from app.shared.feed import join_feed, _feed_add_community, announce_feed_delete_to_subscribers, edit_feed, \
     form_communities_to_ids, make_feed, delete_feed
+from app.shared.syndication import rss_response
 from app.utils import show_ban_message, piefed_markdown_to_lemmy_markdown, markdown_to_html, render_template, \
     user_filters_posts, joined_communities, menu_instance_feeds, validation_required, feed_membership, \
     gibberish, get_task_session, instance_banned, menu_subscribed_feeds, referrer, community_membership, \
     paginate_post_ids, get_deduped_post_ids, get_request, post_ids_to_models, recently_upvoted_posts, \
     recently_downvoted_posts, joined_or_modding_communities, login_required_if_private_instance, \
     communities_banned_from, reported_posts, user_notes, login_required, moderating_communities_ids, approval_required, \
-    blocked_or_banned_instances, blocked_communities, block_honey_pot, user_pronouns, mimetype_from_url, \
-    community_membership_private
+    blocked_or_banned_instances, blocked_communities, block_honey_pot, user_pronouns, \
+    community_membership_private, feed_community_ids
 
 
 @bp.route('/feed/new', methods=['GET', 'POST'])
@@ -465,29 +464,19 @@ def show_feed(feed):
     current_feed = feed
 
     if current_feed:
-        # get the feed_ids
-        if current_feed.show_posts_in_children:  # include posts from child feeds
-            feed_ids = get_all_child_feed_ids(current_feed)
-        else:
-            feed_ids = [current_feed.id]
-
-        # for each feed get the community ids (FeedItem) in the feed
-        # used for the posts searching
-        feed_community_ids = []
-        for fid in feed_ids:
-            feed_items = FeedItem.query.join(Feed, FeedItem.feed_id == fid).\
-                join(Community, Community.id == FeedItem.community_id).\
-                filter(or_(Community.private == False, Community.id.in_(community_membership_private(current_user.get_id())))).all()
-            for item in feed_items:
-                feed_community_ids.append(item.community_id)
-
-        post_ids = get_deduped_post_ids(result_id, feed_community_ids, sort, tag)
+        # the communities in the feed, and in child feeds if show_posts_in_children, used for the posts searching
+        private_communities = community_membership_private(current_user.get_id())
+        community_ids = [community_id for community_id, private
+                         in feed_community_ids(current_feed.id, current_feed.show_posts_in_children).items()
+                         if not private or community_id in private_communities]
+
+        post_ids = get_deduped_post_ids(result_id, community_ids, sort, tag)
         has_next_page = len(post_ids) > page + 1 * page_length
         post_ids = paginate_post_ids(post_ids, page, page_length=page_length)
         posts = post_ids_to_models(post_ids, sort)
 
         feed_communities = Community.query.filter(
-            Community.id.in_(feed_community_ids), Community.banned == False, Community.total_subscriptions_count > 0).\
+            Community.id.in_(community_ids), Community.banned == False, Community.total_subscriptions_count > 0).\
             filter(Community.instance_id.not_in(blocked_or_banned_instances(current_user.get_id()))).\
             filter(Community.id.not_in(blocked_communities(current_user.get_id()))). \
             filter(or_(Community.private == False, Community.id.in_(community_membership_private(current_user.get_id())))). \
@@ -519,7 +508,7 @@ def show_feed(feed):
                                              sort=sort, owner=owner,
                                              page=page, post_layout=post_layout, next_url=next_url, prev_url=prev_url,
                                              feed_communities=feed_communities, content_filters=user_filters_posts(current_user.id) if current_user.is_authenticated else {},
-                                             tags=hashtags_used_in_communities(feed_community_ids, content_filters),
+                                             tags=hashtags_used_in_communities(community_ids, content_filters),
                                              sub_feeds=sub_feeds, feed_path=feed.path(), breadcrumbs=breadcrumbs,
                                              rss_feed=f"{current_app.config['SERVER_URL']}/f/{feed.path()}.rss",
                                              rss_feed_name=f"{current_feed.name} on {g.site.name}",
@@ -548,11 +537,9 @@ def show_feed(feed):
 
 
 def get_all_child_feed_ids(feed: Feed) -> List[int]:
-    # recurse down the feed tree, gathering all the feed IDs found
-    feed_ids = [feed.id]
-    for child_feed in Feed.query.filter(Feed.parent_feed_id == feed.id):
-        feed_ids.extend(get_all_child_feed_ids(child_feed))
-    return feed_ids
+    # the feed and every feed below it
+    return list(db.session.execute(text('SELECT descendant_id FROM "feed_closure" WHERE ancestor_id = :feed_id'),
+                                   {'feed_id': feed.id}).scalars()) or [feed.id]
 
 
 @bp.route('/f/<feed_name>/submit', methods=['GET', 'POST'])
@@ -727,52 +714,6 @@ def show_feed_rss(feed_path):
     feed = Feed.query.filter(Feed.machine_name == last_feed_machine_name.strip().lower()).first()
 
     if feed:
-        # Get the feed_ids
-        if feed.show_posts_in_children:  # include posts from child feeds
-            feed_ids = get_all_child_feed_ids(feed)
-        else:
-            feed_ids = [feed.id]
-
-        # For each feed get the community ids (FeedItem) in the feed
-        feed_community_ids = []
-        for fid in feed_ids:
-            feed_items = FeedItem.query.join(Feed, FeedItem.feed_id == fid).all()
-            for item in feed_items:
-                feed_community_ids.append(item.community_id)
-
-        post_ids = get_deduped_post_ids('', feed_community_ids, 'new')
-        post_ids = paginate_post_ids(post_ids, 0, page_length=100)
-        posts = post_ids_to_models(post_ids, 'new')
-
-        fg = FeedGenerator()
-        fg.id(f"{current_app.config['SERVER_URL']}/f/{last_feed_machine_name}")
-        fg.title(f'{feed.title} on {g.site.name}')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/f/{last_feed_machine_name}", rel='alternate')
-        fg.logo(f"{current_app.config['SERVER_URL']}/static/images/apple-touch-icon.png")
-        fg.subtitle(' ')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/f/{last_feed_machine_name}.rss", rel='self')
-        fg.language('en')
-
-        for post in posts:
-            fe = fg.add_entry()
-            fe.title(post.title)
-            if post.slug:
-                fe.link(href=f"{current_app.config['SERVER_URL']}{post.slug}")
-            else:
-                fe.link(href=f"{current_app.config['SERVER_URL']}/post/{post.id}")
-            if post.url:
-                type = mimetype_from_url(post.url)
-                if type and not type.startswith('text/'):
-                    fe.enclosure(post.url, type=type)
-            fe.description(post.body_html)
-            fe.guid(post.profile_id(), permalink=True)
-            fe.author(name=post.author.user_name)
-            fe.pubDate(post.created_at.replace(tzinfo=timezone.utc))
-
-        response = make_response(fg.rss_str())
-        response.headers.set('Content-Type', 'application/rss+xml')
-        response.headers.add_header('ETag', f"{feed.id}_{hash(g.site.last_active)}")
-        response.headers.add_header('Cache-Control', 'no-cache, max-age=600, must-revalidate')
-        return response
+        return rss_response('feed', feed)
     else:
         abort(404)
@@ -13,7 +13,7 @@ from ua_parser import parse as uaparse
 from app import db, cache, limiter
 from app.activitypub.util import users_total, active_month, local_posts, local_communities, \
     lemmy_site_data, is_activitypub_request
-from app.activitypub.signature import default_context, LDSignature, HttpSignature
+from app.activitypub.signature import default_context, LDSignature
 from app.admin.util import topics_for_form
 from app.api.alpha.utils.misc import get_resolve_object
 from app.constants import SUBSCRIPTION_PENDING, SUBSCRIPTION_MEMBER, SUBSCRIPTION_OWNER, SUBSCRIPTION_MODERATOR, \
@@ -30,7 +30,8 @@ from app.main.forms import ShareLinkForm
 from app.main.util import sidebar_active_communities, sidebar_new_instances, sidebar_upcoming_events, \
     sidebar_new_communities, _base_list_communities_context
 from app.post.routes import show_post
-from app.translation import LibreTranslateAPI
+from app.translation import translator
+from app.shared.syndication import sitemap_response
 from app.utils import render_template, get_setting, request_etag_matches, return_304, blocked_domains, \
     ap_datetime, shorten_string, user_filters_home, \
     joined_communities, moderating_communities, markdown_to_html, \
@@ -553,15 +554,13 @@ def security():
 
 
 @bp.route('/sitemap.xml')
-@cache.cached(timeout=6000)
 def sitemap():
-    posts = Post.query.filter(Post.from_bot == False, Post.deleted == False, Post.status > POST_STATUS_REVIEWING,
-                              Post.instance_id == 1, Post.indexable == True)
-    posts = posts.order_by(desc(Post.posted_at)).limit(500)
+    return sitemap_response()
 
-    resp = make_response(render_template('sitemap.xml', posts=posts, current_app=current_app))
-    resp.mimetype = 'text/xml'
-    return resp
+
+@bp.route('/sitemap-<int:shard>.xml')
+def sitemap_shard(shard):
+    return sitemap_response(shard)
 
 
 @bp.route('/rsl.xml')
@@ -655,7 +654,6 @@ def test():
     #db.session.commit()
     return markdown_to_html('Testing!\n\n![an image :: width=50](https://piefed.social/static/media/logo_8p7en.svg, https://media.piefed.social/posts/up/TR/upTRjfvFt2ma0hz.webp)\n\nthere we go')
 
-    from flask import json
     community = Community.query.get(33)
     announce_activity = {
         'actor': community.ap_profile_id,
@@ -669,17 +667,10 @@ def test():
         'type': 'Announce',
     }
 
-    send_async = []
-    send_async.append(HttpSignature.signed_request('https://piefed.ngrok.app/inbox', announce_activity,
-                                                   community.private_key,
-                                                   community.profile_id() + '#main-key',
-                                                   send_via_async=True))
-
-    from app import redis_client
-    # send announce_activity via redis pub/sub to piefed_notifs service
-    redis_client.publish("http_posts:activity", json.dumps({'urls': [url[0] for url in send_async],
-                                                            'headers': [url[1] for url in send_async],
-                                                            'data': send_async[0][2].decode('utf-8')}))
+    from app.shared.delivery import send_async
+    # send announce_activity via the piefed_notifs service
+    send_async(['https://piefed.ngrok.app/inbox'], announce_activity, community.private_key,
+               community.profile_id() + '#main-key')
 
     return 'Done'
     import json
@@ -956,8 +947,7 @@ def test_ldap_login():
 @bp.route('/test_libretranslate')
 @debug_mode_only
 def test_libretranslate():
-    lt = LibreTranslateAPI(current_app.config['TRANSLATE_ENDPOINT'], api_key=current_app.config['TRANSLATE_KEY'])
-    return lt.translate('<p>Si vous lisez cela en anglais, alors la traduction a fonctionné!</p>', source='auto', target='en')
+    return translator().translate('<p>Si vous lisez cela en anglais, alors la traduction a fonctionné!</p>', source='auto', target='en')
 
 
 @bp.route('/find_voters')
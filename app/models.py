@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import hashlib
 import html
 import math
 import os
@@ -22,11 +23,12 @@ from flask_login import UserMixin, current_user
 from flask_sqlalchemy.query import Query
 from furl import furl
 from slugify import slugify
-from sqlalchemy import or_, text, desc, Index, func
+from sqlalchemy import or_, text, desc, Index, func, event, inspect
 from sqlalchemy.dialects.postgresql import ARRAY, UUID
 from sqlalchemy.dialects.postgresql import BIT
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.mutable import MutableList
+from sqlalchemy.orm import Session, object_session
 from sqlalchemy_searchable import SearchQueryMixin
 from sqlalchemy_utils.types import (
     TSVectorType,
@@ -58,6 +60,7 @@ from app.constants import (
     INVITE_MEMBERS_ONLY,
     INVITE_MODS_ONLY,
     INVITE_OWNER_ONLY,
+    FILE_STATE_READY,
 )
 
 
@@ -134,6 +137,7 @@ class Instance(db.Model):
     popular = db.Column(
         db.Boolean, default=True
     )  # New communities from here have their popular flag set
+    last_health_check = db.Column(db.DateTime)  # When nodeinfo was last probed by monitor_healthy_instances
 
     __table_args__ = (
         Index(
@@ -385,6 +389,18 @@ class Tag(db.Model):
     banned = db.Column(db.Boolean, default=False, index=True)
 
 
+class CommunityTag(db.Model):
+    # How many posts in a community (that aren't deleted) have a tag. Kept up to date by triggers on post_tag and post,
+    # see migration 7c2d5e9a41b3, and corrected by update_hashtag_counts() every night.
+    community_id = db.Column(db.Integer, db.ForeignKey("community.id"), primary_key=True)
+    tag_id = db.Column(db.Integer, db.ForeignKey("tag.id"), primary_key=True)
+    post_count = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.Index("ix_community_tag_community_count", "community_id", "post_count"),
+    )
+
+
 class Licence(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50))
@@ -451,11 +467,12 @@ class File(db.Model):
     width = db.Column(db.Integer)
     height = db.Column(db.Integer)
     alt_text = db.Column(db.String(1500))
-    source_url = db.Column(db.String(1024))
+    source_url = db.Column(db.String(1024), index=True)
     thumbnail_path = db.Column(db.String(255))
     thumbnail_width = db.Column(db.Integer)
     thumbnail_height = db.Column(db.Integer)
     hash = db.Column(BIT(256), index=True)
+    state = db.Column(db.SmallInteger, default=FILE_STATE_READY, server_default="0")   # FILE_STATE_* in constants.py
 
     def view_url(self, resize=False):
         if self.source_url:
@@ -1112,15 +1129,9 @@ class Community(db.Model):
         return result
 
     def delete_dependencies(self):
-        from app import redis_client
+        from app.shared.purge import purge_now
 
-        for post in db.session.query(Post).filter_by(community_id=self.id):
-            with redis_client.lock(
-                f"lock:post:{post.id}", timeout=10, blocking_timeout=6
-            ):
-                post.delete_dependencies()
-                db.session.delete(post)
-                db.session.commit()
+        purge_now("community", self.id)  # all the posts and comments, a batch at a time
         db.session.query(FeedItem).filter(FeedItem.community_id == self.id).delete()
         db.session.query(CommunityBan).filter(
             CommunityBan.community_id == self.id
@@ -1145,6 +1156,7 @@ class Community(db.Model):
         db.session.query(CommunityThemeAllowed).filter(
             CommunityThemeAllowed.community_id == self.id
         ).delete()
+        db.session.query(CommunityTag).filter(CommunityTag.community_id == self.id).delete()
         db.session.commit()
 
 
@@ -1743,20 +1755,24 @@ class User(UserMixin, db.Model):
         return post_votes + post_reply_votes
 
     def recalculate_post_stats(self, posts=True, replies=True):
+        from app.shared import counters
+
+        totals = {}
         if posts:
-            self.post_count = db.session.execute(
+            totals["post_count"] = db.session.execute(
                 text(
                     'SELECT COUNT(*) as c FROM "post" WHERE user_id = :user_id AND deleted = false'
                 ),
                 {"user_id": self.id},
             ).scalar()
         if replies:
-            self.post_reply_count = db.session.execute(
+            totals["post_reply_count"] = db.session.execute(
                 text(
                     'SELECT COUNT(*) as c FROM "post_reply" WHERE user_id = :user_id AND deleted = false'
                 ),
                 {"user_id": self.id},
             ).scalar()
+        counters.apply_totals(self, **totals)
 
     def subscribed(self, community_id: int) -> int:
         if community_id is None:
@@ -1840,6 +1856,7 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
     def delete_dependencies(self):
+        from app.shared import api_context
         if self.cover_id:
             file = db.session.query(File).get(self.cover_id)
             file.delete_from_disk()
@@ -1862,6 +1879,7 @@ class User(UserMixin, db.Model):
             text('DELETE FROM "post_reply_vote" WHERE user_id = :user_id'),
             {"user_id": self.id},
         )
+        api_context.changed(db.session, self.id)
         db.session.execute(
             text('DELETE FROM "user_role" WHERE user_id = :user_id'),
             {"user_id": self.id},
@@ -1927,39 +1945,10 @@ class User(UserMixin, db.Model):
         ).delete()
 
     def purge_content(self, soft=True, flush=True):
-        files = File.query.join(Post).filter(Post.user_id == self.id).all()
-        for file in files:
-            file.delete_from_disk(purge_cdn=flush)
-        db.session.commit()
-        self.delete_dependencies()
-        db.session.commit()
-        posts = Post.query.filter_by(user_id=self.id).all()
-        for post in posts:
-            post.delete_dependencies()
-            if soft:
-                post.deleted = True
-            else:
-                db.session.delete(post)
-            db.session.commit()
-
-        post_replies = PostReply.query.filter_by(user_id=self.id).all()
-        for reply in post_replies:
-            reply.delete_dependencies()
-            if soft:
-                reply.deleted = True
-            else:
-                db.session.delete(reply)
-            db.session.commit()
+        from app.shared.purge import purge_now
 
-        files = File.query.join(user_file).filter(user_file.c.user_id == self.id).all()
-        for file in files:
-            file.delete_from_disk(purge_cdn=flush)
-            db.session.execute(
-                text('DELETE FROM "user_file" WHERE file_id = :file_id'),
-                {"file_id": file.id},
-            )
-            db.session.delete(file)
-            db.session.commit()
+        # comments, then posts, then uploaded files - a batch at a time. See app/shared/purge.py
+        purge_now("user", self.id, soft=soft, purge_cdn=flush)
 
     def mention_tag(self):
         if self.ap_domain is None:
@@ -2074,7 +2063,6 @@ class Post(db.Model):
     mea_culpa = db.Column(db.Boolean, default=False)
     has_embed = db.Column(db.Boolean, default=False)
     reply_count = db.Column(db.Integer, default=0, index=True)
-    reply_count_cross_posted = db.Column(db.Integer, default=0)
     score = db.Column(db.Integer, default=0, index=True)  # used for 'top' ranking
     nsfw = db.Column(db.Boolean, default=False, index=True)
     nsfl = db.Column(db.Boolean, default=False, index=True)
@@ -2103,7 +2091,9 @@ class Post(db.Model):
         db.Integer, default=0
     )  # how many times this post has been reported. Set to -1 to ignore reports
     language_id = db.Column(db.Integer, db.ForeignKey("language.id"), index=True)
-    cross_posts = db.Column(MutableList.as_mutable(ARRAY(db.Integer)))
+    cross_post_group_id = db.Column(
+        db.Integer, db.ForeignKey("cross_post_group.id"), index=True
+    )  # posts that link to the same url are in the same group, see calculate_cross_posts()
     scheduled_for = db.Column(
         db.DateTime, index=True
     )  # The first (or only) occurrence of this post
@@ -2148,6 +2138,9 @@ class Post(db.Model):
         File, lazy="joined", foreign_keys=[image_id], cascade="all, delete"
     )
     domain = db.relationship("Domain", lazy="joined", foreign_keys=[domain_id])
+    cross_post_group = db.relationship(
+        "CrossPostGroup", lazy="joined", foreign_keys=[cross_post_group_id]
+    )
     author = db.relationship(
         "User", lazy="joined", overlaps="posts", foreign_keys=[user_id]
     )
@@ -2294,6 +2287,7 @@ class Post(db.Model):
             notify_about_post,
             find_flair_or_create,
         )
+        from app.shared import counters
         from app.utils import (
             allowlist_html,
             markdown_to_html,
@@ -2699,12 +2693,8 @@ class Post(db.Model):
             db.session.add(post)
             post.ranking = post.post_ranking(post.score, post.posted_at)
             post.ranking_scaled = int(post.ranking + community.scale_by())
-            community.post_count += 1
-            community.last_active = utcnow()
             db.session.execute(
-                text(
-                    'UPDATE "user" SET post_count = post_count + 1, last_seen = now() WHERE id = :user_id'
-                ),
+                text('UPDATE "user" SET last_seen = now() WHERE id = :user_id'),
                 {"user_id": user.id},
             )
             db.session.execute(text('UPDATE "site" SET last_active = NOW()'))
@@ -2713,6 +2703,9 @@ class Post(db.Model):
             except IntegrityError:
                 db.session.rollback()
                 return Post.query.filter_by(ap_id=request_json["object"]["id"]).one()
+            counters.apply(community, post_count=1)
+            counters.touch(Community, community.id)
+            counters.increment(User, user.id, post_count=1)
 
             # Mentions also need a post_id
             if "tag" in request_json["object"] and isinstance(
@@ -2941,60 +2934,79 @@ class Post(db.Model):
 
         return post
 
-    def calculate_cross_posts(self, delete_only=False, url_changed=False):
-        if not self.url and not delete_only:
-            return
-
-        if self.cross_posts and (url_changed or delete_only):
-            old_cross_posts = (
-                db.session.query(Post)
-                .filter(
-                    Post.id.in_(self.cross_posts), Post.status == POST_STATUS_PUBLISHED
-                )
-                .all()
+    @property
+    def cross_posts(self) -> list:
+        """ids of the most recent other posts that link to the same url"""
+        if not self.cross_post_count:
+            return []
+        return [
+            post_id
+            for post_id, in db.session.query(Post.id)
+            .filter(
+                Post.cross_post_group_id == self.cross_post_group_id,
+                Post.id != self.id,
+                Post.deleted == False,
+                Post.status > POST_STATUS_REVIEWING,
             )
-            self.cross_posts.clear()
-            for ocp in old_cross_posts:
-                if ocp.cross_posts and self.id in ocp.cross_posts:
-                    ocp.cross_posts.remove(self.id)
+            .order_by(desc(Post.id))
+            .limit(CROSS_POST_LIMIT)
+        ]
 
+    @property
+    def cross_post_count(self) -> int:
+        if self.cross_post_group is None:
+            return 0
+        return max(self.cross_post_group.post_count - 1, 0)
+
+    @property
+    def reply_count_cross_posted(self) -> int:
+        """Replies on this post and all its cross posts, or 0 if it has none"""
+        if not self.cross_post_count:
+            return 0
+        return self.cross_post_group.reply_count
+
+    def count_replies(self, delta: int):
+        """Add to the reply count of this post and of its cross post group, after the reply has been committed"""
+        from app.shared import counters
+        counters.apply(self, reply_count=delta)
+        if self.cross_post_group_id is not None:
+            counters.increment(CrossPostGroup, self.cross_post_group_id, reply_count=delta)
+
+    def calculate_cross_posts(self, delete_only=False, url_changed=False):
+        """Put this post in the cross post group of its url (taking it out of the old one if the url changed or the post
+        is being deleted). Only published posts that have not been deleted are in a group, so its post_count is how many
+        of them can be seen. The other posts in the group are not touched."""
+        if self.cross_post_group_id is not None:
+            if not (url_changed or delete_only):
+                return
+            db.session.execute(
+                text(
+                    'UPDATE "cross_post_group" SET post_count = post_count - 1, reply_count = reply_count - :reply_count '
+                    "WHERE id = :group_id"
+                ),
+                {"reply_count": self.reply_count or 0, "group_id": self.cross_post_group_id},
+            )
+            self.cross_post_group_id = None
             db.session.commit()
-        if delete_only:
+        if delete_only or not self.url or self.deleted or self.status <= POST_STATUS_REVIEWING:
             return
 
-        if self.url.count("/") < 3 or (
-            self.url.count("/") == 3 and self.url.endswith("/")
-        ):
-            # reject if url is just a domain without a path
+        url_hash = cross_post_url_hash(self.url)
+        if url_hash is None:  # the url is just a domain without a path
             return
 
         if self.community.ap_profile_id == "https://lemmy.zip/c/dailygames":
             # daily posts to this community (e.g. to https://travle.earth/usa or https://www.nytimes.com/games/wordle/index.html) shouldn't be treated as cross-posts
             return
 
-        limit = 9
-        new_cross_posts = (
-            db.session.query(Post)
-            .filter(
-                Post.id != self.id,
-                Post.url == self.url,
-                Post.deleted == False,
-                Post.status > POST_STATUS_REVIEWING,
-            )
-            .order_by(desc(Post.id))
-            .limit(limit)
-        )
-
-        # other posts: update their cross_posts field with this post.id if they have less than the limit
-        for ncp in new_cross_posts:
-            if ncp.cross_posts is None:
-                ncp.cross_posts = [self.id]
-            elif len(ncp.cross_posts) < limit:
-                ncp.cross_posts.append(self.id)
-
-        # this post: set the cross_posts field to the limited list of ids from the most recent other posts
-        if new_cross_posts.count() > 0:
-            self.cross_posts = [ncp.id for ncp in new_cross_posts]
+        self.cross_post_group_id = db.session.execute(
+            text(
+                'INSERT INTO "cross_post_group" (url_hash, post_count, reply_count) VALUES (:url_hash, 1, :reply_count) '
+                'ON CONFLICT (url_hash) DO UPDATE SET post_count = "cross_post_group".post_count + 1, '
+                'reply_count = "cross_post_group".reply_count + EXCLUDED.reply_count RETURNING id'
+            ),
+            {"url_hash": url_hash, "reply_count": self.reply_count or 0},
+        ).scalar()
         db.session.commit()
 
     def delete_dependencies(self):
@@ -3059,7 +3071,15 @@ class Post(db.Model):
             db.session.query(ArchivedPostReply).filter(
                 ArchivedPostReply.post_id == self.id
             ).delete()
-            if (
+            if self.archived.startswith("seg:"):
+                # archive segments are shared with other posts so only this post's part of it is blanked
+                from app.shared.tasks.maintenance import blank_archived_posts
+
+                if current_app.debug:
+                    blank_archived_posts([self.archived])
+                else:
+                    blank_archived_posts.delay([self.archived])
+            elif (
                 self.archived.startswith(
                     f'https://{current_app.config["S3_PUBLIC_URL"]}'
                 )
@@ -3331,13 +3351,15 @@ class Post(db.Model):
 
     def vote(self, user: User, vote_direction: str, emoji: str | None):
         from app import redis_client
+        from app.shared import counters
 
         if vote_direction == "downvote":
             if self.author.has_blocked_user(
                 user.id
             ) or self.author.has_blocked_instance(user.instance_id):
                 return None
-        with redis_client.lock(f"lock:post:{self.id}", timeout=30, blocking_timeout=6):
+        # only this user's votes on this post need to wait for each other, the totals are counted in redis
+        with redis_client.lock(f"lock:vote:post:{self.id}:{user.id}", timeout=30, blocking_timeout=6):
             existing_vote = PostVote.query.filter_by(
                 user_id=user.id, post_id=self.id
             ).first()
@@ -3351,6 +3373,8 @@ class Post(db.Model):
             if vote_direction not in ("upvote", "downvote"):
                 return None  # effect==0 reversal or unexpected value
             undo = None
+            deltas = {}     # counted once the vote itself has been saved
+            reputation = 0
             if existing_vote:
                 prior_effect = (
                     existing_vote.effect
@@ -3374,43 +3398,31 @@ class Post(db.Model):
                     return None  # No undo, vote stays as-is with new emoji
 
                 if not self.community.low_quality:
-                    db.session.execute(
-                        text(
-                            'UPDATE "user" SET reputation = reputation - :effect WHERE id = :user_id'
-                        ),
-                        {"effect": prior_effect, "user_id": self.user_id},
-                    )
-                    db.session.commit()
+                    reputation = -prior_effect
                 if prior_effect > 0:  # previous vote was up
                     if vote_direction == "upvote":  # new vote is also up, so remove it
                         db.session.delete(existing_vote)
                         db.session.commit()
-                        self.up_votes -= 1
-                        self.score -= prior_effect  # score - (+1) = score-1
+                        deltas = dict(up_votes=-1, score=-prior_effect)  # score - (+1) = score-1
                         undo = "Like"
                     else:  # new vote is down while previous vote was up, so reverse their previous vote
                         existing_vote.effect = -1
                         existing_vote.emoji = emoji
                         db.session.commit()
-                        self.up_votes -= 1
-                        self.down_votes += 1
-                        self.score -= 2 * prior_effect  # prior was +1: score -= 2
+                        deltas = dict(up_votes=-1, down_votes=1, score=-2 * prior_effect)  # prior was +1: score -= 2
                 else:  # previous vote was down
                     if (
                         vote_direction == "downvote"
                     ):  # new vote is also down, so remove it
                         db.session.delete(existing_vote)
                         db.session.commit()
-                        self.down_votes -= 1
-                        self.score -= prior_effect  # score - (-1) = score+1
+                        deltas = dict(down_votes=-1, score=-prior_effect)  # score - (-1) = score+1
                         undo = "Dislike"
                     else:  # new vote is up while previous vote was down, so reverse their previous vote
                         existing_vote.effect = 1
                         existing_vote.emoji = emoji
                         db.session.commit()
-                        self.up_votes += 1
-                        self.down_votes -= 1
-                        self.score -= 2 * prior_effect  # prior was -1: score += 2
+                        deltas = dict(up_votes=1, down_votes=-1, score=-2 * prior_effect)  # prior was -1: score += 2
                 db.session.commit()
             else:
                 if vote_direction == "upvote":
@@ -3425,20 +3437,18 @@ class Post(db.Model):
                         spicy_effect = effect * current_app.config["SPICY_UNDER_60"]
                     if user.cannot_vote():
                         effect = spicy_effect = 0
-                    self.up_votes += 1
-                    self.score += spicy_effect  # score + (+1) = score+1
+                    deltas = dict(up_votes=1, score=spicy_effect)  # score + (+1) = score+1
                 else:
                     effect = -1.0
                     spicy_effect = effect
-                    self.down_votes += 1
                     # Make 'hot' sort more spicy by amplifying the effect of early downvotes
-                    if self.up_votes + self.down_votes <= 30:
+                    if self.up_votes + self.down_votes + 1 <= 30:
                         spicy_effect *= current_app.config["SPICY_UNDER_30"]
-                    elif self.up_votes + self.down_votes <= 60:
+                    elif self.up_votes + self.down_votes + 1 <= 60:
                         spicy_effect *= current_app.config["SPICY_UNDER_60"]
                     if user.cannot_vote():
                         effect = spicy_effect = 0
-                    self.score += spicy_effect  # score + (-1) = score-1
+                    deltas = dict(down_votes=1, score=spicy_effect)  # score + (-1) = score-1
                 vote = PostVote(
                     user_id=user.id,
                     post_id=self.id,
@@ -3449,26 +3459,19 @@ class Post(db.Model):
                 # upvotes do not increase reputation in low quality communities
                 if self.community.low_quality and effect > 0:
                     effect = 0
-                db.session.execute(
-                    text(
-                        'UPDATE "user" SET reputation = reputation + :effect WHERE id = :user_id'
-                    ),
-                    {"effect": effect, "user_id": self.user_id},
-                )
-                db.session.commit()
+                reputation = effect
                 db.session.add(vote)
 
             if emoji or emoji == "-1":
                 db.session.commit()
                 self.update_reaction_cache()
 
-            # Calculate new ranking values
-            self.ranking = self.post_ranking(
-                self.score + self.reply_count, self.created_at
-            )
-            self.ranking_scaled = int(self.ranking + self.community.scale_by())
-
+            # ranking is worked out again when the counters are flushed
             db.session.commit()
+            if deltas:
+                counters.apply(self, **deltas)
+            if reputation:
+                counters.increment(User, self.user_id, reputation=reputation)
             if user.is_local():
                 from app.utils import recently_upvoted_posts, recently_downvoted_posts
 
@@ -3645,7 +3648,7 @@ class PostReply(db.Model):
             get_setting,
         )
         from app.activitypub.util import notify_about_post_reply
-        from app import redis_client
+        from app.shared import counters
 
         if session is None:
             session = db.session
@@ -3683,6 +3686,8 @@ class PostReply(db.Model):
             ap_id=request_json["object"]["id"] if request_json else None,
             ap_create_id=request_json["id"] if request_json else None,
             ap_announce_id=announce_id,
+            score=1,  # upvote own reply
+            up_votes=1,
         )
         if request_json and request_json["type"] == "Update":
             reply.edited_at = utcnow()
@@ -3720,7 +3725,7 @@ class PostReply(db.Model):
             reply_is_just_link_to_gif_reaction(reply.body)
             and site.enable_gif_reply_rep_decrease
         ):
-            user.reputation -= 1
+            counters.increment(User, user.id, reputation=-1)
             raise PostReplyValidationError(_("Gif comment ignored"))
 
         if reply_is_stupid(reply.body) and site.enable_this_comment_filter:
@@ -3763,8 +3768,6 @@ class PostReply(db.Model):
             session.add(new_notification)
 
         # upvote own reply
-        reply.score = 1
-        reply.up_votes = 1
         reply.ranking = wilson_confidence_lower_bound(1, 0)
         vote = PostReplyVote(
             user_id=user.id, post_reply_id=reply.id, author_id=user.id, effect=1
@@ -3775,37 +3778,20 @@ class PostReply(db.Model):
 
         reply.ap_id = reply.profile_id()
 
-        with redis_client.lock(f"lock:post:{post.id}", timeout=10, blocking_timeout=6):
-            if not user.bot:
-                post.reply_count += 1
-                post.community.post_reply_count += 1
-                post.community.last_active = post.last_active = utcnow()
-            session.execute(
-                text(
-                    'UPDATE "user" SET post_reply_count = post_reply_count + 1, last_seen = now() WHERE id = :user_id'
-                ),
-                {"user_id": user.id},
-            )
-            session.execute(text('UPDATE "site" SET last_active = NOW()'))
-            session.commit()
-
-            # update reply_count_cross_posted
-            if post.cross_posts and len(post.cross_posts) > 0:
-                ids = [post.id, *post.cross_posts]
-
-                total = (
-                    session.query(db.func.sum(Post.reply_count))
-                    .filter(Post.id.in_(ids))
-                    .scalar()
-                ) or 0
-                session.query(Post).filter(Post.id.in_(ids)).update(
-                    {"reply_count_cross_posted": total}, synchronize_session=False
-                )
+        session.execute(
+            text('UPDATE "user" SET last_seen = now() WHERE id = :user_id'),
+            {"user_id": user.id},
+        )
+        session.execute(text('UPDATE "site" SET last_active = NOW()'))
+        session.commit()
 
-                session.commit()
-            else:
-                post.reply_count_cross_posted = post.reply_count
-                session.commit()
+        # the post, community and author totals are counted in redis rather than by locking the post
+        if not user.bot:
+            post.count_replies(1)
+            counters.increment(Community, post.community_id, post_reply_count=1)
+            counters.touch(Post, post.id)
+            counters.touch(Community, post.community_id)
+        counters.increment(User, user.id, post_reply_count=1)
 
         # LLM Detection
         if (
@@ -4077,10 +4063,10 @@ class PostReply(db.Model):
 
     def vote(self, user: User, vote_direction: str, emoji: str):
         from app import redis_client
-        from app.utils import wilson_confidence_lower_bound
+        from app.shared import counters
 
         with redis_client.lock(
-            f"lock:post_reply:{self.id}", timeout=30, blocking_timeout=6
+            f"lock:vote:post_reply:{self.id}:{user.id}", timeout=30, blocking_timeout=6
         ):
             existing_vote = (
                 db.session.query(PostReplyVote)
@@ -4097,6 +4083,8 @@ class PostReply(db.Model):
             if vote_direction not in ("upvote", "downvote"):
                 return None  # effect==0 reversal or unexpected value
             undo = None
+            deltas = {}     # counted once the vote itself has been saved
+            reputation = 0
             if existing_vote:
                 prior_effect = (
                     existing_vote.effect
@@ -4119,54 +4107,41 @@ class PostReply(db.Model):
                     db.session.commit()
                     return None  # No undo, vote stays as-is with new emoji
 
-                db.session.execute(
-                    text(
-                        'UPDATE "user" SET reputation = reputation - :effect WHERE id = :user_id'
-                    ),
-                    {"effect": prior_effect, "user_id": self.user_id},
-                )
-                db.session.commit()
+                reputation = -prior_effect
                 if prior_effect > 0:  # previous vote was up
                     if vote_direction == "upvote":  # new vote is also up, so remove it
                         db.session.delete(existing_vote)
                         db.session.commit()
-                        self.up_votes -= 1
-                        self.score -= 1
+                        deltas = dict(up_votes=-1, score=-1)
                         undo = "Like"
                     else:  # new vote is down while previous vote was up, so reverse their previous vote
                         existing_vote.effect = -1
                         existing_vote.emoji = emoji
                         db.session.commit()
-                        self.up_votes -= 1
-                        self.down_votes += 1
-                        self.score -= 2 * prior_effect  # prior was +1: score -= 2
+                        deltas = dict(up_votes=-1, down_votes=1, score=-2 * prior_effect)  # prior was +1: score -= 2
                 else:  # previous vote was down
                     if (
                         vote_direction == "downvote"
                     ):  # new vote is also down, so remove it
                         db.session.delete(existing_vote)
                         db.session.commit()
-                        self.down_votes -= 1
-                        self.score += 1
+                        deltas = dict(down_votes=-1, score=1)
                         undo = "Dislike"
                     else:  # new vote is up while previous vote was down, so reverse their previous vote
                         existing_vote.effect = 1
                         existing_vote.emoji = emoji
                         db.session.commit()
-                        self.up_votes += 1
-                        self.down_votes -= 1
-                        self.score -= 2 * prior_effect  # prior was -1: score += 2
+                        deltas = dict(up_votes=1, down_votes=-1, score=-2 * prior_effect)  # prior was -1: score += 2
             else:
                 if user.cannot_vote():
                     effect = 0
                 else:
                     effect = 1
                 if vote_direction == "upvote":
-                    self.up_votes += 1
+                    deltas = dict(up_votes=1, score=effect)
                 else:
                     effect = effect * -1
-                    self.down_votes += 1
-                self.score += effect
+                    deltas = dict(down_votes=1, score=effect)
                 vote = PostReplyVote(
                     user_id=user.id,
                     post_reply_id=self.id,
@@ -4174,21 +4149,18 @@ class PostReply(db.Model):
                     effect=effect,
                     emoji=emoji,
                 )
-                db.session.execute(
-                    text(
-                        'UPDATE "user" SET reputation = reputation + :effect WHERE id = :user_id'
-                    ),
-                    {"effect": effect, "user_id": self.user_id},
-                )
-                db.session.commit()
+                reputation = effect
                 db.session.add(vote)
             if emoji or emoji == "-1":
                 db.session.commit()
                 self.update_reaction_cache()
 
-            # Calculate the new ranking value
-            self.ranking = wilson_confidence_lower_bound(self.up_votes, self.down_votes)
+            # ranking is worked out again when the counters are flushed
             db.session.commit()
+            if deltas:
+                counters.apply(self, **deltas)
+            if reputation:
+                counters.increment(User, self.user_id, reputation=reputation)
             if user.is_local():
                 from app.utils import (
                     recently_upvoted_post_replies,
@@ -4279,14 +4251,9 @@ class Domain(db.Model):
         return block is not None
 
     def purge_content(self):
-        files = File.query.join(Post).filter(Post.domain_id == self.id).all()
-        for file in files:
-            file.delete_from_disk(purge_cdn=False)
-        posts = Post.query.filter_by(domain_id=self.id).all()
-        for post in posts:
-            post.delete_dependencies()
-            db.session.delete(post)
-        db.session.commit()
+        from app.shared.purge import purge_now
+
+        purge_now("domain", self.id)
 
 
 class DomainBlock(db.Model):
@@ -5016,6 +4983,25 @@ def load_user(id):
 # --- Feeds Models ---
 
 
+# Every ancestor of every topic, and of every feed, including itself at depth 0 - so that a topic or feed and everything
+# below it can be found with one query. Kept up to date by _add_to_closure() etc at the bottom of this file.
+topic_closure = db.Table(
+    "topic_closure",
+    db.Column("ancestor_id", db.Integer, db.ForeignKey("topic.id")),
+    db.Column("descendant_id", db.Integer, db.ForeignKey("topic.id"), index=True),
+    db.Column("depth", db.Integer),
+    db.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+)
+
+feed_closure = db.Table(
+    "feed_closure",
+    db.Column("ancestor_id", db.Integer, db.ForeignKey("feed.id")),
+    db.Column("descendant_id", db.Integer, db.ForeignKey("feed.id"), index=True),
+    db.Column("depth", db.Integer),
+    db.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+)
+
+
 class FeedItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     feed_id = db.Column(db.Integer, db.ForeignKey("feed.id"), index=True)
@@ -5312,6 +5298,36 @@ class UserFlair(db.Model):
     flair = db.Column(db.String(50), index=True)
 
 
+CROSS_POST_LIMIT = 9  # how many cross posts are listed under a post
+
+
+class CrossPostGroup(db.Model):
+    # Posts that link to the same url. Posts join a group with one upsert, see Post.calculate_cross_posts().
+    id = db.Column(db.Integer, primary_key=True)
+    url_hash = db.Column(db.String(32), unique=True)  # see cross_post_url_hash()
+    post_count = db.Column(db.Integer, default=0)
+    reply_count = db.Column(db.Integer, default=0)  # replies on all the posts in the group
+
+
+def cross_post_url_hash(url: str) -> str | None:
+    """Posts with urls that only differ by http/https, a #fragment or a trailing / are cross posts of each other.
+    Returns None for urls that are just a domain. Must match the SQL in the cross_post_group migration."""
+    url = url.strip().split("#", 1)[0].rstrip("/")
+    if url.startswith("http://"):
+        url = "https://" + url[len("http://"):]
+    if url.count("/") < 3:
+        return None
+    return hashlib.md5(url.encode("utf-8"), usedforsecurity=False).hexdigest()
+
+
+class ActorUrl(db.Model):
+    # Index of every user, community and feed by ap_profile_id, so an actor url can be resolved with one lookup
+    # instead of trying each table in turn. Kept up to date by the mapper events at the bottom of this file.
+    url = db.Column(db.String(255), primary_key=True)
+    actor_type = db.Column(db.String(10))  # 'User', 'Community' or 'Feed'
+    actor_id = db.Column(db.Integer)
+
+
 class SendQueue(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     destination_domain = db.Column(db.String(255), index=True)
@@ -5344,6 +5360,29 @@ class ActivityBatch(db.Model):
     created = db.Column(db.DateTime, default=utcnow)
 
 
+class Broadcast(db.Model):
+    # One activity sent to the inbox of every known instance, e.g. the Delete of an account. See app/shared/broadcast.py
+    id = db.Column(db.Integer, primary_key=True)
+    activity_id = db.Column(db.String(255))
+    activity_type = db.Column(db.String(20))
+    payload = db.Column(db.JSON)
+    actor = db.Column(db.String(255))  # the key id the activity is signed with
+    private_key = db.Column(db.String(2000))  # cleared once sending has finished
+    total = db.Column(db.Integer, default=0)  # number of instances it will be sent to
+    sent = db.Column(db.Integer, default=0)
+    failed = db.Column(db.Integer, default=0)
+    retrying = db.Column(db.Integer, default=0)  # failed, but handed to the send queue to try again later
+    failures = db.Column(db.JSON)  # reason -> count, e.g. {"timeout": 12, "404": 3}
+    cursor = db.Column(db.Integer, default=0)  # instances with an id up to this have been done
+    created = db.Column(db.DateTime, default=utcnow)
+    finished = db.Column(db.DateTime)
+
+    def progress(self) -> int:
+        if not self.total:
+            return 100 if self.finished else 0
+        return min(100, int((self.sent + self.failed) * 100 / self.total))
+
+
 class BlockedImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     file_name = db.Column(db.String(255), index=True)
@@ -5446,3 +5485,207 @@ def _store_files_in_s3():
         and current_app.config["S3_ACCESS_SECRET"] != ""
         and current_app.config["S3_ENDPOINT"] != ""
     )
+
+
+def _register_actor_url(mapper, connection, target):
+    if target.ap_profile_id:
+        table = ActorUrl.__table__
+        connection.execute(table.delete().where(table.c.url == target.ap_profile_id))
+        connection.execute(table.insert().values(url=target.ap_profile_id, actor_type=target.__class__.__name__,
+                                                 actor_id=target.id))
+
+
+def _update_actor_url(mapper, connection, target):
+    history = inspect(target).attrs.ap_profile_id.history
+    if history.has_changes():
+        for old_url in history.deleted:
+            if old_url:
+                connection.execute(ActorUrl.__table__.delete().where(ActorUrl.__table__.c.url == old_url))
+        _register_actor_url(mapper, connection, target)
+
+
+def _unregister_actor_url(mapper, connection, target):
+    if target.ap_profile_id:
+        connection.execute(ActorUrl.__table__.delete().where(ActorUrl.__table__.c.url == target.ap_profile_id))
+
+
+for _actor_model in (User, Community, Feed):
+    event.listen(_actor_model, 'after_insert', _register_actor_url)
+    event.listen(_actor_model, 'after_update', _update_actor_url)
+    event.listen(_actor_model, 'after_delete', _unregister_actor_url)
+
+
+def _merge_pending_counters(target, context, attrs=None):
+    from app.shared.counters import merge_pending
+    merge_pending(target, attrs)
+
+
+# vote and reply totals not yet written to the database by the write-behind counters in app/shared/counters.py
+for _counted_model in (Post, PostReply, Community, User, CrossPostGroup):
+    event.listen(_counted_model, 'load', _merge_pending_counters)
+    event.listen(_counted_model, 'refresh', _merge_pending_counters)
+
+
+def _increment_committed_counters(session):
+    from app.shared.counters import increment_committed
+    increment_committed(session)
+
+
+def _forget_uncommitted_counters(session):
+    from app.shared.counters import forget_uncommitted
+    forget_uncommitted(session)
+
+
+event.listen(Session, 'after_commit', _increment_committed_counters)
+event.listen(Session, 'after_rollback', _forget_uncommitted_counters)
+
+
+def _note_api_context_changes(session, flush_context, instances):
+    from app.shared.api_context import note_changes
+    note_changes(session, flush_context, instances)
+
+
+def _note_bulk_api_context_changes(orm_execute_state):
+    from app.shared.api_context import note_bulk_changes
+    note_bulk_changes(orm_execute_state)
+
+
+def _bump_api_context_versions(session):
+    from app.shared.api_context import bump_changed
+    bump_changed(session)
+
+
+def _forget_api_context_changes(session):
+    from app.shared.api_context import forget_changed
+    forget_changed(session)
+
+
+# follows, bans, blocks, bookmarks and subscriptions change the cached context of API users in app/shared/api_context.py
+event.listen(Session, 'before_flush', _note_api_context_changes)
+event.listen(Session, 'do_orm_execute', _note_bulk_api_context_changes)
+event.listen(Session, 'after_commit', _bump_api_context_versions)
+event.listen(Session, 'after_rollback', _forget_api_context_changes)
+
+
+def _add_to_closure(closure: str, node_id: int, parent_id: int | None, connection):
+    connection.execute(text(f'''INSERT INTO "{closure}" (ancestor_id, descendant_id, depth)
+                               SELECT ancestor_id, :node_id, depth + 1 FROM "{closure}" WHERE descendant_id = :parent_id
+                               UNION ALL SELECT :node_id, :node_id, 0'''),
+                       {"node_id": node_id, "parent_id": parent_id})
+
+
+def _move_in_closure(closure: str, node_id: int, parent_id: int | None, connection):
+    # detach the node and everything below it from its old ancestors, then attach it all below the new parent
+    connection.execute(text(f'''DELETE FROM "{closure}"
+                               WHERE descendant_id IN (SELECT descendant_id FROM "{closure}" WHERE ancestor_id = :node_id)
+                               AND ancestor_id NOT IN (SELECT descendant_id FROM "{closure}" WHERE ancestor_id = :node_id)'''),
+                       {"node_id": node_id})
+    connection.execute(text(f'''INSERT INTO "{closure}" (ancestor_id, descendant_id, depth)
+                               SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+                               FROM "{closure}" AS above, "{closure}" AS below
+                               WHERE above.descendant_id = :parent_id AND below.ancestor_id = :node_id'''),
+                       {"node_id": node_id, "parent_id": parent_id})
+
+
+def _remove_from_closure(closure: str, node_id: int, connection):
+    _move_in_closure(closure, node_id, None, connection)
+    connection.execute(text(f'DELETE FROM "{closure}" WHERE ancestor_id = :node_id OR descendant_id = :node_id'),
+                       {"node_id": node_id})
+
+
+HIERARCHY_CHANGED = "hierarchy_changed"  # in session.info - a topic, feed or their communities changed
+
+
+def _hierarchy_changed(target):
+    # the cached communities are forgotten once the change is committed, so they are not cached again from before it
+    session = object_session(target)
+    if session is not None:
+        session.info[HIERARCHY_CHANGED] = True
+
+
+def _forget_hierarchy_communities(session):
+    if session.info.pop(HIERARCHY_CHANGED, False):
+        from app.utils import topic_community_ids, feed_community_ids
+        cache.delete_memoized(topic_community_ids)
+        cache.delete_memoized(feed_community_ids)
+
+
+def _forget_hierarchy_changes(session):
+    session.info.pop(HIERARCHY_CHANGED, None)
+
+
+def _closure_listeners(model, closure: str, parent_attr: str):
+    def after_insert(mapper, connection, target):
+        _add_to_closure(closure, target.id, getattr(target, parent_attr), connection)
+        _hierarchy_changed(target)
+
+    def after_update(mapper, connection, target):
+        if inspect(target).attrs[parent_attr].history.has_changes():
+            _move_in_closure(closure, target.id, getattr(target, parent_attr), connection)
+            _hierarchy_changed(target)
+
+    def before_delete(mapper, connection, target):
+        _remove_from_closure(closure, target.id, connection)
+        _hierarchy_changed(target)
+
+    event.listen(model, "after_insert", after_insert)
+    event.listen(model, "after_update", after_update)
+    event.listen(model, "before_delete", before_delete)
+
+
+_closure_listeners(Topic, "topic_closure", "parent_id")
+_closure_listeners(Feed, "feed_closure", "parent_feed_id")
+
+
+def _community_moved(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[field].history.has_changes() for field in ("topic_id", "banned", "private")):
+        _hierarchy_changed(target)
+
+
+def _feed_item_changed(mapper, connection, target):
+    _hierarchy_changed(target)
+
+
+# the communities in each topic and feed are cached by topic_community_ids() and feed_community_ids()
+event.listen(Community, "after_update", _community_moved)
+event.listen(FeedItem, "after_insert", _feed_item_changed)
+event.listen(FeedItem, "after_delete", _feed_item_changed)
+event.listen(Session, "after_commit", _forget_hierarchy_communities)
+event.listen(Session, "after_rollback", _forget_hierarchy_changes)
+
+
+def _queue_committed_uploads(session):
+    from app.shared.upload import queue_committed
+    queue_committed(session)
+
+
+def _forget_uncommitted_uploads(session):
+    from app.shared.upload import forget_uncommitted
+    forget_uncommitted(session)
+
+
+# uploads are processed by the media lane once their File has been committed, see app/shared/upload.py
+event.listen(Session, 'after_commit', _queue_committed_uploads)
+event.listen(Session, 'after_rollback', _forget_uncommitted_uploads)
+
+
+def _note_syndication_changes(session, flush_context, instances):
+    from app.shared.syndication import note_changes
+    note_changes(session, flush_context, instances)
+
+
+def _rebuild_syndication(session):
+    from app.shared.syndication import rebuild_changed
+    rebuild_changed(session)
+
+
+def _forget_syndication_changes(session):
+    from app.shared.syndication import forget_changed
+    forget_changed(session)
+
+
+# the stored RSS feeds and sitemap shards that a post is in are rebuilt when it changes, see app/shared/syndication.py
+event.listen(Session, 'before_flush', _note_syndication_changes)
+event.listen(Session, 'after_commit', _rebuild_syndication)
+event.listen(Session, 'after_rollback', _forget_syndication_changes)
@@ -39,7 +39,7 @@ from app.post.forms import NewReplyForm, ReportPostForm, MeaCulpaForm, CrossPost
     ConfirmationMultiDeleteForm, EditReplyForm, FlairPostForm, DeleteConfirmationForm, NewReminderForm, \
     ShareMastodonForm, ChooseEmojiForm, MovePostForm
 from app.post.util import post_replies, get_comment_branch, tags_to_string, url_needs_archive, \
-    generate_archive_link, body_has_no_archive_link, retrieve_archived_post
+    generate_archive_link, body_has_no_archive_link, retrieve_archived_post_body
 from app.post.util import post_type_to_form_url_type
 from app.shared.post import edit_post, sticky_post, lock_post, bookmark_post, remove_bookmark_post, subscribe_post, \
     vote_for_post, mark_post_read, report_post, delete_post, mod_remove_post, restore_post, mod_restore_post, \
@@ -48,7 +48,9 @@ from app.shared.reply import make_reply, edit_reply, bookmark_reply, remove_book
     delete_reply, mod_remove_reply, vote_for_reply, lock_post_reply, report_reply, choose_answer, unchoose_answer
 from app.shared.site import block_remote_instance
 from app.shared.community import get_comm_flair_list
+from app.shared import counters
 from app.shared.tasks import task_selector
+from app.translation import BATCH_SIZE, translate_strings
 from app.utils import render_template, markdown_to_html, validation_required, \
     shorten_string, markdown_to_text, gibberish, ap_datetime, return_304, \
     request_etag_matches, ip_address, instance_banned, \
@@ -158,11 +160,11 @@ def show_post(post_id: int, sort, low_bandwidth, autoplay):
                 lazy_load_replies = False
                 replies = post_replies(post, sort, current_user if current_user.is_authenticated else None)
                 more_replies = defaultdict(list)
-                if post.cross_posts:
+                if cross_post_ids := post.cross_posts:
                     cbf = communities_banned_from(current_user.get_id())
                     bc = blocked_communities(current_user.get_id())
                     bi = blocked_or_banned_instances(current_user.get_id())
-                    for cross_posted_post in Post.query.filter(Post.id.in_(post.cross_posts)):
+                    for cross_posted_post in Post.query.filter(Post.id.in_(cross_post_ids)):
                         if cross_posted_post.community_id not in cbf \
                                 and cross_posted_post.community_id not in bc \
                                 and cross_posted_post.community.instance_id not in bi:
@@ -268,7 +270,7 @@ def show_post(post_id: int, sort, low_bandwidth, autoplay):
         if current_user.is_authenticated:
             user = current_user
             if current_user.hide_read_posts:
-                main_post_id = [post.id] + post.cross_posts if post.cross_posts is not None else []
+                main_post_id = [post.id] + post.cross_posts
                 mark_post_read(main_post_id, True, current_user.id)
         else:
             user = None
@@ -287,7 +289,7 @@ def show_post(post_id: int, sort, low_bandwidth, autoplay):
 
         if post.archived:
             sort = 'hot'
-            archived_post = retrieve_archived_post(post.archived)
+            archived_post = retrieve_archived_post_body(post.archived)
             post.body_html = archived_post['body_html']     # do this last to avoid the db.session.commit() in mark_post_read(). We don't want to save data in .body_html to the DB, just have it there for display in the jinja template
 
         author_banned = False
@@ -379,11 +381,11 @@ def post_lazy_replies(post_id, nonce):
     
     replies = post_replies(post, sort, current_user if current_user.is_authenticated else None)
     more_replies = defaultdict(list)
-    if post.cross_posts:
+    if cross_post_ids := post.cross_posts:
         cbf = communities_banned_from_list
         bc = blocked_communities(current_user.get_id())
         bi = blocked_or_banned_instances(current_user.get_id())
-        for cross_posted_post in Post.query.filter(Post.id.in_(post.cross_posts)):
+        for cross_posted_post in Post.query.filter(Post.id.in_(cross_post_ids)):
             if cross_posted_post.community_id not in cbf \
                     and cross_posted_post.community_id not in bc \
                     and cross_posted_post.community.instance_id not in bi:
@@ -1224,12 +1226,9 @@ def post_translate(post_id: int):
         source = post.language.code if post.language_id and post.language.code != 'und' else 'auto'
         if source == site_language_code():  # If the source is the same as the default then there's a chance the author didn't specify a language, so just use 'auto'
             source = 'auto'
-        result = libretranslate_string(post.body_html,
-                                       source=source,
-                                       target=recipient_language)
-        result_title = libretranslate_string(post.title,
-                                             source=source,
-                                             target=recipient_language)
+        result, result_title = translate_strings([post.body_html, post.title],
+                                                 source=source,
+                                                 target=recipient_language)
         return f'<div class="post_body">{result}</div><h1 class="mt-2 post_title" hx-swap-oob="outerHTML:h1.post_title">{result_title}</h1>'
 
 
@@ -1248,6 +1247,27 @@ def post_reply_translate(post_reply_id: int):
         return f'<div class="col-12 pr-0" lang="{recipient_language}">' + result + "</div>"
 
 
+@bp.route('/post/<int:post_id>/translate_replies', methods=['POST'])
+@login_required
+def post_replies_translate(post_id: int):
+    # Translate the comments that 'translate all comments' is about to ask for one at a time, with one request to the
+    # translator rather than one for each. They are cached, so the requests for each comment are quick. The page sends
+    # the comments a batch at a time, so one of these never takes longer than one request to the translator.
+    if current_app.config['TRANSLATE_ENDPOINT']:
+        reply_ids = [int(reply_id) for reply_id in request.form.getlist('reply_id') if reply_id.isdigit()][:BATCH_SIZE]
+        recipient_language = get_recipient_language(current_user.id)
+        site_language = site_language_code()
+        by_source = defaultdict(list)
+        for post_reply in PostReply.query.filter(PostReply.post_id == post_id, PostReply.id.in_(reply_ids)):
+            source = post_reply.language.code if post_reply.language_id and post_reply.language.code != 'und' else 'auto'
+            if source == site_language:
+                source = 'auto'
+            by_source[source].append(post_reply.body_html)
+        for source, bodies in by_source.items():
+            translate_strings(bodies, source=source, target=recipient_language)
+    return '', 204
+
+
 @bp.route('/post/<int:post_id>/reminder', methods=['GET', 'POST'])
 @login_required
 def post_reminder(post_id: int):
@@ -1957,13 +1977,13 @@ def post_reply_restore(post_id: int, comment_id: int):
             was_mod_deletion = True
         post_reply.deleted = False
         post_reply.deleted_by = None
-        if not post_reply.author.bot:
-            post.reply_count += 1
-        post_reply.author.post_reply_count += 1
         if post_reply.path:
             db.session.execute(text('update post_reply set child_count = child_count + 1 where id in :parents'),
                                {'parents': tuple(post_reply.path[:-1])})
         db.session.commit()
+        if not post_reply.author.bot:
+            post.count_replies(1)
+        counters.increment(User, post_reply.user_id, post_reply_count=1)
         flash(_('Comment restored.'))
 
         # Federate un-delete
@@ -2071,8 +2091,8 @@ def post_reply_notification(post_reply_id: int):
 @bp.route('/post/<int:post_id>/cross_posts', methods=['GET'])
 def post_cross_posts(post_id: int):
     post = Post.query.get_or_404(post_id)
-    if post.cross_posts:
-        cross_posts = Post.query.filter(Post.id.in_(post.cross_posts))
+    if cross_post_ids := post.cross_posts:
+        cross_posts = Post.query.filter(Post.id.in_(cross_post_ids))
         return render_template('post/post_cross_posts.html', cross_posts=cross_posts)
     else:
         abort(404)
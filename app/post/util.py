@@ -1,3 +1,4 @@
+import base64
 from typing import List
 from urllib.parse import urlparse
 from datetime import datetime
@@ -9,6 +10,7 @@ from flask_login import current_user
 from sqlalchemy import desc, asc, text, or_
 
 from app import db, cache
+from app.archive_store import is_segment_locator, read_post, read_header, read_branch
 from app.constants import POST_TYPE_LINK, POST_TYPE_IMAGE, POST_TYPE_VIDEO, POST_TYPE_POLL
 from app.models import PostReply, Post, Community, User, Language, utcnow
 from app.utils import blocked_or_banned_instances, blocked_users, is_video_hosting_site, get_request
@@ -16,12 +18,14 @@ from app.utils import blocked_or_banned_instances, blocked_users, is_video_hosti
 
 @cache.memoize(timeout=600)
 def retrieve_archived_post(archived_url: str) -> dict:
-    """Load archived post data from S3 or local disk"""
+    """Load archived post data (with all replies) from an archive segment, S3 or local disk"""
     if not archived_url:
         return None
         
     try:
-        if archived_url.startswith('http'):
+        if is_segment_locator(archived_url):
+            return read_post(archived_url)
+        elif archived_url.startswith('http'):
             # Load from S3 via HTTP
             response = get_request(archived_url)
             if response.status_code == 200:
@@ -45,6 +49,33 @@ def retrieve_archived_post(archived_url: str) -> dict:
     return None
 
 
+@cache.memoize(timeout=600)
+def retrieve_archived_post_body(archived_url: str) -> dict:
+    """Load just the body of an archived post. For posts in an archive segment none of the replies are inflated."""
+    if not is_segment_locator(archived_url):
+        return retrieve_archived_post(archived_url)
+    try:
+        return read_header(archived_url)
+    except Exception as e:
+        current_app.logger.error(f"Failed to load archived data from {archived_url}: {e}")
+        return None
+
+
+@cache.memoize(timeout=600)
+def retrieve_archived_branch(archived_url: str, comment_id: int) -> list:
+    """Load the archived replies that contain comment_id. For posts in an archive segment only the top-level branch
+    that the comment is in gets read."""
+    if not is_segment_locator(archived_url):
+        archived_data = retrieve_archived_post(archived_url)
+        return archived_data['replies'] if archived_data and 'replies' in archived_data else None
+    try:
+        branch = read_branch(archived_url, comment_id)
+        return [branch] if branch else []
+    except Exception as e:
+        current_app.logger.error(f"Failed to load archived data from {archived_url}: {e}")
+        return None
+
+
 def convert_archived_replies_to_tree(archived_replies: list, post: Post) -> List[dict]:
     """Convert archived reply data back to the expected tree format using PostReply models"""
     if not archived_replies:
@@ -190,9 +221,9 @@ def post_replies(post: Post, sort_by: str, viewer: User, db_only=False) -> List[
 def get_comment_branch(post: Post, comment_id: int, sort_by: str, viewer: User) -> List[PostReply]:
     # If post is archived, load from archived data
     if post.archived:
-        archived_data = retrieve_archived_post(post.archived)
-        if archived_data and 'replies' in archived_data:
-            branch_data = find_comment_branch_in_archived(archived_data['replies'], comment_id)
+        archived_replies = retrieve_archived_branch(post.archived, comment_id)
+        if archived_replies is not None:
+            branch_data = find_comment_branch_in_archived(archived_replies, comment_id)
             if branch_data:
                 return convert_archived_replies_to_tree(branch_data, post)
             else:
@@ -241,6 +272,147 @@ def get_comment_branch(post: Post, comment_id: int, sort_by: str, viewer: User)
     return [comment for comment in comments_dict.values() if comment['comment'].id == comment_id]
 
 
+# sort -> the expression replies are sorted by and the direction. The reply id breaks ties, so that together they make a
+# keyset cursor that stays put when replies are added or voted on.
+REPLY_SORTS = {
+    'hot': ('COALESCE(r.ranking, 0)', 'DESC'),
+    'top': ('COALESCE(r.score, 0)', 'DESC'),
+    'new': ('r.posted_at', 'DESC'),
+    'old': ('r.posted_at', 'ASC'),
+}
+REPLY_SORTS['topall'] = REPLY_SORTS['top']
+MAX_THREAD_REPLIES = 2000   # the first thread of a page is always included, however big, up to this many replies
+
+
+def reply_sort_key(reply: PostReply, sort_by: str):
+    if sort_by == 'hot':
+        return reply.ranking or 0
+    elif sort_by in ('top', 'topall'):
+        return reply.score or 0
+    return reply.posted_at.isoformat()
+
+
+def encode_reply_cursor(reply: PostReply, sort_by: str) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps([reply_sort_key(reply, sort_by), reply.id])).decode('ascii')
+
+
+def decode_reply_cursor(cursor: str, sort_by: str):
+    """The sort key and reply id in a cursor from encode_reply_cursor(). Raises ValueError if it isn't one, or is one
+    for a different kind of sort."""
+    try:
+        key, reply_id = orjson.loads(base64.urlsafe_b64decode(cursor))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid page cursor')
+    if isinstance(reply_id, bool) or not isinstance(reply_id, int):
+        raise ValueError('Invalid page cursor')
+    if REPLY_SORTS.get(sort_by, REPLY_SORTS['new'])[0] == 'r.posted_at':
+        if not isinstance(key, str):
+            raise ValueError('Invalid page cursor')
+        key = datetime.fromisoformat(key)
+    elif isinstance(key, bool) or not isinstance(key, (int, float)):
+        raise ValueError('Invalid page cursor')
+    return key, reply_id
+
+
+def post_reply_page(post: Post, sort_by: str, viewer: User | None, cursor: str | None, limit: int,
+                    max_depth: int | None = None, parent: PostReply | None = None) -> tuple[list, str | None]:
+    """One page of the reply threads of a post - the top-level replies, or just `parent` - and their replies, with the
+    cursor of the next page. Threads are kept whole and the page holds as many as fit in `limit` replies, or the first
+    one if it doesn't fit. Returns the same tree as post_replies(). Raises ValueError if the cursor is not valid."""
+    sql, params = reply_page_query(post, sort_by, viewer, cursor, limit, max_depth, parent)
+    replies = db.session.query(PostReply).from_statement(text(sql)).params(**params).all()
+
+    # rows come thread by thread, with every reply after its parent
+    root_depth = parent.depth if parent else 0
+    threads = []
+    sizes = []
+    nodes = {}
+    for reply in replies:
+        node = {'comment': reply, 'replies': []}
+        if reply.depth == root_depth:
+            threads.append(node)
+            sizes.append(0)
+        elif reply.parent_id in nodes:
+            nodes[reply.parent_id]['replies'].append(node)
+        else:
+            continue    # its parent was filtered out
+        nodes[reply.id] = node
+        sizes[-1] += 1
+
+    page = []
+    total = 0
+    for node, size in zip(threads[:limit], sizes):
+        if page and total + size > limit:
+            break
+        page.append(node)
+        total += size
+    next_cursor = encode_reply_cursor(page[-1]['comment'], sort_by) if len(threads) > len(page) else None
+    return page, next_cursor
+
+
+def reply_page_query(post: Post, sort_by: str, viewer: User | None, cursor: str | None, limit: int,
+                     max_depth: int | None = None, parent: PostReply | None = None) -> tuple[str, dict]:
+    """The SQL and parameters for post_reply_page(). The threads and their replies are found with one query. Each
+    reply's path holds the ids of its ancestors, so the replies of a thread whose root is at depth d are the ones with
+    that root's id at path[d + 2] (arrays start at 1 and path[1] is 0). The path @> ARRAY[root] that goes with it is
+    what lets the GIN index on path (idx_post_reply_path) find them."""
+    key, direction = REPLY_SORTS.get(sort_by, REPLY_SORTS['new'])
+    comparison = '<' if direction == 'DESC' else '>'
+    params = {'post_id': post.id, 'roots': limit + 1, 'limit': limit, 'max_thread': MAX_THREAD_REPLIES}
+
+    filters = ''
+    if viewer:
+        instance_ids = blocked_or_banned_instances(viewer.id)
+        if instance_ids:
+            filters += ' AND (r.instance_id IS NULL OR NOT r.instance_id = ANY(:instance_ids))'
+            params['instance_ids'] = instance_ids
+        if viewer.ignore_bots == 1:
+            filters += ' AND r.from_bot = false'
+        blocked_accounts = blocked_users(viewer.id)
+        if blocked_accounts:
+            filters += ' AND NOT r.user_id = ANY(:blocked_accounts)'
+            params['blocked_accounts'] = blocked_accounts
+        if viewer.reply_hide_threshold and not (viewer.is_admin_or_staff() or post.community.is_moderator(viewer)):
+            filters += ' AND r.score > :reply_hide_threshold'
+            params['reply_hide_threshold'] = viewer.reply_hide_threshold
+        if viewer.read_language_ids and len(viewer.read_language_ids) > 0:
+            filters += ' AND (r.language_id IS NULL OR r.language_id = ANY(:language_ids))'
+            params['language_ids'] = list(viewer.read_language_ids)
+
+    if parent:
+        roots = 'r.id = :parent_id'
+        params['parent_id'] = parent.id
+    else:
+        roots = 'r.post_id = :post_id AND r.parent_id IS NULL'
+    if cursor:
+        params['after_key'], params['after_id'] = decode_reply_cursor(cursor, sort_by)
+        roots += f' AND ({key}, r.id) {comparison} (:after_key, :after_id)'
+    depth = ''
+    if max_depth:
+        depth = ' AND r.depth - roots.depth <= :max_depth'
+        params['max_depth'] = max_depth
+
+    return f'''
+        WITH roots AS (
+            SELECT r.id, r.depth, {key} AS sort_key,
+                   row_number() OVER (ORDER BY {key} {direction}, r.id {direction}) AS thread
+            FROM "post_reply" r
+            WHERE {roots}{filters}
+            ORDER BY sort_key {direction}, r.id {direction}
+            LIMIT :roots
+        ), threads AS (
+            SELECT r.*, roots.thread,
+                   row_number() OVER (PARTITION BY roots.id ORDER BY r.depth, {key} {direction}, r.id {direction}) AS n
+            FROM roots JOIN "post_reply" r ON r.post_id = :post_id AND r.path @> ARRAY[roots.id]
+                                              AND r.path[roots.depth + 2] = roots.id
+            WHERE true{filters}{depth}
+        )
+        SELECT * FROM threads
+        WHERE n <= CASE WHEN thread = 1 THEN :max_thread ELSE :limit + 1 END
+        ORDER BY thread, n
+    ''', params
+
+
 # The number of replies a post has
 def get_post_reply_count(post_id) -> int:
     return db.session.execute(
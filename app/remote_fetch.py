@@ -0,0 +1,322 @@
+# Shared state for outgoing GET requests to other servers, kept in redis so all gunicorn and celery workers see it.
+#
+# Circuit breaker - after REMOTE_CIRCUIT_FAILURES failed requests to a host within REMOTE_CIRCUIT_WINDOW seconds, no
+#   more requests are made to it for REMOTE_CIRCUIT_OPEN seconds. The host's Instance row gets a failure recorded
+#   (which eventually makes it dormant) so the rest of the code stops sending to it too.
+# Concurrency limit - at most REMOTE_HOST_CONCURRENCY requests to the same host at once, across all workers. Tasks
+#   that find a host busy can try again later - see fetch_refused().
+# Coalescing - when the same ActivityPub object is requested by several workers at once (e.g. the author of a popular
+#   post, when lots of votes on it arrive together), only one request is made. The others wait up to COALESCE_WAIT
+#   seconds for its response, and use that for REMOTE_COALESCE_SECONDS. If it doesn't come they make their own.
+#
+# get_json_many() makes a batch of requests concurrently within the same limits: it takes as many of each host's slots
+# as it can use and is free to, and doesn't request anything from hosts that are failing. Hosts with no free slots are
+# refused, like single requests are.
+#
+# Apart from that short wait for a coalesced response, none of this ever sleeps. Requests that can't be made are refused
+# straight away with RemoteUnavailable (a subclass of httpx.HTTPError so the existing error handling around get_request
+# applies).
+
+import asyncio
+import hashlib
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import httpx
+import orjson
+import redis
+from flask import current_app, g
+from sqlalchemy import text
+
+from app import cache
+
+COALESCE_MAX_SIZE = 1000000     # responses bigger than this are not shared
+COALESCE_WAIT = 2               # seconds to wait for another worker's response to the same request
+SLOT_TTL = 60                   # in case a worker dies before releasing its slot
+
+# KEYS: in flight count. ARGV: ttl, slots wanted, limit. Returns how many were taken, as many as wanted if there are
+# enough free. The ttl is only set when the count is created, so a busy host's count still expires if slots are lost.
+TAKE_SLOTS_SCRIPT = """
+local in_flight = tonumber(redis.call('GET', KEYS[1]) or '0')
+local taken = math.min(tonumber(ARGV[2]), tonumber(ARGV[3]) - in_flight)
+if taken <= 0 then
+    return 0
+end
+redis.call('INCRBY', KEYS[1], taken)
+if in_flight == 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return taken
+"""
+
+# KEYS: in flight count. ARGV: slots. Never goes below 0, e.g. when the count expired while requests were still being
+# made.
+RELEASE_SLOTS_SCRIPT = """
+local in_flight = redis.call('DECRBY', KEYS[1], ARGV[1])
+if in_flight <= 0 then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+return in_flight
+"""
+
+
+class RemoteUnavailable(httpx.HTTPError):
+    pass
+
+
+class RemoteBusy(RemoteUnavailable):
+    """The host has as many requests in progress as it's allowed - unlike a failing one, it can be tried again soon"""
+
+
+def _redis():
+    from app import redis_client
+    return redis_client
+
+
+def guarded_get(uri: str, accept: str, timeout: float, coalesce: bool, fetch) -> httpx.Response:
+    """Make a GET request (by calling fetch) subject to the circuit breaker, concurrency limit and coalescing.
+    If redis is unavailable the request is just made."""
+    host = urlparse(uri).hostname
+    try:
+        if circuit_open(host):
+            raise RemoteUnavailable(f'{host} is failing, not trying again yet')
+    except redis.exceptions.RedisError:
+        return fetch()
+
+    def limited_fetch():
+        with host_slot(host):
+            return fetch()
+
+    try:
+        response = coalesced_get(uri, accept, timeout, limited_fetch) if coalesce else limited_fetch()
+    except RemoteUnavailable:
+        raise
+    except redis.exceptions.RedisError:
+        return fetch()
+    except httpx.HTTPError:
+        _safely(record_failure, host)
+        raise
+    if response.status_code == 429 or response.status_code >= 500:
+        _safely(record_failure, host)
+    else:
+        _safely(record_success, host)
+    return response
+
+
+def _safely(function, *args):
+    try:
+        function(*args)
+    except redis.exceptions.RedisError:
+        pass
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Circuit breaker
+
+def circuit_open(host: str) -> bool:
+    return bool(_redis().exists(f'circuit_open:{host}')) or host_gone_forever(host)
+
+
+@cache.memoize(timeout=300)
+def host_gone_forever(host: str) -> bool:
+    from app import db
+    return bool(db.session.execute(text('SELECT gone_forever FROM "instance" WHERE domain = :domain'),
+                                   {'domain': host}).scalar())
+
+
+def record_failure(host: str):
+    redis_client = _redis()
+    key = f'circuit_failures:{host}'
+    failures = redis_client.incr(key)
+    if failures == 1:
+        redis_client.expire(key, current_app.config['REMOTE_CIRCUIT_WINDOW'])
+    if failures >= current_app.config['REMOTE_CIRCUIT_FAILURES']:
+        if redis_client.set(f'circuit_open:{host}', 1, ex=current_app.config['REMOTE_CIRCUIT_OPEN'], nx=True):
+            redis_client.delete(key)
+            _record_instance_failure(host)
+
+
+def record_success(host: str):
+    _redis().delete(f'circuit_failures:{host}')
+
+
+def _record_instance_failure(host: str):
+    # the same thing get_request_instance and Instance.update_dormant_gone() do, as one statement
+    from app.utils import get_task_session
+    session = get_task_session()
+    try:
+        session.execute(text('''UPDATE "instance" SET failures = failures + 1, most_recent_attempt = now(),
+                                dormant = dormant OR failures + 1 > 2,
+                                gone_forever = gone_forever OR (failures + 1 > 7 AND dormant)
+                                WHERE domain = :domain'''), {'domain': host})
+        session.commit()
+    except Exception:
+        session.rollback()
+    finally:
+        session.close()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Per-host concurrency
+
+@contextmanager
+def host_slot(host: str):
+    """Reserve one of the host's concurrent request slots, or raise RemoteUnavailable if they are all in use"""
+    if not take_slots(host, 1):
+        g.remote_fetch_refused = True
+        raise RemoteBusy(f'Too many requests to {host} in progress')
+    try:
+        yield
+    finally:
+        release_slots(host, 1)
+
+
+def fetch_refused() -> bool:
+    """Whether a request was refused because its host was busy, since reset_fetch_refused(). The activity or task
+    that needed it can be tried again later instead of failing."""
+    return g.get('remote_fetch_refused', False)
+
+
+def reset_fetch_refused():
+    g.pop('remote_fetch_refused', None)
+
+
+def take_slots(host: str, wanted: int) -> int:
+    """Reserve up to `wanted` of the host's concurrent request slots. Returns how many were reserved, maybe 0."""
+    redis_client = _redis()
+    take = redis_client.register_script(TAKE_SLOTS_SCRIPT)
+    return int(take(keys=[f'remote_in_flight:{host}'],
+                    args=[SLOT_TTL, wanted, current_app.config['REMOTE_HOST_CONCURRENCY']], client=redis_client))
+
+
+def release_slots(host: str, slots: int):
+    redis_client = _redis()
+    release = redis_client.register_script(RELEASE_SLOTS_SCRIPT)
+    release(keys=[f'remote_in_flight:{host}'], args=[slots], client=redis_client)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Coalescing
+
+def coalesce_key(uri: str, accept: str) -> str:
+    return 'remote_get:' + hashlib.sha256(f'{accept} {uri}'.encode()).hexdigest()
+
+
+def coalesced_get(uri: str, accept: str, timeout: float, fetch) -> httpx.Response:
+    """Call fetch() to GET uri, unless another worker is already doing so - then use its response, if it arrives within
+    COALESCE_WAIT seconds."""
+    redis_client = _redis()
+    key = coalesce_key(uri, accept)
+    shared = redis_client.get(key)
+    if shared is not None:
+        return _to_response(uri, shared)
+
+    if not redis_client.set(f'{key}:lock', 1, nx=True, ex=int(timeout * 2) + 5):
+        if redis_client.blpop([f'{key}:done'], timeout=COALESCE_WAIT):
+            redis_client.lpush(f'{key}:done', 1)  # pass the wake up on to the next waiter
+            shared = redis_client.get(key)
+            if shared is not None:
+                return _to_response(uri, shared)
+        return fetch()  # it failed, wasn't shareable or is taking too long
+
+    redis_client.delete(f'{key}:done')  # left over from an earlier fetch of the same url
+    try:
+        response = fetch()
+        if response.status_code == 200 and len(response.content) <= COALESCE_MAX_SIZE:
+            redis_client.set(key, orjson.dumps({'status': response.status_code,
+                                                'content_type': response.headers.get('content-type', ''),
+                                                'text': response.text}),
+                             ex=current_app.config['REMOTE_COALESCE_SECONDS'])
+        return response
+    finally:
+        pipe = redis_client.pipeline()
+        pipe.delete(f'{key}:lock')
+        pipe.rpush(f'{key}:done', 1)
+        pipe.expire(f'{key}:done', COALESCE_WAIT + 1)
+        pipe.execute()
+
+
+def _to_response(uri: str, shared: str) -> httpx.Response:
+    shared = orjson.loads(shared)
+    return httpx.Response(shared['status'], headers={'content-type': shared['content_type']},
+                          content=shared['text'].encode('utf-8'), request=httpx.Request('GET', uri))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Batches
+
+def get_json_many(urls: list, accept: str, timeout: float = 10) -> dict:
+    """GET a batch of json documents concurrently, subject to the circuit breaker and the concurrency limits. Returns
+    {url: parsed json}. Urls that failed, or that could not be requested because of the limits, are left out - if it was
+    because a host was busy, fetch_refused() says so."""
+    by_host = defaultdict(list)
+    for url in urls:
+        by_host[urlparse(url).hostname].append(url)
+    try:
+        slots = {}
+        for host, host_urls in by_host.items():
+            if not circuit_open(host):
+                slots[host] = take_slots(host, len(host_urls))
+                if not slots[host]:
+                    g.remote_fetch_refused = True
+    except redis.exceptions.RedisError:
+        _safely(_release_all, slots)
+        limit = current_app.config['REMOTE_HOST_CONCURRENCY']
+        result, _, _ = _run_batch(urls, {host: limit for host in by_host}, accept, timeout)
+        return result
+
+    try:
+        result, failures, successes = _run_batch([url for host, taken in slots.items() if taken
+                                                  for url in by_host[host]], slots, accept, timeout)
+    finally:
+        _safely(_release_all, slots)
+    for host, failed in failures.items():
+        for _ in range(failed):
+            _safely(record_failure, host)
+    for host in successes - set(failures):
+        _safely(record_success, host)
+    return result
+
+
+def _release_all(slots: dict):
+    for host, taken in slots.items():
+        if taken:
+            release_slots(host, taken)
+
+
+def _run_batch(urls: list, slots: dict, accept: str, timeout: float) -> tuple:
+    """(result, {host: failed requests}, {hosts that answered}) - fetching no more than slots[host] from a host at
+    once"""
+    user_agent = f'PieFed/{current_app.config["VERSION"]}; +https://{current_app.config["SERVER_NAME"]}'
+    return asyncio.run(_fetch_all(urls, slots, accept, timeout, user_agent))
+
+
+async def _fetch_all(urls: list, slots: dict, accept: str, timeout: float, user_agent: str) -> tuple:
+    host_semaphores = {host: asyncio.Semaphore(taken) for host, taken in slots.items() if taken}
+    result, failures, successes = {}, defaultdict(int), set()
+    limits = httpx.Limits(max_connections=sum(slots.values()) or 1, max_keepalive_connections=0)
+    async with httpx.AsyncClient(limits=limits, http2=True, follow_redirects=True,
+                                 timeout=httpx.Timeout(timeout, connect=min(5.0, timeout)),
+                                 headers={'User-Agent': user_agent, 'Accept': accept}) as client:
+        async def one(url):
+            host = urlparse(url).hostname
+            async with host_semaphores[host]:
+                try:
+                    response = await asyncio.wait_for(client.get(url), timeout=timeout)
+                except Exception:
+                    failures[host] += 1
+                    return
+                if response.status_code == 429 or response.status_code >= 500:
+                    failures[host] += 1
+                    return
+                successes.add(host)
+                if response.status_code == 200:
+                    try:
+                        result[url] = response.json()
+                    except ValueError:
+                        pass
+
+        await asyncio.gather(*[one(url) for url in urls])
+    return result, failures, successes
@@ -0,0 +1,121 @@
+# Batched delivery of activities (mostly votes) to other PieFed instances.
+#
+# Activities are stored in the activity_batch table so nothing is lost if redis or a worker goes away. Redis only
+# tracks how many activities are waiting for each instance and whether a flush has been scheduled. Each destination
+# instance gets its own batching window: the first activity for it schedules a flush ACTIVITY_BATCH_MAX_AGE seconds
+# later, or straight away once ACTIVITY_BATCH_MAX_SIZE activities are waiting. The send-queue cron job sweeps up
+# anything that was missed.
+#
+# PieFed accepts an Announce of a list of activities as long as they are all from the same community, so each flush
+# sends one request per community (more if there are more than ACTIVITY_BATCH_MAX_SIZE activities for it).
+
+from collections import defaultdict
+from datetime import timedelta
+
+import redis
+from flask import current_app
+from sqlalchemy import text
+
+from app import celery
+from app.models import ActivityBatch, Community, Instance, utcnow
+from app.utils import gibberish, get_task_session, patch_db_session
+
+PENDING_KEY = 'activity_batch:pending'       # hash of instance id -> number of activities waiting
+SCHEDULED_KEY = 'activity_batch:scheduled'   # hash of instance id -> 1 when a flush task has been queued
+
+
+def queue_batched_activity(session, instance_id: int, community_id: int, payload: dict):
+    """Save an activity to be sent to instance_id in a batch with others, and make sure a flush is on its way"""
+    session.add(ActivityBatch(instance_id=instance_id, community_id=community_id, payload=payload))
+    session.commit()
+
+    if current_app.debug:   # no celery, the send-queue cron job will send it
+        return
+    from app import redis_client
+    pipe = redis_client.pipeline()
+    pipe.hincrby(PENDING_KEY, instance_id, 1)
+    pipe.hsetnx(SCHEDULED_KEY, instance_id, 1)
+    pending, newly_scheduled = pipe.execute()
+
+    if pending >= current_app.config['ACTIVITY_BATCH_MAX_SIZE']:
+        redis_client.hset(SCHEDULED_KEY, instance_id, 1)
+        redis_client.hdel(PENDING_KEY, instance_id)
+        flush_instance_batch.delay(instance_id)
+    elif newly_scheduled:
+        flush_instance_batch.apply_async(args=[instance_id], countdown=current_app.config['ACTIVITY_BATCH_MAX_AGE'])
+
+
+@celery.task
+def flush_instance_batch(instance_id: int):
+    session = get_task_session()
+    try:
+        with patch_db_session(session):
+            from app import redis_client
+            # clear the window first - anything that arrives while this is sending starts a new one
+            redis_client.hdel(SCHEDULED_KEY, instance_id)
+            redis_client.hdel(PENDING_KEY, instance_id)
+            try:
+                with redis_client.lock(f'lock:activity_batch:{instance_id}', timeout=300, blocking_timeout=0):
+                    send_instance_batch(session, instance_id)
+            except redis.exceptions.LockError:  # a flush for this instance is already running, try again after it
+                flush_instance_batch.apply_async(args=[instance_id],
+                                                 countdown=current_app.config['ACTIVITY_BATCH_MAX_AGE'])
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def send_instance_batch(session, instance_id: int):
+    """Send everything waiting for one instance, grouped into as few requests as it will accept"""
+    from app.activitypub.signature import send_post_request, default_context
+
+    rows = session.query(ActivityBatch.id, ActivityBatch.community_id, ActivityBatch.payload).\
+        filter(ActivityBatch.instance_id == instance_id).\
+        order_by(ActivityBatch.community_id, ActivityBatch.created, ActivityBatch.id).all()
+    if not rows:
+        return
+    instance = session.query(Instance).get(instance_id)
+    by_community = defaultdict(list)
+    for row in rows:
+        by_community[row.community_id].append(row.payload)
+
+    if instance is not None and instance.inbox and instance.online():
+        communities = {community.id: community for community in
+                       session.query(Community).filter(Community.id.in_(list(by_community.keys())))}
+        max_size = current_app.config['ACTIVITY_BATCH_MAX_SIZE']
+        for community_id, payloads in by_community.items():
+            community = communities.get(community_id)
+            if community is None:
+                continue
+            for start in range(0, len(payloads), max_size):
+                announce = {
+                    'id': f"{current_app.config['SERVER_URL']}/activities/announce/{gibberish(15)}",
+                    'type': 'Announce',
+                    'actor': community.public_url(),
+                    'object': payloads[start:start + max_size],
+                    '@context': default_context(),
+                    'to': ['https://www.w3.org/ns/activitystreams#Public'],
+                    'cc': [community.ap_followers_url]
+                }
+                send_post_request(instance.inbox, announce, community.private_key,
+                                  community.public_url() + '#main-key', new_task=False)
+
+    # only delete what was loaded, more may have been added in the meantime
+    session.execute(text('DELETE FROM "activity_batch" WHERE id IN :ids'), {'ids': tuple(row.id for row in rows)})
+    session.commit()
+
+
+def sweep_activity_batches(session):
+    """Flush batches that have been waiting longer than they should have, e.g. because redis was restarted"""
+    cutoff = utcnow() - timedelta(seconds=current_app.config['ACTIVITY_BATCH_MAX_AGE'] * 2)
+    if current_app.debug:
+        cutoff = utcnow()
+    instance_ids = session.execute(text('SELECT DISTINCT instance_id FROM "activity_batch" WHERE created < :cutoff'),
+                                   {'cutoff': cutoff}).scalars().all()
+    for instance_id in instance_ids:
+        if current_app.debug:
+            send_instance_batch(session, instance_id)
+        else:
+            flush_instance_batch.delay(instance_id)
@@ -0,0 +1,91 @@
+# Remembering which incoming activities have been dealt with, so that the same activity delivered twice - by a relay,
+# by a sender that retries, or by two instances Announcing the same thing - is only processed once.
+#
+# Two layers, checked together in one redis round trip by is_duplicate():
+#
+# - a claim on the activity id, taken with an atomic SET NX that lasts CLAIM_TTL seconds. Concurrent deliveries of the
+#   same activity can't both get past it, whichever gets there first wins.
+# - a Bloom filter per hour, in a redis bitmap, of the activities that were accepted (remember_activity()). The last
+#   ACTIVITY_DEDUPE_HOURS of them are checked, which catches the redeliveries that come minutes or hours later at a few
+#   hundred KB an hour instead of a key per activity. A Bloom filter can be wrong in one direction only - very
+#   occasionally (FALSE_POSITIVE_RATE per hour checked) an activity that is new will be taken for a duplicate.
+#
+# Redis being unavailable makes everything look new, like it did before there was any deduplication.
+
+import hashlib
+import math
+import time
+
+import redis
+from flask import current_app
+
+CLAIM_KEY = 'activity_claim:{}'
+CLAIM_TTL = 90
+SEEN_KEY = 'activity_seen:{}'   # bitmap per hour
+FALSE_POSITIVE_RATE = 0.0001
+
+
+def filter_size(capacity: int, error_rate: float = FALSE_POSITIVE_RATE) -> tuple[int, int]:
+    """(bits, hashes) of a Bloom filter that holds capacity items with the given false positive rate"""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+def bit_positions(activity_id: str, bits: int, hashes: int) -> list[int]:
+    # double hashing - two halves of one digest make as many hash functions as are needed
+    digest = hashlib.sha256(activity_id.encode('utf-8')).digest()
+    h1 = int.from_bytes(digest[:8], 'big')
+    h2 = int.from_bytes(digest[8:16], 'big') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+def _filter_hours() -> list[int]:
+    this_hour = int(time.time() // 3600)
+    return list(range(this_hour - current_app.config['ACTIVITY_DEDUPE_HOURS'] + 1, this_hour + 1))
+
+
+def is_duplicate(activity_id: str) -> bool:
+    """True if activity_id is being handled already or was accepted in the last ACTIVITY_DEDUPE_HOURS. Otherwise it is
+    claimed for CLAIM_TTL seconds, so other deliveries of it are duplicates until then."""
+    from app import redis_client
+    hours = _filter_hours()
+    bits, hashes = filter_size(current_app.config['ACTIVITY_DEDUPE_PER_HOUR'])
+    positions = bit_positions(activity_id, bits, hashes)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.set(CLAIM_KEY.format(activity_id), 1, nx=True, ex=CLAIM_TTL)
+        for hour in hours:
+            pipe.execute_command('BITFIELD', SEEN_KEY.format(hour),
+                                 *[arg for position in positions for arg in ('GET', 'u1', position)])
+        claimed, *seen = pipe.execute()
+    except redis.exceptions.RedisError:
+        return False
+    return not claimed or any(all(bits_in_hour) for bits_in_hour in seen)
+
+
+def remember_activity(activity_id: str):
+    """activity_id has been accepted - later deliveries of it are duplicates for the next ACTIVITY_DEDUPE_HOURS"""
+    from app import redis_client
+    if current_app.config['ACTIVITY_DEDUPE_HOURS'] <= 0:
+        return
+    hour = _filter_hours()[-1]
+    bits, hashes = filter_size(current_app.config['ACTIVITY_DEDUPE_PER_HOUR'])
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.execute_command('BITFIELD', SEEN_KEY.format(hour),
+                             *[arg for position in bit_positions(activity_id, bits, hashes)
+                               for arg in ('SET', 'u1', position, 1)])
+        pipe.expire(SEEN_KEY.format(hour), (current_app.config['ACTIVITY_DEDUPE_HOURS'] + 1) * 3600)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+
+
+def release_activity(activity_id: str):
+    """activity_id was turned away before being accepted (e.g. with a 429), so the sender's retry isn't a duplicate"""
+    from app import redis_client
+    try:
+        redis_client.delete(CLAIM_KEY.format(activity_id))
+    except redis.exceptions.RedisError:
+        pass
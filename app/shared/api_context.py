@@ -0,0 +1,160 @@
+# What an authenticated API request needs to know about the user making it - whether they can log in, the communities
+# they follow, moderate and are banned from, who they block, their bookmarked, subscribed and voted-on comments - cached
+# in redis so it can be loaded with one round trip instead of a User query, five more queries and three cache lookups.
+#
+# Each user has a context version in redis, which is incremented when a transaction that changes any of those things is
+# committed. Changes made through the ORM are noticed automatically (note_changes() and bump_changed(), listening to
+# every session), and so are bulk query deletes and updates (note_bulk_changes()). Code that changes them with raw SQL
+# calls changed() instead.
+#
+# A context is only used if it was built at the current version. The version is read before the context is built from
+# the database, so a change committed while it was being built makes it out of date straight away rather than letting
+# it be served.
+
+import base64
+import zlib
+
+import orjson
+import redis
+from sqlalchemy import inspect, select, text
+
+from app.constants import NOTIF_REPLY
+
+CONTEXT_KEY = 'api_context:{}'
+VERSION_KEY = 'api_context_version:{}'   # never expires, so a version number is never used twice for a user
+CONTEXT_TTL = 60 * 60
+CHANGED = 'api_context_changed'         # in session.info - ids of users whose context the transaction changes
+
+# tables that are part of the context -> the column with the id of the user they belong to
+WATCHED = {
+    'community_member': 'user_id',
+    'community_ban': 'user_id',
+    'instance_ban': 'user_id',
+    'user_block': 'blocker_id',
+    'post_reply_bookmark': 'user_id',
+    'notification_subscription': 'user_id',
+    'post_reply_vote': 'user_id',
+}
+LOGIN_FIELDS = ('ap_id', 'verified', 'banned', 'deleted', 'password_updated_at')
+
+
+def api_context(user_id: int) -> dict | None:
+    """The context of a user, from redis if it is up to date. None if there is no such user."""
+    from app import db, redis_client
+    try:
+        version, packed = redis_client.mget(VERSION_KEY.format(user_id), CONTEXT_KEY.format(user_id))
+    except redis.exceptions.RedisError:
+        return build_context(db.session, user_id)
+    version = version or '0'
+    if packed:
+        context = unpack(packed)
+        if context['version'] == version:
+            return context
+    context = build_context(db.session, user_id)
+    if context is not None:
+        context['version'] = version
+        try:
+            redis_client.set(CONTEXT_KEY.format(user_id), pack(context), ex=CONTEXT_TTL)
+        except redis.exceptions.RedisError:
+            pass
+    return context
+
+
+def build_context(session, user_id: int) -> dict | None:
+    login = session.execute(text('SELECT ap_id IS NOT NULL AS remote, verified, banned, deleted, password_updated_at '
+                                 'FROM "user" WHERE id = :user_id'), {'user_id': user_id}).first()
+    if login is None:
+        return None
+
+    def ids(sql):
+        return list(session.execute(text(sql), {'user_id': user_id, 'type': NOTIF_REPLY}).scalars())
+
+    return {
+        'id': user_id,
+        'remote': login.remote,
+        'verified': login.verified,
+        'banned': login.banned,
+        'deleted': login.deleted,
+        'password_updated_at': int(login.password_updated_at.timestamp()) if login.password_updated_at else None,
+        'user_ban_community_ids':
+            ids('SELECT community_id FROM "community_ban" WHERE user_id = :user_id') +
+            ids('SELECT c.id FROM "community" c JOIN "instance_ban" ib ON c.instance_id = ib.instance_id '
+                'WHERE ib.user_id = :user_id'),
+        'followed_community_ids': ids('SELECT community_id FROM "community_member" WHERE user_id = :user_id'),
+        'bookmarked_reply_ids': ids('SELECT post_reply_id FROM "post_reply_bookmark" WHERE user_id = :user_id'),
+        'blocked_creator_ids': ids('SELECT blocked_id FROM "user_block" WHERE blocker_id = :user_id'),
+        # sorted so that in_sorted_list can be used
+        'upvoted_reply_ids': sorted(ids('SELECT post_reply_id FROM "post_reply_vote" '
+                                        'WHERE user_id = :user_id AND effect > 0 ORDER BY id DESC LIMIT 3000')),
+        'downvoted_reply_ids': sorted(ids('SELECT post_reply_id FROM "post_reply_vote" '
+                                          'WHERE user_id = :user_id AND effect < 0 ORDER BY id DESC LIMIT 3000')),
+        'subscribed_reply_ids': ids('SELECT entity_id FROM "notification_subscription" '
+                                    'WHERE type = :type AND user_id = :user_id'),
+        'moderated_community_ids': ids('SELECT community_id FROM "community_member" '
+                                       'WHERE user_id = :user_id AND is_moderator = true'),
+    }
+
+
+def pack(context: dict) -> str:
+    # the id lists can be thousands long and compress well. base85 because redis_client decodes responses as text.
+    return base64.b85encode(zlib.compress(orjson.dumps(context))).decode('ascii')
+
+
+def unpack(packed: str) -> dict:
+    return orjson.loads(zlib.decompress(base64.b85decode(packed)))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Invalidation
+
+def changed(session, *user_ids: int):
+    """The context of these users is changed by something the session is doing that the ORM doesn't see, e.g. raw SQL"""
+    session.info.setdefault(CHANGED, set()).update(user_ids)
+
+
+def note_changes(session, flush_context, instances):
+    """before_flush - remember whose context the objects about to be written belong to. Before rather than after, so
+    the rows of deleted objects are still there if their user id has to be loaded."""
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table in WATCHED:
+            changed(session, getattr(obj, WATCHED[table]))
+        elif table == 'user' and obj in session.dirty:
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in LOGIN_FIELDS):
+                changed(session, obj.id)
+
+
+def note_bulk_changes(orm_execute_state):
+    """do_orm_execute - query(...).delete() and .update() don't go through the session's objects, so look up whose rows
+    they are about to change"""
+    if not (orm_execute_state.is_delete or orm_execute_state.is_update):
+        return
+    statement = orm_execute_state.statement
+    column = WATCHED.get(statement.table.name)
+    if column is None:
+        return
+    users = select(statement.table.c[column]).distinct()
+    if statement.whereclause is not None:
+        users = users.where(statement.whereclause)
+    changed(orm_execute_state.session, *orm_execute_state.session.execute(users).scalars())
+
+
+def bump_changed(session):
+    """after_commit - the changes are visible to other transactions now, so contexts built before them are out of date"""
+    user_ids = session.info.pop(CHANGED, None)
+    if user_ids:
+        from app import redis_client
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for user_id in user_ids:
+                if user_id is not None:
+                    pipe.incr(VERSION_KEY.format(user_id))
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            pass
+
+
+def forget_changed(session):
+    """after_rollback - nothing was changed after all"""
+    session.info.pop(CHANGED, None)
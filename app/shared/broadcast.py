@@ -0,0 +1,205 @@
+# Sending one activity to every instance we know about (e.g. the Delete of an account) without queuing a celery task
+# per instance.
+#
+# The activity and the key to sign it with are stored once, in a Broadcast row. A task then sends it to
+# BROADCAST_CHUNK_SIZE instances at a time through one pooled async http client (at most BROADCAST_CONCURRENCY requests
+# at once, REMOTE_HOST_CONCURRENCY to any one host) and queues itself again for the next chunk. The results are only
+# counted, on the Broadcast row - see /admin/queues.
+#
+# Deliveries that fail with a 429 or 5xx are handed to the send queue to be retried like any other. Instances that
+# respond with 410 are marked as gone forever, as post_request() does.
+#
+# The send-queue cron queues a broadcast again if it stops making progress (e.g. the worker sending it was restarted)
+# and gives up on it after ABANDON_AFTER, so the private key stored with it is not kept forever.
+
+import asyncio
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+from urllib.parse import urlparse
+
+import httpx
+import redis
+from flask import current_app, json
+
+from app import celery
+from app.activitypub.signature import HttpSignature, default_context, local_actor_private_key
+from app.models import ActivityPubLog, Broadcast, Instance, SendQueue, utcnow
+from app.utils import get_task_session, patch_db_session
+
+DELIVERED = {200, 201, 202, 204}
+GONE = {410, 418}
+BROADCASTS_KEY = 'broadcasts'   # sorted set of the id of each broadcast being sent -> when it last sent a chunk
+STALLED_AFTER = 60 * 11         # longer than the lock a chunk is sent under
+ABANDON_AFTER = timedelta(days=1)
+
+
+def broadcast_to_all_instances(session, payload: dict, private_key: str, key_id: str) -> Broadcast:
+    """Send an activity to the inbox of every instance that is online"""
+    if '@context' not in payload:
+        payload['@context'] = default_context()
+    broadcast = Broadcast(activity_id=payload.get('id'), activity_type=payload.get('type', ''), payload=payload,
+                          actor=key_id, private_key=private_key, failures={},
+                          total=session.query(Instance).filter(*_recipients()).count())
+    session.add(broadcast)
+    session.commit()
+    save_progress(broadcast.id)
+    if current_app.debug:
+        send_broadcast(broadcast.id)
+    else:
+        send_broadcast.delay(broadcast.id)
+    return broadcast
+
+
+def _recipients():
+    return [Instance.id != 1,  # instance id 1 is always the current instance
+            Instance.inbox != None, Instance.inbox != '', Instance.dormant == False, Instance.gone_forever == False]
+
+
+def save_progress(broadcast_id: int):
+    from app import redis_client
+    redis_client.zadd(BROADCASTS_KEY, {str(broadcast_id): time.time()})
+
+
+def resume_stalled_broadcasts(session=None):
+    """Queue again any broadcast that has not sent a chunk for a while, or finish it if it has been going for too long.
+    Run by the send-queue cron."""
+    from app import db, redis_client
+    session = session or db.session
+    for broadcast_id in redis_client.zrangebyscore(BROADCASTS_KEY, '-inf', time.time() - STALLED_AFTER):
+        broadcast = session.query(Broadcast).get(int(broadcast_id))
+        if broadcast is None or broadcast.finished:
+            redis_client.zrem(BROADCASTS_KEY, broadcast_id)
+        elif broadcast.created < utcnow() - ABANDON_AFTER:
+            finish_broadcast(session, broadcast, abandoned=True)
+        else:
+            save_progress(broadcast.id)
+            if current_app.debug:
+                send_broadcast(broadcast.id)
+            else:
+                send_broadcast.delay(broadcast.id)
+
+
+@celery.task
+def send_broadcast(broadcast_id: int):
+    session = get_task_session()
+    try:
+        with patch_db_session(session):
+            from app import redis_client
+            try:
+                with redis_client.lock(f'lock:broadcast:{broadcast_id}', timeout=600, blocking_timeout=0):
+                    more = send_broadcast_chunk(session, broadcast_id)
+            except redis.exceptions.LockError:  # already being sent
+                return
+            if more:
+                if current_app.debug:
+                    send_broadcast(broadcast_id)
+                else:
+                    send_broadcast.delay(broadcast_id)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def send_broadcast_chunk(session, broadcast_id: int) -> bool:
+    """Send to the next chunk of instances. True if there are more to do."""
+    broadcast = session.query(Broadcast).get(broadcast_id)
+    if broadcast is None or broadcast.finished:
+        return False
+    chunk_size = current_app.config['BROADCAST_CHUNK_SIZE']
+    instances = session.query(Instance.id, Instance.inbox).filter(Instance.id > broadcast.cursor, *_recipients()).\
+        order_by(Instance.id).limit(chunk_size).all()
+    private_key = broadcast.private_key or local_actor_private_key(broadcast.actor, session)
+
+    if instances and private_key:
+        # signed here rather than when the broadcast was created because signatures are only valid for a while
+        requests = HttpSignature.signed_requests([instance.inbox for instance in instances], broadcast.payload,
+                                                 private_key, broadcast.actor)
+        outcomes = deliver(requests)
+        record_outcomes(session, broadcast, instances, outcomes)
+        broadcast.cursor = instances[-1].id
+
+    if len(instances) < chunk_size or not private_key:
+        finish_broadcast(session, broadcast)
+        return False
+    session.commit()
+    save_progress(broadcast.id)
+    return True
+
+
+def record_outcomes(session, broadcast: Broadcast, instances: list, outcomes: list):
+    failures = Counter(broadcast.failures or {})
+    retry = []
+    gone = []
+    for instance, outcome in zip(instances, outcomes):
+        if outcome in DELIVERED:
+            broadcast.sent += 1
+            continue
+        broadcast.failed += 1
+        failures[str(outcome)] += 1
+        if outcome in GONE:
+            gone.append(instance.id)
+        elif isinstance(outcome, int) and (outcome == 429 or outcome >= 500):
+            retry.append(instance.inbox)
+    broadcast.failures = dict(failures)
+
+    if gone:
+        session.query(Instance).filter(Instance.id.in_(gone)).update({Instance.gone_forever: True},
+                                                                   synchronize_session=False)
+    if retry:
+        # the send queue looks up the keys of local actors when it's time to retry, only store other ones
+        stored_key = None if local_actor_private_key(broadcast.actor, session) else broadcast.private_key
+        payload = json.dumps(broadcast.payload)
+        send_after = utcnow() + timedelta(seconds=60)
+        session.add_all([SendQueue(destination=inbox, destination_domain=urlparse(inbox).hostname,
+                                   actor=broadcast.actor, private_key=stored_key, payload=payload, retries=0,
+                                   retry_reason=f'broadcast {broadcast.id}', send_after=send_after)
+                         for inbox in retry])
+        broadcast.retrying += len(retry)
+
+
+def finish_broadcast(session, broadcast: Broadcast, abandoned: bool = False):
+    """Done, or `abandoned` part way through. Either way the private key is not needed any more."""
+    from app import redis_client
+    broadcast.finished = utcnow()
+    broadcast.private_key = None
+    session.add(ActivityPubLog(direction='out', activity_type=broadcast.activity_type, activity_id=broadcast.activity_id,
+                               activity_json=json.dumps(broadcast.payload),
+                               result='success' if (broadcast.sent or not broadcast.failed) and not abandoned
+                               else 'failure',
+                               exception_message=f'Broadcast {"abandoned after" if abandoned else "to"} '
+                                                 f'{broadcast.sent + broadcast.failed} instances: '
+                                                 f'{broadcast.sent} delivered, {broadcast.failed} failed, '
+                                                 f'{broadcast.retrying} queued for retry'))
+    session.commit()
+    redis_client.zrem(BROADCASTS_KEY, str(broadcast.id))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Pooled async sending
+
+def deliver(requests: list) -> list:
+    """POST each (uri, headers, body) from HttpSignature.signed_requests(). Returns the status code of each response, or
+    'timeout' / 'error', in the same order."""
+    return asyncio.run(_deliver_all(requests, current_app.config['BROADCAST_CONCURRENCY'],
+                                    current_app.config['REMOTE_HOST_CONCURRENCY'], timeout=10))
+
+
+async def _deliver_all(requests: list, concurrency: int, host_concurrency: int, timeout: float) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    host_semaphores = defaultdict(lambda: asyncio.Semaphore(host_concurrency))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout, connect=min(5.0, timeout))) as client:
+        async def one(uri, headers, body):
+            async with semaphore, host_semaphores[urlparse(uri).hostname]:
+                try:
+                    response = await client.post(uri, headers=headers, content=body)
+                    return response.status_code
+                except httpx.TimeoutException:
+                    return 'timeout'
+                except Exception:
+                    return 'error'
+
+        return await asyncio.gather(*[one(uri, headers, body) for uri, headers, body in requests])
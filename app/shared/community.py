@@ -30,7 +30,7 @@ from app.models import (
     CommunityInvitation,
 )
 from app.shared.tasks import task_selector
-from app.shared.upload import process_upload
+from app.shared.upload import process_upload, file_for_image_url
 from app.user.utils import search_for_user
 from app.utils import (
     authorise_api_user,
@@ -471,16 +471,14 @@ def edit_community(
         )
 
     if icon_url and (from_scratch or icon_url_changed) and is_image_url(icon_url):
-        file = File(source_url=icon_url)
-        db.session.add(file)
+        file = file_for_image_url(icon_url)
         db.session.commit()
         community.icon_id = file.id
         make_image_sizes(
             community.icon_id, 40, 250, "communities", community.low_quality
         )
     if banner_url and (from_scratch or banner_url_changed) and is_image_url(banner_url):
-        file = File(source_url=banner_url)
-        db.session.add(file)
+        file = file_for_image_url(banner_url)
         db.session.commit()
         community.image_id = file.id
         make_image_sizes(
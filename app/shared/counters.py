@@ -0,0 +1,271 @@
+# Write-behind counters for the busiest aggregate columns: the votes, score and reply count of posts and comments, the
+# post and comment counts of communities and users, users' reputation and last_active.
+#
+# Each vote used to update its post and the post's author in the voter's transaction, so a popular post was a hot row
+# that everyone voting on it queued up for, behind a redis lock. Now the change goes into a hash in redis
+# (HINCRBYFLOAT, so concurrent votes don't wait for each other). COUNTER_FLUSH_DELAY seconds later flush_counters() adds
+# everything that has built up to the database with one UPDATE per table and works out the new rankings.
+#
+# Until then the database is behind, so when one of these rows is loaded the changes not flushed yet are added to it
+# without marking it as modified (merge_pending()). That is only for showing them: the columns are never assigned and
+# saved the usual way, e.g. `post.reply_count -= 1`, as that would write an absolute value over changes flushed in the
+# meantime. Every change goes through increment() or apply(), after the change it counts has been committed - or, for
+# changes made in bulk in SQL, increment_on_commit() which waits for the commit itself.
+
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import redis
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import celery
+
+COUNTERS = {
+    'post': ('up_votes', 'down_votes', 'score', 'reply_count'),
+    'post_reply': ('up_votes', 'down_votes', 'score'),
+    'community': ('post_count', 'post_reply_count'),
+    'user': ('reputation', 'post_count', 'post_reply_count'),
+    'cross_post_group': ('reply_count',),
+}
+TIMESTAMPS = {'post': ('last_active',), 'community': ('last_active',)}
+
+KEY = 'counters:{}:{}'          # hash of column -> change not yet flushed, or the time for a timestamp column
+DIRTY_KEY = 'counters:dirty'    # set of 'table:id' that have something to flush
+FLUSH_DUE_KEY = 'counters:flush_due'
+INCREMENT_AFTER_COMMIT = 'counters_after_commit'    # in session.info - (model, column) -> {id: change}
+
+_dirty_snapshot = (0.0, frozenset())    # (when it was read, DIRTY_KEY) - see _recently_dirty()
+
+
+def increment(model, row_id: int, **deltas):
+    """Add to counter columns of one row, e.g. increment(Post, 5, up_votes=1, score=1)"""
+    from app import redis_client
+    table = model.__tablename__
+    key = KEY.format(table, row_id)
+    pipe = redis_client.pipeline(transaction=False)
+    for field, delta in deltas.items():
+        if delta:
+            pipe.hincrbyfloat(key, field, delta)
+    pipe.sadd(DIRTY_KEY, f'{table}:{row_id}')
+    pipe.execute()
+    _schedule_flush()
+
+
+def increment_each(model, field: str, deltas: dict):
+    """increment() the same column of many rows, e.g. increment_each(Post, 'reply_count', {5: -2, 9: -1})"""
+    from app import redis_client
+    deltas = {row_id: delta for row_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    table = model.__tablename__
+    pipe = redis_client.pipeline(transaction=False)
+    for row_id, delta in deltas.items():
+        pipe.hincrbyfloat(KEY.format(table, row_id), field, delta)
+        pipe.sadd(DIRTY_KEY, f'{table}:{row_id}')
+    pipe.execute()
+    _schedule_flush()
+
+
+def increment_on_commit(session, model, field: str, deltas: dict):
+    """increment_each() once the session commits, for changes counted in the same transaction as the rows they count"""
+    pending = session.info.setdefault(INCREMENT_AFTER_COMMIT, {}).setdefault((model, field), Counter())
+    pending.update(deltas)
+
+
+def increment_committed(session):
+    """after_commit"""
+    for (model, field), deltas in session.info.pop(INCREMENT_AFTER_COMMIT, {}).items():
+        increment_each(model, field, deltas)
+
+
+def forget_uncommitted(session):
+    """after_rollback - the changes were never made"""
+    session.info.pop(INCREMENT_AFTER_COMMIT, None)
+
+
+def touch(model, row_id: int, field: str = 'last_active'):
+    """Set a timestamp column to now"""
+    from app import redis_client
+    table = model.__tablename__
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(KEY.format(table, row_id), field, time.time())
+    pipe.sadd(DIRTY_KEY, f'{table}:{row_id}')
+    pipe.execute()
+    _schedule_flush()
+
+
+def apply(obj, **deltas):
+    """increment() a loaded object and add the same to it in memory, so it can be shown straight away"""
+    current = {field: getattr(obj, field) or 0 for field in deltas}     # load them first, if they have been expired
+    increment(type(obj), obj.id, **deltas)
+    for field, delta in deltas.items():
+        if isinstance(current[field], int):
+            delta = round(delta)
+        set_committed_value(obj, field, current[field] + delta)
+
+
+def apply_totals(obj, **totals):
+    """Make counter columns of a loaded object equal to totals counted some other way (a recount, or a remote server's
+    numbers) by apply()ing the difference, so changes that are still on their way to the database are not lost"""
+    current = {field: getattr(obj, field) or 0 for field in totals}
+    apply(obj, **{field: total - current[field] for field, total in totals.items()})
+
+
+def _schedule_flush():
+    from app import redis_client
+    delay = current_app.config['COUNTER_FLUSH_DELAY']
+    if redis_client.set(FLUSH_DUE_KEY, 1, nx=True, ex=delay + 60):
+        if current_app.debug:
+            flush_counters()
+        else:
+            flush_counters.apply_async(countdown=delay)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Reading
+
+def _recently_dirty() -> frozenset:
+    """The rows with unflushed changes, as of up to a second ago. Re-read at most once a second per process so loading
+    rows that have nothing pending (nearly all of them) costs nothing."""
+    global _dirty_snapshot
+    read_at, dirty = _dirty_snapshot
+    now = time.monotonic()
+    if now - read_at > 1.0:
+        from app import redis_client
+        dirty = frozenset(redis_client.smembers(DIRTY_KEY)) if redis_client is not None else frozenset()
+        _dirty_snapshot = (now, dirty)
+    return dirty
+
+
+def merge_pending(obj, fields=None):
+    """Add the changes that have not been flushed yet to a row that has just been loaded from the database. `fields` is
+    the columns that were loaded, if it was only some of them."""
+    table = obj.__tablename__
+    try:
+        if f'{table}:{obj.id}' not in _recently_dirty():
+            return
+        from app import redis_client
+        pending = redis_client.hgetall(KEY.format(table, obj.id))
+    except redis.exceptions.RedisError:
+        return
+    loaded = obj.__dict__
+    for field, value in pending.items():
+        if field not in loaded or (fields and field not in fields):
+            continue
+        if field in TIMESTAMPS.get(table, ()):
+            when = datetime.fromtimestamp(float(value), timezone.utc).replace(tzinfo=None)
+            if loaded[field] is None or when > loaded[field]:
+                set_committed_value(obj, field, when)
+        elif field in COUNTERS[table]:
+            current = loaded[field] or 0
+            delta = round(float(value)) if isinstance(current, int) else float(value)
+            set_committed_value(obj, field, current + delta)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Flushing
+
+@celery.task
+def flush_counters():
+    from app.utils import get_task_session, patch_db_session
+    from app import redis_client
+    redis_client.delete(FLUSH_DUE_KEY)
+    session = get_task_session()
+    try:
+        with patch_db_session(session):
+            while flush_batch(session, current_app.config['COUNTER_FLUSH_BATCH']):
+                pass
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def flush_batch(session, size: int) -> bool:
+    """Write up to `size` rows worth of changes to the database. True if there may be more."""
+    from app import redis_client
+    members = redis_client.spop(DIRTY_KEY, size)
+    if not members:
+        return False
+
+    # move the changes aside so that new ones can keep arriving while these are written
+    pipe = redis_client.pipeline()
+    for member in members:
+        key = KEY.format(*member.split(':'))
+        pipe.hgetall(key)
+        pipe.delete(key)
+    results = pipe.execute()
+    changes = {}
+    for member, pending in zip(members, results[::2]):
+        if pending:
+            table, row_id = member.split(':')
+            changes.setdefault(table, {})[int(row_id)] = pending
+
+    try:
+        for table, rows in changes.items():
+            session.execute(*update_statement(table, rows))
+        session.commit()
+        update_rankings(session, list(changes.get('post', {})), list(changes.get('post_reply', {})))
+    except Exception:
+        session.rollback()
+        restore(changes)
+        raise
+    return len(members) == size
+
+
+def update_statement(table: str, rows: dict) -> tuple:
+    """One UPDATE ... FROM (VALUES ...) for all the rows of a table"""
+    counters = COUNTERS[table]
+    timestamps = TIMESTAMPS.get(table, ())
+    values = []
+    params = {}
+    for i, (row_id, pending) in enumerate(rows.items()):
+        params[f'id{i}'] = row_id
+        columns = [f':id{i}']
+        for field in counters:
+            params[f'{field}{i}'] = float(pending.get(field, 0))
+            columns.append(f'CAST(:{field}{i} AS double precision)')
+        for field in timestamps:
+            params[f'{field}{i}'] = datetime.fromtimestamp(float(pending[field]), timezone.utc).replace(tzinfo=None) \
+                if field in pending else None
+            columns.append(f'CAST(:{field}{i} AS timestamp)')
+        values.append(f"({', '.join(columns)})")
+    assignments = [f'{field} = COALESCE(t.{field}, 0) + v.{field}' for field in counters] + \
+                  [f'{field} = GREATEST(t.{field}, v.{field})' for field in timestamps]
+    sql = f'UPDATE "{table}" AS t SET {", ".join(assignments)} ' \
+          f'FROM (VALUES {", ".join(values)}) AS v(id, {", ".join(counters + timestamps)}) WHERE t.id = v.id'
+    return text(sql), params
+
+
+def restore(changes: dict):
+    """Put changes that could not be written back into redis, to be tried again"""
+    from app import redis_client
+    pipe = redis_client.pipeline(transaction=False)
+    for table, rows in changes.items():
+        for row_id, pending in rows.items():
+            key = KEY.format(table, row_id)
+            for field, value in pending.items():
+                if field in TIMESTAMPS.get(table, ()):
+                    pipe.hset(key, field, value)
+                else:
+                    pipe.hincrbyfloat(key, field, float(value))
+            pipe.sadd(DIRTY_KEY, f'{table}:{row_id}')
+    pipe.execute()
+
+
+def update_rankings(session, post_ids: list, reply_ids: list):
+    """Votes and replies change the 'hot' ranking, which used to be worked out on every vote"""
+    from app.models import Post, PostReply
+    from app.utils import wilson_confidence_lower_bound
+    if post_ids:
+        for post in session.query(Post).filter(Post.id.in_(post_ids)):
+            post.ranking = post.post_ranking(post.score + post.reply_count, post.created_at)
+            post.ranking_scaled = int(post.ranking + post.community.scale_by())
+    if reply_ids:
+        for reply in session.query(PostReply).filter(PostReply.id.in_(reply_ids)):
+            reply.ranking = wilson_confidence_lower_bound(reply.up_votes, reply.down_votes)
+    session.commit()
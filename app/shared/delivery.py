@@ -0,0 +1,85 @@
+# Sending activities through the piefed-notifs service (fastapi_server.py), which POSTs them from one pooled async http
+# client instead of a celery task per inbox.
+#
+# The signed requests are pushed onto a redis list that every notifs process takes batches from, so each is sent once
+# however many processes there are. The service reports back through redis:
+#   - which hosts accepted deliveries, which failed (and how often) and which said they are gone (410)
+#   - deliveries that failed with a 429, 5xx or timeout, if they were sent with retry=True
+# record_delivery_results(), run by the send-queue cron, applies all that to the instance table with a few bulk UPDATEs
+# and puts the retries on the send queue, where they are signed again and retried with the usual backoff.
+
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from flask import json
+from sqlalchemy import text
+
+from app.activitypub.signature import HttpSignature, local_actor_private_key
+from app.models import SendQueue, utcnow
+
+# Must match fastapi_server.py
+DELIVERY_QUEUE = 'http_posts:queue'
+OK_KEY = 'delivery:ok'              # set of hosts that accepted a delivery
+FAILED_KEY = 'delivery:failed'      # hash of host -> number of failed deliveries
+GONE_KEY = 'delivery:gone'          # set of hosts that responded 410 or 418
+RETRY_KEY = 'delivery:retry'        # list of {"url", "actor", "data", "reason"} to send again later
+
+RETRY_BATCH = 1000
+
+
+def send_async(inboxes: list, activity: dict, private_key: str, key_id: str, retry: bool = False):
+    """Have the notifs service POST an activity to some inboxes. With retry=False failures are only counted against the
+    instance, which is fine for votes."""
+    from app import redis_client
+    if not inboxes:
+        return
+    # sign for all the inboxes at once, the body and its digest are the same for all of them
+    requests = HttpSignature.signed_requests(inboxes, activity, private_key, key_id)
+    redis_client.rpush(DELIVERY_QUEUE, json.dumps({'urls': [request[0] for request in requests],
+                                                   'headers': [request[1] for request in requests],
+                                                   'data': requests[0][2].decode('utf-8'),
+                                                   'actor': key_id,
+                                                   'retry': retry}))
+
+
+def record_delivery_results(session):
+    """Update the health of instances from the notifs service's deliveries since last time, and queue its retries"""
+    from app import redis_client
+    pipe = redis_client.pipeline()
+    pipe.smembers(OK_KEY)
+    pipe.hgetall(FAILED_KEY)
+    pipe.smembers(GONE_KEY)
+    pipe.lrange(RETRY_KEY, 0, RETRY_BATCH - 1)
+    pipe.delete(OK_KEY, FAILED_KEY, GONE_KEY)
+    pipe.ltrim(RETRY_KEY, RETRY_BATCH, -1)
+    ok, failed, gone, retries = pipe.execute()[:4]
+
+    if ok:
+        session.execute(text('''UPDATE "instance" SET failures = 0, dormant = false, start_trying_again = null,
+                                last_successful_send = now() WHERE domain IN :domains'''), {'domains': tuple(ok)})
+    # a host that failed but also accepted something is probably fine. One failure per run for the others, however many
+    # deliveries failed - the same as get_request_instance and Instance.update_dormant_gone() do, as one statement.
+    failing = set(failed) - set(ok) - set(gone)
+    if failing:
+        session.execute(text('''UPDATE "instance" SET failures = failures + 1, most_recent_attempt = now(),
+                                dormant = dormant OR failures + 1 > 2,
+                                gone_forever = gone_forever OR (failures + 1 > 7 AND dormant)
+                                WHERE domain IN :domains'''), {'domains': tuple(failing)})
+    if gone:
+        session.execute(text('UPDATE "instance" SET gone_forever = true WHERE domain IN :domains'),
+                        {'domains': tuple(gone)})
+        session.query(SendQueue).filter(SendQueue.destination_domain.in_(gone)).delete(synchronize_session=False)
+
+    send_after = utcnow() + timedelta(seconds=60)
+    local_actors = {}
+    for retry in retries:
+        retry = json.loads(retry)
+        # the send queue signs them again with the key of the local actor, anything else can't be retried
+        if retry['actor'] not in local_actors:
+            local_actors[retry['actor']] = local_actor_private_key(retry['actor'], session) is not None
+        if urlparse(retry['url']).hostname in gone or not local_actors[retry['actor']]:
+            continue
+        session.add(SendQueue(destination=retry['url'], destination_domain=urlparse(retry['url']).hostname,
+                              actor=retry['actor'], private_key=None, payload=retry['data'], retries=0,
+                              retry_reason=retry['reason'], send_after=send_after))
+    session.commit()
@@ -14,9 +14,10 @@ from app.activitypub.util import find_actor_or_create, make_image_sizes
 from app.constants import *
 from app.models import User, Feed, FeedMember, FeedItem, Community, FeedJoinRequest, CommunityMember, \
     CommunityJoinRequest, Instance, File
+from app.shared import api_context
 from app.shared.tasks import task_selector
 from app.shared.community import leave_community
-from app.shared.upload import process_upload
+from app.shared.upload import process_upload, file_for_image_url
 from app.utils import authorise_api_user, feed_membership, get_request, menu_subscribed_feeds, joined_communities, \
     community_membership, gibberish, get_task_session, instance_banned, menu_instance_feeds, \
     piefed_markdown_to_lemmy_markdown, markdown_to_html, is_image_url
@@ -201,14 +202,12 @@ def make_feed(input, src, auth=None, uploaded_icon_file=None, uploaded_banner_fi
         feed.parent_feed_id = None
 
     if icon_url and is_image_url(icon_url):
-        file = File(source_url=icon_url)
-        db.session.add(file)
+        file = file_for_image_url(icon_url)
         db.session.commit()
         feed.icon_id = file.id
         make_image_sizes(feed.icon_id, 40, 250, 'feeds', False)
     if banner_url and is_image_url(banner_url):
-        file = File(source_url=banner_url)
-        db.session.add(file)
+        file = file_for_image_url(banner_url)
         db.session.commit()
         feed.image_id = file.id
         make_image_sizes(feed.image_id, 878, 1600, 'feeds', False)
@@ -298,8 +297,7 @@ def edit_feed(input, feed, src, auth=None, uploaded_icon_file=None, uploaded_ban
             banner_url_changed = True
 
     if icon_url and (from_scratch or icon_url_changed) and is_image_url(icon_url):
-        file = File(source_url=icon_url)
-        db.session.add(file)
+        file = file_for_image_url(icon_url)
         db.session.commit()
         feed.icon_id = file.id
         make_image_sizes(feed.icon_id, 40, 250, 'feeds', False)
@@ -310,8 +308,7 @@ def edit_feed(input, feed, src, auth=None, uploaded_icon_file=None, uploaded_ban
                 remove_file.delete_from_disk()
                 db.session.delete(remove_file)
     if banner_url and (from_scratch or banner_url_changed) and is_image_url(banner_url):
-        file = File(source_url=banner_url)
-        db.session.add(file)
+        file = file_for_image_url(banner_url)
         db.session.commit()
         feed.image_id = file.id
         make_image_sizes(feed.image_id, 878, 1600, 'feeds', False)
@@ -485,6 +482,7 @@ def _feed_remove_community(community_id: int, current_feed_id: int):
 
                 if proceed:
                     db.session.query(CommunityMember).filter_by(user_id=user.id, community_id=community.id).delete()
+                    api_context.changed(db.session, user.id)
                     db.session.query(CommunityJoinRequest).filter_by(user_id=user.id, community_id=community.id).delete()
                     community.subscriptions_count -= 1
                     db.session.commit()
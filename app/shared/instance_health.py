@@ -0,0 +1,135 @@
+import asyncio
+from collections import namedtuple
+from datetime import timedelta
+
+import httpx
+from flask import current_app
+
+from app.models import utcnow
+
+NODEINFO_RELS = [
+    'http://nodeinfo.diaspora.software/ns/schema/2.0',
+    'https://nodeinfo.diaspora.software/ns/schema/2.0',
+    'http://nodeinfo.diaspora.software/ns/schema/2.1',
+]
+
+# What gets probed: a plain snapshot of the Instance row so the probing can happen outside of any db session
+ProbeTarget = namedtuple('ProbeTarget', ['instance_id', 'domain', 'nodeinfo_href'])
+
+# status is one of 'ok', 'http_error' (nodeinfo responded with >= 300), 'no_nodeinfo' (well-known discovery failed)
+# or 'error' (timeout, connection failure, garbage json)
+ProbeResult = namedtuple('ProbeResult', ['instance_id', 'status', 'nodeinfo_href', 'software', 'version'])
+
+HEADERS = {'Accept': 'application/activity+json'}
+
+
+def probe_due(instance, now=None) -> bool:
+    """Adaptive scheduling - should this healthy instance be probed on this run?
+
+    Instances that keep failing are backed off exponentially (6h, 12h, 24h ... capped at 5 days) from their most
+    recent failure. Peers that have sent us something in the last day are probed every run, quiet ones once every few
+    days and ones we have not heard from in a month once a week."""
+    if now is None:
+        now = utcnow()
+    if instance.failures and instance.most_recent_attempt:
+        backoff = timedelta(hours=min(6 * 2 ** (instance.failures - 1), 120))
+        if now < instance.most_recent_attempt + backoff:
+            return False
+    if instance.last_health_check is None:
+        return True
+    if instance.last_seen and instance.last_seen > now - timedelta(days=1):
+        interval = timedelta(hours=12)
+    elif instance.last_seen and instance.last_seen > now - timedelta(days=30):
+        interval = timedelta(days=3)
+    else:
+        interval = timedelta(days=7)
+    return now >= instance.last_health_check + interval
+
+
+def probe_instances(targets, concurrency=None, timeout=None) -> list:
+    """Fetch nodeinfo for many instances at once. Safe to call from a celery task - the event loop only lives for the
+    duration of this call."""
+    if not targets:
+        return []
+    if concurrency is None:
+        concurrency = current_app.config['INSTANCE_HEALTH_CONCURRENCY']
+    if timeout is None:
+        timeout = current_app.config['INSTANCE_HEALTH_TIMEOUT']
+    user_agent = f'PieFed/{current_app.config["VERSION"]}; +https://{current_app.config["SERVER_NAME"]}'
+    return asyncio.run(_probe_all(targets, concurrency, timeout, user_agent))
+
+
+def fetch_json_many(urls, concurrency=None, timeout=None, accept='application/json') -> dict:
+    """GET a batch of json documents concurrently. Returns {url: parsed json}, failed urls are left out."""
+    if not urls:
+        return {}
+    if concurrency is None:
+        concurrency = current_app.config['INSTANCE_HEALTH_CONCURRENCY']
+    if timeout is None:
+        timeout = current_app.config['INSTANCE_HEALTH_TIMEOUT']
+    user_agent = f'PieFed/{current_app.config["VERSION"]}; +https://{current_app.config["SERVER_NAME"]}'
+    return asyncio.run(_fetch_all(urls, concurrency, timeout, user_agent, accept))
+
+
+def _async_client(concurrency, timeout, user_agent) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    return httpx.AsyncClient(limits=limits, http2=True, follow_redirects=True,
+                             timeout=httpx.Timeout(timeout, connect=min(5.0, timeout)),
+                             headers={'User-Agent': user_agent, **HEADERS})
+
+
+async def _probe_all(targets, concurrency, timeout, user_agent) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    async with _async_client(concurrency, timeout, user_agent) as client:
+        async def bounded(target):
+            async with semaphore:
+                try:
+                    # discovery + nodeinfo is two requests so give the whole probe twice the per-request timeout
+                    return await asyncio.wait_for(_probe(client, target), timeout=timeout * 2)
+                except Exception:
+                    return ProbeResult(target.instance_id, 'error', target.nodeinfo_href, None, None)
+
+        return await asyncio.gather(*[bounded(target) for target in targets])
+
+
+async def _probe(client: httpx.AsyncClient, target: ProbeTarget) -> ProbeResult:
+    nodeinfo_href = target.nodeinfo_href
+    if not nodeinfo_href:
+        response = await client.get(f'https://{target.domain}/.well-known/nodeinfo')
+        if response.status_code == 200:
+            for links in response.json().get('links', []):
+                if isinstance(links, dict) and links.get('rel') in NODEINFO_RELS and links.get('href'):
+                    nodeinfo_href = links['href']
+                    break
+        if not nodeinfo_href:
+            return ProbeResult(target.instance_id, 'no_nodeinfo', None, None, None)
+
+    response = await client.get(nodeinfo_href)
+    if response.status_code == 200:
+        node_json = response.json()
+        if 'software' in node_json:
+            return ProbeResult(target.instance_id, 'ok', nodeinfo_href[:100],
+                               node_json['software']['name'].lower()[:50],
+                               str(node_json['software'].get('version', ''))[:50])
+        return ProbeResult(target.instance_id, 'ok', nodeinfo_href[:100], None, None)
+    elif response.status_code >= 300:
+        return ProbeResult(target.instance_id, 'http_error', None, None, None)
+    return ProbeResult(target.instance_id, 'error', nodeinfo_href, None, None)
+
+
+async def _fetch_all(urls, concurrency, timeout, user_agent, accept) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    result = {}
+    async with _async_client(concurrency, timeout, user_agent) as client:
+        async def bounded(url):
+            async with semaphore:
+                try:
+                    response = await asyncio.wait_for(client.get(url, headers={'Accept': accept}),
+                                                      timeout=timeout)
+                    if response.status_code == 200:
+                        result[url] = response.json()
+                except Exception:
+                    pass
+
+        await asyncio.gather(*[bounded(url) for url in urls])
+    return result
@@ -19,6 +19,7 @@ from app.community.util import tags_from_string_old, end_poll_date, flair_from_f
 from app.constants import *
 from app.models import File, Notification, NotificationSubscription, Poll, PollChoice, Post, PostBookmark, PostVote, \
     Report, Site, User, utcnow, Instance, Event, Community
+from app.shared import counters
 from app.shared.tasks import task_selector
 from app.utils import render_template, authorise_api_user, shorten_string, gibberish, ensure_directory_exists, \
     piefed_markdown_to_lemmy_markdown, markdown_to_html, fixup_url, domain_from_url, \
@@ -198,20 +199,15 @@ def make_post(input, community, type, src, auth=None, uploaded_file=None):
             raise Exception('filetype not allowed')
 
     post = Post(user_id=user.id, community_id=community.id, instance_id=user.instance_id, from_bot=user.bot or user.bot_override,
-                posted_at=utcnow(), ap_id=gibberish(), title=title, language_id=language_id)
+                posted_at=utcnow(), ap_id=gibberish(), title=title, language_id=language_id, up_votes=1, score=1.0)
     db.session.add(post)
     db.session.commit()
 
-    post.up_votes = 1
-    effect = 1.0
-    post.score = post.up_votes * effect
     post.ranking = post.post_ranking(post.score, post.posted_at)
     post.ranking_scaled = int(post.ranking + community.scale_by())
     cache.delete_memoized(recently_upvoted_posts, user.id)
 
-    community.post_count += 1
     community.last_active = g.site.last_active = utcnow()
-    user.post_count += 1
     user.last_seen = utcnow()
 
     post.generate_ap_id(community)
@@ -219,6 +215,8 @@ def make_post(input, community, type, src, auth=None, uploaded_file=None):
     vote = PostVote(user_id=user.id, post_id=post.id, author_id=user.id, effect=1)
     db.session.add(vote)
     db.session.commit()
+    counters.apply(community, post_count=1)
+    counters.increment(User, user.id, post_count=1)
 
     try:    # federation is done in edit_post
         post = edit_post(input, post, type, src, user, auth, uploaded_file, from_scratch=True)
@@ -737,9 +735,9 @@ def delete_post(post_id: int, federate_deletion, src, auth):
 
         post.deleted = True
         post.deleted_by = user_id
-        post.author.post_count -= 1
-        post.community.post_count -= 1
         db.session.commit()
+        counters.increment(User, post.user_id, post_count=-1)
+        counters.increment(Community, post.community_id, post_count=-1)
 
     if federate_deletion and post.status == POST_STATUS_PUBLISHED:
         task_selector('delete_post', user_id=user_id, post_id=post.id)
@@ -766,14 +764,13 @@ def restore_post(post_id: int, src, auth):
         user_id = current_user.id
 
     post = db.session.query(Post).get(post_id)
-    if post.url:
-        post.calculate_cross_posts()
-
     post.deleted = False
     post.deleted_by = None
-    post.author.post_count += 1
-    post.community.post_count += 1
     db.session.commit()
+    if post.url:
+        post.calculate_cross_posts()
+    counters.increment(User, post.user_id, post_count=1)
+    counters.increment(Community, post.community_id, post_count=1)
 
     task_selector('restore_post', user_id=user_id, post_id=post.id)
 
@@ -1010,9 +1007,9 @@ def mod_remove_post(post_id: int, reason, src, auth):
 
         post.deleted = True
         post.deleted_by = user.id
-        post.author.post_count -= 1
-        post.community.post_count -= 1
         db.session.commit()
+        counters.increment(User, post.user_id, post_count=-1)
+        counters.increment(Community, post.community_id, post_count=-1)
 
     add_to_modlog('delete_post', actor=user, target_user=post.author, reason=reason,
                   community=post.community, post=post,
@@ -1047,14 +1044,13 @@ def mod_restore_post(post_id: int, reason, src, auth):
         if not post.community.is_moderator(user) and not user.is_admin_or_staff():
             raise Exception('Does not have permission')
 
-        if post.url:
-            post.calculate_cross_posts()
-
         post.deleted = False
         post.deleted_by = None
-        post.author.post_count += 1
-        post.community.post_count += 1
         db.session.commit()
+        if post.url:
+            post.calculate_cross_posts()
+        counters.increment(User, post.user_id, post_count=1)
+        counters.increment(Community, post.community_id, post_count=1)
 
     add_to_modlog('restore_post', actor=user, target_user=post.author, reason=reason,
                   community=post.community, post=post,
@@ -0,0 +1,300 @@
+# Deleting a lot of content at once - everything in a community, everything a spammer posted, old soft-deleted posts.
+#
+# Rather than loading each post and letting the ORM delete its votes, bookmarks, etc one row at a time, posts and comments
+# are deleted PURGE_BATCH_SIZE at a time using a few "DELETE ... WHERE x IN (...)" statements, one per dependent table.
+# Each batch is committed on its own so the rows being deleted are not locked for longer than that one batch takes.
+#
+# A purge works through a list of phases (e.g. a user's comments, then their posts) and remembers the phase and the
+# last id done. purge_now() runs a purge to the end. start_purge() runs it as a background job instead, a batch per
+# celery task, with the progress in redis so it can be shown in /admin/queues and carried on by the send-queue cron if a
+# worker is restarted part way through.
+
+import os
+import time
+from collections import Counter
+
+import redis
+from flask import current_app, json
+from sqlalchemy import text
+
+from app import celery
+from app.constants import POST_TYPE_VIDEO
+from app.models import File, Post, PostReply, Community, CrossPostGroup
+from app.shared import counters
+from app.utils import get_task_session, patch_db_session
+
+# For each kind of purge, its phases and the query that lists the ids for each phase
+PHASES = {
+    'user': [('replies', 'SELECT id FROM "post_reply" WHERE user_id = :target_id'),
+             ('posts', 'SELECT id FROM "post" WHERE user_id = :target_id'),
+             ('files', 'SELECT file_id AS id FROM "user_file" WHERE user_id = :target_id')],
+    'community': [('replies', 'SELECT id FROM "post_reply" WHERE community_id = :target_id'),
+                  ('posts', 'SELECT id FROM "post" WHERE community_id = :target_id')],
+    'domain': [('posts', 'SELECT id FROM "post" WHERE domain_id = :target_id')],
+}
+PURGE_KEY = 'purge:{}:{}'   # hash of 'phase', 'cursor' (last id done), 'done' (rows so far) and 'options'
+PURGES_KEY = 'purges'       # sorted set of the key of each purge in progress -> when it last saved its progress
+STALLED_AFTER = 60 * 10
+
+
+def purge_now(kind: str, target_id: int, soft: bool = False, purge_cdn: bool = False, session=None) -> int:
+    """Run a purge to the end, committing after each batch. Returns how many posts, comments and files were purged."""
+    from app import db
+    session = session or db.session
+    options = {'soft': soft, 'purge_cdn': purge_cdn}
+    done = 0
+    for phase in range(len(PHASES[kind])):
+        cursor = 0
+        while True:
+            count, cursor = purge_batch(session, kind, target_id, phase, cursor, options)
+            if not count:
+                break
+            done += count
+    return done
+
+
+def purge_batch(session, kind: str, target_id: int, phase: int, cursor: int, options: dict) -> tuple[int, int]:
+    """Purge the next batch of one phase, after id `cursor`. Returns the number purged and the new cursor."""
+    name, query = PHASES[kind][phase]
+    ids = list(session.execute(text(f'SELECT id FROM ({query}) AS q WHERE id > :cursor ORDER BY id LIMIT :limit'),
+                               {'target_id': target_id, 'cursor': cursor,
+                                'limit': current_app.config['PURGE_BATCH_SIZE']}).scalars())
+    if not ids:
+        return 0, cursor
+    PURGERS[name](session, ids, soft=options.get('soft', False), purge_cdn=options.get('purge_cdn', False))
+    session.commit()
+    return len(ids), ids[-1]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Background purges
+
+def start_purge(kind: str, target_id: int, soft: bool = False, purge_cdn: bool = False, then: str | None = None):
+    """Purge in the background. then='delete_community' deletes the community itself once all its content is gone.
+    Does nothing if the same purge is already in progress."""
+    from app import redis_client
+    key = PURGE_KEY.format(kind, target_id)
+    if not redis_client.hsetnx(key, 'options', json.dumps({'soft': soft, 'purge_cdn': purge_cdn, 'then': then})):
+        return
+    redis_client.hset(key, mapping={'phase': 0, 'cursor': 0, 'done': 0})
+    redis_client.zadd(PURGES_KEY, {key: time.time()})
+    queue_purge(kind, target_id)
+
+
+def queue_purge(kind: str, target_id: int):
+    if current_app.debug:
+        purge_task(kind, target_id)
+    else:
+        purge_task.delay(kind, target_id)
+
+
+@celery.task
+def purge_task(kind: str, target_id: int):
+    session = get_task_session()
+    try:
+        with patch_db_session(session):
+            from app import redis_client
+            try:
+                with redis_client.lock(f'lock:{PURGE_KEY.format(kind, target_id)}', timeout=600, blocking_timeout=0):
+                    more = purge_next_batch(session, kind, target_id)
+            except redis.exceptions.LockError:  # already being purged
+                return
+            if more:
+                queue_purge(kind, target_id)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def purge_next_batch(session, kind: str, target_id: int) -> bool:
+    """Do the next batch of a background purge. True if there is more to do."""
+    from app import redis_client
+    key = PURGE_KEY.format(kind, target_id)
+    state = redis_client.hgetall(key)
+    if not state:
+        redis_client.zrem(PURGES_KEY, key)
+        return False
+    options = json.loads(state['options'])
+    phase = int(state.get('phase', 0))
+    cursor = int(state.get('cursor', 0))
+
+    if phase >= len(PHASES[kind]):
+        finish_purge(session, target_id, options.get('then'))
+        redis_client.delete(key)
+        redis_client.zrem(PURGES_KEY, key)
+        return False
+
+    count, cursor = purge_batch(session, kind, target_id, phase, cursor, options)
+    pipe = redis_client.pipeline()
+    if count:
+        pipe.hset(key, mapping={'cursor': cursor})
+        pipe.hincrby(key, 'done', count)
+    else:
+        pipe.hset(key, mapping={'phase': phase + 1, 'cursor': 0})
+    pipe.zadd(PURGES_KEY, {key: time.time()})
+    pipe.execute()
+    return True
+
+
+def finish_purge(session, target_id: int, then: str | None):
+    if then == 'delete_community':
+        community = session.query(Community).get(target_id)
+        if community:
+            community.delete_dependencies()
+            session.delete(community)
+            session.commit()
+
+
+def purges_in_progress() -> list[dict]:
+    """For /admin/queues"""
+    from app import redis_client
+    result = []
+    for key in redis_client.zrange(PURGES_KEY, 0, -1):
+        state = redis_client.hgetall(key)
+        if state:
+            _, kind, target_id = key.split(':')
+            phases = PHASES[kind]
+            phase = int(state.get('phase', 0))
+            result.append({'kind': kind, 'target_id': int(target_id), 'done': int(state.get('done', 0)),
+                           'phase': phases[phase][0] if phase < len(phases) else 'finishing'})
+    return result
+
+
+def resume_stalled_purges():
+    """Queue again any purge that has not saved progress for a while. Run by the send-queue cron."""
+    from app import redis_client
+    for key in redis_client.zrangebyscore(PURGES_KEY, '-inf', time.time() - STALLED_AFTER):
+        if not redis_client.exists(key):
+            redis_client.zrem(PURGES_KEY, key)
+            continue
+        redis_client.zadd(PURGES_KEY, {key: time.time()})
+        _, kind, target_id = key.split(':')
+        queue_purge(kind, int(target_id))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Set-based deletes. `soft` leaves the posts and comments themselves in place, marked as deleted, but removes everything
+# else - as Post.delete_dependencies() followed by post.deleted = True would.
+
+def purge_replies(session, ids: list, soft: bool = False, purge_cdn: bool = False):
+    params = {'ids': tuple(ids)}
+    # the replies that are counted in the reply count of their post and its cross post group, once this is committed
+    post_replies, group_replies = Counter(), Counter()
+    for post_id, group_id, replies in session.execute(text(
+            'SELECT r.post_id, p.cross_post_group_id, count(*) FROM "post_reply" r '
+            'JOIN "post" p ON p.id = r.post_id JOIN "user" u ON u.id = r.user_id '
+            'WHERE r.id IN :ids AND r.deleted = false AND u.bot = false GROUP BY r.post_id, p.cross_post_group_id'),
+            params):
+        post_replies[post_id] -= replies
+        if group_id is not None:
+            group_replies[group_id] -= replies
+    counters.increment_on_commit(session, Post, 'reply_count', post_replies)
+    counters.increment_on_commit(session, CrossPostGroup, 'reply_count', group_replies)
+
+    file_ids = _delete_files_from_disk(session, PostReply, ids, purge_cdn)
+    session.execute(text('DELETE FROM "report" WHERE suspect_post_reply_id IN :ids'), params)
+    session.execute(text('UPDATE "mod_log" SET reply_id = NULL WHERE reply_id IN :ids'), params)
+    session.execute(text('DELETE FROM "reminder" WHERE reminder_type = 2 AND reminder_destination IN :ids'), params)
+    if soft:
+        session.execute(text('UPDATE "post_reply" SET deleted = true WHERE id IN :ids'), params)
+        return
+    session.execute(text('DELETE FROM "post_reply_vote" WHERE post_reply_id IN :ids'), params)
+    session.execute(text('DELETE FROM "post_reply_bookmark" WHERE post_reply_id IN :ids'), params)
+    session.execute(text('DELETE FROM "post_reply" WHERE id IN :ids'), params)
+    _delete_file_rows(session, file_ids)
+
+
+def purge_posts(session, ids: list, soft: bool = False, purge_cdn: bool = False):
+    params = {'ids': tuple(ids)}
+    # comments by anyone on these posts go too, a batch at a time as a post can have thousands
+    batch_size = current_app.config['PURGE_BATCH_SIZE']
+    cursor = 0
+    while reply_ids := list(session.execute(text('SELECT id FROM "post_reply" WHERE post_id IN :ids AND id > :cursor '
+                                                 'ORDER BY id LIMIT :limit'),
+                                            {**params, 'cursor': cursor, 'limit': batch_size}).scalars()):
+        purge_replies(session, reply_ids, soft=soft, purge_cdn=purge_cdn)
+        cursor = reply_ids[-1]
+
+    file_ids = _delete_files_from_disk(session, Post, ids, purge_cdn)
+    _delete_post_media(session, ids)
+    session.execute(text('DELETE FROM "report" WHERE suspect_post_id IN :ids'), params)
+    session.execute(text('UPDATE "mod_log" SET post_id = NULL WHERE post_id IN :ids'), params)
+    session.execute(text('DELETE FROM "reminder" WHERE reminder_type = 1 AND reminder_destination IN :ids'), params)
+    for table, column in (('event_user', 'post_id'), ('hidden_posts', 'hidden_post_id'),
+                          ('read_posts', 'read_post_id'), ('archived_post_reply', 'post_id')):
+        session.execute(text(f'DELETE FROM "{table}" WHERE {column} IN :ids'), params)
+    # their replies have been taken off the group's reply count already, above
+    session.execute(text('UPDATE "cross_post_group" AS g SET post_count = g.post_count - c.posts '
+                         'FROM (SELECT cross_post_group_id, count(*) AS posts FROM "post" '
+                         '      WHERE id IN :ids AND cross_post_group_id IS NOT NULL GROUP BY cross_post_group_id) AS c '
+                         'WHERE g.id = c.cross_post_group_id'), params)
+    if soft:
+        session.execute(text('UPDATE "post" SET deleted = true, cross_post_group_id = NULL WHERE id IN :ids'), params)
+        return
+
+    for table in ('post_vote', 'post_bookmark', 'poll_choice_vote', 'poll_choice', 'poll', 'event', 'post_tag',
+                  'post_flair', 'post_file'):
+        session.execute(text(f'DELETE FROM "{table}" WHERE post_id IN :ids'), params)
+    session.execute(text('DELETE FROM "post" WHERE id IN :ids'), params)
+    _delete_file_rows(session, file_ids)
+
+
+def purge_user_files(session, ids: list, soft: bool = False, purge_cdn: bool = False):
+    for file in session.query(File).filter(File.id.in_(ids)):
+        file.delete_from_disk(purge_cdn=purge_cdn)
+    session.execute(text('DELETE FROM "user_file" WHERE file_id IN :ids'), {'ids': tuple(ids)})
+    _delete_file_rows(session, ids)
+
+
+PURGERS = {'replies': purge_replies, 'posts': purge_posts, 'files': purge_user_files}
+
+
+def _delete_files_from_disk(session, model, ids: list, purge_cdn: bool) -> list:
+    """Delete the images of these posts or comments from disk / S3. Returns the ids of their File rows."""
+    files = session.query(File).join(model, model.image_id == File.id).filter(model.id.in_(ids)).all()
+    for file in files:
+        file.delete_from_disk(purge_cdn=purge_cdn)
+    return [file.id for file in files]
+
+
+def _delete_file_rows(session, file_ids: list):
+    if file_ids:
+        session.execute(text('DELETE FROM "file" WHERE id IN :ids'), {'ids': tuple(file_ids)})
+
+
+def _delete_post_media(session, ids: list):
+    """Videos uploaded to S3 and the archives of old comments, which are not File rows"""
+    from app.models import _store_files_in_s3
+    from app.shared.tasks.maintenance import delete_from_s3, blank_archived_posts
+    if not _store_files_in_s3():
+        s3_prefix = None
+    else:
+        s3_prefix = f'https://{current_app.config["S3_PUBLIC_URL"]}/'
+    s3_paths = []
+    segment_locators = []
+    for post_type, url, archived in session.query(Post.type, Post.url, Post.archived).\
+            filter(Post.id.in_(ids), (Post.type == POST_TYPE_VIDEO) | (Post.archived != None)):
+        if s3_prefix and post_type == POST_TYPE_VIDEO and url and url.startswith(s3_prefix):
+            s3_paths.append(url)    # as Post.delete_dependencies() does
+        if archived and archived.startswith('seg:'):    # archive segments are shared with other posts
+            segment_locators.append(archived)
+        elif archived:
+            if s3_prefix and archived.startswith(s3_prefix):
+                s3_paths.append(archived.replace(s3_prefix, ''))
+            elif not archived.startswith('https://'):
+                try:
+                    os.unlink(archived)
+                except (FileNotFoundError, IsADirectoryError):
+                    ...
+    if s3_paths:
+        if current_app.debug:
+            delete_from_s3(s3_paths)
+        else:
+            delete_from_s3.delay(s3_paths)
+    if segment_locators:
+        if current_app.debug:
+            blank_archived_posts(segment_locators)
+        else:
+            blank_archived_posts.delay(segment_locators)
@@ -19,6 +19,7 @@ from app.models import (
     utcnow,
     Instance,
 )
+from app.shared import counters
 from app.shared.tasks import task_selector
 from app.utils import (
     render_template,
@@ -324,9 +325,6 @@ def delete_reply(reply_id, src, auth):
     reply.deleted = True
     reply.deleted_by = user_id
 
-    if not reply.author.bot:
-        reply.post.reply_count -= 1
-    reply.author.post_reply_count -= 1
     if reply.path:
         db.session.execute(
             text(
@@ -335,6 +333,9 @@ def delete_reply(reply_id, src, auth):
             {"parents": tuple(reply.path[:-1])},
         )
     db.session.commit()
+    if not reply.author.bot:
+        reply.post.count_replies(-1)
+    counters.increment(User, reply.user_id, post_reply_count=-1)
 
     task_selector("delete_reply", user_id=user_id, reply_id=reply.id)
 
@@ -358,9 +359,6 @@ def restore_reply(reply_id, src, auth):
     reply.deleted = False
     reply.deleted_by = None
 
-    if not reply.author.bot:
-        reply.post.reply_count += 1
-    reply.author.post_reply_count += 1
     if reply.path:
         db.session.execute(
             text(
@@ -369,6 +367,9 @@ def restore_reply(reply_id, src, auth):
             {"parents": tuple(reply.path[:-1])},
         )
     db.session.commit()
+    if not reply.author.bot:
+        reply.post.count_replies(1)
+    counters.increment(User, reply.user_id, post_reply_count=1)
     if src == SRC_WEB:
         flash(_("Comment restored."))
 
@@ -525,9 +526,6 @@ def mod_remove_reply(reply_id, reason, src, auth):
     reply.deleted = True
     # set deleted_by to -1 if a mod is removing their own reply as part of a mod action, so it's shows as 'removed' rather than 'deleted'
     reply.deleted_by = user.id if user.id != reply.user_id else -1
-    if not reply.author.bot:
-        reply.post.reply_count -= 1
-    reply.author.post_reply_count -= 1
     if reply.path:
         db.session.execute(
             text(
@@ -536,6 +534,9 @@ def mod_remove_reply(reply_id, reason, src, auth):
             {"parents": tuple(reply.path[:-1])},
         )
     db.session.commit()
+    if not reply.author.bot:
+        reply.post.count_replies(-1)
+    counters.increment(User, reply.user_id, post_reply_count=-1)
     if src == SRC_WEB:
         flash(_("Comment deleted."))
 
@@ -573,9 +574,6 @@ def mod_restore_reply(reply_id, reason, src, auth):
 
     reply.deleted = False
     reply.deleted_by = None
-    if not reply.author.bot:
-        reply.post.reply_count += 1
-    reply.author.post_reply_count += 1
     if reply.path:
         db.session.execute(
             text(
@@ -585,6 +583,9 @@ def mod_restore_reply(reply_id, reason, src, auth):
         )
 
     db.session.commit()
+    if not reply.author.bot:
+        reply.post.count_replies(1)
+    counters.increment(User, reply.user_id, post_reply_count=1)
     if src == SRC_WEB:
         flash(_("Comment restored."))
 
@@ -0,0 +1,423 @@
+# RSS feeds and the sitemap, kept in redis as finished documents so that serving one is a redis round trip rather than
+# a few queries and a feedgen run - crawlers fetch them far more often than they change.
+#
+# A document is built from the database the first time it is asked for and stored with a strong ETag, a hash of its
+# bytes. When a post is published, edited or deleted the documents it is in - those of its community, author, domain
+# and tags and of the topics and feeds its community is in - are rebuilt by rebuild_artifacts_task once the transaction
+# has been committed. Only documents that are stored are rebuilt, the rest wait until someone asks for them. They expire
+# after a day without changes, which also heals any change that was missed (e.g. raw SQL updates).
+#
+# The sitemap is split by post id into shards of SITEMAP_SHARD_SIZE posts, listed by a sitemap index at /sitemap.xml.
+# An instance with only one shard gets it at /sitemap.xml directly. Rebuilding the index looks at every indexable post,
+# so the sitemap isn't rebuilt for each post that changes - the shards that changed, and the index, are marked and the
+# cron rebuilds them at most every SITEMAP_REBUILD_INTERVAL seconds (rebuild_sitemap()).
+
+import hashlib
+from datetime import timezone
+
+import redis
+from feedgen.feed import FeedGenerator
+from flask import current_app, g, make_response, render_template
+from sqlalchemy import bindparam, desc, func, inspect, text
+
+from app import celery, db
+from app.constants import POST_STATUS_REVIEWING
+from app.models import Community, Domain, Feed, Post, Site, Tag, Topic, User, post_tag
+from app.utils import ap_datetime, cross_posts_from_groups, dedupe_post_ids, feed_community_ids, get_task_session, \
+    is_valid_xml_utf8, mimetype_from_url, patch_db_session, post_ids_to_models, request_etag_matches, return_304, \
+    shorten_string, topic_community_ids
+
+ARTIFACT_KEY = 'artifact:{}'
+ARTIFACT_TTL = 24 * 60 * 60
+RSS_CONTENT_TYPE = 'application/rss+xml'
+SITEMAP_CONTENT_TYPE = 'text/xml'
+RSS_ITEMS = 20
+RSS_HIERARCHY_ITEMS = 100           # topics and feeds
+SITEMAP_SHARD_SIZE = 10000          # posts per shard, the limit is 50000 urls per file
+SITEMAP_REBUILD_INTERVAL = 15 * 60
+SITEMAP_CHANGED_KEY = 'sitemap_changed'     # set of the names of the sitemap documents changed since the last rebuild
+CHANGED = 'syndication_changed'     # in session.info - what the posts in the transaction were, and are now, part of
+
+# changes to these are visible in a feed or the sitemap
+WATCHED_FIELDS = ('title', 'body_html', 'url', 'slug', 'deleted', 'status', 'community_id', 'domain_id', 'user_id',
+                  'posted_at', 'edited_at', 'indexable', 'from_bot', 'nsfw', 'nsfl', 'instance_sticky')
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Stored documents
+
+def artifact(name: str, build) -> tuple[bytes, str]:
+    """The stored document called name and its ETag. If there isn't one it is built with build() and stored."""
+    from app import redis_client
+    try:
+        body, etag = redis_client.hmget(ARTIFACT_KEY.format(name), 'body', 'etag')
+    except redis.exceptions.RedisError:
+        body = etag = None
+    if body is not None and etag:
+        return body.encode('utf-8'), etag
+    return store_artifact(name, build())
+
+
+def store_artifact(name: str, body: bytes) -> tuple[bytes, str]:
+    from app import redis_client
+    etag = strong_etag(body)
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(ARTIFACT_KEY.format(name), mapping={'body': body.decode('utf-8'), 'etag': etag})
+        pipe.expire(ARTIFACT_KEY.format(name), ARTIFACT_TTL)
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        pass
+    return body, etag
+
+
+def strong_etag(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+def artifact_response(body: bytes, etag: str, content_type: str):
+    if request_etag_matches(etag):
+        return return_304(etag, content_type)
+    response = make_response(body)
+    response.headers.set('Content-Type', content_type)
+    response.headers.set('ETag', etag)
+    response.headers.set('Cache-Control', 'no-cache, max-age=600, must-revalidate')
+    return response
+
+
+def rss_response(kind: str, entity):
+    """The stored RSS feed of a community, user, domain, tag, topic or feed"""
+    body, etag = artifact(f'rss:{kind}:{entity.id}', lambda: RSS_BUILDERS[kind][1](entity))
+    return artifact_response(body, etag, RSS_CONTENT_TYPE)
+
+
+def sitemap_response(shard: int | None = None):
+    """The sitemap index, or one shard of the sitemap"""
+    if shard is None:
+        body, etag = artifact('sitemap:index', sitemap_index)
+    else:
+        body, etag = artifact(f'sitemap:{shard}', lambda: sitemap_shard(shard))
+    return artifact_response(body, etag, SITEMAP_CONTENT_TYPE)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# RSS
+
+def _site() -> Site:
+    return getattr(g, 'site', None) or Site.query.get(1)
+
+
+def rss_document(link: str, title: str, posts, subtitle: str | None = None, logo: str | None = None,
+                 self_link: str | None = None) -> bytes:
+    server = current_app.config['SERVER_URL']
+    fg = FeedGenerator()
+    fg.id(f"{server}{link}")
+    fg.title(f'{title} on {_site().name}')
+    fg.link(href=f"{server}{link}", rel='alternate')
+    fg.logo(logo or f"{server}/static/images/apple-touch-icon.png")
+    fg.subtitle(subtitle or ' ')
+    fg.link(href=f"{server}{self_link or link + '/feed'}", rel='self')
+    fg.language('en')
+
+    enclosed = set()
+    for post in posts:
+        # skip posts that would make the whole document invalid
+        post_title = post.title.strip() if post.title else ''
+        body_html = post.body_html.strip() if post.body_html else ''
+        if not post_title or not is_valid_xml_utf8(post_title) or (body_html and not is_valid_xml_utf8(body_html)):
+            continue
+
+        fe = fg.add_entry()
+        fe.title(post_title)
+        if post.slug:
+            fe.link(href=f"{server}{post.slug}")
+        else:
+            fe.link(href=f"{server}/post/{post.id}")
+        if post.url and post.url not in enclosed:
+            type = mimetype_from_url(post.url)
+            if type and not type.startswith('text/'):
+                fe.enclosure(post.url, type=type)
+            enclosed.add(post.url)
+        if body_html:
+            fe.description(body_html)
+        fe.guid(post.profile_id(), permalink=True)
+        fe.author(name=post.author.user_name)
+        fe.pubDate(post.created_at.replace(tzinfo=timezone.utc))
+    return fg.rss_str()
+
+
+def community_rss(community: Community, score: int = 0) -> bytes:
+    posts = Post.query.filter(Post.community_id == community.id, Post.from_bot == False, Post.deleted == False,
+                              Post.status > POST_STATUS_REVIEWING)
+    if score:
+        posts = posts.filter(Post.score >= score)
+    posts = posts.order_by(desc(Post.created_at)).limit(RSS_ITEMS)
+    description = shorten_string(community.description, 150) if community.description else None
+    logo = community.image.source_url if community.image_id else None
+    return rss_document(f'/c/{community.link()}', community.title, posts, description, logo)
+
+
+def user_rss(user: User) -> bytes:
+    posts = user.posts.filter(Post.from_bot == False, Post.deleted == False, Post.status > POST_STATUS_REVIEWING)
+    posts = posts.order_by(desc(Post.created_at)).limit(RSS_ITEMS)
+    description = shorten_string(user.about, 150) if user.about else None
+    logo = user.avatar_image() if user.avatar_id else None
+    return rss_document(f'/u/{user.link()}', user.display_name(), posts, description, logo)
+
+
+def domain_rss(domain: Domain) -> bytes:
+    posts = Post.query.join(Community, Community.id == Post.community_id). \
+        filter(Post.from_bot == False, Post.domain_id == domain.id, Community.banned == False, Post.deleted == False,
+               Post.status > POST_STATUS_REVIEWING, Community.private == False)
+    posts = posts.order_by(desc(Post.posted_at)).limit(RSS_ITEMS)
+    return rss_document(f'/d/{domain.id}', domain.name, posts)
+
+
+def tag_rss(tag: Tag, include_bots: bool = False) -> bytes:
+    posts = Post.query.join(Community, Community.id == Post.community_id). \
+        join(post_tag, post_tag.c.post_id == Post.id).filter(post_tag.c.tag_id == tag.id). \
+        filter(Community.banned == False, Community.private == False, Post.deleted == False,
+               Post.status > POST_STATUS_REVIEWING)
+    if not include_bots:
+        posts = posts.filter(Post.from_bot == False)
+    posts = posts.order_by(desc(Post.posted_at)).limit(RSS_ITEMS)
+    site = _site()
+    logo = f"{current_app.config['SERVER_URL']}{site.logo_152 if site.logo_152 else '/static/images/apple-touch-icon.png'}"
+    return rss_document(f'/tag/{tag.name}', f'#{tag.display_as}', posts, logo=logo)
+
+
+def topic_rss(topic: Topic) -> bytes:
+    community_ids = [community_id for community_id, private
+                     in topic_community_ids(topic.id, topic.show_posts_in_children).items() if not private]
+    posts = post_ids_to_models(latest_post_ids(community_ids), 'new')
+    return rss_document(f'/topic/{topic.machine_name}', topic.name, posts,
+                        self_link=f'/topic/{topic.machine_name}.rss')
+
+
+def feed_rss(feed: Feed) -> bytes:
+    community_ids = [community_id for community_id, private
+                     in feed_community_ids(feed.id, feed.show_posts_in_children).items() if not private]
+    posts = post_ids_to_models(latest_post_ids(community_ids), 'new')
+    return rss_document(f'/f/{feed.machine_name}', feed.title, posts, self_link=f'/f/{feed.machine_name}.rss')
+
+
+def latest_post_ids(community_ids: list[int]) -> list[int]:
+    """The newest posts in the communities as someone who isn't logged in sees them, with cross posts removed"""
+    if not community_ids:
+        return []
+    nsfw = '' if current_app.config['CONTENT_WARNING'] else 'AND p.nsfw is false '
+    rows = db.session.execute(text(f'''SELECT p.id, p.cross_post_group_id, p.user_id, p.reply_count FROM "post" AS p
+                                       INNER JOIN "community" AS c ON p.community_id = c.id
+                                       WHERE c.id IN :community_ids AND c.banned is false AND c.private is false
+                                       AND p.from_bot is false AND p.nsfl is false {nsfw}AND p.deleted is false
+                                       AND p.status > 0 AND p.instance_sticky is false
+                                       ORDER BY p.posted_at DESC LIMIT 1000''').
+                              bindparams(bindparam('community_ids', expanding=True)),
+                              {'community_ids': list(community_ids)}).all()
+    return dedupe_post_ids(cross_posts_from_groups(rows), limit_to_visible=True)[:RSS_HIERARCHY_ITEMS]
+
+
+# kind -> (model, builder) of the stored RSS feeds
+RSS_BUILDERS = {
+    'community': (Community, community_rss),
+    'user': (User, user_rss),
+    'domain': (Domain, domain_rss),
+    'tag': (Tag, tag_rss),
+    'topic': (Topic, topic_rss),
+    'feed': (Feed, feed_rss),
+}
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Sitemap
+
+def _sitemap_posts():
+    return Post.query.filter(Post.from_bot == False, Post.deleted == False, Post.status > POST_STATUS_REVIEWING,
+                             Post.instance_id == 1, Post.indexable == True)
+
+
+def sitemap_shards() -> list[tuple[int, object]]:
+    """(shard, when a post in it last changed) of each shard that has posts in it"""
+    shard = (Post.id // SITEMAP_SHARD_SIZE).label('shard')
+    return [(row.shard, row.lastmod) for row in
+            _sitemap_posts().with_entities(shard, func.max(func.coalesce(Post.edited_at, Post.posted_at)).label('lastmod')).
+            group_by(shard).order_by(shard)]
+
+
+def sitemap_index() -> bytes:
+    shards = sitemap_shards()
+    if len(shards) <= 1:
+        return sitemap_shard(shards[0][0] if shards else 0)
+    return render_template('sitemap_index.xml', shards=shards, current_app=current_app,
+                           ap_datetime=ap_datetime).encode('utf-8')
+
+
+def sitemap_shard(shard: int) -> bytes:
+    posts = _sitemap_posts().filter(Post.id >= shard * SITEMAP_SHARD_SIZE, Post.id < (shard + 1) * SITEMAP_SHARD_SIZE)
+    return render_template('sitemap.xml', posts=posts.order_by(Post.id), current_app=current_app,
+                           ap_datetime=ap_datetime).encode('utf-8')
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Keeping them up to date
+
+def note_changes(session, flush_context, instances):
+    """before_flush - remember which documents the posts about to be written were and will be in. The posts themselves
+    are kept too, new ones only get their id during the flush."""
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if not isinstance(obj, Post):
+            continue
+        state = inspect(obj)
+        if obj in session.dirty and not any(state.attrs[field].history.has_changes() for field in WATCHED_FIELDS):
+            continue
+        changes = session.info.setdefault(CHANGED, {'posts': [], 'community': set(), 'user': set(), 'domain': set(),
+                                                    'local': False})
+        changes['posts'].append(obj)
+        for kind in ('community', 'user', 'domain'):
+            history = state.attrs[f'{kind}_id'].history
+            changes[kind].update(value for value in (*history.added, *history.unchanged, *history.deleted) if value)
+        changes['local'] = changes['local'] or obj.instance_id == 1
+
+
+def rebuild_changed(session):
+    """after_commit - the changes can be seen by the task now"""
+    changes = session.info.pop(CHANGED, None)
+    if not changes:
+        return
+    post_ids = [identity[0] for identity in (inspect(post).identity for post in changes['posts']) if identity]
+    changed = {'post_ids': post_ids, 'community': list(changes['community']), 'user': list(changes['user']),
+               'domain': list(changes['domain']), 'local': changes['local']}
+    if current_app.debug:
+        # there is no worker to rebuild them during development, and the session can't query any more in after_commit
+        forget_artifacts()
+    else:
+        rebuild_artifacts_task.delay(changed)
+
+
+def forget_changed(session):
+    """after_rollback - nothing was changed after all"""
+    session.info.pop(CHANGED, None)
+
+
+def forget_artifacts():
+    from app import redis_client
+    try:
+        keys = list(redis_client.scan_iter(ARTIFACT_KEY.format('*'), count=1000))
+        if keys:
+            redis_client.delete(*keys)
+    except redis.exceptions.RedisError:
+        pass
+
+
+@celery.task
+def rebuild_artifacts_task(changed: dict):
+    with current_app.app_context():
+        session = get_task_session()
+        try:
+            with patch_db_session(session):
+                names = changed_artifacts(session, changed)
+                mark_sitemap_changed([name for name in names if name.startswith('sitemap:')])
+                for name in stored_artifacts([name for name in names if not name.startswith('sitemap:')]):
+                    rebuild_artifact(name)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def changed_artifacts(session, changed: dict) -> list[str]:
+    """The names of the documents that the changed posts are in"""
+    def ids(sql, values):
+        if not values:
+            return []
+        return session.execute(text(sql).bindparams(bindparam('ids', expanding=True)), {'ids': list(values)}).scalars()
+
+    names = [f'rss:{kind}:{entity_id}' for kind in ('community', 'user', 'domain') for entity_id in changed[kind]]
+    names.extend(f'rss:tag:{tag_id}' for tag_id in
+                 ids('SELECT DISTINCT tag_id FROM "post_tag" WHERE post_id IN :ids', changed['post_ids']))
+    names.extend(f'rss:topic:{topic_id}' for topic_id in
+                 ids('SELECT DISTINCT tc.ancestor_id FROM "community" AS c '
+                     'JOIN "topic_closure" AS tc ON tc.descendant_id = c.topic_id WHERE c.id IN :ids',
+                     changed['community']))
+    names.extend(f'rss:feed:{feed_id}' for feed_id in
+                 ids('SELECT DISTINCT fc.ancestor_id FROM "feed_item" AS fi '
+                     'JOIN "feed_closure" AS fc ON fc.descendant_id = fi.feed_id WHERE fi.community_id IN :ids',
+                     changed['community']))
+    if changed['local']:
+        names.extend(f'sitemap:{shard}' for shard in sorted({post_id // SITEMAP_SHARD_SIZE
+                                                             for post_id in changed['post_ids']}))
+        names.append('sitemap:index')
+    return names
+
+
+def mark_sitemap_changed(names: list[str]):
+    from app import redis_client
+    if names:
+        try:
+            redis_client.sadd(SITEMAP_CHANGED_KEY, *names)
+        except redis.exceptions.RedisError:
+            pass
+
+
+def rebuild_sitemap():
+    """From the cron - rebuild the stored sitemap documents that have changed, unless they were rebuilt less than
+    SITEMAP_REBUILD_INTERVAL seconds ago"""
+    from app import redis_client
+    try:
+        if not redis_client.exists(SITEMAP_CHANGED_KEY) or \
+                not redis_client.set('sitemap_rebuilt', 1, nx=True, ex=SITEMAP_REBUILD_INTERVAL):
+            return
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.smembers(SITEMAP_CHANGED_KEY)
+        pipe.delete(SITEMAP_CHANGED_KEY)
+        names = stored_artifacts(sorted(pipe.execute()[0]))
+    except redis.exceptions.RedisError:
+        return
+    if names:
+        if current_app.debug:
+            rebuild_sitemap_task(names)
+        else:
+            rebuild_sitemap_task.delay(names)
+
+
+@celery.task
+def rebuild_sitemap_task(names: list[str]):
+    with current_app.app_context():
+        session = get_task_session()
+        try:
+            with patch_db_session(session):
+                for name in names:
+                    rebuild_artifact(name)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def stored_artifacts(names: list[str]) -> list[str]:
+    from app import redis_client
+    if not names:
+        return []
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for name in names:
+            pipe.exists(ARTIFACT_KEY.format(name))
+        return [name for name, exists in zip(names, pipe.execute()) if exists]
+    except redis.exceptions.RedisError:
+        return []
+
+
+def rebuild_artifact(name: str):
+    parts = name.split(':')
+    if parts[0] == 'sitemap':
+        store_artifact(name, sitemap_index() if parts[1] == 'index' else sitemap_shard(int(parts[1])))
+        return
+    model, build = RSS_BUILDERS[parts[1]]
+    entity = db.session.get(model, int(parts[2]))
+    if entity is None:
+        from app import redis_client
+        redis_client.delete(ARTIFACT_KEY.format(name))
+    else:
+        store_artifact(name, build(entity))
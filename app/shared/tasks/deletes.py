@@ -12,6 +12,7 @@ from app.models import (
     Notification,
     ChatMessage,
 )
+from app.shared import counters
 from app.utils import gibberish, instance_banned, get_task_session, patch_db_session
 
 from flask import current_app
@@ -297,12 +298,12 @@ def delete_posts_with_blocked_images(post_ids, user_id, send_async):
                             post.calculate_cross_posts(delete_only=True)
                         post.deleted = True
                         post.deleted_by = user_id
-                        post.author.post_count -= 1
-                        post.community.post_count -= 1
                         if post.image_id:
                             file = session.query(File).get(post.image_id)
                             file.delete_from_disk()
                         session.commit()
+                        counters.increment(User, post.user_id, post_count=-1)
+                        counters.increment(Community, post.community_id, post_count=-1)
 
                         delete_object(
                             user_id, post, is_post=True, reason="Contains blocked image"
@@ -1,20 +1,20 @@
 from app import celery
-from app.activitypub.signature import default_context, send_post_request, HttpSignature
+from app.activitypub.signature import default_context, send_post_request
 from app.models import (
     CommunityBan,
     Post,
     PostReply,
     User,
-    ActivityBatch,
     Community,
     PollChoiceVote,
     PollChoice,
     utcnow,
 )
+from app.shared.activity_batch import queue_batched_activity
 from app.shared.tasks import task_selector
 from app.utils import gibberish, instance_banned, get_task_session, patch_db_session
 
-from flask import current_app, json
+from flask import current_app
 
 """ JSON format
 {
@@ -164,27 +164,12 @@ def send_vote(user_id, object, vote_to_undo, vote_direction, emoji):
                     continue
 
                 if instance.software == "piefed":  # Send in a batch later
-                    session.add(
-                        ActivityBatch(
-                            instance_id=instance.id,
-                            community_id=community.id,
-                            payload=payload_copy,
-                        )
-                    )
-                    session.commit()
+                    queue_batched_activity(session, instance.id, community.id, payload_copy)
                 else:
                     if current_app.config[
                         "NOTIF_SERVER"
-                    ]:  # Votes make up a very high percentage of activities, so it is more efficient to send them via fastapi_server.py. However fastapi_server.py does not retry failed sends. For votes this is acceptable.
-                        send_async.append(
-                            HttpSignature.signed_request(
-                                instance.inbox,
-                                announce,
-                                community.private_key,
-                                community.public_url() + "#main-key",
-                                send_via_async=True,
-                            )
-                        )
+                    ]:  # Votes make up a very high percentage of activities, so it is more efficient to send them via fastapi_server.py. Failed sends are not retried, for votes this is acceptable.
+                        send_async.append(instance.inbox)
                     else:
                         # Send the announcement directly
                         send_post_request(
@@ -195,18 +180,13 @@ def send_vote(user_id, object, vote_to_undo, vote_direction, emoji):
                         )
 
             if len(send_async):
-                from app import redis_client
-
-                # send announce_activity via redis pub/sub to piefed_notifs service
-                redis_client.publish(
-                    "http_posts:activity",
-                    json.dumps(
-                        {
-                            "urls": [url[0] for url in send_async],
-                            "headers": [url[1] for url in send_async],
-                            "data": send_async[0][2].decode("utf-8"),
-                        }
-                    ),
+                from app.shared.delivery import send_async as send_via_notifs_server
+
+                send_via_notifs_server(
+                    send_async,
+                    announce,
+                    community.private_key,
+                    community.public_url() + "#main-key",
                 )
         else:
             # For remote communities, select appropriate payload
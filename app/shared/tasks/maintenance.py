@@ -7,17 +7,21 @@ import time
 import httpx
 import boto3
 from flask import current_app
-from sqlalchemy import text, select, func
+from sqlalchemy import text, select, func, update
 
 from app import celery, cache, httpx_client
+from app.archive_store import SEGMENT_POSTS
 from app.activitypub.util import find_actor_or_create, find_language_or_create, find_instance_id
 from app.constants import NOTIF_UNBAN, SRC_WEB
 from app.models import Notification, SendQueue, CommunityBan, CommunityMember, User, Community, Post, PostReply, \
     DefederationSubscription, Instance, ActivityPubLog, InstanceRole, utcnow, InstanceChooser, \
     InstanceBan, Emoji
+from app.shared import api_context, counters
+from app.shared.instance_health import ProbeTarget, probe_due, probe_instances, fetch_json_many
 from app.shared.post import delete_post
-from app.utils import get_task_session, download_defeds, instance_banned, get_request_instance, get_request, \
-    shorten_string, patch_db_session, archive_post, get_setting, set_setting, communities_banned_from_all_users, \
+from app.shared.purge import purge_posts, purge_replies
+from app.utils import get_task_session, download_defeds, instance_banned, get_request, \
+    shorten_string, patch_db_session, archive_posts, get_setting, set_setting, communities_banned_from_all_users, \
     banned_instances, blocked_or_banned_instances, get_emoji_replacements
 
 
@@ -187,15 +191,35 @@ def remove_old_bot_content():
 
 @celery.task
 def update_hashtag_counts():
-    """Ensure accurate count of posts associated with each hashtag"""
+    """Correct any drift in the hashtag post counts that triggers on post_tag and post keep up to date"""
     session = get_task_session()
     try:
+        # only rows whose count is wrong are written
         session.execute(text('''
-            UPDATE tag 
-            SET post_count = (
-                SELECT COUNT(post_tag.post_id)
-                FROM post_tag 
-                WHERE post_tag.tag_id = tag.id
+            UPDATE tag
+            SET post_count = actual.post_count
+            FROM (
+                SELECT tag.id, COUNT(post_tag.post_id) AS post_count
+                FROM tag LEFT JOIN post_tag ON post_tag.tag_id = tag.id
+                GROUP BY tag.id
+            ) AS actual
+            WHERE tag.id = actual.id AND tag.post_count IS DISTINCT FROM actual.post_count
+        '''))
+        session.execute(text('''
+            INSERT INTO community_tag (community_id, tag_id, post_count)
+            SELECT post.community_id, post_tag.tag_id, COUNT(*)
+            FROM post_tag JOIN post ON post.id = post_tag.post_id
+            WHERE post.deleted IS NOT TRUE
+            GROUP BY post.community_id, post_tag.tag_id
+            ON CONFLICT (community_id, tag_id) DO UPDATE SET post_count = EXCLUDED.post_count
+            WHERE community_tag.post_count IS DISTINCT FROM EXCLUDED.post_count
+        '''))
+        session.execute(text('''
+            DELETE FROM community_tag
+            WHERE NOT EXISTS (
+                SELECT 1 FROM post_tag JOIN post ON post.id = post_tag.post_id
+                WHERE post_tag.tag_id = community_tag.tag_id AND post.community_id = community_tag.community_id
+                  AND post.deleted IS NOT TRUE
             )
         '''))
         session.commit()
@@ -213,7 +237,6 @@ def delete_old_soft_deleted_content():
         session = get_task_session()
         try:
             with patch_db_session(session):
-                from app import redis_client
                 cutoff = utcnow() - timedelta(days=7)
 
                 # Delete old posts only when no replies, mod-deleted or forced by community retention policy (deleted_by = 1)
@@ -230,30 +253,24 @@ def delete_old_soft_deleted_content():
                     ).scalars()
                 )
 
-                for post_id in post_ids:
-                    with redis_client.lock(f"lock:post:{post_id}", timeout=10, blocking_timeout=6):
-                        post = session.query(Post).get(post_id)
-                        if post:  # Check if still exists
-                            post.delete_dependencies()
-                            session.delete(post)
-                            session.commit()
-
-                # Delete old post replies
+                batch_size = current_app.config['PURGE_BATCH_SIZE']
+                for i in range(0, len(post_ids), batch_size):
+                    purge_posts(session, post_ids[i:i + batch_size])
+                    session.commit()
+
+                # Delete old post replies, except those that still have replies of their own
                 post_reply_ids = list(
                     session.execute(
-                        text('SELECT id FROM post_reply WHERE deleted = true AND posted_at < :cutoff'),
+                        text("""SELECT id FROM post_reply r
+                                WHERE r.deleted = true AND r.posted_at < :cutoff
+                                  AND NOT EXISTS (SELECT 1 FROM post_reply c WHERE c.parent_id = r.id)"""),
                         {'cutoff': cutoff}
                     ).scalars()
                 )
 
-                for post_reply_id in post_reply_ids:
-                    with redis_client.lock(f"lock:post_reply:{post_reply_id}", timeout=10, blocking_timeout=6):
-                        post_reply = session.query(PostReply).get(post_reply_id)
-                        if post_reply:  # Check if still exists
-                            post_reply.delete_dependencies()
-                            if not post_reply.has_replies(include_deleted=True):
-                                session.delete(post_reply)
-                                session.commit()
+                for i in range(0, len(post_reply_ids), batch_size):
+                    purge_replies(session, post_reply_ids[i:i + batch_size])
+                    session.commit()
 
         except Exception:
             session.rollback()
@@ -289,13 +306,14 @@ def update_community_stats():
                     (community.total_subscriptions_count is None or community.total_subscriptions_count < community.subscriptions_count):
                 community.total_subscriptions_count = community.subscriptions_count
 
-            community.post_count = session.execute(text(
+            post_count = session.execute(text(
                 'SELECT COUNT(*) as c FROM post WHERE deleted is false and community_id = :community_id'
             ), {'community_id': community.id}).scalar()
 
-            community.post_reply_count = session.execute(text(
+            post_reply_count = session.execute(text(
                 'SELECT COUNT(*) as c FROM post_reply WHERE deleted is false and community_id = :community_id'
             ), {'community_id': community.id}).scalar()
+            counters.apply_totals(community, post_count=post_count, post_reply_count=post_reply_count)
 
             session.commit()
 
@@ -329,13 +347,18 @@ def cleanup_old_voting_data():
             session.commit()
 
             # Delete local user post reply votes
-            session.execute(text('''
-                DELETE FROM "post_reply_vote"
-                WHERE user_id IN (
-                    SELECT id FROM "user" WHERE instance_id = :instance_id
+            voters = session.execute(text('''
+                WITH deleted AS (
+                    DELETE FROM "post_reply_vote"
+                    WHERE user_id IN (
+                        SELECT id FROM "user" WHERE instance_id = :instance_id
+                    )
+                    AND created_at < :cutoff
+                    RETURNING user_id
                 )
-                AND created_at < :cutoff
-            '''), {'cutoff': cutoff_local, 'instance_id': 1})
+                SELECT DISTINCT user_id FROM deleted
+            '''), {'cutoff': cutoff_local, 'instance_id': 1}).scalars().all()
+            api_context.changed(session, *voters)
 
             session.commit()
 
@@ -354,13 +377,18 @@ def cleanup_old_voting_data():
             session.commit()
 
             # Delete remote user post reply votes
-            session.execute(text('''
-                DELETE FROM "post_reply_vote"
-                WHERE user_id IN (
-                    SELECT id FROM "user" WHERE instance_id != :instance_id
+            voters = session.execute(text('''
+                WITH deleted AS (
+                    DELETE FROM "post_reply_vote"
+                    WHERE user_id IN (
+                        SELECT id FROM "user" WHERE instance_id != :instance_id
+                    )
+                    AND created_at < :cutoff
+                    RETURNING user_id
                 )
-                AND created_at < :cutoff
-            '''), {'cutoff': cutoff_remote, 'instance_id': 1})
+                SELECT DISTINCT user_id FROM deleted
+            '''), {'cutoff': cutoff_remote, 'instance_id': 1}).scalars().all()
+            api_context.changed(session, *voters)
 
             session.commit()
 
@@ -376,9 +404,11 @@ def unban_expired_users():
     """Unban users after ban expires"""
     session = get_task_session()
     try:
-        session.execute(text(
-            'UPDATE "user" SET banned = false WHERE banned is true AND banned_until < :cutoff AND banned_until is not null'
-        ), {'cutoff': utcnow()})
+        unbanned = session.execute(text(
+            'UPDATE "user" SET banned = false WHERE banned is true AND banned_until < :cutoff AND banned_until is not null '
+            'RETURNING id'
+        ), {'cutoff': utcnow()}).scalars().all()
+        api_context.changed(session, *unbanned)
         session.commit()
     except Exception:
         session.rollback()
@@ -411,74 +441,46 @@ def check_instance_health():
     session = get_task_session()
     try:
         with patch_db_session(session):
-            HEADERS = {'Accept': 'application/activity+json'}
-
             # Mark dormant instances as gone_forever after 5 days
             five_days_ago = utcnow() - timedelta(days=5)
-            dormant_instances = session.query(Instance).filter(
-                Instance.dormant == True,
-                Instance.start_trying_again < five_days_ago
-            ).all()
-
-            for instance in dormant_instances:
-                instance.gone_forever = True
+            session.execute(update(Instance).where(Instance.dormant == True,
+                                                   Instance.start_trying_again < five_days_ago).
+                            values(gone_forever=True))
             session.commit()
 
             # Re-check dormant instances that are not gone_forever
-            dormant_to_recheck = session.query(Instance).filter(
+            dormant_to_recheck = session.query(Instance.id, Instance.domain, Instance.nodeinfo_href,
+                                               Instance.failures).filter(
                 Instance.dormant == True,
                 Instance.gone_forever == False,
                 Instance.id != 1
             ).all()
 
+            targets = []
+            failures = {}
             for instance in dormant_to_recheck:
                 if instance_banned(instance.domain) or instance.domain == 'flipboard.com':
                     continue
-
-                try:
-                    # Try the nodeinfo endpoint first
-                    if instance.nodeinfo_href:
-                        node = get_request_instance(instance.nodeinfo_href, headers=HEADERS, instance=instance)
-                        if node.status_code == 200:
-                            try:
-                                node_json = node.json()
-                                if 'software' in node_json:
-                                    instance.software = node_json['software']['name'].lower()[:50]
-                                    instance.version = node_json['software']['version'][:50]
-                                    instance.failures = 0
-                                    instance.dormant = False
-                                    current_app.logger.info(f"Dormant instance {instance.domain} is back online")
-                            finally:
-                                node.close()
-                    else:
-                        # Try to discover nodeinfo
-                        nodeinfo = get_request_instance(
-                            f"https://{instance.domain}/.well-known/nodeinfo",
-                            headers=HEADERS,
-                            instance=instance
-                        )
-                        if nodeinfo.status_code == 200:
-                            try:
-                                nodeinfo_json = nodeinfo.json()
-                                for links in nodeinfo_json['links']:
-                                    if isinstance(links, dict) and 'rel' in links and links['rel'] in [
-                                        'http://nodeinfo.diaspora.software/ns/schema/2.0',
-                                        'https://nodeinfo.diaspora.software/ns/schema/2.0',
-                                        'http://nodeinfo.diaspora.software/ns/schema/2.1'
-                                    ]:
-                                        instance.nodeinfo_href = links['href']
-                                        instance.failures = 0
-                                        instance.dormant = False
-                                        current_app.logger.info(f"Dormant instance {instance.domain} is back online")
-                                        break
-                            finally:
-                                nodeinfo.close()
-                except Exception as e:
-                    session.rollback()
-                    instance.failures += 1
-                    current_app.logger.warning(f"Error rechecking dormant instance {instance.domain}: {e}")
-
+                targets.append(ProbeTarget(instance.id, instance.domain, instance.nodeinfo_href))
+                failures[instance.id] = instance.failures or 0
+
+            updates = []
+            for result in probe_instances(targets):
+                if result.status == 'ok':
+                    values = {'id': result.instance_id, 'nodeinfo_href': result.nodeinfo_href, 'failures': 0,
+                              'dormant': False, 'last_health_check': utcnow()}
+                    if result.software:
+                        values['software'] = result.software
+                        values['version'] = result.version
+                    updates.append(values)
+                elif result.status == 'error':
+                    updates.append({'id': result.instance_id, 'failures': failures[result.instance_id] + 1})
+
+            if updates:
+                session.execute(update(Instance), updates)
             session.commit()
+            current_app.logger.info(f"Rechecked {len(targets)} dormant instances, "
+                                    f"{len([u for u in updates if u.get('dormant') is False])} are back online")
 
     except Exception:
         session.rollback()
@@ -492,197 +494,79 @@ def monitor_healthy_instances():
     """Check healthy instances to see if still healthy"""
     session = get_task_session()
     try:
-        HEADERS = {'Accept': 'application/activity+json'}
-
-        instances = session.query(Instance).filter(
-            Instance.gone_forever == False,
-            Instance.dormant == False,
-            Instance.id != 1
-        ).all()
-
-        for instance in instances:
-            if instance_banned(instance.domain) or instance.domain == 'flipboard.com':
-                continue
-
-            nodeinfo_href = instance.nodeinfo_href
-            if (instance.software == 'lemmy' and instance.version is not None and
-                    instance.version >= '0.19.4' and instance.nodeinfo_href and
-                    instance.nodeinfo_href.endswith('nodeinfo/2.0.json')):
-                nodeinfo_href = None
-
-            if not nodeinfo_href:
-                try:
-                    nodeinfo = get_request_instance(
-                        f"https://{instance.domain}/.well-known/nodeinfo",
-                        headers=HEADERS,
-                        instance=instance
-                    )
-
-                    if nodeinfo.status_code == 200:
-                        nodeinfo_json = nodeinfo.json()
-                        for links in nodeinfo_json['links']:
-                            if isinstance(links, dict) and 'rel' in links and links['rel'] in [
-                                'http://nodeinfo.diaspora.software/ns/schema/2.0',
-                                'https://nodeinfo.diaspora.software/ns/schema/2.0',
-                                'http://nodeinfo.diaspora.software/ns/schema/2.1'
-                            ]:
-                                instance.nodeinfo_href = links['href']
-                                instance.failures = 0
-                                instance.dormant = False
-                                instance.gone_forever = False
-                                break
-                            else:
-                                instance.failures += 1
-                    elif nodeinfo.status_code >= 300:
-                        current_app.logger.info(f"{instance.domain} has no well-known/nodeinfo response")
-                        instance.failures += 1
-                except Exception:
-                    session.rollback()
-                    instance.failures += 1
-                finally:
-                    nodeinfo.close()
-                session.commit()
-
-            if instance.nodeinfo_href:
-                try:
-                    node = get_request_instance(instance.nodeinfo_href, headers=HEADERS, instance=instance)
-                    if node.status_code == 200:
-                        node_json = node.json()
-                        if 'software' in node_json:
-                            instance.software = node_json['software']['name'].lower()[:50]
-                            instance.version = node_json['software']['version'][:50]
-                            instance.failures = 0
-                            instance.dormant = False
-                            instance.gone_forever = False
-                    elif node.status_code >= 300:
-                        instance.nodeinfo_href = None
-                        instance.failures += 1
-                        instance.most_recent_attempt = utcnow()
-                        if instance.failures > 5:
-                            instance.dormant = True
-                            instance.start_trying_again = utcnow() + timedelta(days=5)
-                except Exception:
-                    session.rollback()
-                    instance.failures += 1
-                    instance.most_recent_attempt = utcnow()
-                    if instance.failures > 5:
-                        instance.dormant = True
-                        instance.start_trying_again = utcnow() + timedelta(days=5)
-                    if instance.failures > 12:
-                        instance.gone_forever = True
-                finally:
-                    node.close()
-
-                session.commit()
-            else:
-                instance.failures += 1
-                instance.most_recent_attempt = utcnow()
-                if instance.failures > 5:
-                    instance.dormant = True
-                    instance.start_trying_again = utcnow() + timedelta(days=5)
-                if instance.failures > 12:
-                    instance.gone_forever = True
-                session.commit()
+        with patch_db_session(session):
+            instances = session.query(Instance).filter(
+                Instance.gone_forever == False,
+                Instance.dormant == False,
+                Instance.id != 1
+            ).all()
 
-            # Handle admin roles for Lemmy/PieFed instances
-            if instance.online() and (instance.software == 'lemmy' or instance.software == 'piefed'):
-                try:
-                    response = get_request(f'https://{instance.domain}/api/v3/site')
-                    if response and response.status_code == 200:
-                        instance_data = response.json()
-                        admin_profile_ids = []
-
-                        for admin in instance_data['admins']:
-                            profile_id = admin['person']['actor_id']
-                            if profile_id.startswith('https://') or profile_id.startswith('http://'):
-                                admin_profile_ids.append(profile_id.lower())
-                                user = find_actor_or_create(profile_id)
-                                if user and not instance.user_is_admin(user.id):
-                                    new_instance_role = InstanceRole(
-                                        instance_id=instance.id,
-                                        user_id=user.id,
-                                        role='admin'
-                                    )
-                                    session.add(new_instance_role)
-
-                        # Remove old admin roles
-                        for instance_admin in session.query(InstanceRole).filter_by(instance_id=instance.id):
-                            if instance_admin.user.profile_id() not in admin_profile_ids:
-                                session.query(InstanceRole).filter(
-                                    InstanceRole.user_id == instance_admin.user.id,
-                                    InstanceRole.instance_id == instance.id,
-                                    InstanceRole.role == 'admin'
-                                ).delete()
-
-                        # refresh custom emoji
-                        if not instance_banned(instance.domain):
-                            for emoji in instance_data['custom_emojis']:
-                                token = emoji['custom_emoji']['shortcode']
-                                aliases = [keyword['keyword'] for keyword in emoji['keywords']]
-                                existing_emoji = session.query(Emoji).filter(Emoji.instance_id == instance.id,
-                                                                             Emoji.token == f":{token}:").first()
-                                if existing_emoji:
-                                    existing_emoji.url = emoji['custom_emoji']['image_url']
-                                    existing_emoji.category = emoji['custom_emoji']['category']
-                                    existing_emoji.aliases = ' '.join(aliases)
-                                else:
-                                    new_emoji = Emoji(instance_id=instance.id, token=f':{token}:',
-                                                      url=emoji['custom_emoji']['image_url'],
-                                                      category=emoji['custom_emoji']['category'],
-                                                      aliases=' '.join(aliases))
-                                    session.add(new_emoji)
-                                session.commit()
-                    cache.delete_memoized(get_emoji_replacements)
-                except Exception:
-                    session.rollback()
-                    instance.failures += 1
-                finally:
-                    if response:
-                        response.close()
-                session.commit()
+            now = utcnow()
+            targets = []
+            for instance in instances:
+                if instance_banned(instance.domain) or instance.domain == 'flipboard.com':
+                    continue
+                if not probe_due(instance, now):
+                    continue
 
-            # Handle admin roles for MBIN instances
-            """
-            (unlike Lemmy / PieFed, API response for this endpoint doesn't give enough info to create User,
-            only add instance role info to Users that the DB is already aware of)
-            """
-            if instance.online() and instance.software == 'mbin':
+                nodeinfo_href = instance.nodeinfo_href
+                if (instance.software == 'lemmy' and instance.version is not None and
+                        instance.version >= '0.19.4' and instance.nodeinfo_href and
+                        instance.nodeinfo_href.endswith('nodeinfo/2.0.json')):
+                    nodeinfo_href = None
+                targets.append(ProbeTarget(instance.id, instance.domain, nodeinfo_href))
+
+            instances_by_id = {instance.id: instance for instance in instances}
+            updates = []
+            for result in probe_instances(targets):
+                instance = instances_by_id[result.instance_id]
+                values = {'id': instance.id, 'last_health_check': now}
+                if result.status == 'ok':
+                    values.update(nodeinfo_href=result.nodeinfo_href, failures=0, dormant=False, gone_forever=False)
+                    if result.software:
+                        values.update(software=result.software, version=result.version)
+                else:
+                    failures = (instance.failures or 0) + 1
+                    values.update(failures=failures, most_recent_attempt=now)
+                    if result.status == 'http_error':
+                        values['nodeinfo_href'] = None
+                    if failures > 5:
+                        values.update(dormant=True, start_trying_again=now + timedelta(days=5))
+                    if failures > 12 and result.status != 'http_error':
+                        values['gone_forever'] = True
+                updates.append(values)
+
+            if updates:
+                session.execute(update(Instance), updates)
+            session.commit()
+            current_app.logger.info(f"Probed {len(targets)} of {len(instances)} healthy instances")
+
+            # Admin roles and custom emoji for Lemmy/PieFed/MBIN instances that are still online
+            probed = {target.instance_id for target in targets}
+            site_urls = {}
+            for instance in session.query(Instance).filter(Instance.id.in_(probed), Instance.dormant == False,
+                                                            Instance.gone_forever == False):
+                if instance.software == 'lemmy' or instance.software == 'piefed':
+                    site_urls[instance.id] = f'https://{instance.domain}/api/v3/site'
+                elif instance.software == 'mbin':
+                    site_urls[instance.id] = f'https://{instance.domain}/api/users/admins'
+
+            site_data = fetch_json_many(list(site_urls.values()))
+            for instance_id, url in site_urls.items():
+                instance = session.query(Instance).get(instance_id)
+                if url not in site_data:
+                    continue
                 try:
-                    response = get_request(f'https://{instance.domain}/api/users/admins')
-                    if response and response.status_code == 200:
-                        instance_data = response.json()
-                        admin_user_ids = []
-
-                        for item in instance_data['items']:
-                            username = item['username'] if 'username' in item else None
-                            if username and (item.get('isAdmin') or item.get('isGlobalModerator')):
-                                user = session.query(User).filter_by(user_name=username, instance_id=instance.id).first()
-                                if user:
-                                    admin_user_ids.append(user.id)
-                                    if not instance.user_is_admin(user.id):
-                                        new_instance_role = InstanceRole(
-                                            instance_id=instance.id,
-                                            user_id=user.id,
-                                            role='admin'
-                                        )
-                                        session.add(new_instance_role)
-
-                        # Remove old admin roles
-                        for instance_admin in session.query(InstanceRole).filter_by(instance_id=instance.id):
-                            if instance_admin.user_id not in admin_user_ids:
-                                session.query(InstanceRole).filter(
-                                    InstanceRole.user_id == instance_admin.user_id,
-                                    InstanceRole.instance_id == instance.id,
-                                    InstanceRole.role == 'admin'
-                                ).delete()
+                    if instance.software == 'mbin':
+                        refresh_mbin_admins(session, instance, site_data[url])
+                    else:
+                        refresh_lemmy_admins_and_emoji(session, instance, site_data[url])
                 except Exception:
                     session.rollback()
                     instance.failures += 1
-                finally:
-                    if response:
-                        response.close()
                 session.commit()
-
+            if site_urls:
+                cache.delete_memoized(get_emoji_replacements)
 
     except Exception:
         session.rollback()
@@ -691,6 +575,82 @@ def monitor_healthy_instances():
         session.close()
 
 
+def refresh_lemmy_admins_and_emoji(session, instance, instance_data):
+    admin_profile_ids = []
+
+    for admin in instance_data['admins']:
+        profile_id = admin['person']['actor_id']
+        if profile_id.startswith('https://') or profile_id.startswith('http://'):
+            admin_profile_ids.append(profile_id.lower())
+            user = find_actor_or_create(profile_id)
+            if user and not instance.user_is_admin(user.id):
+                new_instance_role = InstanceRole(
+                    instance_id=instance.id,
+                    user_id=user.id,
+                    role='admin'
+                )
+                session.add(new_instance_role)
+
+    # Remove old admin roles
+    for instance_admin in session.query(InstanceRole).filter_by(instance_id=instance.id):
+        if instance_admin.user.profile_id() not in admin_profile_ids:
+            session.query(InstanceRole).filter(
+                InstanceRole.user_id == instance_admin.user.id,
+                InstanceRole.instance_id == instance.id,
+                InstanceRole.role == 'admin'
+            ).delete()
+
+    # refresh custom emoji
+    if not instance_banned(instance.domain):
+        for emoji in instance_data['custom_emojis']:
+            token = emoji['custom_emoji']['shortcode']
+            aliases = [keyword['keyword'] for keyword in emoji['keywords']]
+            existing_emoji = session.query(Emoji).filter(Emoji.instance_id == instance.id,
+                                                         Emoji.token == f":{token}:").first()
+            if existing_emoji:
+                existing_emoji.url = emoji['custom_emoji']['image_url']
+                existing_emoji.category = emoji['custom_emoji']['category']
+                existing_emoji.aliases = ' '.join(aliases)
+            else:
+                new_emoji = Emoji(instance_id=instance.id, token=f':{token}:',
+                                  url=emoji['custom_emoji']['image_url'],
+                                  category=emoji['custom_emoji']['category'],
+                                  aliases=' '.join(aliases))
+                session.add(new_emoji)
+            session.commit()
+
+
+def refresh_mbin_admins(session, instance, instance_data):
+    """
+    (unlike Lemmy / PieFed, API response for this endpoint doesn't give enough info to create User,
+    only add instance role info to Users that the DB is already aware of)
+    """
+    admin_user_ids = []
+
+    for item in instance_data['items']:
+        username = item['username'] if 'username' in item else None
+        if username and (item.get('isAdmin') or item.get('isGlobalModerator')):
+            user = session.query(User).filter_by(user_name=username, instance_id=instance.id).first()
+            if user:
+                admin_user_ids.append(user.id)
+                if not instance.user_is_admin(user.id):
+                    new_instance_role = InstanceRole(
+                        instance_id=instance.id,
+                        user_id=user.id,
+                        role='admin'
+                    )
+                    session.add(new_instance_role)
+
+    # Remove old admin roles
+    for instance_admin in session.query(InstanceRole).filter_by(instance_id=instance.id):
+        if instance_admin.user_id not in admin_user_ids:
+            session.query(InstanceRole).filter(
+                InstanceRole.user_id == instance_admin.user_id,
+                InstanceRole.instance_id == instance.id,
+                InstanceRole.role == 'admin'
+            ).delete()
+
+
 @celery.task
 def recalculate_user_attitudes():
     """Recalculate recent active user attitudes"""
@@ -866,6 +826,9 @@ def cleanup_old_activitypub_logs():
         session.close()
 
 
+POSTS_KEPT_PER_COMMUNITY = 100     # the newest posts in each community are never archived, however old they are
+
+
 @celery.task
 def archive_old_posts():
     """Archive old posts to reduce DB size"""
@@ -887,12 +850,13 @@ def archive_old_posts():
                       FROM "post" p2 
                       WHERE p2.community_id = p.community_id 
                       ORDER BY p2.created_at DESC 
-                      LIMIT 100
+                      LIMIT :keep_newest
                   )
             '''
-            post_ids = session.execute(text(sql), {'cutoff': cutoff}).scalars()
-            for post_id in post_ids:
-                archive_post(post_id)
+            post_ids = list(session.execute(text(sql), {'cutoff': cutoff,
+                                                        'keep_newest': POSTS_KEPT_PER_COMMUNITY}).scalars())
+            for i in range(0, len(post_ids), SEGMENT_POSTS):
+                archive_posts(post_ids[i:i + SEGMENT_POSTS])
 
         except Exception:
             session.rollback()
@@ -1106,6 +1070,43 @@ def delete_from_s3(s3_files_to_delete):
     s3.close()
 
 
+@celery.task
+def repair_actor_url(actor_url: str):
+    """Make the actor_url index entry for actor_url agree with the user, community and feed tables"""
+    from app.activitypub.actor import ACTOR_TYPES
+    from app.models import ActorUrl
+    session = get_task_session()
+    try:
+        session.query(ActorUrl).filter(ActorUrl.url == actor_url).delete()
+        for actor_type, model in ACTOR_TYPES.items():
+            actor_id = session.query(model.id).filter(model.ap_profile_id == actor_url).\
+                order_by(model.banned).limit(1).scalar()
+            if actor_id is not None:
+                session.add(ActorUrl(url=actor_url, actor_type=actor_type, actor_id=actor_id))
+                break
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+@celery.task
+def blank_archived_posts(locators: list):
+    """Remove deleted posts from the archive segments they were packed into - see archive_store.blank_records()"""
+    from app import redis_client
+    from app.archive_store import parse_locator, blank_records
+    records = {}
+    for locator in locators:
+        segment_name, offset, header_length, record_length = parse_locator(locator)
+        records.setdefault(segment_name, []).append((offset, record_length))
+    for segment_name, segment_records in records.items():
+        # a segment in S3 is rewritten whole, so two deletions from the same one must not overlap
+        with redis_client.lock(f'lock:archive_segment:{segment_name}', timeout=300, blocking_timeout=60):
+            blank_records(segment_name, segment_records)
+
+
 @celery.task
 def clean_up_tmp():
     DELETABLE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".heic", ".mp3", ".mp4"}
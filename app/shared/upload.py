@@ -1,167 +1,391 @@
+# Uploads are stored as they are and answered straight away, with a File in the pending state. process_file_task, in
+# the media lane, then makes the variants - resized, converted to MEDIA_IMAGE_FORMAT, thumbnails - in a pool of
+# processes so that the decoding and encoding doesn't hold up the worker's other tasks, moves them to S3 if it's used
+# and marks the File ready (or failed). The UI and API can poll File.state - see get_upload_state().
+#
+# Until then a File from store_image_with_thumbnail() points at the stored upload, so it can be shown. A url returned
+# by process_upload() is where the processed image will be - the stored upload is put there too, so that the url works
+# straight away, and the processed image replaces it.
+
+import multiprocessing
 import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 import boto3
 from PIL import Image, ImageOps
 from flask import current_app
 from pillow_heif import register_heif_opener
-from sqlalchemy import text
+from sqlalchemy import inspect, text
 
-from app import db
-from app.models import File, user_file
+from app import celery, db
+from app.constants import FILE_STATE_FAILED, FILE_STATE_PENDING, FILE_STATE_READY
+from app.models import Community, Feed, File, user_file
 from app.utils import (
     gibberish,
     ensure_directory_exists,
     store_files_in_s3,
     guess_mime_type,
+    scale_gif,
+    get_task_session,
+    patch_db_session,
 )
 
+ALLOWED_EXTENSIONS = [
+    ".gif",
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".webp",
+    ".heic",
+    ".mpo",
+    ".avif",
+    ".svg",
+]
+IMAGE_FORMATS = {"GIF", "JPEG", "PNG", "WEBP", "HEIF", "MPO", "AVIF"}   # what Pillow calls them
+PROCESS_AFTER_COMMIT = "process_uploads_after_commit"   # in session.info - (File, plan) of uploads to process
+
 
 def process_upload(image_file, destination="posts", user_id=None):
     # should have errored earlier if no upload, but just to be paranoid
     if not image_file or image_file.filename == "":
         raise Exception("file not uploaded")
 
-    allowed_extensions = [
-        ".gif",
-        ".jpg",
-        ".jpeg",
-        ".png",
-        ".webp",
-        ".heic",
-        ".mpo",
-        ".avif",
-        ".svg",
-    ]
-    file_ext = os.path.splitext(image_file.filename)[1]
-    if file_ext.lower() not in allowed_extensions:
+    upload = store_upload(image_file, destination)
+
+    # Use environment variables to determine image max dimension, format, and quality
+    image_max_dimension = current_app.config["MEDIA_IMAGE_MAX_DIMENSION"]
+    image_format = current_app.config["MEDIA_IMAGE_FORMAT"]
+    image_quality = current_app.config["MEDIA_IMAGE_QUALITY"]
+
+    if upload["ext"] in (".svg", ".gif"):
+        variant = image_variant(upload, "file", None, upload["ext"])
+    else:
+        variant = image_variant(upload, "file", (image_max_dimension, image_max_dimension),
+                                "." + image_format.lower() if image_format else upload["ext"],
+                                image_format, image_quality,
+                                rgb=image_format == "JPEG" or upload["ext"] in (".jpg", ".jpeg"))
+    location = variant_location(variant)
+    url = location if location.startswith("http") else \
+        f"{current_app.config['SERVER_URL']}/{location.replace('app/', '', 1)}"
+
+    # associate file with uploader. Only provide user_id to this function when the image is not being used for a community icon, user avatar, etc where there is some other way to associate the image with the user.
+    file = File(source_url=url)
+    process_after_commit(file, {"source": upload["path"], "variants": [variant]})
+    if file.state == FILE_STATE_PENDING:
+        publish_upload(upload, variant)  # before the commit, after which the processed image can replace it
+    db.session.add(file)
+    db.session.flush()
+    if user_id:
+        db.session.execute(
+            text(
+                'INSERT INTO "user_file" (file_id, user_id, size) VALUES (:file_id, :user_id, :size)'
+            ),
+            {"file_id": file.id, "user_id": user_id, "size": os.path.getsize(upload["path"])},
+        )
+    db.session.commit()
+
+    return url
+
+
+def store_image_with_thumbnail(upload_file, directory: str, alt_text: str, size, thumbnail_size) -> File:
+    """A pending File for an icon or banner, which will be resized to fit in size with a thumbnail that fits in
+    thumbnail_size. The caller adds it to whatever it is for, and it is processed once that is committed."""
+    upload = store_upload(upload_file, directory)
+    if upload["ext"] == ".svg":  # svgs don't need to be resized
+        main = image_variant(upload, "file", None, ".svg")
+        thumbnail = dict(main, field="thumbnail")
+    elif upload["ext"] == ".gif":  # animated gifs are scaled frame by frame
+        main = image_variant(upload, "file", size, ".gif")
+        thumbnail = image_variant(upload, "thumbnail", thumbnail_size, ".gif", suffix="_thumbnail")
+    else:
+        image_format = current_app.config["MEDIA_IMAGE_FORMAT"]
+        thumbnail_image_format = current_app.config["MEDIA_IMAGE_THUMBNAIL_FORMAT"]
+        main = image_variant(upload, "file", size, "." + image_format.lower() if image_format else upload["ext"],
+                             image_format, current_app.config["MEDIA_IMAGE_QUALITY"],
+                             rgb=image_format == "JPEG" or upload["ext"] in (".jpg", ".jpeg"))
+        thumbnail = image_variant(upload, "thumbnail", thumbnail_size,
+                                  "." + thumbnail_image_format.lower() if thumbnail_image_format else ".webp",
+                                  thumbnail_image_format, current_app.config["MEDIA_IMAGE_THUMBNAIL_QUALITY"],
+                                  rgb=thumbnail_image_format == "JPEG", suffix="_thumbnail")
+
+    file = File(file_path=upload["path"], file_name=os.path.basename(main["path"]), alt_text=alt_text,
+                thumbnail_path=upload["path"])
+    process_after_commit(file, {"source": upload["path"], "variants": [main, thumbnail]})
+    db.session.add(file)
+    return file
+
+
+def publish_upload(upload: dict, variant: dict):
+    """Put the stored upload where variant will be, so that its url works before the variant has been made"""
+    if variant["s3_key"]:
+        s3 = s3_client()
+        try:
+            s3.upload_file(upload["path"], current_app.config["S3_BUCKET"], variant["s3_key"],
+                           ExtraArgs=s3_extra_args(upload["path"]))
+        finally:
+            s3.close()
+    elif variant["path"] != upload["path"]:
+        shutil.copyfile(upload["path"], variant["path"])
+
+
+def file_for_image_url(url: str) -> File:
+    """A File for an icon or banner at url, added to the session. When url came from process_upload() it is that
+    upload's File, unless something else has it already - two Files for the one image would each delete it when they go.
+    """
+    file = (
+        db.session.query(File)
+        .filter(File.source_url == url)
+        .filter(~user_file.select().where(user_file.c.file_id == File.id).exists())
+        .filter(~db.session.query(Community.id).filter((Community.icon_id == File.id) |
+                                                      (Community.image_id == File.id)).exists())
+        .filter(~db.session.query(Feed.id).filter((Feed.icon_id == File.id) | (Feed.image_id == File.id)).exists())
+        .order_by(File.id.desc())
+        .first()
+    )
+    if file is None:
+        file = File(source_url=url)
+        db.session.add(file)
+    return file
+
+
+def store_upload(upload_file, directory: str) -> dict:
+    """Save an upload as it is - where it will stay, or in tmp if it's going to S3 - after checking it's an image"""
+    file_ext = os.path.splitext(upload_file.filename)[1].lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
         raise Exception("filetype not allowed")
 
     new_filename = gibberish(15)
+    subdirectory = f"{directory}/{new_filename[0:2]}/{new_filename[2:4]}"
     # set up the storage directory
-    if store_files_in_s3():
-        directory = "app/static/tmp"
-    else:
-        directory = (
-            "app/static/media/"
-            + destination
-            + "/"
-            + new_filename[0:2]
-            + "/"
-            + new_filename[2:4]
-        )
-    ensure_directory_exists(directory)
+    local_directory = "app/static/tmp" if store_files_in_s3() else f"app/static/media/{subdirectory}"
+    ensure_directory_exists(local_directory)
 
-    # save the file
-    final_place = os.path.join(directory, new_filename + file_ext)
-    image_file.seek(0)
-    image_file.save(final_place)
-    file_size = os.path.getsize(final_place)
+    path = os.path.join(local_directory, new_filename + file_ext)
+    upload_file.seek(0)
+    upload_file.save(path)
+    if file_ext != ".svg" and not is_image(path):
+        os.unlink(path)
+        raise Exception("filetype not allowed")
+    return {"path": path, "ext": file_ext, "name": new_filename, "local_directory": local_directory,
+            "subdirectory": subdirectory}
 
-    final_ext = file_ext.lower()  # track file extension for conversion
 
-    if file_ext.lower() == ".heic":
-        register_heif_opener()
-    if file_ext.lower() == ".avif":
-        import pillow_avif  # NOQA
+def is_image(path: str) -> bool:
+    register_image_formats(path)
+    try:
+        with Image.open(path) as img:  # only reads enough to know what it is
+            return img.format in IMAGE_FORMATS
+    except Exception:
+        return False
+
+
+def image_variant(upload: dict, field: str, max_size, ext: str, image_format: str = "", quality: int = 0,
+                  rgb: bool = False, suffix: str = "") -> dict:
+    """How to make one variant of a stored upload. field is the File column it's for - 'file' or 'thumbnail'. With no
+    max_size the upload is used as it is."""
+    name = upload["name"] + suffix + ext
+    return {
+        "field": field,
+        "path": os.path.join(upload["local_directory"], name),
+        "s3_key": f"{upload['subdirectory']}/{name}" if store_files_in_s3() else None,
+        "max_size": list(max_size) if max_size else None,
+        "format": image_format.upper() or None,
+        "quality": int(quality) if quality else None,
+        "rgb": rgb,
+    }
+
+
+def variant_location(variant: dict) -> str:
+    """Where a variant will be once it is made - a local path, or a url on S3"""
+    if variant["s3_key"]:
+        return f"https://{current_app.config['S3_PUBLIC_URL']}/{variant['s3_key']}"
+    return variant["path"]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Queueing, once the File is committed
+
+def process_after_commit(file: File, plan: dict):
+    """Make the variants in plan for file, once the transaction that adds it has been committed"""
+    if all(variant["max_size"] is None and variant["s3_key"] is None and variant["path"] == plan["source"]
+           for variant in plan["variants"]):
+        file.state = FILE_STATE_READY  # e.g. an svg, kept where it was stored
+        return
+    file.state = FILE_STATE_PENDING
+    db.session.info.setdefault(PROCESS_AFTER_COMMIT, []).append((file, plan))
 
+
+def queue_committed(session):
+    """after_commit - the Files are in the database now, so the media lane can find them"""
+    for file, plan in session.info.pop(PROCESS_AFTER_COMMIT, ()):
+        file_id = inspect(file).identity[0]  # file has been expired by the commit, this doesn't load it again
+        if current_app.debug:
+            process_file_task(file_id, plan)
+        else:
+            process_file_task.delay(file_id, plan)
+
+
+def forget_uncommitted(session):
+    """after_rollback - the Files were never added"""
+    session.info.pop(PROCESS_AFTER_COMMIT, None)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# The media lane
+
+@celery.task
+def process_file_task(file_id: int, plan: dict):
+    with current_app.app_context():
+        session = get_task_session()
+        try:
+            with patch_db_session(session):
+                file = session.get(File, file_id)
+                try:
+                    made = make_variants(plan)
+                except Exception:
+                    current_app.logger.exception(f"Could not process upload {plan['source']}")
+                    if file:
+                        file.state = FILE_STATE_FAILED
+                        session.commit()
+                    return
+                if file is None:  # deleted while it was waiting
+                    for location, _, _, _ in made:
+                        if not location.startswith("http") and os.path.exists(location):
+                            os.unlink(location)
+                    return
+
+                for variant, (location, width, height, size) in zip(plan["variants"], made):
+                    if variant["field"] == "thumbnail":
+                        file.thumbnail_path = location
+                        file.thumbnail_width, file.thumbnail_height = width, height
+                    else:
+                        if file.source_url is None:
+                            file.file_path = location
+                        file.width, file.height = width, height
+                        session.execute(text('UPDATE "user_file" SET size = :size WHERE file_id = :file_id'),
+                                        {"file_id": file.id, "size": size})
+                file.state = FILE_STATE_READY
+                session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+def make_variants(plan: dict) -> list[tuple]:
+    """Make each variant in plan, moving them to S3 if needed. Returns (where it is, width, height, size) of each."""
+    made = []
+    uploaded = set()
+    s3 = None
+    try:
+        for variant in plan["variants"]:
+            width, height = run_in_media_pool(make_variant, plan["source"], variant["path"], variant["max_size"],
+                                              variant["format"], variant["quality"], variant["rgb"])
+            size = os.path.getsize(variant["path"])
+            if variant["s3_key"] and variant["s3_key"] not in uploaded:
+                if s3 is None:
+                    s3 = s3_client()
+                s3.upload_file(variant["path"], current_app.config["S3_BUCKET"], variant["s3_key"],
+                               ExtraArgs=s3_extra_args(variant["path"]))
+                uploaded.add(variant["s3_key"])
+            made.append((variant_location(variant), width, height, size))
+    finally:
+        if s3 is not None:
+            s3.close()
+
+    # the stored upload, and anything that went to S3, is no longer needed locally
+    keep = {variant["path"] for variant in plan["variants"] if not variant["s3_key"]}
+    for path in {plan["source"], *(variant["path"] for variant in plan["variants"])} - keep:
+        if os.path.exists(path):
+            os.unlink(path)
+    return made
+
+
+def make_variant(source: str, destination: str, max_size, image_format=None, quality=None, rgb=False) -> tuple:
+    """Make destination from source, resized to fit in max_size and saved as image_format. Returns its width and
+    height. Runs in the media process pool, so everything it gets and returns has to be picklable."""
     Image.MAX_IMAGE_PIXELS = 89478485
+    register_image_formats(source, image_format)
+    ext = os.path.splitext(source)[1].lower()
+
+    if max_size is None or ext == ".gif":
+        size = (None, None) if ext == ".svg" else image_size(source)
+        if max_size is None or (size[0] <= max_size[0] and size[1] <= max_size[1]):
+            if destination != source:
+                shutil.copyfile(source, destination)
+            return size
+        return scale_gif(source, tuple(max_size), destination)
+
+    with Image.open(source) as img:
+        img = ImageOps.exif_transpose(img)
+        img = img.convert("RGB" if rgb else "RGBA")
+        img.thumbnail(tuple(max_size), resample=Image.LANCZOS)
+
+        kwargs = {}
+        if image_format:
+            kwargs["format"] = image_format
+        if quality:
+            kwargs["quality"] = quality
+        img.save(destination, optimize=True, **kwargs)
+        return img.size
+
+
+def image_size(path: str) -> tuple[int, int]:
+    with Image.open(path) as img:
+        return img.size
 
-    # Use environment variables to determine image max dimension, format, and quality
-    image_max_dimension = current_app.config["MEDIA_IMAGE_MAX_DIMENSION"]
-    image_format = current_app.config["MEDIA_IMAGE_FORMAT"]
-    image_quality = current_app.config["MEDIA_IMAGE_QUALITY"]
 
-    if image_format == "AVIF":
+def register_image_formats(path: str, image_format=None):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".heic":
+        register_heif_opener()
+    if ext == ".avif" or image_format == "AVIF":
         import pillow_avif  # NOQA
 
-    if not final_place.endswith(".svg") and not final_place.endswith(".gif"):
-        img = Image.open(final_place)
-        if "." + img.format.lower() in allowed_extensions:
-            img = ImageOps.exif_transpose(img)
-            img = img.convert(
-                "RGB"
-                if (image_format == "JPEG" or final_ext in [".jpg", ".jpeg"])
-                else "RGBA"
-            )
-            img.thumbnail(
-                (image_max_dimension, image_max_dimension), resample=Image.LANCZOS
-            )
 
-            kwargs = {}
-            if image_format:
-                kwargs["format"] = image_format.upper()
-                final_ext = "." + image_format.lower()
-                final_place = os.path.splitext(final_place)[0] + final_ext
-            if image_quality:
-                kwargs["quality"] = int(image_quality)
+_media_pool = None
+_media_pool_lock = threading.Lock()
 
-            img.save(final_place, optimize=True, **kwargs)
 
-            file_size = os.path.getsize(final_place)
+def run_in_media_pool(fn, *args):
+    """fn(*args) in the pool of MEDIA_PROCESSES processes. Right here instead if MEDIA_PROCESSES is 0, when debugging,
+    or in a daemonic process (e.g. the prefork pool), which can't have children."""
+    global _media_pool
+    processes = current_app.config["MEDIA_PROCESSES"]
+    if not processes or current_app.debug or multiprocessing.current_process().daemon:
+        return fn(*args)
+    with _media_pool_lock:
+        if _media_pool is None:
+            # spawned rather than forked - the worker has threads, whose locks a forked child would inherit
+            _media_pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+    return _media_pool.submit(fn, *args).result()
 
-            url = (
-                f"{current_app.config['SERVER_URL']}/{final_place.replace('app/', '')}"
-            )
-        else:
-            raise Exception("filetype not allowed")
-    else:
-        url = f"{current_app.config['SERVER_URL']}/{final_place.replace('app/', '')}"
-
-    # Move uploaded file to S3
-    if store_files_in_s3():
-        session = boto3.session.Session()
-        extra_args = {"ContentType": guess_mime_type(final_place)}
-        if current_app.config.get("S3_STORAGE_CLASS"):
-            extra_args["StorageClass"] = current_app.config["S3_STORAGE_CLASS"]
-        s3 = session.client(
-            service_name="s3",
-            region_name=current_app.config["S3_REGION"],
-            endpoint_url=current_app.config["S3_ENDPOINT"],
-            aws_access_key_id=current_app.config["S3_ACCESS_KEY"],
-            aws_secret_access_key=current_app.config["S3_ACCESS_SECRET"],
-        )
-        s3.upload_file(
-            final_place,
-            current_app.config["S3_BUCKET"],
-            destination
-            + "/"
-            + new_filename[0:2]
-            + "/"
-            + new_filename[2:4]
-            + "/"
-            + new_filename
-            + final_ext,
-            ExtraArgs=extra_args,
-        )
-        url = (
-            f"https://{current_app.config['S3_PUBLIC_URL']}/{destination}/"
-            + new_filename[0:2]
-            + "/"
-            + new_filename[2:4]
-            + "/"
-            + new_filename
-            + final_ext
-        )
-        s3.close()
-        os.unlink(final_place)
 
-    # associate file with uploader. Only provide user_id to this function when the image is not being used for a community icon, user avatar, etc where there is some other way to associate the image with the user.
-    if user_id:
-        file = File(source_url=url)
-        db.session.add(file)
-        db.session.commit()
-        db.session.execute(
-            text(
-                'INSERT INTO "user_file" (file_id, user_id, size) VALUES (:file_id, :user_id, :size)'
-            ),
-            {"file_id": file.id, "user_id": user_id, "size": file_size},
-        )
-        db.session.commit()
+def s3_client():
+    session = boto3.session.Session()
+    return session.client(
+        service_name="s3",
+        region_name=current_app.config["S3_REGION"],
+        endpoint_url=current_app.config["S3_ENDPOINT"],
+        aws_access_key_id=current_app.config["S3_ACCESS_KEY"],
+        aws_secret_access_key=current_app.config["S3_ACCESS_SECRET"],
+    )
 
-    if not url:
-        raise Exception("unable to process upload")
 
-    return url
+def s3_extra_args(path: str) -> dict:
+    extra_args = {"ContentType": guess_mime_type(path)}
+    if current_app.config.get("S3_STORAGE_CLASS"):
+        extra_args["StorageClass"] = current_app.config["S3_STORAGE_CLASS"]
+    return extra_args
+
+
+def get_upload_state(url: str) -> int | None:
+    """The FILE_STATE_* of an upload, by the url process_upload() returned. None if there is no such upload."""
+    return db.session.execute(text('SELECT state FROM "file" WHERE source_url = :url ORDER BY id DESC LIMIT 1'),
+                              {"url": url}).scalar()
 
 
 def process_file_delete(url: str, user_id: int):
@@ -194,7 +194,6 @@ def ban_user(input, src, auth=None):
                 )
         else:
             to_ban.delete_dependencies()
-            to_ban.purge_content(flush=flush_cdn)
             from app import redis_client
 
             with redis_client.lock(
@@ -204,6 +203,9 @@ def ban_user(input, src, auth=None):
                 to_ban.deleted = True
                 to_ban.deleted_by = user.id
                 db.session.commit()
+            from app.shared.purge import start_purge
+
+            start_purge("user", to_ban.id, soft=True, purge_cdn=flush_cdn)
             if SRC_WEB:
                 flash(
                     _(
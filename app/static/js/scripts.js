@@ -2266,12 +2266,32 @@ function setupTranslateAll() {
     if(triggerElement && !triggerElement.dataset.listenerAdded) {
         triggerElement.addEventListener('click', async function(event) {
             event.preventDefault();
-            const anchors = document.querySelectorAll('div.post_translate_icon a');
-              for (const a of anchors) {
-                a.click();
-                // don't flood the server
-                await new Promise(resolve => setTimeout(resolve, 500));
-              }
+            const anchors = Array.from(document.querySelectorAll('div.post_translate_icon a'));
+            // have the comments translated a batch at a time (BATCH_SIZE in app/translation.py), then fetch the
+            // translation of each comment in the batch
+            const batchSize = 50;
+            for (let start = 0; start < anchors.length; start += batchSize) {
+                const batch = anchors.slice(start, start + batchSize);
+                const replyIds = new FormData();
+                for (const a of batch) {
+                    const match = (a.getAttribute('hx-post') || '').match(/\/post_reply\/(\d+)\/translate/);
+                    if (match) replyIds.append('reply_id', match[1]);
+                }
+                try {
+                    await fetch(triggerElement.dataset.translateUrl, {
+                        method: 'POST',
+                        body: replyIds,
+                        headers: {'X-CSRFToken': document.querySelector('meta[name="csrf-token"]').getAttribute('content')}
+                    });
+                } catch (e) {
+                    // fall back to translating them one at a time
+                }
+                for (const a of batch) {
+                    a.click();
+                    // don't flood the server
+                    await new Promise(resolve => setTimeout(resolve, 100));
+                }
+            }
         });
         triggerElement.dataset.listenerAdded = 'true'; // mark as initialized
     }
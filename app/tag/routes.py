@@ -1,9 +1,7 @@
-from datetime import timezone
 from random import randint
 
 import flask
-from feedgen.feed import FeedGenerator
-from flask import redirect, url_for, flash, request, make_response, current_app, abort, g
+from flask import redirect, url_for, flash, request, current_app, abort, g
 from flask_babel import _
 from flask_login import current_user
 from sqlalchemy import desc, or_, text
@@ -12,12 +10,13 @@ from app import db, constants
 from app.constants import POST_STATUS_REVIEWING
 from app.feed.routes import get_all_child_feed_ids
 from app.inoculation import inoculation
-from app.models import Post, Community, Tag, post_tag, Topic, FeedItem, Feed
+from app.models import Post, Community, Tag, post_tag, Topic, FeedItem, Feed, CommunityTag
+from app.shared.syndication import RSS_CONTENT_TYPE, artifact_response, rss_response, strong_etag, tag_rss
 from app.tag import bp
 from app.topic.routes import get_all_child_topic_ids
 from app.utils import render_template, permission_required, user_filters_posts, blocked_or_banned_instances, \
     blocked_users, \
-    blocked_domains, mimetype_from_url, \
+    blocked_domains, \
     blocked_communities, login_required, moderating_communities_ids, community_membership_private, \
     login_required_if_private_instance
 
@@ -120,51 +119,11 @@ def show_tag(tag):
 def show_tag_rss(tag):
     tag = Tag.query.filter(Tag.name == tag.lower()).first()
     if tag:
-        posts = Post.query.join(Community, Community.id == Post.community_id). \
-            join(post_tag, post_tag.c.post_id == Post.id).filter(post_tag.c.tag_id == tag.id). \
-            filter(Community.banned == False, Post.deleted == False, Post.status > POST_STATUS_REVIEWING)
-
-        if current_user.is_anonymous or current_user.ignore_bots == 1:
-            posts = posts.filter(Post.from_bot == False)
-        posts = posts.filter(Community.private == False)
-        posts = posts.order_by(desc(Post.posted_at)).limit(20).all()
-
-        description = None
-        og_image = None
-        fg = FeedGenerator()
-        fg.id(f"{current_app.config['SERVER_URL']}/tag/{tag.name}")
-        fg.title(f'#{tag.display_as} on {g.site.name}')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/tag/{tag.name}", rel='alternate')
-        if og_image:
-            fg.logo(og_image)
-        else:
-            fg.logo(f"{current_app.config['SERVER_URL']}{g.site.logo_152 if g.site.logo_152 else '/static/images/apple-touch-icon.png'}")
-        if description:
-            fg.subtitle(description)
-        else:
-            fg.subtitle(' ')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/tag/{tag.name}/feed", rel='self')
-        fg.language('en')
-
-        for post in posts:
-            fe = fg.add_entry()
-            fe.title(post.title)
-            if post.slug:
-                fe.link(href=f"{current_app.config['SERVER_URL']}{post.slug}")
-            else:
-                fe.link(href=f"{current_app.config['SERVER_URL']}/post/{post.id}")
-            if post.url:
-                type = mimetype_from_url(post.url)
-                if type and not type.startswith('text/'):
-                    fe.enclosure(post.url, type=type)
-            fe.description(post.body_html)
-            fe.guid(post.profile_id(), permalink=True)
-            fe.author(name=post.author.user_name)
-            fe.pubDate(post.created_at.replace(tzinfo=timezone.utc))
-
-        response = make_response(fg.rss_str())
-        response.headers.set('Content-Type', 'application/rss+xml')
-        return response
+        if current_user.is_authenticated and current_user.ignore_bots != 1:
+            # only the feed without bots is stored
+            body = tag_rss(tag, include_bots=True)
+            return artifact_response(body, strong_etag(body), RSS_CONTENT_TYPE)
+        return rss_response('tag', tag)
     else:
         abort(404)
 
@@ -263,7 +222,7 @@ def tag_cloud(type, category_id: int):
             topic_ids = [topic.id]
         community_ids = db.session.execute(
             text('SELECT id FROM community WHERE banned is false AND topic_id IN :topic_ids'),
-            {'topic_ids': tuple(topic_ids)}).scalars()
+            {'topic_ids': tuple(topic_ids)}).scalars().all()
     elif type == 'feed':
         feed = Feed.query.get_or_404(category_id)
         # get the feed_ids
@@ -279,12 +238,11 @@ def tag_cloud(type, category_id: int):
             for item in feed_items:
                 community_ids.append(item.community_id)
 
-    # Get tags with post counts
-    tags_query = db.session.query(Tag, db.func.count(Post.id).label('num_posts')). \
+    # Get tags with post counts, from the counts kept for each community rather than by counting posts
+    tags_query = db.session.query(Tag, db.cast(db.func.sum(CommunityTag.post_count), db.Integer).label('num_posts')). \
         filter(Tag.banned == False). \
-        join(post_tag, post_tag.c.tag_id == Tag.id). \
-        join(Post, Post.id == post_tag.c.post_id). \
-        filter(Post.community_id.in_(community_ids), Post.deleted == False). \
+        join(CommunityTag, CommunityTag.tag_id == Tag.id). \
+        filter(CommunityTag.community_id.in_(community_ids), CommunityTag.post_count > 0). \
         group_by(Tag.id)
     
     tag_list_results = tags_query.paginate(page=page, per_page=50, error_out=False)
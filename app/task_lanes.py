@@ -0,0 +1,357 @@
+# Priority lanes for celery tasks.
+#
+# Each lane is a celery queue that gets its own worker(s) so that a flood of work in one lane (e.g. thousands of
+# incoming activities from a busy peer) can't make local users wait for their own posts and votes to be processed.
+# See entrypoint_celery.sh and INSTALL.md for how workers are started, one per lane.
+#
+# The interactive, outbound and maintenance lanes use the queue names that existed before lanes were introduced
+# (celery, send and background) so existing worker configurations keep working.
+
+import time
+from fnmatch import fnmatch
+from urllib.parse import urlparse
+
+import redis
+from flask import current_app
+
+from app import cache, celery
+
+LANE_INTERACTIVE = 'interactive'
+LANE_INBOUND = 'inbound'
+LANE_OUTBOUND = 'outbound'
+LANE_MEDIA = 'media'
+LANE_MAINTENANCE = 'maintenance'
+
+LANES = {
+    LANE_INTERACTIVE: {'queue': 'celery', 'description': 'Actions by local users - posting, voting, notifications'},
+    LANE_INBOUND: {'queue': 'inbound', 'description': 'Activities received from other instances'},
+    LANE_OUTBOUND: {'queue': 'send', 'description': 'Activities being sent to other instances'},
+    LANE_MEDIA: {'queue': 'media', 'description': 'Thumbnails, image resizing, CDN purges'},
+    LANE_MAINTENANCE: {'queue': 'background', 'description': 'Scheduled maintenance, imports, purges, backfill'},
+}
+
+# Task name (or fnmatch pattern) -> lane. Tasks not listed here go in the interactive lane. First match wins.
+TASK_LANES = {
+    # inbound federation
+    'app.activitypub.routes.process_inbox_request': LANE_INBOUND,
+    'app.activitypub.routes.process_delete_request': LANE_INBOUND,
+    'app.activitypub.util.refresh_user_profile_task': LANE_INBOUND,
+    'app.activitypub.util.refresh_community_profile_task': LANE_INBOUND,
+    'app.activitypub.util.refresh_feed_profile_task': LANE_INBOUND,
+    'app.activitypub.util.new_instance_profile_task': LANE_INBOUND,
+    'app.activitypub.util.get_nodebb_replies_in_background': LANE_INBOUND,
+    'app.activitypub.util.populate_child_feed_worker': LANE_INBOUND,
+
+    # outbound federation
+    'app.activitypub.signature.post_request': LANE_OUTBOUND,
+    'app.community.util.send_to_remote_instance_task': LANE_OUTBOUND,
+    'app.community.util.send_to_remote_instance_fast_task': LANE_OUTBOUND,
+    'app.shared.feed.announce_feed_add_remove_to_subscribers': LANE_OUTBOUND,
+    'app.shared.feed.announce_feed_delete_to_subscribers': LANE_OUTBOUND,
+    'app.user.routes.send_deletion_requests': LANE_OUTBOUND,
+    'app.shared.activity_batch.flush_instance_batch': LANE_OUTBOUND,
+    'app.shared.broadcast.send_broadcast': LANE_OUTBOUND,
+
+    # media
+    'app.activitypub.util.make_image_sizes_async': LANE_MEDIA,
+    'app.admin.util.move_community_images_to_here': LANE_MEDIA,
+    'app.models.flush_cdn_cache_task': LANE_MEDIA,
+    'app.shared.tasks.maintenance.delete_from_s3': LANE_MEDIA,
+    'app.shared.upload.process_file_task': LANE_MEDIA,
+
+    # maintenance
+    'app.shared.tasks.maintenance.*': LANE_MAINTENANCE,
+    'app.shared.tasks.users.check_user_application': LANE_MAINTENANCE,
+    'app.user.utils.purge_user_then_delete_task': LANE_MAINTENANCE,
+    'app.user.settings_import.import_settings_task': LANE_MAINTENANCE,
+    'app.community.util.retrieve_mods_and_backfill': LANE_MAINTENANCE,
+    'app.community.backfill.backfill_community_page': LANE_MAINTENANCE,
+    'app.shared.purge.purge_task': LANE_MAINTENANCE,
+    'app.shared.syndication.rebuild_artifacts_task': LANE_MAINTENANCE,
+    'app.shared.syndication.rebuild_sitemap_task': LANE_MAINTENANCE,
+    'app.community.util.publicize_community_task': LANE_MAINTENANCE,
+    'app.admin.routes.*': LANE_MAINTENANCE,
+    'app.admin.util.*': LANE_MAINTENANCE,
+    'app.utils.download_defeds_worker': LANE_MAINTENANCE,
+}
+
+
+def lane_for_task(task_name: str) -> str:
+    for pattern, lane in TASK_LANES.items():
+        if fnmatch(task_name, pattern):
+            return lane
+    return LANE_INTERACTIVE
+
+
+def celery_routes() -> dict:
+    """For CELERY_ROUTES. Celery matches glob patterns in routes itself but the first-match order of TASK_LANES
+    needs to be preserved, so the exact names are listed first."""
+    exact = {task: {'queue': LANES[lane]['queue']} for task, lane in TASK_LANES.items() if '*' not in task}
+    globs = {task: {'queue': LANES[lane]['queue']} for task, lane in TASK_LANES.items() if '*' in task}
+    return {**exact, **globs}
+
+
+def parse_rate_limits(setting: str) -> dict:
+    """'media=120/m, inbound=50/s' -> {'media': '120/m', 'inbound': '50/s'}"""
+    result = {}
+    for part in setting.split(','):
+        if '=' in part:
+            lane, rate = part.split('=', 1)
+            if lane.strip() in LANES and rate.strip():
+                result[lane.strip()] = rate.strip()
+    return result
+
+
+class LaneRateLimits:
+    """Celery task annotation that applies each lane's rate limit to all the tasks in that lane. Rate limits are
+    enforced by each worker, per task type."""
+
+    def __init__(self, rate_limits: dict):
+        self.rate_limits = rate_limits
+
+    def annotate(self, task):
+        rate_limit = self.rate_limits.get(lane_for_task(task.name))
+        if rate_limit:
+            return {'rate_limit': rate_limit}
+        return None
+
+
+@cache.memoize(timeout=10)
+def queue_depths() -> dict:
+    """How many tasks are waiting in each lane. None if the broker could not be asked."""
+    result = {}
+    try:
+        with celery.connection_for_read() as connection:
+            channel = connection.default_channel
+            for lane, info in LANES.items():
+                try:
+                    result[lane] = channel.queue_declare(queue=info['queue'], passive=True).message_count
+                except Exception:
+                    result[lane] = None
+    except Exception as e:
+        current_app.logger.warning(f'Could not retrieve queue depths: {e}')
+        result = {lane: None for lane in LANES}
+    return result
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Load shedding of inbound federation.
+#
+# SHED_NONE      everything is accepted
+# SHED_LOW_VALUE votes on old content are dropped, everything else is accepted
+# SHED_OVERLOAD  all votes are dropped. Everything else is accepted, except from instances with more than their share
+#                of the backlog (see admit_activity()), which get a 429 so they retry later
+# SHED_PAUSED    redis is full - all votes are dropped and everything else gets a 429, whoever sent it
+
+SHED_NONE = 0
+SHED_LOW_VALUE = 1
+SHED_OVERLOAD = 2
+SHED_PAUSED = 3
+
+VOTE_TYPES = {'Like', 'Dislike', 'EmojiReact'}
+
+
+def federation_shed_level() -> int:
+    from app import redis_client
+    if redis_client.get('pause_federation') == '1':     # set by the send-queue cli command when redis is full
+        return SHED_PAUSED
+    inbound_depth = queue_depths().get(LANE_INBOUND)
+    if inbound_depth is None:
+        return SHED_NONE
+    if inbound_depth == 0:
+        _forget_intake_queue()
+    if inbound_depth >= current_app.config['FEDERATION_SHED_OVERLOAD_DEPTH']:
+        return SHED_OVERLOAD
+    if inbound_depth >= current_app.config['FEDERATION_SHED_LOW_VALUE_DEPTH']:
+        return SHED_LOW_VALUE
+    return SHED_NONE
+
+
+def vote_target(request_json: dict) -> str | None:
+    """If the activity is a vote (possibly Announced or Undone), the ap_id of what is being voted on"""
+    activity = request_json
+    for _ in range(3):  # Announce -> Undo -> Like is as deep as it gets
+        if not isinstance(activity, dict):
+            return None
+        if activity.get('type') in VOTE_TYPES:
+            target = activity.get('object')
+            if isinstance(target, dict):
+                target = target.get('id')
+            return target if isinstance(target, str) else None
+        if activity.get('type') not in ('Announce', 'Undo'):
+            return None
+        activity = activity.get('object')
+    return None
+
+
+def should_shed(request_json: dict, shed_level: int) -> bool:
+    """True if this incoming activity is low value enough to be dropped at the current shed level"""
+    if shed_level == SHED_NONE:
+        return False
+    target = vote_target(request_json)
+    if target is None:
+        return False
+    if shed_level >= SHED_OVERLOAD:
+        return True
+    return not _recently_posted(target)
+
+
+def _recently_posted(ap_id: str) -> bool:
+    from datetime import timedelta
+    from app import db
+    from app.models import Post, PostReply, utcnow
+    cutoff = utcnow() - timedelta(days=current_app.config['FEDERATION_SHED_VOTE_AGE'])
+    posted_at = db.session.query(Post.posted_at).filter(Post.ap_id == ap_id).scalar()
+    if posted_at is None:
+        posted_at = db.session.query(PostReply.posted_at).filter(PostReply.ap_id == ap_id).scalar()
+    return posted_at is not None and posted_at > cutoff
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# Per-instance intake of inbound federation, so that one chatty or misbehaving instance can't fill the inbound lane for
+# everyone else.
+#
+# Each sending instance has a token bucket in redis that refills at FEDERATION_INTAKE_RATE activities a second, times
+# the instance's weight, and holds FEDERATION_INTAKE_BURST seconds' worth. Trusted instances and the threadiverse
+# software that relays whole communities get more. An instance with an empty bucket gets a 429 with a Retry-After of
+# how long until it has a token again.
+#
+# The activities from each instance that are waiting in the inbound lane are counted too (when shared_inbox() queues
+# one and when process_inbox_request() starts it). Once the lane is backed up, an instance with more than its share of
+# the backlog gets a 429 until its activities have been worked through, while everyone else carries on as normal.
+
+INTAKE_BUCKET_KEY = 'intake_bucket:{}'
+INTAKE_ACCEPTED_KEY = 'intake_accepted:{}'   # hash per minute, domain -> activities accepted
+INTAKE_REFUSED_KEY = 'intake_refused:{}'     # hash per minute, domain -> activities refused
+INTAKE_QUEUED_KEY = 'intake_queued'          # hash, domain -> activities waiting in the inbound lane
+INTAKE_STATS_TTL = 15 * 60
+INTAKE_MIN_QUEUED = 500                      # an instance is never over its share of the backlog with fewer than this
+INTAKE_QUEUE_RETRY_AFTER = 120
+
+INTAKE_TRUSTED_WEIGHT = 4.0
+# threadiverse software announces every post, comment and vote in its communities so sends a lot more, legitimately
+INTAKE_SOFTWARE_WEIGHTS = {'lemmy': 2.0, 'piefed': 2.0, 'mbin': 2.0, 'kbin': 1.5, 'nodebb': 1.5,
+                           'mastodon': 0.5, 'misskey': 0.5, 'sharkey': 0.5, 'akkoma': 0.5, 'pleroma': 0.5}
+
+# KEYS: bucket, accepted, refused, queued. ARGV: domain, capacity, rate, now, stats ttl. Returns the seconds to wait, 0
+# if the activity was accepted.
+TAKE_TOKEN_SCRIPT = """
+local capacity, rate, now = tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    redis.call('HINCRBY', KEYS[4], ARGV[1], 1)
+else
+    retry_after = math.ceil((1 - tokens) / rate)
+    redis.call('HINCRBY', KEYS[3], ARGV[1], 1)
+    redis.call('EXPIRE', KEYS[3], ARGV[5])
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return retry_after
+"""
+
+
+def intake_domain(request_json: dict) -> str | None:
+    """The instance an incoming activity is counted against"""
+    actor = request_json.get('actor')
+    if isinstance(actor, dict):  # Discourse does this
+        actor = actor.get('id')
+    return urlparse(actor).hostname if isinstance(actor, str) else None
+
+
+def intake_weight(instance) -> float:
+    weight = INTAKE_SOFTWARE_WEIGHTS.get((instance.software or '').lower(), 1.0)
+    if instance.trusted:
+        weight *= INTAKE_TRUSTED_WEIGHT
+    return weight
+
+
+def admit_activity(domain: str, weight: float, shed_level: int) -> int:
+    """0 if an activity from domain can be queued, otherwise the number of seconds it should wait before sending it
+    again. Accepted activities are counted as waiting in the inbound lane until intake_done()."""
+    from app import redis_client
+    rate = current_app.config['FEDERATION_INTAKE_RATE'] * weight
+    if not domain or rate <= 0:
+        return 0
+    now = time.time()
+    minute = int(now // 60)
+    try:
+        if shed_level >= SHED_LOW_VALUE and over_queue_share(domain, weight):
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hincrby(INTAKE_REFUSED_KEY.format(minute), domain, 1)
+            pipe.expire(INTAKE_REFUSED_KEY.format(minute), INTAKE_STATS_TTL)
+            pipe.execute()
+            return INTAKE_QUEUE_RETRY_AFTER
+        take_token = redis_client.register_script(TAKE_TOKEN_SCRIPT)
+        capacity = max(1.0, rate * current_app.config['FEDERATION_INTAKE_BURST'])
+        return int(take_token(keys=[INTAKE_BUCKET_KEY.format(domain), INTAKE_ACCEPTED_KEY.format(minute),
+                                     INTAKE_REFUSED_KEY.format(minute), INTAKE_QUEUED_KEY],
+                               args=[domain, capacity, rate, now, INTAKE_STATS_TTL], client=redis_client))
+    except redis.exceptions.RedisError:
+        return 0
+
+
+def over_queue_share(domain: str, weight: float) -> bool:
+    """True if more of the backlog in the inbound lane is from this instance than its weight entitles it to"""
+    from app import redis_client
+    inbound_depth = queue_depths().get(LANE_INBOUND)
+    if not inbound_depth:
+        return False
+    queued = int(redis_client.hget(INTAKE_QUEUED_KEY, domain) or 0)
+    share = min(1.0, current_app.config['FEDERATION_INTAKE_QUEUE_SHARE'] * weight)
+    return queued > max(INTAKE_MIN_QUEUED, share * inbound_depth)
+
+
+def intake_done(domain: str):
+    """An activity counted by admit_activity() has left the inbound lane"""
+    from app import redis_client
+    try:
+        if redis_client.hincrby(INTAKE_QUEUED_KEY, domain, -1) <= 0:
+            # the count drifts if tasks are lost, e.g. when the broker is flushed. It resets once the lane is empty.
+            redis_client.hdel(INTAKE_QUEUED_KEY, domain)
+    except redis.exceptions.RedisError:
+        pass
+
+
+@cache.memoize(timeout=60)
+def _forget_intake_queue() -> bool:
+    """The inbound lane is empty, so whatever the counts of waiting activities say, nothing is waiting"""
+    from app import redis_client
+    try:
+        redis_client.delete(INTAKE_QUEUED_KEY)
+    except redis.exceptions.RedisError:
+        pass
+    return True
+
+
+def intake_stats(minutes: int = 5, limit: int = 50) -> list[dict]:
+    """The instances that have sent the most in the last few minutes, for the admin dashboard"""
+    from app import redis_client
+    this_minute = int(time.time() // 60)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for minute in range(this_minute - minutes + 1, this_minute + 1):
+            pipe.hgetall(INTAKE_ACCEPTED_KEY.format(minute))
+            pipe.hgetall(INTAKE_REFUSED_KEY.format(minute))
+        pipe.hgetall(INTAKE_QUEUED_KEY)
+        *counts, queued = pipe.execute()
+    except redis.exceptions.RedisError:
+        return []
+    stats = {}
+    for i, per_minute in enumerate(counts):
+        for domain, count in per_minute.items():
+            peer = stats.setdefault(domain, {'domain': domain, 'accepted': 0, 'refused': 0, 'queued': 0})
+            peer['refused' if i % 2 else 'accepted'] += int(count)
+    for domain, count in queued.items():
+        stats.setdefault(domain, {'domain': domain, 'accepted': 0, 'refused': 0})['queued'] = max(0, int(count))
+    for peer in stats.values():
+        peer['per_minute'] = round(peer['accepted'] / minutes, 1)
+    return sorted(stats.values(), key=lambda peer: (peer['accepted'] + peer['refused'], peer['queued']),
+                  reverse=True)[:limit]
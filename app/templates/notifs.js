@@ -1,13 +1,19 @@
 
 let eventSource;
 let reconnectAttempts = 0;
+let lastEventId = '';
 
 function connect() {
     const userId = "{{ current_user.id }}";
-    eventSource = new EventSource(`{{ notif_server }}/notifications/stream?user_id=${userId}`);
+    // after reconnecting, the server sends anything that was missed since the last event received
+    const resume = lastEventId ? `&last_event_id=${encodeURIComponent(lastEventId)}` : '';
+    eventSource = new EventSource(`{{ notif_server }}/notifications/stream?user_id=${userId}${resume}`);
 
     eventSource.onmessage = (event) => {
         console.log('received message');
+        if(event.lastEventId) {
+            lastEventId = event.lastEventId;
+        }
         const data = JSON.parse(event.data);
         console.log(data);
         if(data['num_notifs'] > unreadNotifications) {      // unreadNotifications is set in base.html when the page loads initially.
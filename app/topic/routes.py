@@ -1,29 +1,29 @@
 from collections import namedtuple
-from datetime import timedelta, timezone
+from datetime import timedelta
 from random import randint
 from typing import List
 
-from feedgen.feed import FeedGenerator
-from flask import request, flash, url_for, current_app, redirect, abort, make_response, g
+from flask import request, flash, url_for, current_app, redirect, abort, g
 from flask_babel import _
 from flask_login import current_user
 from sqlalchemy import text, desc, asc, or_
 
-from app import db, cache
+from app import db
 from app.community.util import hashtags_used_in_communities
 from app.constants import SUBSCRIPTION_OWNER, SUBSCRIPTION_MODERATOR, POST_TYPE_IMAGE, \
     POST_TYPE_LINK, POST_TYPE_VIDEO, NOTIF_TOPIC
 from app.email import send_topic_suggestion
 from app.inoculation import inoculation
 from app.models import Topic, Community, NotificationSubscription, PostReply, utcnow
+from app.shared.syndication import rss_response
 from app.topic import bp
 from app.topic.forms import SuggestTopicsForm
-from app.utils import render_template, user_filters_posts, validation_required, mimetype_from_url, login_required, \
+from app.utils import render_template, user_filters_posts, validation_required, login_required, \
     gibberish, get_deduped_post_ids, paginate_post_ids, post_ids_to_models, blocked_communities, \
     recently_upvoted_posts, recently_downvoted_posts, blocked_or_banned_instances, blocked_users, \
     joined_or_modding_communities, \
     login_required_if_private_instance, communities_banned_from, reported_posts, user_notes, moderating_communities_ids, \
-    approval_required, block_honey_pot, user_pronouns, community_membership_private
+    approval_required, block_honey_pot, user_pronouns, community_membership_private, topic_community_ids
 
 
 @bp.route('/topic/<path:topic_path>', methods=['GET'])
@@ -75,16 +75,10 @@ def show_topic(topic_path):
         if len(private_communities) == 0:
             private_communities = [0, 0]
 
-        # get posts from communities in that topic
-        if current_topic.show_posts_in_children:  # include posts from child topics
-            topic_ids = get_all_child_topic_ids(current_topic)
-        else:
-            topic_ids = [current_topic.id]
-        community_ids = db.session.execute(
-            text('SELECT id FROM community WHERE (private is false OR id IN :private_communities) AND banned is false AND topic_id IN :topic_ids'),
-            {'topic_ids': tuple(topic_ids), 'private_communities': tuple(private_communities)}).scalars()
-
-        community_ids = list(community_ids)
+        # get posts from communities in that topic, and in child topics if show_posts_in_children
+        community_ids = [community_id for community_id, private
+                         in topic_community_ids(current_topic.id, current_topic.show_posts_in_children).items()
+                         if not private or community_id in private_communities]
 
         topic_communities = Community.query.filter(
             Community.topic_id == current_topic.id, Community.banned == False, Community.total_subscriptions_count > 0).\
@@ -209,55 +203,13 @@ def show_topic(topic_path):
 
 
 @bp.route('/topic/<path:topic_path>.rss', methods=['GET'])
-@cache.cached(timeout=600)
 def show_topic_rss(topic_path):
     topic_url_parts = topic_path.split('/')
     last_topic_machine_name = topic_url_parts[-1]
     topic = Topic.query.filter(Topic.machine_name == last_topic_machine_name.strip().lower()).first()
 
     if topic:
-        if topic.show_posts_in_children:  # include posts from child topics
-            topic_ids = get_all_child_topic_ids(topic)
-        else:
-            topic_ids = [topic.id]
-
-        community_ids = db.session.execute(
-            text('SELECT id FROM community WHERE banned is false AND private is false AND topic_id IN :topic_ids'),
-            {'topic_ids': tuple(topic_ids)}).scalars()
-        post_ids = get_deduped_post_ids('', list(community_ids), 'new')
-        post_ids = paginate_post_ids(post_ids, 0, page_length=100)
-        posts = post_ids_to_models(post_ids, 'new')
-
-        fg = FeedGenerator()
-        fg.id(f"{current_app.config['SERVER_URL']}/topic/{last_topic_machine_name}")
-        fg.title(f'{topic.name} on {g.site.name}')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/topic/{last_topic_machine_name}", rel='alternate')
-        fg.logo(f"{current_app.config['SERVER_URL']}/static/images/apple-touch-icon.png")
-        fg.subtitle(' ')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/topic/{last_topic_machine_name}.rss", rel='self')
-        fg.language('en')
-
-        for post in posts:
-            fe = fg.add_entry()
-            fe.title(post.title)
-            if post.slug:
-                fe.link(href=f"{current_app.config['SERVER_URL']}{post.slug}")
-            else:
-                fe.link(href=f"{current_app.config['SERVER_URL']}/post/{post.id}")
-            if post.url:
-                type = mimetype_from_url(post.url)
-                if type and not type.startswith('text/'):
-                    fe.enclosure(post.url, type=type)
-            fe.description(post.body_html)
-            fe.guid(post.profile_id(), permalink=True)
-            fe.author(name=post.author.user_name)
-            fe.pubDate(post.created_at.replace(tzinfo=timezone.utc))
-
-        response = make_response(fg.rss_str())
-        response.headers.set('Content-Type', 'application/rss+xml')
-        response.headers.add_header('ETag', f"{topic.id}_{hash(g.site.last_active)}")
-        response.headers.add_header('Cache-Control', 'no-cache, max-age=600, must-revalidate')
-        return response
+        return rss_response('topic', topic)
     else:
         abort(404)
 
@@ -329,8 +281,6 @@ def suggestion_denied():
 
 
 def get_all_child_topic_ids(topic: Topic) -> List[int]:
-    # recurse down the topic tree, gathering all the topic IDs found
-    topic_ids = [topic.id]
-    for child_topic in Topic.query.filter(Topic.parent_id == topic.id):
-        topic_ids.extend(get_all_child_topic_ids(child_topic))
-    return topic_ids
+    # the topic and every topic below it
+    return list(db.session.execute(text('SELECT descendant_id FROM "topic_closure" WHERE ancestor_id = :topic_id'),
+                                   {'topic_id': topic.id}).scalars()) or [topic.id]
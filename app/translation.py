@@ -1,6 +1,12 @@
 # copied from https://github.com/LibreTranslate/LibreTranslate
 
-from typing import Any, Dict
+import hashlib
+import time
+from typing import Any, Dict, List
+
+import redis
+from flask import current_app
+
 from app import httpx_client
 
 
@@ -61,6 +67,28 @@ class LibreTranslateAPI:
         response.raise_for_status()
         return response.json()["translatedText"]
 
+    def translate_many(
+        self, q: List[str], source: str = "en", target: str = "es", timeout: int = 60
+    ) -> List[str]:
+        """Translate several strings with one request
+
+        Args:
+            q (list): The texts to translate
+            source (str): The source language code (ISO 639)
+            target (str): The target language code (ISO 639)
+            timeout (int): Request timeout in seconds
+
+        Returns:
+            list: The translated texts, in the same order
+        """
+        url = self.url + "translate"
+        params: Dict[str, Any] = {"q": q, "source": source, "target": target}
+        if self.api_key:
+            params["api_key"] = self.api_key
+        response = httpx_client.post(url, json=params, timeout=timeout)
+        response.raise_for_status()
+        return response.json()["translatedText"]
+
     def detect(self, q: str, timeout: int = 30) -> Any:
         """Detect the language of a single text.
 
@@ -95,3 +123,106 @@ class LibreTranslateAPI:
         response = httpx_client.get(url, params=params, timeout=timeout)
         response.raise_for_status()
         return response.json()
+
+
+class LocalTranslator:
+    """Stands in for LibreTranslate when TRANSLATE_ENDPOINT is 'local', for tests and development. It doesn't
+    translate anything, it just marks each text with the language it was meant to be translated into."""
+
+    def translate(self, q: str, source: str = "en", target: str = "es", timeout: int = 30) -> str:
+        return self.translate_many([q], source, target)[0]
+
+    def translate_many(self, q: List[str], source: str = "en", target: str = "es", timeout: int = 60) -> List[str]:
+        return [f"[{target}] {text}" for text in q]
+
+    def languages(self, timeout: int = 30) -> Any:
+        return [{"code": "en", "name": "English"}]
+
+
+def translator():
+    if current_app.config['TRANSLATE_ENDPOINT'] == 'local':
+        return LocalTranslator()
+    return LibreTranslateAPI(current_app.config['TRANSLATE_ENDPOINT'], api_key=current_app.config['TRANSLATE_KEY'])
+
+
+# Translations are kept in redis, keyed by a hash of the text and the language pair, so a post or comment is translated
+# once however many people read it in the same language. Texts that aren't cached yet are sent to the translator in
+# batches. While one process is translating a text, others that want the same translation wait a few seconds for it
+# rather than asking for it again, then give up and ask anyway - a web request is not held up for longer than that.
+CACHE_KEY = 'translation:{}:{}:{}'
+PENDING_KEY = 'translation_pending:{}:{}:{}'
+CACHE_TTL = 60 * 60 * 24 * 30
+PENDING_TTL = 60            # longer than a translation can take, in case the process translating it dies
+BATCH_SIZE = 50             # texts per request to the translator
+MAX_WAIT = 5                # seconds to wait for a translation that another process is doing
+POLL_INTERVAL = 0.2
+
+
+def translate_strings(texts: List[str], source: str, target: str) -> List[str]:
+    """Translate texts from the source language (or 'auto') to the target one. Returns '' for texts that couldn't be
+    translated."""
+    from app import redis_client
+    hashes = [hashlib.sha256((text or '').encode('utf-8')).hexdigest() for text in texts]
+    if not texts:
+        return []
+    try:
+        cached = redis_client.mget([CACHE_KEY.format(source, target, text_hash) for text_hash in hashes])
+    except redis.exceptions.RedisError:
+        return _translate(texts, source, target)
+    cached = [translation if text else '' for text, translation in zip(texts, cached)]
+
+    # texts that are needed more than once are only translated once
+    missing = {text_hash: text for text, text_hash, translation in zip(texts, hashes, cached) if translation is None}
+    if not missing:
+        return cached
+    mine, waiting = [], []
+    for text_hash in missing:
+        claimed = redis_client.set(PENDING_KEY.format(source, target, text_hash), 1, nx=True, ex=PENDING_TTL)
+        (mine if claimed else waiting).append(text_hash)
+    translated = {}
+    if mine:
+        translated.update(zip(mine, _translate([missing[text_hash] for text_hash in mine], source, target)))
+        pipe = redis_client.pipeline(transaction=False)
+        for text_hash in mine:
+            if translated[text_hash]:
+                pipe.set(CACHE_KEY.format(source, target, text_hash), translated[text_hash], ex=CACHE_TTL)
+            pipe.delete(PENDING_KEY.format(source, target, text_hash))
+        pipe.execute()
+    if waiting:
+        translated.update(_wait_for(waiting, [missing[text_hash] for text_hash in waiting], source, target))
+    return [translation if translation is not None else translated[text_hash]
+            for text_hash, translation in zip(hashes, cached)]
+
+
+def _wait_for(hashes: List[str], texts: List[str], source: str, target: str) -> dict:
+    """Wait for other processes to finish translating these texts. If they give up, translate them here after all."""
+    from app import redis_client
+    keys = [CACHE_KEY.format(source, target, text_hash) for text_hash in hashes]
+    pending = [PENDING_KEY.format(source, target, text_hash) for text_hash in hashes]
+    deadline = time.monotonic() + MAX_WAIT
+    while True:
+        translations = redis_client.mget(keys)
+        if all(translation is not None for translation in translations):
+            return dict(zip(hashes, translations))
+        if time.monotonic() > deadline or not redis_client.exists(*pending):
+            break
+        time.sleep(POLL_INTERVAL)
+    left = [i for i, translation in enumerate(translations) if translation is None]
+    for i, translation in zip(left, _translate([texts[i] for i in left], source, target)):
+        translations[i] = translation
+    return dict(zip(hashes, translations))
+
+
+def _translate(texts: List[str], source: str, target: str) -> List[str]:
+    if not any(texts):
+        return [''] * len(texts)
+    results = []
+    backend = translator()
+    for start in range(0, len(texts), BATCH_SIZE):
+        batch = texts[start:start + BATCH_SIZE]
+        try:
+            results.extend(backend.translate_many(batch, source=source, target=target))
+        except Exception as e:
+            current_app.logger.exception(str(e))
+            results.extend([''] * len(batch))
+    return results
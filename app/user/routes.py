@@ -1,10 +1,9 @@
 import json as python_json
 import os
 from collections import defaultdict
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from io import BytesIO
 
-from feedgen.feed import FeedGenerator
 from flask import redirect, url_for, flash, request, make_response, session, current_app, abort, json, g, send_file
 from flask_babel import _, lazy_gettext as _l
 from flask_login import logout_user, current_user
@@ -12,18 +11,19 @@ from sqlalchemy import desc, or_, text, asc
 from sqlalchemy.orm.exc import NoResultFound
 
 from app import db, cache, celery
-from app.activitypub.signature import default_context, send_post_request
-from app.activitypub.util import find_actor_or_create, extract_domain_and_actor
+from app.activitypub.signature import default_context
+from app.activitypub.util import find_actor_or_create
 from app.auth.util import random_token
-from app.community.util import save_icon_file, save_banner_file, retrieve_mods_and_backfill, search_for_community
+from app.community.util import save_icon_file, save_banner_file, search_for_community
 from app.constants import *
 from app.email import send_verification_email
 from app.ldap_utils import sync_user_to_ldap
 from app.models import Post, Community, CommunityMember, User, PostReply, PostVote, Notification, utcnow, File, Site, \
-    Instance, Report, UserBlock, CommunityBan, CommunityJoinRequest, CommunityBlock, Filter, Domain, DomainBlock, \
+    Instance, Report, UserBlock, CommunityBlock, Filter, Domain, DomainBlock, \
     InstanceBlock, NotificationSubscription, PostBookmark, PostReplyBookmark, read_posts, Topic, UserNote, \
     UserExtraField, Feed, FeedMember, IpBan, user_file, ArchivedPostReply
 from app.shared.site import block_remote_instance
+from app.shared.syndication import rss_response
 from app.shared.tasks import task_selector
 from app.shared.upload import process_file_delete, process_upload
 from app.shared.user import subscribe_user, ban_user, unban_user
@@ -35,15 +35,15 @@ from app.user.utils import purge_user_then_delete, unsubscribe_from_community, s
     _get_user_upvoted_posts, _get_user_subscribed_communities, _get_user_posts, _get_user_post_replies, \
     _get_user_archived_replies, _get_user_posts_and_replies, _get_user_same_ip
 from app.utils import render_template, markdown_to_html, user_access, markdown_to_text, shorten_string, \
-    gibberish, file_get_contents, community_membership, user_filters_home, \
+    gibberish, file_get_contents, user_filters_home, \
     user_filters_posts, user_filters_replies, theme_list, \
     blocked_users, add_to_modlog, \
     blocked_communities, piefed_markdown_to_lemmy_markdown, \
-    read_language_choices, request_etag_matches, return_304, mimetype_from_url, notif_id_to_string, \
+    read_language_choices, notif_id_to_string, \
     login_required_if_private_instance, recently_upvoted_posts, recently_downvoted_posts, recently_upvoted_post_replies, \
     recently_downvoted_post_replies, reported_posts, user_notes, login_required, get_setting, filtered_out_communities, \
-    moderating_communities_ids, is_valid_xml_utf8, blocked_or_banned_instances, blocked_domains, get_task_session, \
-    patch_db_session, user_in_restricted_country, referrer, user_pronouns, community_membership_private, \
+    moderating_communities_ids, blocked_or_banned_instances, blocked_domains, \
+    user_in_restricted_country, referrer, user_pronouns, community_membership_private, \
     intlist_to_strlist
 
 
@@ -1018,7 +1018,6 @@ def send_deletion_requests(user_id):
             community = Community.query.get(membership.community_id)
             unsubscribe_from_community(community, user)
 
-        instances = Instance.query.filter(Instance.dormant == False, Instance.gone_forever == False).all()
         payload = {
             "@context": default_context(),
             "actor": user.public_url(),
@@ -1030,9 +1029,8 @@ def send_deletion_requests(user_id):
             "removeData": True,
             "type": "Delete"
         }
-        for instance in instances:
-            if instance.inbox and instance.online() and instance.id != 1:  # instance id 1 is always the current instance
-                send_post_request(instance.inbox, payload, user.private_key, f"{user.public_url()}#main-key")
+        from app.shared.broadcast import broadcast_to_all_instances
+        broadcast_to_all_instances(db.session, payload, user.private_key, f"{user.public_url()}#main-key")
 
         user.banned = True
         user.deleted = True
@@ -1165,142 +1163,8 @@ def notifications_all_read():
 
 
 def import_settings(redis_key):
-    if current_app.debug:
-        import_settings_task(current_user.id, redis_key)
-    else:
-        import_settings_task.delay(current_user.id, redis_key)
-
-
-@celery.task
-def import_settings_task(user_id, redis_key):
-    from app.api.alpha.utils.misc import get_resolve_object
-
-    with current_app.app_context():
-        session = get_task_session()
-        try:
-            with patch_db_session(session):
-                from app import redis_client
-                user = session.query(User).get(user_id)
-                contents = redis_client.get(redis_key)
-                contents_json = json.loads(contents)
-
-                # Follow communities
-                for community_ap_id in contents_json['followed_communities'] if 'followed_communities' in contents_json else []:
-                    community = find_actor_or_create(community_ap_id, community_only=True)
-                    if community:
-                        if community.posts.count() == 0:
-                            server, name = extract_domain_and_actor(community.ap_profile_id)
-                            if current_app.debug:
-                                retrieve_mods_and_backfill(community.id, server, name)
-                            else:
-                                retrieve_mods_and_backfill.delay(community.id, server, name)
-                        if community_membership(user, community) != SUBSCRIPTION_MEMBER and community_membership(
-                                user, community) != SUBSCRIPTION_PENDING:
-                            if not community.is_local():
-                                # send ActivityPub message to remote community, asking to follow. Accept message will be sent to our shared inbox
-                                join_request = CommunityJoinRequest(user_id=user.id, community_id=community.id)
-                                session.add(join_request)
-                                existing_member = session.query(CommunityMember).filter_by(user_id=user.id,
-                                                                                  community_id=community.id).first()
-                                if not existing_member:
-                                    member = CommunityMember(user_id=user.id, community_id=community.id)
-                                    session.add(member)
-                                    if community.subscriptions_count is None:
-                                        community.subscriptions_count = 0
-                                    if community.total_subscriptions_count is None:
-                                        community.total_subscriptions_count = 0
-                                    community.subscriptions_count += 1
-                                    community.total_subscriptions_count += 1
-                                    session.commit()
-                                if not community.instance.gone_forever:
-                                    follow = {
-                                        "actor": user.public_url(),
-                                        "to": [community.public_url()],
-                                        "object": community.public_url(),
-                                        "type": "Follow",
-                                        "id": f"{current_app.config['SERVER_URL']}/activities/follow/{join_request.uuid}"
-                                    }
-                                    send_post_request(community.ap_inbox_url, follow, user.private_key,
-                                                      user.public_url() + '#main-key')
-                            else:  # for local communities, joining is instant
-                                banned = session.query(CommunityBan).filter_by(user_id=user.id, community_id=community.id).first()
-                                if not banned:
-                                    existing_member = session.query(CommunityMember).filter_by(user_id=user.id,
-                                                                                      community_id=community.id).first()
-                                    if not existing_member:
-                                        member = CommunityMember(user_id=user.id, community_id=community.id)
-                                        session.add(member)
-                                        community.subscriptions_count += 1
-                                        community.total_subscriptions_count += 1
-                                        session.commit()
-                            cache.delete_memoized(community_membership, user, community)
-
-                for community_ap_id in contents_json['blocked_communities'] if 'blocked_communities' in contents_json else []:
-                    community = find_actor_or_create(community_ap_id, community_only=True)
-                    if community:
-                        existing_block = session.query(CommunityBlock).filter_by(user_id=user.id, community_id=community.id).first()
-                        if not existing_block:
-                            block = CommunityBlock(user_id=user.id, community_id=community.id)
-                            session.add(block)
-
-
-                for user_ap_id in contents_json['blocked_users'] if 'blocked_users' in contents_json else []:
-                    blocked_user = find_actor_or_create(user_ap_id)
-                    if blocked_user:
-                        existing_block = session.query(UserBlock).filter_by(blocker_id=user.id, blocked_id=blocked_user.id).first()
-                        if not existing_block:
-                            user_block = UserBlock(blocker_id=user.id, blocked_id=blocked_user.id)
-                            session.add(user_block)
-                            if not blocked_user.is_local():
-                                ...  # todo: federate block
-
-                for user_note in contents_json['user_notes'] if 'user_notes' in contents_json else []:
-                    note_target = find_actor_or_create(user_note['target'])
-                    if note_target:
-                        session.add(UserNote(user_id=user.id, target_id=note_target.id, body=user_note['body']))
-
-                cache.delete_memoized(user_notes, user.id)
-
-                for instance_domain in contents_json['blocked_instances'] if 'blocked_instances' in contents_json else []:
-                    instance = Instance.query.filter(Instance.domain == instance_domain).first()
-                    if instance:
-                        session.add(InstanceBlock(user_id=user.id, instance_id=instance.id))
-
-                for ap_id in contents_json['saved_posts'] if 'saved_posts' in contents_json else []:
-                    try:
-                        post = get_resolve_object(None, {"q": ap_id}, user_id=user.id, recursive=True)
-                        if post:
-                            existing_bookmark = session.query(PostBookmark).filter_by(post_id=post.id, user_id=user.id).first()
-                            if not existing_bookmark:
-                                session.add(PostBookmark(post_id=post.id, user_id=user.id))
-                    except Exception:
-                        continue
-
-                for ap_id in contents_json['saved_comments'] if 'saved_comments' in contents_json else []:
-                    try:
-                        reply = get_resolve_object(None, {"q": ap_id}, user_id=user.id, recursive=True)
-                        if reply:
-                            existing_bookmark = session.query(PostReplyBookmark).filter_by(post_reply_id=reply.id, user_id=user.id).first()
-                            if not existing_bookmark:
-                                session.add(PostReplyBookmark(post_reply_id=reply.id, user_id=user.id))
-                    except Exception:
-                        continue
-
-                session.commit()
-                cache.delete_memoized(blocked_communities, user.id)
-                cache.delete_memoized(blocked_or_banned_instances, user.id)
-                cache.delete_memoized(blocked_users, user.id)
-                cache.delete_memoized(blocked_domains, user.id)
-                from app.api.alpha.views import user_view
-                cache.delete_memoized(user_view)
-
-                redis_client.delete(redis_key)
-
-        except Exception:
-            session.rollback()
-            raise
-        finally:
-            session.close()
+    from app.user.settings_import import start_import
+    start_import(redis_key, current_user.id)
 
 
 @bp.route('/user/settings/filters', methods=['GET', 'POST'])
@@ -1999,9 +1863,8 @@ def user_feeds(actor):
                            )
 
 
-# RSS feed of the community
+# RSS feed of the user
 @bp.route('/u/<actor>/feed', methods=['GET'])
-@cache.cached(timeout=600)
 def show_profile_rss(actor):
     actor = actor.strip()
     if '@' in actor:
@@ -2010,64 +1873,7 @@ def show_profile_rss(actor):
         user = find_actor_or_create(f'{current_app.config["SERVER_URL"]}/u/{actor}', create_if_not_found=False)
 
     if user is not None:
-        # If nothing has changed since their last visit, return HTTP 304
-        current_etag = f"{user.id}_{hash(user.last_seen)}"
-        if request_etag_matches(current_etag):
-            return return_304(current_etag, 'application/rss+xml')
-
-        posts = user.posts.filter(Post.from_bot == False, Post.deleted == False,
-                                  Post.status > POST_STATUS_REVIEWING).order_by(desc(Post.created_at)).limit(20).all()
-        description = shorten_string(user.about, 150) if user.about else None
-        og_image = user.avatar_image() if user.avatar_id else None
-        fg = FeedGenerator()
-        fg.id(f"{current_app.config['SERVER_URL']}/c/{actor}")
-        fg.title(f'{user.display_name()} on {g.site.name}')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/c/{actor}", rel='alternate')
-        if og_image:
-            fg.logo(og_image)
-        else:
-            fg.logo(f"{current_app.config['SERVER_URL']}/static/images/apple-touch-icon.png")
-        if description:
-            fg.subtitle(description)
-        else:
-            fg.subtitle(' ')
-        fg.link(href=f"{current_app.config['SERVER_URL']}/c/{actor}/feed", rel='self')
-        fg.language('en')
-
-        already_added = set()
-        for post in posts:
-            # Validate title and body - skip this post if invalid
-            if not is_valid_xml_utf8(post.title.strip()):
-                continue
-            if post.body_html is None:
-                continue
-            if post.body_html.strip() and not is_valid_xml_utf8(post.body_html.strip()):
-                continue
-            
-            fe = fg.add_entry()
-            fe.title(post.title.strip())
-            if post.slug:
-                fe.link(href=f"{current_app.config['SERVER_URL']}{post.slug}")
-            else:
-                fe.link(href=f"{current_app.config['SERVER_URL']}/post/{post.id}")
-            if post.url:
-                if post.url in already_added:
-                    continue
-                type = mimetype_from_url(post.url)
-                if type and not type.startswith('text/'):
-                    fe.enclosure(post.url, type=type)
-                already_added.add(post.url)
-            if post.body_html.strip():
-                fe.description(post.body_html.strip())
-            fe.guid(post.profile_id(), permalink=True)
-            fe.author(name=post.author.user_name)
-            fe.pubDate(post.created_at.replace(tzinfo=timezone.utc))
-
-        response = make_response(fg.rss_str())
-        response.headers.set('Content-Type', 'application/rss+xml')
-        response.headers.add_header('ETag', f"{user.id}_{hash(user.last_seen)}")
-        response.headers.add_header('Cache-Control', 'no-cache, max-age=600, must-revalidate')
-        return response
+        return rss_response('user', user)
     else:
         abort(404)
 
@@ -0,0 +1,303 @@
+# Importing the subscriptions, blocks, notes and bookmarks in a Lemmy / PieFed settings export.
+#
+# An export can list hundreds of communities so it is imported in stages (one per list in the file) and each stage a
+# batch of IMPORT_BATCH_SIZE at a time:
+#   - everything in the batch that we already know about is looked up with one query (via the actor_url index for
+#     communities and users), the rest is fetched concurrently - saved posts and comments as well as actors
+#   - the joins, blocks, etc are saved with one commit
+#   - the Follows for a batch of remote communities are sent together through one pooled http client
+#
+# The uploaded file and how far the import has got (the stage and the position in its list) are kept in redis. After
+# each batch a new task is queued for the next one. If a worker dies part way through, the send-queue cron notices that
+# the import has stopped moving and queues it again, carrying on from the last batch that was saved.
+
+import time
+from urllib.parse import urlparse
+
+import redis
+from flask import current_app, json
+
+from app import cache, celery
+from app.activitypub.signature import HttpSignature, default_context, send_post_request
+from app.activitypub.util import create_resolved_object, extract_domain_and_actor, find_community
+from app.community.backfill import fetch_many, resolve_actors, resolve_users
+from app.community.util import retrieve_mods_and_backfill
+from app.models import Community, CommunityBan, CommunityBlock, CommunityJoinRequest, CommunityMember, Instance, \
+    InstanceBlock, Post, PostBookmark, PostReply, PostReplyBookmark, User, UserBlock, UserNote
+from app.shared.broadcast import DELIVERED, deliver
+from app.utils import get_task_session, patch_db_session, community_membership, user_notes, blocked_communities, \
+    blocked_or_banned_instances, blocked_users, blocked_domains, instance_banned
+
+STAGES = ('followed_communities', 'blocked_communities', 'blocked_users', 'user_notes', 'blocked_instances',
+          'saved_posts', 'saved_comments')
+PROGRESS_KEY = '{}:progress'    # hash of 'stage' (index into STAGES) and 'position' (in that stage's list)
+IMPORTS_KEY = 'settings_imports'  # sorted set of the redis key of each import -> when it last saved its progress
+IMPORT_TTL = 60 * 60 * 24
+STALLED_AFTER = 60 * 10
+
+
+def start_import(redis_key: str, user_id: int):
+    """Import the settings export that has been stored in redis under `redis_key`"""
+    from app import redis_client
+    redis_client.expire(redis_key, IMPORT_TTL)
+    save_progress(redis_key, 0, 0)
+    if current_app.debug:
+        import_settings_task(user_id, redis_key)
+    else:
+        import_settings_task.delay(user_id, redis_key)
+
+
+def save_progress(redis_key: str, stage: int, position: int):
+    from app import redis_client
+    pipe = redis_client.pipeline()
+    pipe.hset(PROGRESS_KEY.format(redis_key), mapping={'stage': stage, 'position': position})
+    pipe.expire(PROGRESS_KEY.format(redis_key), IMPORT_TTL)
+    pipe.expire(redis_key, IMPORT_TTL)
+    pipe.zadd(IMPORTS_KEY, {redis_key: time.time()})
+    pipe.execute()
+
+
+def resume_stalled_imports():
+    """Queue again any import that has not saved progress for a while, e.g. because the worker running it was restarted.
+    Run by the send-queue cron."""
+    from app import redis_client
+    for redis_key in redis_client.zrangebyscore(IMPORTS_KEY, '-inf', time.time() - STALLED_AFTER):
+        if not redis_client.exists(redis_key):
+            redis_client.zrem(IMPORTS_KEY, redis_key)
+            continue
+        redis_client.zadd(IMPORTS_KEY, {redis_key: time.time()})
+        user_id = int(redis_key.split(':')[1])
+        if current_app.debug:
+            import_settings_task(user_id, redis_key)
+        else:
+            import_settings_task.delay(user_id, redis_key)
+
+
+@celery.task
+def import_settings_task(user_id: int, redis_key: str):
+    session = get_task_session()
+    try:
+        with patch_db_session(session):
+            from app import redis_client
+            try:
+                with redis_client.lock(f'lock:{redis_key}', timeout=600, blocking_timeout=0):
+                    more = import_next_batch(session, user_id, redis_key)
+            except redis.exceptions.LockError:  # already being imported
+                return
+            if more:
+                if current_app.debug:
+                    import_settings_task(user_id, redis_key)
+                else:
+                    import_settings_task.delay(user_id, redis_key)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def import_next_batch(session, user_id: int, redis_key: str) -> bool:
+    """Import the next batch from the export. True if there is more to do."""
+    from app import redis_client
+    contents = redis_client.get(redis_key)
+    user = session.query(User).get(user_id)
+    if contents is None or user is None:
+        forget_import(redis_key)
+        return False
+    contents_json = json.loads(contents)
+    progress = redis_client.hgetall(PROGRESS_KEY.format(redis_key))
+    stage = int(progress.get('stage', 0))
+    position = int(progress.get('position', 0))
+
+    # skip past stages that are finished or have nothing in them
+    while stage < len(STAGES) and position >= len(contents_json.get(STAGES[stage]) or []):
+        stage += 1
+        position = 0
+    if stage >= len(STAGES):
+        finish_import(session, user, redis_key)
+        return False
+
+    batch = contents_json[STAGES[stage]][position:position + current_app.config['IMPORT_BATCH_SIZE']]
+    IMPORTERS[STAGES[stage]](session, user, batch)
+    session.commit()
+    save_progress(redis_key, stage, position + len(batch))
+    return True
+
+
+def finish_import(session, user: User, redis_key: str):
+    cache.delete_memoized(blocked_communities, user.id)
+    cache.delete_memoized(blocked_or_banned_instances, user.id)
+    cache.delete_memoized(blocked_users, user.id)
+    cache.delete_memoized(blocked_domains, user.id)
+    cache.delete_memoized(user_notes, user.id)
+    from app.api.alpha.views import user_view
+    cache.delete_memoized(user_view)
+    forget_import(redis_key)
+
+
+def forget_import(redis_key: str):
+    from app import redis_client
+    redis_client.delete(redis_key, PROGRESS_KEY.format(redis_key))
+    redis_client.zrem(IMPORTS_KEY, redis_key)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# One function per stage, each given a batch of items from that stage's list
+
+def follow_communities(session, user: User, urls: list):
+    communities = list({community.id: community
+                        for community in resolve_actors(session, urls, Community).values()}.values())
+    if not communities:
+        return
+    ids = [community.id for community in communities]
+    already = {row[0] for row in session.query(CommunityMember.community_id).
+               filter(CommunityMember.user_id == user.id, CommunityMember.community_id.in_(ids))}
+    already |= {row[0] for row in session.query(CommunityJoinRequest.community_id).
+                filter(CommunityJoinRequest.user_id == user.id, CommunityJoinRequest.community_id.in_(ids))}
+    banned = {row[0] for row in session.query(CommunityBan.community_id).
+              filter(CommunityBan.user_id == user.id, CommunityBan.community_id.in_(ids))}
+
+    follows = []
+    for community in communities:
+        if community.id in already or (community.is_local() and community.id in banned):
+            continue
+        session.add(CommunityMember(user_id=user.id, community_id=community.id))
+        community.subscriptions_count = (community.subscriptions_count or 0) + 1
+        community.total_subscriptions_count = (community.total_subscriptions_count or 0) + 1
+        if not community.is_local():    # for local communities, joining is instant
+            join_request = CommunityJoinRequest(user_id=user.id, community_id=community.id)
+            session.add(join_request)
+            if not community.instance.gone_forever and community.ap_inbox_url:
+                follows.append((community, join_request))
+    session.commit()
+
+    for community in communities:
+        cache.delete_memoized(community_membership, user, community)
+        if not community.is_local() and not community.post_count:
+            server, name = extract_domain_and_actor(community.ap_profile_id)
+            if current_app.debug:
+                retrieve_mods_and_backfill(community.id, server, name)
+            else:
+                retrieve_mods_and_backfill.delay(community.id, server, name)
+
+    send_follows(user, follows)
+
+
+def send_follows(user: User, follows: list):
+    """Send Follows to remote communities all at once. Our shared inbox will receive the Accepts."""
+    if not follows:
+        return
+    key_id = user.public_url() + '#main-key'
+    activities = [{'@context': default_context(),
+                   'actor': user.public_url(),
+                   'to': [community.public_url()],
+                   'object': community.public_url(),
+                   'type': 'Follow',
+                   'id': f"{current_app.config['SERVER_URL']}/activities/follow/{join_request.uuid}"}
+                  for community, join_request in follows]
+    requests = [HttpSignature.signed_request(community.ap_inbox_url, activity, user.private_key, key_id,
+                                             send_via_async=True)
+                for (community, join_request), activity in zip(follows, activities)]
+    outcomes = deliver(requests)
+    for (community, join_request), activity, outcome in zip(follows, activities, outcomes):
+        if outcome not in DELIVERED:
+            # send again the usual way, which logs the failure and retries later via the send queue if need be
+            send_post_request(community.ap_inbox_url, activity, user.private_key, key_id)
+
+
+def block_communities(session, user: User, urls: list):
+    ids = {community.id for community in resolve_actors(session, urls, Community).values()}
+    if ids:
+        ids -= {row[0] for row in session.query(CommunityBlock.community_id).
+                filter(CommunityBlock.user_id == user.id, CommunityBlock.community_id.in_(ids))}
+        session.add_all([CommunityBlock(user_id=user.id, community_id=community_id) for community_id in ids])
+
+
+def block_users(session, user: User, urls: list):
+    ids = {blocked.id for blocked in resolve_actors(session, urls, User).values()}
+    if ids:
+        ids -= {row[0] for row in session.query(UserBlock.blocked_id).
+                filter(UserBlock.blocker_id == user.id, UserBlock.blocked_id.in_(ids))}
+        session.add_all([UserBlock(blocker_id=user.id, blocked_id=blocked_id) for blocked_id in ids])
+        # todo: federate blocks of remote users
+
+
+def add_user_notes(session, user: User, notes: list):
+    notes = [note for note in notes if isinstance(note, dict) and note.get('target')]
+    targets = resolve_actors(session, [note['target'] for note in notes], User)
+    if not targets:
+        return
+    noted = {row[0] for row in session.query(UserNote.target_id).
+             filter(UserNote.user_id == user.id, UserNote.target_id.in_([target.id for target in targets.values()]))}
+    for note in notes:
+        target = targets.get(note['target'].strip())
+        if target is not None and target.id not in noted:
+            session.add(UserNote(user_id=user.id, target_id=target.id, body=note.get('body')))
+            noted.add(target.id)
+
+
+def block_instances(session, user: User, domains: list):
+    ids = {row[0] for row in session.query(Instance.id).filter(Instance.domain.in_(domains))}
+    if ids:
+        ids -= {row[0] for row in session.query(InstanceBlock.instance_id).
+                filter(InstanceBlock.user_id == user.id, InstanceBlock.instance_id.in_(ids))}
+        session.add_all([InstanceBlock(user_id=user.id, instance_id=instance_id) for instance_id in ids])
+
+
+def save_posts(session, user: User, ap_ids: list):
+    ids = resolve_objects(session, user, ap_ids, Post)
+    if ids:
+        ids -= {row[0] for row in session.query(PostBookmark.post_id).
+                filter(PostBookmark.user_id == user.id, PostBookmark.post_id.in_(ids))}
+        session.add_all([PostBookmark(post_id=post_id, user_id=user.id) for post_id in ids])
+
+
+def save_comments(session, user: User, ap_ids: list):
+    ids = resolve_objects(session, user, ap_ids, PostReply)
+    if ids:
+        ids -= {row[0] for row in session.query(PostReplyBookmark.post_reply_id).
+                filter(PostReplyBookmark.user_id == user.id, PostReplyBookmark.post_reply_id.in_(ids))}
+        session.add_all([PostReplyBookmark(post_reply_id=reply_id, user_id=user.id) for reply_id in ids])
+
+
+def resolve_objects(session, user: User, ap_ids: list, model) -> set:
+    """Ids of the posts or comments with these ap_ids. The ones we don't have yet are fetched all at once, then their
+    authors, and only those that couldn't be fetched that way are resolved one at a time."""
+    from app.api.alpha.utils.misc import get_resolve_object
+    ap_ids = [ap_id for ap_id in ap_ids if isinstance(ap_id, str)]
+    known = dict(session.query(model.ap_id, model.id).filter(model.ap_id.in_(ap_ids), model.deleted == False))
+    result = set(known.values())
+    banned = {domain for domain in {urlparse(ap_id).hostname for ap_id in ap_ids if ap_id not in known}
+              if instance_banned(domain)}
+    missing = [ap_id for ap_id in dict.fromkeys(ap_ids)
+               if ap_id not in known and urlparse(ap_id).hostname not in banned]
+
+    fetched = {ap_id: data for ap_id, data in fetch_many(missing).items()
+               if isinstance(data, dict) and data.get('type') not in ('Conversation', 'OrderedCollection')}  # NodeBB
+    resolve_users(session, [data['attributedTo'] for data in fetched.values()
+                            if isinstance(data.get('attributedTo'), str)])
+    for ap_id in missing:
+        try:
+            if ap_id in fetched:
+                community = find_community(fetched[ap_id])
+                found = create_resolved_object(ap_id, fetched[ap_id], urlparse(ap_id).netloc, community, None, False) \
+                    if community else None
+            else:   # maybe the server needs signed fetches, try the slow way
+                found = get_resolve_object(None, {"q": ap_id}, user_id=user.id, recursive=True)
+        except Exception:
+            session.rollback()
+            continue
+        if isinstance(found, model):
+            result.add(found.id)
+    return result
+
+
+IMPORTERS = {
+    'followed_communities': follow_communities,
+    'blocked_communities': block_communities,
+    'blocked_users': block_users,
+    'user_notes': add_user_notes,
+    'blocked_instances': block_instances,
+    'saved_posts': save_posts,
+    'saved_comments': save_comments,
+}
@@ -33,7 +33,8 @@ from babel.numbers import format_compact_decimal
 import orjson
 
 from app.markdown_extras import apply_enhanced_image_attributes
-from app.translation import LibreTranslateAPI
+from app.remote_fetch import guarded_get
+from app.translation import translate_strings
 
 warnings.filterwarnings("ignore", category=MarkupResemblesLocatorWarning)
 import os
@@ -133,32 +134,30 @@ def get_request(uri, params=None, headers=None) -> httpx.Response:
         payload_str = urllib.parse.urlencode(params, safe=':@')
     else:
         payload_str = urllib.parse.urlencode(params) if params else None
-    try:
-        response = httpx_client.get(uri, params=payload_str, headers=headers, timeout=timeout, follow_redirects=True)
-    except ValueError as ex:
-        # Convert to a more generic error we handle
-        raise httpx.HTTPError(f"HTTPError: {str(ex)}") from None
-    except httpx.ReadError as connection_error:
-        try:  # retry, this time with a longer timeout
-            sleep(random.randint(3, 10))
-            response = httpx_client.get(uri, params=payload_str, headers=headers, timeout=timeout * 2,
-                                        follow_redirects=True)
-        except Exception as e:
-            current_app.logger.info(f"{uri} {connection_error}")
-            raise httpx_client.ReadError(f"HTTPReadError: {str(e)}") from connection_error
-    except httpx.HTTPError as read_timeout:
-        try:  # retry, this time with a longer timeout
-            sleep(random.randint(3, 10))
-            response = httpx_client.get(uri, params=payload_str, headers=headers, timeout=timeout * 2,
+
+    def fetch():
+        try:
+            return httpx_client.get(uri, params=payload_str, headers=headers, timeout=timeout, follow_redirects=True)
+        except ValueError as ex:
+            # Convert to a more generic error we handle
+            raise httpx.HTTPError(f"HTTPError: {str(ex)}") from None
+        except httpx.TimeoutException:
+            raise   # no retry - a slow server gets slower when hit again, leave it to the circuit breaker
+        except (httpx.ReadError, httpx.RemoteProtocolError, httpx.ConnectError) as connection_error:
+            try:  # the connection was dropped, retry straight away on a new one
+                return httpx_client.get(uri, params=payload_str, headers=headers, timeout=timeout,
                                         follow_redirects=True)
-        except Exception as e:
-            current_app.logger.info(f"{uri} {read_timeout}")
-            raise httpx.HTTPError(f"HTTPError: {str(e)}") from read_timeout
-    except httpx.StreamError as stream_error:
-        # Convert to a more generic error we handle
-        raise httpx.HTTPError(f"HTTPError: {str(stream_error)}") from None
+            except Exception as e:
+                current_app.logger.info(f"{uri} {connection_error}")
+                raise httpx.HTTPError(f"HTTPError: {str(e)}") from connection_error
+        except httpx.StreamError as stream_error:
+            # Convert to a more generic error we handle
+            raise httpx.HTTPError(f"HTTPError: {str(stream_error)}") from None
 
-    return response
+    # ActivityPub objects are often requested by several workers at once, share one response between them
+    accept = headers.get('Accept', '')
+    coalesce = payload_str is None and ('activity+json' in accept or 'ld+json' in accept)
+    return guarded_get(uri, accept, timeout, coalesce, fetch)
 
 
 # Same as get_request except updates instance on failure and does not raise any exceptions
@@ -2178,6 +2177,37 @@ def topic_tree() -> List:
     return [topic for topic in topics_dict.values() if topic['topic'].parent_id is None]
 
 
+@cache.memoize(timeout=300)
+def topic_community_ids(topic_id: int, with_children: bool = True) -> dict[int, bool]:
+    """The communities in a topic, and in the topics below it if with_children. {community id: private}"""
+    if with_children:
+        rows = db.session.execute(text('''SELECT c.id, c.private FROM "topic_closure" AS tc
+                                          JOIN "community" AS c ON c.topic_id = tc.descendant_id
+                                          WHERE tc.ancestor_id = :topic_id AND c.banned is false'''),
+                                  {'topic_id': topic_id})
+    else:
+        rows = db.session.execute(text('SELECT id, private FROM "community" WHERE topic_id = :topic_id AND banned is false'),
+                                  {'topic_id': topic_id})
+    return {community_id: bool(private) for community_id, private in rows}
+
+
+@cache.memoize(timeout=300)
+def feed_community_ids(feed_id: int, with_children: bool = True) -> dict[int, bool]:
+    """The communities in a feed, and in the feeds below it if with_children. {community id: private}"""
+    if with_children:
+        rows = db.session.execute(text('''SELECT DISTINCT c.id, c.private FROM "feed_closure" AS fc
+                                          JOIN "feed_item" AS fi ON fi.feed_id = fc.descendant_id
+                                          JOIN "community" AS c ON c.id = fi.community_id
+                                          WHERE fc.ancestor_id = :feed_id'''),
+                                  {'feed_id': feed_id})
+    else:
+        rows = db.session.execute(text('''SELECT DISTINCT c.id, c.private FROM "feed_item" AS fi
+                                          JOIN "community" AS c ON c.id = fi.community_id
+                                          WHERE fi.feed_id = :feed_id'''),
+                                  {'feed_id': feed_id})
+    return {community_id: bool(private) for community_id, private in rows}
+
+
 # feeds, in a tree
 def feed_tree(user_id) -> List[dict]:
     feeds = Feed.query.filter(Feed.user_id == user_id).order_by(Feed.name)
@@ -2736,52 +2766,40 @@ def authorise_api_user(auth, return_type=None, id_match=None) -> User | dict | i
 
     decoded = jwt.decode(token, current_app.config['SECRET_KEY'], algorithms=["HS256"])
     if decoded:
-        user_id = decoded['sub']
-        user = User.query.get(user_id)
-        if user is None:
+        user_id = int(decoded['sub'])
+        # everything needed to check the login and fill in the dict, in one redis round trip - see app/shared/api_context.py
+        from app.shared.api_context import api_context
+        context = api_context(user_id)
+        if context is None:
             raise Exception('incorrect_login')
-        if user.ap_id is not None or user.verified is False or user.banned is True or user.deleted is True:
+        if context['remote'] or context['verified'] is False or context['banned'] is True or context['deleted'] is True:
             raise Exception('incorrect_login')
-        if user.password_updated_at:
+        if context['password_updated_at']:
             issued_at_time = decoded['iat']
-            password_updated_time = int(user.password_updated_at.timestamp())
-            if issued_at_time < password_updated_time:
+            if issued_at_time < context['password_updated_at']:
                 raise Exception('incorrect_login')
-        if id_match and user.id != id_match:
+        if id_match and user_id != id_match:
             raise Exception('incorrect_login')
         if return_type and return_type == 'model':
+            user = User.query.get(user_id)
+            if user is None:
+                raise Exception('incorrect_login')
             return user
         elif return_type and return_type == 'dict':
-            user_ban_community_ids = communities_banned_from(user_id)
-            followed_community_ids = list(db.session.execute(text(
-                'SELECT community_id FROM "community_member" WHERE user_id = :user_id'),
-                {'user_id': user_id}).scalars())
-            bookmarked_reply_ids = list(db.session.execute(text(
-                'SELECT post_reply_id FROM "post_reply_bookmark" WHERE user_id = :user_id'),
-                {'user_id': user_id}).scalars())
-            blocked_creator_ids = blocked_users(user_id)
-            upvoted_reply_ids = recently_upvoted_post_replies(user_id)
-            downvoted_reply_ids = recently_downvoted_post_replies(user_id)
-            subscribed_reply_ids = list(db.session.execute(text(
-                'SELECT entity_id FROM "notification_subscription" WHERE type = :type and user_id = :user_id'),
-                {'type': NOTIF_REPLY, 'user_id': user_id}).scalars())
-            moderated_community_ids = list(db.session.execute(text(
-                'SELECT community_id FROM "community_member" WHERE user_id = :user_id AND is_moderator = true'),
-                {'user_id': user_id}).scalars())
             user_dict = {
-                'id': user.id,
-                'user_ban_community_ids': user_ban_community_ids,
-                'followed_community_ids': followed_community_ids,
-                'bookmarked_reply_ids': bookmarked_reply_ids,
-                'blocked_creator_ids': blocked_creator_ids,
-                'upvoted_reply_ids': upvoted_reply_ids,
-                'downvoted_reply_ids': downvoted_reply_ids,
-                'subscribed_reply_ids': subscribed_reply_ids,
-                'moderated_community_ids': moderated_community_ids
+                'id': user_id,
+                'user_ban_community_ids': context['user_ban_community_ids'],
+                'followed_community_ids': context['followed_community_ids'],
+                'bookmarked_reply_ids': context['bookmarked_reply_ids'],
+                'blocked_creator_ids': context['blocked_creator_ids'],
+                'upvoted_reply_ids': context['upvoted_reply_ids'],
+                'downvoted_reply_ids': context['downvoted_reply_ids'],
+                'subscribed_reply_ids': context['subscribed_reply_ids'],
+                'moderated_community_ids': context['moderated_community_ids']
             }
             return user_dict
         else:
-            return user.id
+            return user_id
 
 
 # Set up a new SQLAlchemy session specifically for Celery tasks
@@ -2792,8 +2810,8 @@ def get_task_session() -> Session:
 
 @contextmanager
 def patch_db_session(task_session):
-    """Temporarily replace db.session with task_session for functions that use it internally"""
-    from app import db
+    """Make db.session task_session for functions that use it internally, in this thread or greenlet only"""
+    from app import current_task_session
     from flask import has_request_context
 
     # Only patch if we're not in a Flask request context (i.e., in a Celery worker)
@@ -2802,28 +2820,11 @@ def patch_db_session(task_session):
         yield
         return
 
-    original_session = db.session
-
-    # Create a wrapper that makes the task session work with Flask-SQLAlchemy's Model.query
-    class SessionWrapper:
-        def __init__(self, session):  # noqa: F811
-            self._session = session
-
-        def __call__(self):
-            return self._session
-
-        def __getattr__(self, name):
-            # Handle scoped session methods that don't exist on regular Session
-            if name == 'remove':
-                # For task sessions, we don't want to remove since we manage the lifecycle
-                return lambda: None
-            return getattr(self._session, name)
-
-    db.session = SessionWrapper(task_session)
+    token = current_task_session.set(task_session)
     try:
         yield
     finally:
-        db.session = original_session
+        current_task_session.reset(token)
 
 
 def get_redis_connection(connection_string=None) -> redis.Redis:
@@ -3095,6 +3096,20 @@ def dedupe_post_ids(post_ids: List[Tuple[int, Optional[List[int]], int, int]], l
     return result
 
 
+def cross_posts_from_groups(rows) -> List[Tuple[int, Optional[List[int]], int, int]]:
+    # rows are (post_id, cross_post_group_id, user_id, reply_count). The cross posts of each post are the other posts in
+    # rows that are in the same group, which is what dedupe_post_ids() needs.
+    members = defaultdict(list)
+    for row in rows:
+        if row[1] is not None:
+            members[row[1]].append(row[0])
+    result = []
+    for row in rows:
+        cross_post_ids = [post_id for post_id in members[row[1]] if post_id != row[0]] if row[1] is not None else None
+        result.append((row[0], cross_post_ids or None, row[2], row[3]))
+    return result
+
+
 def paginate_post_ids(post_ids, page: int, page_length: int):
     start = page * page_length
     end = start + page_length
@@ -3110,13 +3125,13 @@ def get_deduped_post_ids(result_id: str, community_ids: List[int], sort: str, ha
             return json.loads(redis_client.get(result_id))
 
     if community_ids[0] == -1:  # A special value meaning to get posts from all communities
-        post_id_sql = 'SELECT p.id, p.cross_posts, p.user_id, p.reply_count FROM "post" as p\nINNER JOIN "community" as c on p.community_id = c.id\n'
+        post_id_sql = 'SELECT p.id, p.cross_post_group_id, p.user_id, p.reply_count FROM "post" as p\nINNER JOIN "community" as c on p.community_id = c.id\n'
         post_id_where = ['c.banned is false AND c.show_all is true']
         if current_user.is_authenticated and current_user.hide_low_quality:
             post_id_where.append('c.low_quality is false')
         params = {}
     else:
-        post_id_sql = 'SELECT p.id, p.cross_posts, p.user_id, p.reply_count FROM "post" as p\nINNER JOIN "community" as c on p.community_id = c.id\n'
+        post_id_sql = 'SELECT p.id, p.cross_post_group_id, p.user_id, p.reply_count FROM "post" as p\nINNER JOIN "community" as c on p.community_id = c.id\n'
         post_id_where = ['c.id IN :community_ids AND c.banned is false ']
         params = {'community_ids': tuple(community_ids)}
         if hashtag:
@@ -3231,7 +3246,7 @@ def get_deduped_post_ids(result_id: str, community_ids: List[int], sort: str, ha
     post_id_where.append('p.instance_sticky is false ')
     final_post_id_sql = f"{post_id_sql} WHERE {' AND '.join(post_id_where)}\n{post_id_sort}\nLIMIT 1000"
     post_ids = db.session.execute(text(final_post_id_sql), params).all()
-    post_ids = dedupe_post_ids(post_ids, limit_to_visible=(community_ids[0] != -1))
+    post_ids = dedupe_post_ids(cross_posts_from_groups(post_ids), limit_to_visible=(community_ids[0] != -1))
 
     if current_user.is_authenticated:
         redis_client.set(result_id, json.dumps(post_ids), ex=86400)  # 86400 is 1 day
@@ -3343,7 +3358,7 @@ def total_comments_on_post_and_cross_posts(post_id):
             p.reply_count + (
                 SELECT COALESCE(SUM(cp.reply_count), 0)
                 FROM post cp
-                WHERE cp.id = ANY(p.cross_posts)
+                WHERE cp.cross_post_group_id = p.cross_post_group_id AND cp.id != p.id AND cp.deleted is false
             ) AS total_reply_count
         FROM post p
         WHERE p.id = :post_id;
@@ -3691,8 +3706,18 @@ def on_unread_notifications_set(target, value, oldvalue, initiator):
 
 
 def publish_sse_event(key, value):
-    r = get_redis_connection()
-    r.publish(key, value)
+    """Send an event to the browsers of a user through the piefed-notifs service (fastapi_server.py). `key` is
+    'notifications:<user id>' or 'messages:<user id>'. The event is also added to a short stream per user so that a
+    browser which reconnects can be sent what it missed."""
+    from app import redis_client
+    kind, user_id = key.split(':', 1)
+    stream = f'sse:stream:{user_id}'
+    event_id = redis_client.xadd(stream, {'kind': kind, 'data': value},
+                                 maxlen=current_app.config['SSE_STREAM_LENGTH'], approximate=True)
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.expire(stream, 60 * 60)
+    pipe.publish(f'sse:{user_id}', json.dumps({'id': event_id, 'kind': kind, 'data': value}))
+    pipe.execute()
 
 
 def apply_feed_url_rules(self):
@@ -3884,195 +3909,74 @@ def is_valid_xml_utf8(pystring):
 
 
 def archive_post(post_id: int):
+    archive_posts([post_id])
+
+
+def archive_posts(post_ids: list):
+    """Archive a batch of posts into a single archive segment - see app/archive_store.py"""
     from app import redis_client
-    import os
+    from app.archive_store import SegmentWriter, train_dictionary, write_segment, make_locator
     session = get_task_session()  # noqa: F811
     try:
         with patch_db_session(session):
-            if current_app.debug:
-                filename = f'post_{post_id}{gibberish(5)}.json'
-            else:
-                filename = f'post_{post_id}.json'
-            with redis_client.lock(f"lock:post:{post_id}", timeout=300, blocking_timeout=6):
-                post = session.query(Post).get(post_id)
-
-                if post is None:
-                    return
-
-                # Delete thumbnail and medium sized versions if post has an image
-                if post.image_id is not None:
-
-                    image_file = session.query(File).get(post.image_id)
-                    if image_file:
-                        if store_files_in_s3():
-                            boto3_session = boto3.session.Session()
-                            s3 = boto3_session.client(
-                                service_name='s3',
-                                region_name=current_app.config['S3_REGION'],
-                                endpoint_url=current_app.config['S3_ENDPOINT'],
-                                aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
-                                aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
-                            )
-
-                        # Delete thumbnail
-                        if image_file.thumbnail_path:
-                            if image_file.thumbnail_path.startswith('app/'):
-                                # Local file deletion
-                                try:
-                                    os.unlink(image_file.thumbnail_path)
-                                except (OSError, FileNotFoundError):
-                                    pass
-                            elif store_files_in_s3() and image_file.thumbnail_path.startswith(
-                                    f'https://{current_app.config["S3_PUBLIC_URL"]}'):
-                                # S3 file deletion
-                                try:
-                                    s3_key = image_file.thumbnail_path.split(current_app.config['S3_PUBLIC_URL'])[-1].lstrip('/')
-                                    s3.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=s3_key)
-                                except Exception:
-                                    pass
-                            image_file.thumbnail_path = None
-
-                        # Delete medium sized version (file_path)
-                        if image_file.file_path:
-                            if image_file.file_path.startswith('app/'):
-                                # Local file deletion
-                                try:
-                                    os.unlink(image_file.file_path)
-                                except (OSError, FileNotFoundError):
-                                    pass
-                            elif store_files_in_s3() and image_file.file_path.startswith(
-                                    f'https://{current_app.config["S3_PUBLIC_URL"]}'):
-                                # S3 file deletion
-                                try:
-                                    s3_key = image_file.file_path.split(current_app.config['S3_PUBLIC_URL'])[-1].lstrip('/')
-                                    s3.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=s3_key)
-                                except Exception:
-                                    pass
-                            image_file.file_path = None
-
-                        if store_files_in_s3():
-                            s3.close()
-
+            to_save = {}
+            for post_id in post_ids:
+                with redis_client.lock(f"lock:post:{post_id}", timeout=300, blocking_timeout=6):
+                    post = session.get(Post, post_id)
+
+                    if post is None or post.archived:
+                        continue
+
+                    if post.reply_count == 0 and (post.body is None or len(post.body) < 200):  # don't save to json when the url of the json will be longer than the savings from removing the body
+                        continue
+
+                    to_save[post.id] = _serialize_post_for_archive(post)
+
+            if not to_save:
+                return
+
+            samples = [orjson.dumps(save_this) for save_this in list(to_save.values())[:100]]
+            writer = SegmentWriter(train_dictionary(samples))
+            positions = {post_id: writer.add(save_this) for post_id, save_this in to_save.items()}
+            segment_name = f'{utcnow().strftime("%Y%m%d%H%M%S")}{gibberish(6)}'
+            write_segment(segment_name, writer.getvalue(), store_files_in_s3())
+
+            for post_id, position in positions.items():
+                with redis_client.lock(f"lock:post:{post_id}", timeout=300, blocking_timeout=6):
+                    # the lock was released while the segment was written. Posts deleted, archived or edited since then
+                    # are left as they are - an edited one is archived next time, with its new body.
+                    post = session.get(Post, post_id, populate_existing=True)
+                    if post is None or post.archived or \
+                            (post.body, post.body_html) != (to_save[post_id]['body'], to_save[post_id]['body_html']):
+                        continue
+
+                    _delete_archived_post_images(session, post)
+                    post.body = None
+                    post.body_html = None
+                    post.archived = make_locator(segment_name, *position)
                     session.commit()
 
-                if post.reply_count == 0 and (post.body is None or len(post.body) < 200):  # don't save to json when the url of the json will be longer than the savings from removing the body
-                    return
-
-                save_this = {}
-
-                save_this['id'] = post.id
-                save_this['version'] = 1
-                save_this['body'] = post.body
-                save_this['body_html'] = post.body_html
-                save_this['replies'] = []
-                post.body = None
-                post.body_html = None
-                if post.reply_count:
-                    from app.post.util import post_replies
-                    # Get replies sorted by 'hot' with scores preserved - keep hierarchical structure
-                    hot_replies = post_replies(post, 'hot', None, db_only=True)  # No viewer to get all replies
-
-                    # Serialization of hierarchical tree
-                    def serialize_tree(reply_tree):
-                        result = []
-                        for reply_dict in reply_tree:
-                            comment = reply_dict['comment']
-                            serialized = {
-                                'id': int(comment.id) if comment.id else None,
-                                'body': str(comment.body) if comment.body else '',
-                                'body_html': str(comment.body_html) if comment.body_html else '',
-                                'posted_at': comment.posted_at.isoformat() if comment.posted_at else None,
-                                'edited_at': comment.edited_at.isoformat() if comment.edited_at else None,
-                                'score': int(comment.score) if comment.score else 0,
-                                'ranking': float(comment.ranking) if comment.ranking else 0.0,
-                                'parent_id': int(comment.parent_id) if comment.parent_id else None,
-                                'distinguished': bool(comment.distinguished),
-                                'deleted': bool(comment.deleted),
-                                'deleted_by': int(comment.deleted_by) if comment.deleted_by else None,
-                                'user_id': int(comment.user_id) if comment.user_id else None,
-                                'depth': int(comment.depth) if comment.depth else 0,
-                                'language_id': int(comment.language_id) if comment.language_id else None,
-                                'replies_enabled': bool(comment.replies_enabled),
-                                'community_id': int(comment.community_id) if comment.community_id else None,
-                                'up_votes': int(comment.up_votes) if comment.up_votes else 0,
-                                'down_votes': int(comment.down_votes) if comment.down_votes else 0,
-                                'child_count': int(comment.child_count) if comment.child_count else 0,
-                                'path': list(comment.path) if comment.path else [],
-                                'author_name': str(comment.author.display_name()) if comment.author and comment.author.display_name() else 'Unknown',
-                                'author_id': int(comment.author.id) if comment.author and comment.author.id else None,
-                                'author_indexable': bool(comment.author.indexable) if comment.author else True,
-                                'author_deleted': bool(comment.author.deleted) if comment.author else False,
-                                'author_user_name': comment.author.user_name if comment.author else False,
-                                'author_ap_id': comment.author.ap_id if comment.author else False,
-                                'author_ap_profile_id': comment.author.ap_profile_id if comment.author else False,
-                                'author_reputation': comment.author.reputation if comment.author else 0,
-                                'author_created': comment.author.created.isoformat() if comment.author else None,
-                                'author_ap_domain': comment.author.ap_domain if comment.author else '',
-                                'author_bot': comment.author.bot if comment.author else False,
-                                'author_banned': comment.author.banned if comment.author else False,
-                                'replies': serialize_tree(reply_dict['replies'])
-                            }
-                            result.append(serialized)
-                        return result
-
-                    save_this['replies'] = serialize_tree(hot_replies)
-
-                if store_files_in_s3():
-                    # upload to s3
-                    boto3_session = boto3.session.Session()
-                    s3 = boto3_session.client(
-                        service_name='s3',
-                        region_name=current_app.config['S3_REGION'],
-                        endpoint_url=current_app.config['S3_ENDPOINT'],
-                        aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
-                        aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
-                    )
-
-                    # upload orjson(save_this) to a file in S3 named f'archived/{filename}'
-                    # save url to  new file into s3_url variable
-                    s3_key = f'archived/{filename}.gz'
-                    json_data = orjson.dumps(save_this)
-                    compressed_data = gzip.compress(json_data)
-
-                    s3.put_object(
-                        Bucket=current_app.config['S3_BUCKET'],
-                        Key=s3_key,
-                        Body=compressed_data,
-                        ContentType='application/gzip',
-                        ContentEncoding='gzip'
+                    # Delete all post_replies associated with the post
+                    # First, get all reply IDs that have bookmarks by users other than the reply author
+                    bookmarked_reply_ids = set(
+                        session.execute(text('''
+                            SELECT DISTINCT prb.post_reply_id
+                            FROM post_reply_bookmark prb
+                            JOIN post_reply pr ON prb.post_reply_id = pr.id
+                            WHERE pr.post_id = :post_id
+                        '''), {'post_id': post.id}).scalars()
                     )
 
-                    s3_url = f"https://{current_app.config['S3_PUBLIC_URL']}/{s3_key}"
-
-                    s3.close()
-                    post.archived = s3_url
-                else:
-                    ensure_directory_exists('app/static/media/archived')
-                    file_path = f'app/static/media/archived/{filename}'
-                    with gzip.open(file_path + '.gz', 'wb') as f:
-                        f.write(orjson.dumps(save_this))
-                    post.archived = file_path + '.gz'
-
-                session.commit()
-
-                # Delete all post_replies associated with the post
-                # First, get all reply IDs that have bookmarks by users other than the reply author
-                bookmarked_reply_ids = set(
-                    session.execute(text('''
-                        SELECT DISTINCT prb.post_reply_id
-                        FROM post_reply_bookmark prb
-                        JOIN post_reply pr ON prb.post_reply_id = pr.id
-                        WHERE pr.post_id = :post_id
-                    '''), {'post_id': post.id}).scalars()
-                )
-
-                for reply in session.query(PostReply).filter(PostReply.post_id == post.id).order_by(desc(PostReply.created_at)):
-                    session.add(ArchivedPostReply(user_id=reply.user_id, post_id=post.id, post_reply_id=reply.id,
-                                                  created_at=reply.created_at))
-                    if reply.id not in bookmarked_reply_ids:
-                        reply.delete_dependencies()
-                        session.delete(reply)
-                    session.commit()
+                    # Only the replies that made it into the segment - any that arrived since are left as they are
+                    archived_reply_ids = _archived_reply_ids(to_save[post_id]['replies'])
+                    for reply in session.query(PostReply).filter(PostReply.post_id == post.id,
+                                                                 PostReply.id.in_(archived_reply_ids)).order_by(desc(PostReply.created_at)):
+                        session.add(ArchivedPostReply(user_id=reply.user_id, post_id=post.id, post_reply_id=reply.id,
+                                                      created_at=reply.created_at))
+                        if reply.id not in bookmarked_reply_ids:
+                            reply.delete_dependencies()
+                            session.delete(reply)
+                        session.commit()
 
     except Exception:
         session.rollback()
@@ -4081,19 +3985,140 @@ def archive_post(post_id: int):
         session.close()
 
 
+def _archived_reply_ids(replies: list) -> list:
+    reply_ids = []
+    for reply in replies:
+        if reply['id']:
+            reply_ids.append(reply['id'])
+        reply_ids.extend(_archived_reply_ids(reply['replies']))
+    return reply_ids
+
+
+def _delete_archived_post_images(session, post: Post):
+    """Delete thumbnail and medium sized versions if post has an image"""
+    if post.image_id is not None:
+        image_file = session.query(File).get(post.image_id)
+        if image_file:
+            if store_files_in_s3():
+                boto3_session = boto3.session.Session()
+                s3 = boto3_session.client(
+                    service_name='s3',
+                    region_name=current_app.config['S3_REGION'],
+                    endpoint_url=current_app.config['S3_ENDPOINT'],
+                    aws_access_key_id=current_app.config['S3_ACCESS_KEY'],
+                    aws_secret_access_key=current_app.config['S3_ACCESS_SECRET'],
+                )
+
+            # Delete thumbnail
+            if image_file.thumbnail_path:
+                if image_file.thumbnail_path.startswith('app/'):
+                    # Local file deletion
+                    try:
+                        os.unlink(image_file.thumbnail_path)
+                    except (OSError, FileNotFoundError):
+                        pass
+                elif store_files_in_s3() and image_file.thumbnail_path.startswith(
+                        f'https://{current_app.config["S3_PUBLIC_URL"]}'):
+                    # S3 file deletion
+                    try:
+                        s3_key = image_file.thumbnail_path.split(current_app.config['S3_PUBLIC_URL'])[-1].lstrip('/')
+                        s3.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=s3_key)
+                    except Exception:
+                        pass
+                image_file.thumbnail_path = None
+
+            # Delete medium sized version (file_path)
+            if image_file.file_path:
+                if image_file.file_path.startswith('app/'):
+                    # Local file deletion
+                    try:
+                        os.unlink(image_file.file_path)
+                    except (OSError, FileNotFoundError):
+                        pass
+                elif store_files_in_s3() and image_file.file_path.startswith(
+                        f'https://{current_app.config["S3_PUBLIC_URL"]}'):
+                    # S3 file deletion
+                    try:
+                        s3_key = image_file.file_path.split(current_app.config['S3_PUBLIC_URL'])[-1].lstrip('/')
+                        s3.delete_object(Bucket=current_app.config['S3_BUCKET'], Key=s3_key)
+                    except Exception:
+                        pass
+                image_file.file_path = None
+
+            if store_files_in_s3():
+                s3.close()
+
+        session.commit()
+
+
+def _serialize_post_for_archive(post: Post) -> dict:
+    save_this = {}
+
+    save_this['id'] = post.id
+    save_this['version'] = 1
+    save_this['body'] = post.body
+    save_this['body_html'] = post.body_html
+    save_this['replies'] = []
+    if post.reply_count:
+        from app.post.util import post_replies
+        # Get replies sorted by 'hot' with scores preserved - keep hierarchical structure
+        hot_replies = post_replies(post, 'hot', None, db_only=True)  # No viewer to get all replies
+
+        # Serialization of hierarchical tree
+        def serialize_tree(reply_tree):
+            result = []
+            for reply_dict in reply_tree:
+                comment = reply_dict['comment']
+                serialized = {
+                    'id': int(comment.id) if comment.id else None,
+                    'body': str(comment.body) if comment.body else '',
+                    'body_html': str(comment.body_html) if comment.body_html else '',
+                    'posted_at': comment.posted_at.isoformat() if comment.posted_at else None,
+                    'edited_at': comment.edited_at.isoformat() if comment.edited_at else None,
+                    'score': int(comment.score) if comment.score else 0,
+                    'ranking': float(comment.ranking) if comment.ranking else 0.0,
+                    'parent_id': int(comment.parent_id) if comment.parent_id else None,
+                    'distinguished': bool(comment.distinguished),
+                    'deleted': bool(comment.deleted),
+                    'deleted_by': int(comment.deleted_by) if comment.deleted_by else None,
+                    'user_id': int(comment.user_id) if comment.user_id else None,
+                    'depth': int(comment.depth) if comment.depth else 0,
+                    'language_id': int(comment.language_id) if comment.language_id else None,
+                    'replies_enabled': bool(comment.replies_enabled),
+                    'community_id': int(comment.community_id) if comment.community_id else None,
+                    'up_votes': int(comment.up_votes) if comment.up_votes else 0,
+                    'down_votes': int(comment.down_votes) if comment.down_votes else 0,
+                    'child_count': int(comment.child_count) if comment.child_count else 0,
+                    'path': list(comment.path) if comment.path else [],
+                    'author_name': str(comment.author.display_name()) if comment.author and comment.author.display_name() else 'Unknown',
+                    'author_id': int(comment.author.id) if comment.author and comment.author.id else None,
+                    'author_indexable': bool(comment.author.indexable) if comment.author else True,
+                    'author_deleted': bool(comment.author.deleted) if comment.author else False,
+                    'author_user_name': comment.author.user_name if comment.author else False,
+                    'author_ap_id': comment.author.ap_id if comment.author else False,
+                    'author_ap_profile_id': comment.author.ap_profile_id if comment.author else False,
+                    'author_reputation': comment.author.reputation if comment.author else 0,
+                    'author_created': comment.author.created.isoformat() if comment.author else None,
+                    'author_ap_domain': comment.author.ap_domain if comment.author else '',
+                    'author_bot': comment.author.bot if comment.author else False,
+                    'author_banned': comment.author.banned if comment.author else False,
+                    'replies': serialize_tree(reply_dict['replies'])
+                }
+                result.append(serialized)
+            return result
+
+        save_this['replies'] = serialize_tree(hot_replies)
+
+    return save_this
+
+
 def user_in_restricted_country(user: User) -> bool:
     restricted_countries = get_setting('nsfw_country_restriction', '').split('\n')
     return user.ip_address_country and user.ip_address_country in [country_code.strip() for country_code in restricted_countries]
 
 
-@cache.memoize(timeout=80600)
 def libretranslate_string(text: str, source: str, target: str):
-    try:
-        lt = LibreTranslateAPI(current_app.config['TRANSLATE_ENDPOINT'], api_key=current_app.config['TRANSLATE_KEY'])
-        return lt.translate(text, source=source, target=target)
-    except Exception as e:
-        current_app.logger.exception(str(e))
-        return ''
+    return translate_strings([text], source, target)[0]
 
 
 def to_srgb(im: Image.Image, assume="sRGB"):
@@ -4199,43 +4224,47 @@ def expand_hex_color(text: str) -> str:
     return new_text
 
 
-def scale_gif(path, scale, new_path=None):
+def scale_gif(path, scale, new_path=None) -> tuple[int, int]:
+    """Scale an animated gif down to fit in scale. The frames of the original are read one at a time rather than all
+    loaded at once, so a long gif does not need hundreds of full size frames in memory. Returns the new size."""
     # from https://stackoverflow.com/a/69850807
-    gif = Image.open(path)
     if not new_path:
         new_path = path
-    old_gif_information = {
-        'loop': bool(gif.info.get('loop', 1)),
-        'duration': gif.info.get('duration', 40),
-        'background': gif.info.get('background', 223),
-        'extension': gif.info.get('extension', (b'NETSCAPE2.0')),
-        'transparency': gif.info.get('transparency', 223)
-    }
-    new_frames = get_new_frames(gif, scale)
-    save_new_gif(new_frames, old_gif_information, new_path)
+    temp_path = new_path + '.tmp'   # path is still being read while the new gif is written
+    with Image.open(path) as gif:
+        old_gif_information = {
+            'loop': bool(gif.info.get('loop', 1)),
+            'duration': gif.info.get('duration', 40),
+            'background': gif.info.get('background', 223),
+            'extension': gif.info.get('extension', (b'NETSCAPE2.0')),
+            'transparency': gif.info.get('transparency', 223)
+        }
+        new_frames = get_new_frames(gif, scale)
+        first_frame = next(new_frames)
+        save_new_gif(first_frame, new_frames, old_gif_information, temp_path)
+    os.replace(temp_path, new_path)
+    return first_frame.size
 
 
 def get_new_frames(gif, scale):
-    new_frames = []
-    actual_frames = gif.n_frames
-    for frame in range(actual_frames):
+    for frame in range(gif.n_frames):
         gif.seek(frame)
         new_frame = Image.new('RGBA', gif.size)
         new_frame.paste(gif)
         new_frame.thumbnail(scale)
-        new_frames.append(new_frame)
-    return new_frames
-
-
-def save_new_gif(new_frames, old_gif_information, new_path):
-    new_frames[0].save(new_path,
-                       save_all = True,
-                       append_images = new_frames[1:],
-                       duration = old_gif_information['duration'],
-                       loop = old_gif_information['loop'],
-                       background = old_gif_information['background'],
-                       extension = old_gif_information['extension'] ,
-                       transparency = old_gif_information['transparency'])
+        yield new_frame
+
+
+def save_new_gif(first_frame, new_frames, old_gif_information, new_path):
+    first_frame.save(new_path,
+                     format='GIF',
+                     save_all=True,
+                     append_images=new_frames,
+                     duration=old_gif_information['duration'],
+                     loop=old_gif_information['loop'],
+                     background=old_gif_information['background'],
+                     extension=old_gif_information['extension'],
+                     transparency=old_gif_information['transparency'])
 
 
 @cache.memoize(timeout=100)
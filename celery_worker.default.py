@@ -2,6 +2,7 @@
 import os
 from app import celery, create_app, db
 from celery.signals import worker_process_init, task_prerun, task_postrun
+from flask import has_app_context
 
 
 app = create_app()
@@ -33,6 +34,8 @@ from app.shared.tasks import (
     users,
     blocks,
 )
+from app.shared import broadcast, counters, purge, syndication, upload
+from app.user import settings_import
 
 
 # Dispose of connection pool inherited from parent process after fork
@@ -51,15 +54,34 @@ def init_celery_worker(**kwargs):
     # close=False prevents closing parent process connections
     db.engine.dispose(close=False)
 
+    # Parse the signing keys of busy local actors now rather than during the first deliveries
+    from app.activitypub.signature import HttpSignature
+    try:
+        HttpSignature.warm_key_cache(db.session)
+    except Exception as e:
+        app.logger.warning(f'Could not warm the signing key cache: {e}')
+    finally:
+        db.session.remove()
+
+
+# With the threads or gevent pool, tasks don't run where the app context above was pushed - they get one each
+_task_app_contexts = {}
+
 
 # Ensure fresh database session for each Celery task
 @task_prerun.connect
-def celery_task_prerun(*args, **kwargs):
+def celery_task_prerun(task_id=None, **kwargs):
     """Remove any existing database session before task starts to prevent stale connections"""
+    if not has_app_context():
+        _task_app_contexts[task_id] = app.app_context()
+        _task_app_contexts[task_id].push()
     db.session.remove()
 
 
 @task_postrun.connect
-def celery_task_postrun(*args, **kwargs):
+def celery_task_postrun(task_id=None, **kwargs):
     """Clean up database session after task completes"""
     db.session.remove()
+    app_context = _task_app_contexts.pop(task_id, None)
+    if app_context is not None:
+        app_context.pop()
@@ -132,6 +132,8 @@ class Config(object):
     MEDIA_IMAGE_THUMBNAIL_FORMAT = os.environ.get('MEDIA_IMAGE_THUMBNAIL_FORMAT') or 'WEBP'
     MEDIA_IMAGE_THUMBNAIL_QUALITY = int(os.environ.get('MEDIA_IMAGE_THUMBNAIL_QUALITY') or 93)
 
+    MEDIA_PROCESSES = int(os.environ.get('MEDIA_PROCESSES') or 2)  # processes resizing uploads, per media worker
+
     FILE_UPLOAD_QUOTA = int(os.environ.get('FILE_UPLOAD_QUOTA') or 52428800)   # default 50 MB
 
     # LDAP configuration - common config
@@ -184,3 +186,62 @@ class Config(object):
     DETECT_AI_ENDPOINT = os.environ.get('DETECT_AI_ENDPOINT') or ''
 
     REDIS_MEMORY_LIMIT = int(os.environ.get('REDIS_MEMORY_LIMIT') or 200000000)
+
+    # Instance health checks - how many instances to probe at once and how long to wait for each request
+    INSTANCE_HEALTH_CONCURRENCY = int(os.environ.get('INSTANCE_HEALTH_CONCURRENCY') or 50)
+    INSTANCE_HEALTH_TIMEOUT = float(os.environ.get('INSTANCE_HEALTH_TIMEOUT') or 10)
+
+    # Task lanes - see app/task_lanes.py. Rate limits are like 'media=60/m,maintenance=10/s'.
+    CELERY_LANE_RATE_LIMITS = os.environ.get('CELERY_LANE_RATE_LIMITS') or ''
+    # Once this many activities are waiting in the inbound lane, votes on content older than FEDERATION_SHED_VOTE_AGE days
+    # are dropped. At FEDERATION_SHED_OVERLOAD_DEPTH all votes are dropped and other activities are refused with a 429.
+    FEDERATION_SHED_LOW_VALUE_DEPTH = int(os.environ.get('FEDERATION_SHED_LOW_VALUE_DEPTH') or 5000)
+    FEDERATION_SHED_OVERLOAD_DEPTH = int(os.environ.get('FEDERATION_SHED_OVERLOAD_DEPTH') or 50000)
+    FEDERATION_SHED_VOTE_AGE = int(os.environ.get('FEDERATION_SHED_VOTE_AGE') or 7)
+    # Each instance sending to us can send FEDERATION_INTAKE_RATE activities a second (more if it is trusted or runs
+    # threadiverse software), in bursts of up to FEDERATION_INTAKE_BURST seconds' worth. Once the inbound lane is backed
+    # up an instance with more than FEDERATION_INTAKE_QUEUE_SHARE of the backlog is asked to retry later. 0 turns it off.
+    FEDERATION_INTAKE_RATE = float(os.environ.get('FEDERATION_INTAKE_RATE') or 25)
+    FEDERATION_INTAKE_BURST = int(os.environ.get('FEDERATION_INTAKE_BURST') or 60)
+    FEDERATION_INTAKE_QUEUE_SHARE = float(os.environ.get('FEDERATION_INTAKE_QUEUE_SHARE') or 0.25)
+    # Incoming activities accepted in the last ACTIVITY_DEDUPE_HOURS are ignored if they are delivered again. Sized for
+    # ACTIVITY_DEDUPE_PER_HOUR activities an hour, which takes about 2.4 bytes each. 0 hours only ignores them for 90 seconds.
+    ACTIVITY_DEDUPE_HOURS = int(os.environ.get('ACTIVITY_DEDUPE_HOURS') or 6)
+    ACTIVITY_DEDUPE_PER_HOUR = int(os.environ.get('ACTIVITY_DEDUPE_PER_HOUR') or 200000)
+
+    # Votes to other PieFed instances are sent in batches, once this many seconds have passed since the first one or
+    # once this many are waiting, whichever comes first.
+    ACTIVITY_BATCH_MAX_AGE = int(os.environ.get('ACTIVITY_BATCH_MAX_AGE') or 20)
+    ACTIVITY_BATCH_MAX_SIZE = int(os.environ.get('ACTIVITY_BATCH_MAX_SIZE') or 100)
+
+    # Remote actors that could not be fetched are not tried again for this many seconds. At most SIZE are remembered.
+    ACTOR_NEGATIVE_CACHE_TTL = int(os.environ.get('ACTOR_NEGATIVE_CACHE_TTL') or 3600)
+    ACTOR_NEGATIVE_CACHE_SIZE = int(os.environ.get('ACTOR_NEGATIVE_CACHE_SIZE') or 100000)
+
+    # Outgoing GET requests - see app/remote_fetch.py
+    REMOTE_CIRCUIT_FAILURES = int(os.environ.get('REMOTE_CIRCUIT_FAILURES') or 5)
+    REMOTE_CIRCUIT_WINDOW = int(os.environ.get('REMOTE_CIRCUIT_WINDOW') or 120)
+    REMOTE_CIRCUIT_OPEN = int(os.environ.get('REMOTE_CIRCUIT_OPEN') or 300)
+    REMOTE_HOST_CONCURRENCY = int(os.environ.get('REMOTE_HOST_CONCURRENCY') or 10)
+    REMOTE_COALESCE_SECONDS = int(os.environ.get('REMOTE_COALESCE_SECONDS') or 10)
+
+    # How many posts to backfill when a remote community is first subscribed to. `flask backfill-community` can get more.
+    BACKFILL_POSTS = int(os.environ.get('BACKFILL_POSTS') or 50)
+
+    # Activities sent to every instance (account deletions) go out this many instances per task, this many at once
+    BROADCAST_CHUNK_SIZE = int(os.environ.get('BROADCAST_CHUNK_SIZE') or 1000)
+    BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY') or 50)
+
+    # Settings imports (Lemmy / PieFed exports) resolve, join and block this many things per task
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE') or 50)
+
+    # Posts and comments are purged (deleted along with their votes, bookmarks, etc) this many per transaction
+    PURGE_BATCH_SIZE = int(os.environ.get('PURGE_BATCH_SIZE') or 500)
+
+    # Votes and reply counts are totalled in redis and written to the database this many seconds later, this many rows
+    # per transaction
+    COUNTER_FLUSH_DELAY = int(os.environ.get('COUNTER_FLUSH_DELAY') or 5)
+    COUNTER_FLUSH_BATCH = int(os.environ.get('COUNTER_FLUSH_BATCH') or 1000)
+
+    # How many recent notification events are kept per user for browsers that reconnect to the notifs service
+    SSE_STREAM_LENGTH = int(os.environ.get('SSE_STREAM_LENGTH') or 50)
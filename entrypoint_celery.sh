@@ -1,3 +1,32 @@
-#!/bin/sh
+#!/bin/bash
 
-uv run celery -A celery_worker_docker.celery worker --concurrency=4 --queues=celery,background,send
+# One worker per task lane (see app/task_lanes.py) so a backlog in one lane does not hold up the others.
+# Set CELERY_SINGLE_WORKER=1 to run one worker for all lanes instead, which uses less memory.
+# The inbound and outbound lanes mostly wait on other servers, so they can use CELERY_IO_POOL=threads (or gevent, if it
+# is installed) with a much higher concurrency. Each concurrent task holds a database connection, so DB_POOL_SIZE plus
+# DB_MAX_OVERFLOW has to be at least the concurrency.
+# The media lane uses threads by default, and resizes uploads in MEDIA_PROCESSES processes of its own.
+
+if [ -n "$CELERY_SINGLE_WORKER" ]; then
+    exec uv run celery -A celery_worker_docker.celery worker --concurrency=4 --queues=celery,inbound,send,media,background
+fi
+
+# docker stop's SIGTERM goes to this script, not the workers - pass it on so they finish their tasks (warm shutdown).
+# If any worker exits, stop the rest too so the container exits and is restarted, rather than running without a lane.
+stop_workers() {
+    kill -TERM $(jobs -p) 2>/dev/null
+    wait
+}
+trap 'stop_workers; exit 0' TERM INT
+
+uv run celery -A celery_worker_docker.celery worker -n interactive@%h --concurrency=${CELERY_INTERACTIVE_CONCURRENCY:-2} --queues=celery &
+uv run celery -A celery_worker_docker.celery worker -n inbound@%h --concurrency=${CELERY_INBOUND_CONCURRENCY:-4} --pool=${CELERY_IO_POOL:-prefork} --queues=inbound &
+uv run celery -A celery_worker_docker.celery worker -n outbound@%h --concurrency=${CELERY_OUTBOUND_CONCURRENCY:-4} --pool=${CELERY_IO_POOL:-prefork} --queues=send &
+uv run celery -A celery_worker_docker.celery worker -n media@%h --concurrency=${CELERY_MEDIA_CONCURRENCY:-1} --pool=${CELERY_MEDIA_POOL:-threads} --queues=media &
+uv run celery -A celery_worker_docker.celery worker -n maintenance@%h --concurrency=${CELERY_MAINTENANCE_CONCURRENCY:-1} --queues=background &
+
+wait -n
+status=$?
+echo "A celery worker exited with status $status, stopping the others"
+stop_workers
+exit $status
@@ -1,7 +1,9 @@
+from collections import defaultdict
 from typing import List
+from urllib.parse import urlparse
 
-from fastapi import FastAPI
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import asyncio
 import redis.asyncio as redis
@@ -36,25 +38,171 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dictionary of {user_id: set of asyncio.Queue instances}
+# How many events can wait to be sent to one connection. See ClientQueue.
+QUEUE_SIZE = int(os.getenv("SSE_QUEUE_SIZE") or 20)
+# Each connected user's channel is subscribed to on one of this many redis connections, chosen by user id
+PUBSUB_SHARDS = int(os.getenv("SSE_PUBSUB_SHARDS") or 8)
+HEARTBEAT_SECONDS = 60
+
+# Must match publish_sse_event() in app/utils.py
+CHANNEL = "sse:{}"  # pub/sub channel per user, messages are {"id", "kind", "data"}
+STREAM_KEY = "sse:stream:{}"  # the same events, kept for a while so reconnecting browsers can catch up
+KEEPALIVE_CHANNEL = "sse:keepalive"  # never published to
+
+# Delivery of activities for the Flask app. The redis keys must match app/shared/delivery.py.
+DELIVERY_QUEUE = "http_posts:queue"
+OK_KEY = "delivery:ok"
+FAILED_KEY = "delivery:failed"
+GONE_KEY = "delivery:gone"
+RETRY_KEY = "delivery:retry"
+# At most this many requests at once, and this many to any one host (over one HTTP/2 connection where possible)
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY") or 200)
+HOST_CONCURRENCY = int(os.getenv("REMOTE_HOST_CONCURRENCY") or 10)
+BATCHES_IN_FLIGHT = 50
+MAX_RETRIES_KEPT = 10000
+DELIVERED = {200, 201, 202, 204}
+GONE = {410, 418}
+
+delivery_slots = asyncio.Semaphore(DELIVERY_CONCURRENCY)
+host_slots = defaultdict(lambda: asyncio.Semaphore(HOST_CONCURRENCY))
+
+# Dictionary of {user_id: set of ClientQueue instances}
 connected_clients = {}
+shards = []
 
 # HTTP client for connection pooling
 http_client = None
 
 
+def parse_event_id(event_id: str):
+    """Redis stream ids are '<milliseconds>-<sequence>'"""
+    try:
+        ms, seq = event_id.split("-")
+        return int(ms), int(seq)
+    except (AttributeError, ValueError):
+        return 0, 0
+
+
+class ClientQueue:
+    """The events waiting to be sent to one connection. A slow client can't make this grow without limit:
+    - an event replaces one of the same sort that hasn't been sent yet, e.g. only the latest unread notification
+      count matters, and a conversation only needs refreshing once
+    - if there are still QUEUE_SIZE events waiting, the oldest is dropped"""
+
+    def __init__(self, maxsize: int = QUEUE_SIZE):
+        self.maxsize = maxsize
+        self.pending = {}  # coalesce key -> (event id, kind, data), oldest first
+        self.ready = asyncio.Event()
+        self.last_id = (0, 0)  # the newest event queued, so events are not sent twice
+        self.dropped = 0
+
+    def put(self, event_id: str, kind: str, data: str):
+        parsed = parse_event_id(event_id)
+        if parsed <= self.last_id:
+            return
+        self.last_id = parsed
+        key = kind if kind == "notifications" else f"{kind}:{data}"
+        self.pending.pop(key, None)
+        if len(self.pending) >= self.maxsize:
+            del self.pending[next(iter(self.pending))]
+            self.dropped += 1
+        self.pending[key] = (event_id, kind, data)
+        self.ready.set()
+
+    def replay(self, last_event_id: str, events: list):
+        """Queue events from the stream that came after last_event_id, ahead of any live ones that arrived meanwhile"""
+        live = sorted(self.pending.values(), key=lambda event: parse_event_id(event[0]))
+        self.pending = {}
+        self.last_id = parse_event_id(last_event_id)
+        for event_id, kind, data in events + live:
+            self.put(event_id, kind, data)
+
+    async def get(self, timeout: float):
+        """The next (event id, data) to send. Raises asyncio.TimeoutError if there is nothing for `timeout` seconds."""
+        if not self.pending:
+            self.ready.clear()
+            await asyncio.wait_for(self.ready.wait(), timeout=timeout)
+        event_id, kind, data = self.pending.pop(next(iter(self.pending)))
+        return event_id, data
+
+
+class PubSubShard:
+    """One redis connection subscribed to the channels of the users connected to this process that hash to it. Only
+    the events for those users are sent to this process, so more processes can be added behind a load balancer."""
+
+    def __init__(self):
+        self.pubsub = r.pubsub()
+        self.channels = set()
+        self.lock = asyncio.Lock()
+
+    async def sync(self, user_id: str):
+        """Subscribe to or unsubscribe from a user's channel, depending on whether they are connected"""
+        channel = CHANNEL.format(user_id)
+        async with self.lock:
+            wanted = bool(connected_clients.get(user_id))
+            if wanted and channel not in self.channels:
+                await self.pubsub.subscribe(channel)
+                self.channels.add(channel)
+            elif not wanted and channel in self.channels:
+                await self.pubsub.unsubscribe(channel)
+                self.channels.discard(channel)
+
+    async def listen(self):
+        # so that listen() always has something to wait on, even when nobody is connected
+        await self.pubsub.subscribe(KEEPALIVE_CHANNEL)
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] == "message" and message["channel"] != KEEPALIVE_CHANNEL:
+                        dispatch(message["channel"], message["data"])
+            except redis.ConnectionError as e:
+                logger.error(f"Redis connection error: {e}")
+                await asyncio.sleep(5)  # the channels are subscribed to again when it reconnects
+            except Exception as e:
+                logger.error(f"Unexpected error in SSE listener: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
+
+def shard_for(user_id: str) -> PubSubShard:
+    return shards[int(user_id) % len(shards)]
+
+
+def dispatch(channel: str, message: str):
+    _, user_id = channel.split(":", 1)
+    logger.debug(f"Received Redis notification for user {user_id}")
+    try:
+        event = json.loads(message)
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse SSE event JSON: {e}")
+        return
+    for client in connected_clients.get(user_id, ()):
+        client.put(event["id"], event["kind"], event["data"])
+
+
 @app.get("/notifications/stream")
-async def notifications_stream(user_id: str):
-    if not user_id:
-        return {"error": "Missing user_id"}, 400
+async def notifications_stream(request: Request, user_id: str, last_event_id: str = ""):
+    if not user_id or not user_id.isdigit():
+        return JSONResponse({"error": "Missing user_id"}, status_code=400)
+    # browsers send Last-Event-ID when they reconnect by themselves, notifs.js passes it in the url when it reconnects
+    last_event_id = request.headers.get("last-event-id") or last_event_id
 
     logger.debug(f"New SSE connection for user {user_id}")
-    q = asyncio.Queue()
-    connected_clients.setdefault(user_id, set()).add(q)
+    client = ClientQueue()
+    connected_clients.setdefault(user_id, set()).add(client)
+    await shard_for(user_id).sync(user_id)
     logger.debug(
         f"Total connections for user {user_id}: {len(connected_clients[user_id])}"
     )
 
+    if last_event_id:
+        # subscribed first, so that nothing published while this is read is missed
+        try:
+            missed = await r.xrevrange(STREAM_KEY.format(user_id), max="+", min="(" + last_event_id, count=QUEUE_SIZE)
+            client.replay(last_event_id, [(event_id, fields["kind"], fields["data"])
+                                          for event_id, fields in reversed(missed)])
+        except redis.ResponseError:  # not a valid stream id
+            pass
+
     async def event_stream():
         try:
             logger.debug(f"Starting event stream for user {user_id}")
@@ -62,35 +210,32 @@ async def notifications_stream(user_id: str):
 
             while True:
                 try:
-                    # Monitor the queue for 60 seconds
-                    message = await asyncio.wait_for(q.get(), timeout=60.0)
+                    event_id, message = await client.get(timeout=HEARTBEAT_SECONDS)
                     logger.debug(f"Sending message to user {user_id}: {message}")
-                    yield f"data: {message}\n\n"
-                except asyncio.TimeoutError:  # the queue has had nothing in it for 60 seconds so send a heartbeat to keep the connection alive
+                    yield f"id: {event_id}\ndata: {message}\n\n"
+                except asyncio.TimeoutError:  # nothing to send for a while so send a heartbeat to keep the connection alive
                     logger.debug(f"Sending heartbeat to user {user_id}")
                     yield ": heartbeat\n\n"
-                except Exception as e:
-                    logger.error(f"Error getting message for user {user_id}: {e}")
-                    break
         except (asyncio.CancelledError, GeneratorExit) as e:
             logger.debug(
                 f"SSE connection cancelled for user {user_id}: {type(e).__name__}: {e}"
             )
         except Exception as e:
-            # Log unexpected errors but don't break the connection
             logger.error(
                 f"SSE unexpected error for user {user_id}: {type(e).__name__}: {e}",
                 exc_info=True,
             )
         finally:
             logger.debug(f"Cleaning up SSE connection for user {user_id}")
-            # Clean up the queue from connected clients
+            if client.dropped:
+                logger.debug(f"Dropped {client.dropped} events for slow client of user {user_id}")
             if user_id in connected_clients:
-                connected_clients[user_id].discard(q)
+                connected_clients[user_id].discard(client)
                 # Remove user entry if no more connections
                 if not connected_clients[user_id]:
                     del connected_clients[user_id]
                     logger.debug(f"Removed user {user_id} from connected_clients")
+            asyncio.create_task(shard_for(user_id).sync(user_id))
 
     return StreamingResponse(
         event_stream(),
@@ -103,102 +248,121 @@ async def notifications_stream(user_id: str):
     )
 
 
-async def send_http_posts(all_urls: List, all_headers: List, data_json: str):
-    """Send HTTP POST requests to multiple URLs concurrently with connection limits"""
+async def send_http_posts(all_urls: List, all_headers: List, data_json: str, actor: str = None, retry: bool = False):
+    """Send HTTP POST requests to multiple URLs concurrently, at most DELIVERY_CONCURRENCY at once and HOST_CONCURRENCY
+    to any one host, and report how they went"""
     if not http_client:
         logger.error("HTTP client not initialized")
         return
 
-    async def post_to_url(url, headers):
-        try:
-            logger.debug(f"Sending POST to {url}")
-            response = await http_client.post(
-                url, headers=headers, data=data_json.encode("utf8"), timeout=10.0
-            )
-            if response.status_code >= 400:
-                logger.warning(
-                    f"HTTP POST to {url} failed with status {response.status_code} - {response.content!r}"
+    hosts = [urlparse(url).hostname for url in all_urls]
+    # don't use up connections on hosts that the Flask app's circuit breaker has given up on for now
+    pipe = r.pipeline(transaction=False)
+    for host in hosts:
+        pipe.exists(f"circuit_open:{host}")
+    circuit_open = await pipe.execute()
+
+    async def post_to_url(url, headers, host, skip):
+        if skip:
+            logger.debug(f"Not sending POST to {url}, {host} is failing")
+            return "circuit open"
+        async with delivery_slots, host_slots[host]:
+            try:
+                logger.debug(f"Sending POST to {url}")
+                response = await http_client.post(
+                    url, headers=headers, data=data_json.encode("utf8"), timeout=10.0
                 )
-            else:
-                logger.debug(f"HTTP POST to {url} succeeded")
-            return url, response.status_code
-        except httpx.TimeoutError:
-            logger.warning(f"HTTP POST to {url} timed out")
-            return url, "timeout"
-        except Exception as e:
-            logger.error(f"HTTP POST to {url} failed: {e}")
-            return url, f"error: {e}"
-
-    # Process URLs in batches to respect connection limits
-    results = []
-    for i in range(0, len(all_urls), 100):
-        url_batch = all_urls[i : i + 100]
-        header_batch = all_headers[i : i + 100]
-        batch_results = await asyncio.gather(
-            *[post_to_url(url, header) for url, header in zip(url_batch, header_batch)],
-            return_exceptions=True,
-        )
-        results.extend(batch_results)
-
+                if response.status_code >= 400:
+                    logger.warning(
+                        f"HTTP POST to {url} failed with status {response.status_code} - {response.content!r}"
+                    )
+                else:
+                    logger.debug(f"HTTP POST to {url} succeeded")
+                return response.status_code
+            except httpx.TimeoutException:
+                logger.warning(f"HTTP POST to {url} timed out")
+                return "timeout"
+            except Exception as e:
+                logger.error(f"HTTP POST to {url} failed: {e}")
+                return "error"
+
+    outcomes = await asyncio.gather(
+        *[post_to_url(url, headers, host, skip)
+          for url, headers, host, skip in zip(all_urls, all_headers, hosts, circuit_open)]
+    )
+    await record_outcomes(all_urls, hosts, outcomes, data_json, actor, retry)
     logger.info(f"Completed HTTP POST requests to {len(all_urls)} URLs")
-    return results
+    return list(zip(all_urls, outcomes))
+
+
+async def record_outcomes(urls: List, hosts: List, outcomes: List, data_json: str, actor: str, retry: bool):
+    """Tell the Flask app which hosts are working and which aren't, and hand back deliveries to be retried. Its
+    send-queue cron picks these up - see record_delivery_results() in app/shared/delivery.py."""
+    pipe = r.pipeline(transaction=False)
+    retries = 0
+    for url, host, outcome in zip(urls, hosts, outcomes):
+        if outcome in DELIVERED:
+            pipe.sadd(OK_KEY, host)
+            continue
+        if outcome in GONE:
+            pipe.sadd(GONE_KEY, host)
+            continue
+        if outcome != "circuit open":
+            pipe.hincrby(FAILED_KEY, host, 1)
+        retryable = outcome in ("timeout", "circuit open") or (isinstance(outcome, int) and (outcome == 429 or outcome >= 500))
+        if retry and actor and retryable:
+            pipe.rpush(RETRY_KEY, json.dumps({"url": url, "actor": actor, "data": data_json, "reason": f"{outcome}: {url}"}))
+            retries += 1
+    if retries:
+        pipe.ltrim(RETRY_KEY, -MAX_RETRIES_KEPT, -1)
+    try:
+        await pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"Failed to record delivery results: {e}")
+
+
+async def send_batch(message: str):
+    try:
+        message_data = json.loads(message)
+        urls = message_data.get("urls", [])
+        headers = message_data.get("headers", [])
+        # Data is already a JSON string from the sender
+        post_data_json = message_data.get("data", "{}")
+
+        if not urls:
+            logger.warning("HTTP POST message missing URLs")
+            return
 
+        await send_http_posts(urls, headers, post_data_json, message_data.get("actor"), message_data.get("retry", False))
 
-async def redis_listener():
+    except json.JSONDecodeError as e:
+        logger.error(f"Failed to parse HTTP POST message JSON: {e}")
+    except Exception as e:
+        logger.error(f"Failed to process HTTP POST message: {e}", exc_info=True)
+
+
+async def delivery_worker():
+    """Take batches of deliveries off the queue, BATCHES_IN_FLIGHT at a time. When that many are being sent the rest wait
+    in redis, for this process or another one to take."""
+    batches = asyncio.Semaphore(BATCHES_IN_FLIGHT)
     while True:
         try:
-            logger.info("Starting Redis listener")
-            pubsub = r.pubsub()
-            await pubsub.psubscribe("notifications:*", "http_posts:*", "messages:*")
-
-            async for message in pubsub.listen():
-                if message["type"] == "pmessage":
-                    channel = message["channel"]
-                    data = message["data"]
-
-                    if channel.startswith("notifications:") or channel.startswith(
-                        "messages:"
-                    ):
-                        # Handle SSE notification messages
-                        _, user_id = channel.split(":", 1)
-                        logger.debug(f"Received Redis notification for user {user_id}")
-                        for q in connected_clients.get(user_id, []):
-                            try:
-                                await q.put(data)
-                            except Exception as e:
-                                logger.error(
-                                    f"Failed to queue message for user {user_id}: {e}"
-                                )
-
-                    elif channel.startswith("http_posts:"):
-                        # Handle HTTP POST messages
-                        logger.debug(f"Received Redis HTTP POST message on {channel}")
-                        try:
-                            message_data = json.loads(data)
-                            urls = message_data.get("urls", [])
-                            headers = message_data.get("headers", [])
-                            # Data is already a JSON string from the sender
-                            post_data_json = message_data.get("data", "{}")
-
-                            if not urls:
-                                logger.warning("HTTP POST message missing URLs")
-                                continue
-
-                            # Send HTTP POST requests asynchronously
-                            asyncio.create_task(
-                                send_http_posts(urls, headers, post_data_json)
-                            )
-
-                        except json.JSONDecodeError as e:
-                            logger.error(f"Failed to parse HTTP POST message JSON: {e}")
-                        except Exception as e:
-                            logger.error(f"Failed to process HTTP POST message: {e}")
-
+            logger.info("Starting delivery worker")
+            while True:
+                await batches.acquire()
+                try:
+                    _, message = await r.blpop(DELIVERY_QUEUE, timeout=0)
+                except BaseException:
+                    batches.release()
+                    raise
+                logger.debug(f"Received delivery batch from {DELIVERY_QUEUE}")
+                task = asyncio.create_task(send_batch(message))
+                task.add_done_callback(lambda _: batches.release())
         except redis.ConnectionError as e:
             logger.error(f"Redis connection error: {e}")
             await asyncio.sleep(5)  # Wait before reconnecting
         except Exception as e:
-            logger.error(f"Unexpected error in Redis listener: {e}", exc_info=True)
+            logger.error(f"Unexpected error in delivery worker: {e}", exc_info=True)
             await asyncio.sleep(5)
 
 
@@ -214,6 +378,7 @@ async def health_check():
             "active_connections": sum(
                 len(conns) for conns in connected_clients.values()
             ),
+            "deliveries_queued": await r.llen(DELIVERY_QUEUE),
         }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
@@ -224,11 +389,15 @@ async def health_check():
 async def startup_event():
     global http_client
     # Initialize HTTP client with connection limits
-    limits = httpx.Limits(max_keepalive_connections=200, max_connections=200)
+    limits = httpx.Limits(max_keepalive_connections=DELIVERY_CONCURRENCY, max_connections=DELIVERY_CONCURRENCY)
     http_client = httpx.AsyncClient(limits=limits, http2=True)
-    logger.info("HTTP client initialized with 200 connection limit")
+    logger.info(f"HTTP client initialized with {DELIVERY_CONCURRENCY} connection limit")
 
-    asyncio.create_task(redis_listener())
+    asyncio.create_task(delivery_worker())
+    for _ in range(PUBSUB_SHARDS):
+        shard = PubSubShard()
+        shards.append(shard)
+        asyncio.create_task(shard.listen())
 
 
 @app.on_event("shutdown")
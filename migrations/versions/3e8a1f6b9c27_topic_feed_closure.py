@@ -0,0 +1,54 @@
+"""topic and feed closure tables
+
+Revision ID: 3e8a1f6b9c27
+Revises: 7c2d5e9a41b3
+Create Date: 2026-10-18 22:41:09.518304
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+# revision identifiers, used by Alembic.
+revision = '3e8a1f6b9c27'
+down_revision = '7c2d5e9a41b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table, parent in (('topic', 'parent_id'), ('feed', 'parent_feed_id')):
+        op.create_table(f'{table}_closure',
+        sa.Column('ancestor_id', sa.Integer(), nullable=False),
+        sa.Column('descendant_id', sa.Integer(), nullable=False),
+        sa.Column('depth', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['ancestor_id'], [f'{table}.id'], ),
+        sa.ForeignKeyConstraint(['descendant_id'], [f'{table}.id'], ),
+        sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+        )
+        with op.batch_alter_table(f'{table}_closure', schema=None) as batch_op:
+            batch_op.create_index(batch_op.f(f'ix_{table}_closure_descendant_id'), ['descendant_id'], unique=False)
+
+        # depth < 50 stops a loop in the existing parents from running forever
+        conn = op.get_bind()
+        conn.execute(text(f"""
+            INSERT INTO "{table}_closure" (ancestor_id, descendant_id, depth)
+            WITH RECURSIVE tree (ancestor_id, descendant_id, depth) AS (
+                SELECT id, id, 0 FROM "{table}"
+                UNION ALL
+                SELECT tree.ancestor_id, child.id, tree.depth + 1
+                FROM tree JOIN "{table}" AS child ON child.{parent} = tree.descendant_id
+                WHERE tree.depth < 50
+            )
+            SELECT DISTINCT ON (ancestor_id, descendant_id) ancestor_id, descendant_id, depth FROM tree
+            ORDER BY ancestor_id, descendant_id, depth
+        """))
+
+
+def downgrade():
+    for table in ('feed', 'topic'):
+        with op.batch_alter_table(f'{table}_closure', schema=None) as batch_op:
+            batch_op.drop_index(batch_op.f(f'ix_{table}_closure_descendant_id'))
+
+        op.drop_table(f'{table}_closure')
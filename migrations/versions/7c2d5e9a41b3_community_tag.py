@@ -0,0 +1,105 @@
+"""community tag counts
+
+Revision ID: 7c2d5e9a41b3
+Revises: d9f3b6c2e817
+Create Date: 2026-10-18 21:04:17.392816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.sql import text
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2d5e9a41b3'
+down_revision = 'd9f3b6c2e817'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('community_tag',
+    sa.Column('community_id', sa.Integer(), nullable=False),
+    sa.Column('tag_id', sa.Integer(), nullable=False),
+    sa.Column('post_count', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['community_id'], ['community.id'], ),
+    sa.ForeignKeyConstraint(['tag_id'], ['tag.id'], ),
+    sa.PrimaryKeyConstraint('community_id', 'tag_id')
+    )
+    with op.batch_alter_table('community_tag', schema=None) as batch_op:
+        batch_op.create_index('ix_community_tag_community_count', ['community_id', 'post_count'], unique=False)
+
+    conn = op.get_bind()
+    # tag.post_count counts every post with the tag, community_tag.post_count only the undeleted ones in the community
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION post_tag_counts() RETURNS trigger AS $$
+        DECLARE
+            p RECORD;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE "tag" SET post_count = COALESCE(post_count, 0) + 1 WHERE id = NEW.tag_id;
+                SELECT community_id, deleted INTO p FROM "post" WHERE id = NEW.post_id;
+                IF FOUND AND p.deleted IS NOT TRUE THEN
+                    INSERT INTO "community_tag" (community_id, tag_id, post_count) VALUES (p.community_id, NEW.tag_id, 1)
+                    ON CONFLICT (community_id, tag_id) DO UPDATE SET post_count = community_tag.post_count + 1;
+                END IF;
+                RETURN NEW;
+            END IF;
+            UPDATE "tag" SET post_count = GREATEST(COALESCE(post_count, 0) - 1, 0) WHERE id = OLD.tag_id;
+            SELECT community_id, deleted INTO p FROM "post" WHERE id = OLD.post_id;
+            IF FOUND AND p.deleted IS NOT TRUE THEN
+                UPDATE "community_tag" SET post_count = post_count - 1
+                WHERE community_id = p.community_id AND tag_id = OLD.tag_id;
+            END IF;
+            RETURN OLD;
+        END
+        $$ LANGUAGE plpgsql;
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER post_tag_counts_trigger AFTER INSERT OR DELETE ON "post_tag"
+        FOR EACH ROW EXECUTE FUNCTION post_tag_counts();
+    """))
+    # deleting, restoring or moving a post moves the counts of all its tags
+    conn.execute(text("""
+        CREATE OR REPLACE FUNCTION post_tag_counts_moved() RETURNS trigger AS $$
+        BEGIN
+            IF OLD.deleted IS NOT TRUE THEN
+                UPDATE "community_tag" AS ct SET post_count = ct.post_count - 1 FROM "post_tag" AS pt
+                WHERE pt.post_id = OLD.id AND ct.tag_id = pt.tag_id AND ct.community_id = OLD.community_id;
+            END IF;
+            IF NEW.deleted IS NOT TRUE THEN
+                INSERT INTO "community_tag" (community_id, tag_id, post_count)
+                SELECT NEW.community_id, pt.tag_id, 1 FROM "post_tag" AS pt WHERE pt.post_id = NEW.id
+                ON CONFLICT (community_id, tag_id) DO UPDATE SET post_count = community_tag.post_count + 1;
+            END IF;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql;
+    """))
+    conn.execute(text("""
+        CREATE TRIGGER post_tag_counts_moved_trigger AFTER UPDATE OF deleted, community_id ON "post"
+        FOR EACH ROW WHEN (OLD.deleted IS DISTINCT FROM NEW.deleted OR OLD.community_id IS DISTINCT FROM NEW.community_id)
+        EXECUTE FUNCTION post_tag_counts_moved();
+    """))
+
+    conn.execute(text("""
+        INSERT INTO "community_tag" (community_id, tag_id, post_count)
+        SELECT p.community_id, pt.tag_id, COUNT(*) FROM "post_tag" AS pt JOIN "post" AS p ON p.id = pt.post_id
+        WHERE p.deleted IS NOT TRUE
+        GROUP BY p.community_id, pt.tag_id
+    """))
+    conn.execute(text("""
+        UPDATE "tag" SET post_count = (SELECT COUNT(*) FROM "post_tag" WHERE post_tag.tag_id = tag.id)
+    """))
+
+
+def downgrade():
+    conn = op.get_bind()
+    conn.execute(text('DROP TRIGGER IF EXISTS post_tag_counts_moved_trigger ON "post"'))
+    conn.execute(text('DROP TRIGGER IF EXISTS post_tag_counts_trigger ON "post_tag"'))
+    conn.execute(text('DROP FUNCTION IF EXISTS post_tag_counts_moved()'))
+    conn.execute(text('DROP FUNCTION IF EXISTS post_tag_counts()'))
+    with op.batch_alter_table('community_tag', schema=None) as batch_op:
+        batch_op.drop_index('ix_community_tag_community_count')
+
+    op.drop_table('community_tag')
@@ -0,0 +1,28 @@
+"""file state
+
+Revision ID: b5f04c7d2e19
+Revises: 3e8a1f6b9c27
+Create Date: 2026-10-18 23:37:52.104685
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5f04c7d2e19'
+down_revision = '3e8a1f6b9c27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('state', sa.SmallInteger(), server_default='0', nullable=True))
+        batch_op.create_index(batch_op.f('ix_file_source_url'), ['source_url'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('file', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_file_source_url'))
+        batch_op.drop_column('state')
@@ -4,6 +4,9 @@ Shared pytest fixtures for all test files
 
 import pytest
 import os
+from unittest.mock import patch
+
+import fakeredis
 
 
 class TestConfig:
@@ -64,3 +67,21 @@ def app(test_app):
 def client(test_app):
     """Create test client"""
     return test_app.test_client()
+
+
+@pytest.fixture
+def fake_redis_server():
+    """An empty in-memory redis server, for tests that need more than one client of it"""
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def fake_redis(request, fake_redis_server):
+    """app.redis_client replaced by a client of fake_redis_server. unittest test cases that use this fixture (with
+    @pytest.mark.usefixtures) get the client as self.redis."""
+    client = fakeredis.FakeRedis(server=fake_redis_server, decode_responses=True)
+    if request.instance is not None:
+        request.instance.redis = client
+        request.instance.redis_server = fake_redis_server
+    with patch("app.redis_client", client, create=True):
+        yield client
@@ -0,0 +1,40 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from flask import Flask
+
+from app.shared import activity_batch
+
+
+class TestQueueBatchedActivity(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(ACTIVITY_BATCH_MAX_AGE=20, ACTIVITY_BATCH_MAX_SIZE=3)
+        self.redis = MagicMock()
+        self.session = MagicMock()
+
+    def queue(self, pending, newly_scheduled):
+        self.redis.pipeline.return_value.execute.return_value = [pending, newly_scheduled]
+        with self.app.app_context(), patch('app.redis_client', self.redis), \
+                patch.object(activity_batch, 'flush_instance_batch') as flush:
+            activity_batch.queue_batched_activity(self.session, 5, 7, {'type': 'Like'})
+        self.session.commit.assert_called()
+        return flush
+
+    def test_first_activity_opens_a_window(self):
+        flush = self.queue(pending=1, newly_scheduled=1)
+        flush.apply_async.assert_called_once_with(args=[5], countdown=20)
+        flush.delay.assert_not_called()
+
+    def test_window_already_open(self):
+        flush = self.queue(pending=2, newly_scheduled=0)
+        flush.apply_async.assert_not_called()
+        flush.delay.assert_not_called()
+
+    def test_full_batch_is_sent_straight_away(self):
+        flush = self.queue(pending=3, newly_scheduled=0)
+        flush.delay.assert_called_once_with(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
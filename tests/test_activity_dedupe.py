@@ -0,0 +1,67 @@
+import unittest
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+
+from app.shared import activity_dedupe
+
+ACTIVITY = 'https://a.example/activities/1'
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestActivityDedupe(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(ACTIVITY_DEDUPE_HOURS=6, ACTIVITY_DEDUPE_PER_HOUR=1000)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def claim_expired(self):
+        self.redis.delete(activity_dedupe.CLAIM_KEY.format(ACTIVITY))
+
+    def test_concurrent_delivery_is_duplicate(self):
+        self.assertFalse(activity_dedupe.is_duplicate(ACTIVITY))
+        self.assertTrue(activity_dedupe.is_duplicate(ACTIVITY))
+        self.assertFalse(activity_dedupe.is_duplicate('https://a.example/activities/2'))
+
+    def test_remembered_after_claim_expires(self):
+        activity_dedupe.is_duplicate(ACTIVITY)
+        activity_dedupe.remember_activity(ACTIVITY)
+        self.claim_expired()
+        self.assertTrue(activity_dedupe.is_duplicate(ACTIVITY))
+        [seen_key] = self.redis.keys('activity_seen:*')
+        self.assertEqual(self.redis.ttl(seen_key), 7 * 3600)
+
+        # an hour later it is still found, in the previous hour's filter
+        with patch.object(activity_dedupe.time, 'time', return_value=activity_dedupe.time.time() + 3600):
+            self.claim_expired()
+            self.assertTrue(activity_dedupe.is_duplicate(ACTIVITY))
+
+    def test_released_activity_can_be_retried(self):
+        activity_dedupe.is_duplicate(ACTIVITY)
+        activity_dedupe.release_activity(ACTIVITY)
+        self.assertFalse(activity_dedupe.is_duplicate(ACTIVITY))
+
+    def test_filter_disabled(self):
+        self.app.config['ACTIVITY_DEDUPE_HOURS'] = 0
+        activity_dedupe.is_duplicate(ACTIVITY)
+        activity_dedupe.remember_activity(ACTIVITY)
+        self.claim_expired()
+        self.assertFalse(activity_dedupe.is_duplicate(ACTIVITY))
+        self.assertEqual(self.redis.keys('activity_seen:*'), [])
+
+    def test_filter_size(self):
+        bits, hashes = activity_dedupe.filter_size(200000)
+        self.assertEqual(hashes, 13)
+        self.assertLess(bits / 8, 500 * 1024)
+        positions = activity_dedupe.bit_positions(ACTIVITY, bits, hashes)
+        self.assertEqual(len(set(positions)), hashes)
+        self.assertTrue(all(0 <= position < bits for position in positions))
+
+
+if __name__ == '__main__':
+    unittest.main()
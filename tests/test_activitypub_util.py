@@ -294,3 +294,50 @@ def test_signed_request_async(app):
             print(f"Signature verification failed: {e}")
 
         assert signature_valid, "Generated signature should be valid"
+
+
+def test_signed_requests_many_inboxes(app):
+    """signed_requests should give each inbox its own valid signature over a shared body and digest"""
+    from urllib.parse import urlparse
+
+    with app.app_context():
+        private_key, public_key = RsaKeys.generate_keypair()
+        test_body = {
+            "type": "Announce",
+            "id": "https://example.com/activities/announce/1",
+            "actor": "https://example.com/c/test",
+            "object": {"type": "Like", "object": "https://example.com/post/1"},
+        }
+        test_key_id = "https://example.com/c/test#main-key"
+        inboxes = ["https://one.example/inbox", "https://two.example/site_inbox"]
+
+        results = HttpSignature.signed_requests(inboxes, test_body, private_key, test_key_id)
+
+        assert [result[0] for result in results] == inboxes
+        assert results[0][2] == results[1][2]
+        for uri, headers, body_bytes in results:
+            assert headers["Digest"] == HttpSignature.calculate_digest(body_bytes)
+            details = HttpSignature.parse_signature(headers["Signature"])
+            signed_string = "\n".join([
+                f"(request-target): post {urlparse(uri).path}",
+                f"host: {headers['Host']}",
+                f"date: {headers['Date']}",
+                f"digest: {headers['Digest']}",
+                f"content-type: {headers['Content-Type']}",
+            ])
+            HttpSignature.verify_signature(details["signature"], signed_string, public_key)
+
+
+def test_key_cache_is_lru():
+    from app.activitypub.signature import KeyCache
+
+    loads = []
+    key_cache = KeyCache(lambda pem: loads.append(pem) or pem.upper(), max_size=2)
+    key_cache.get("a")
+    key_cache.get("b")
+    key_cache.get("a")  # a is now the most recently used
+    key_cache.get("c")  # so b gets evicted
+    assert key_cache.get("a") == "A"
+    key_cache.get("b")
+    assert loads == ["a", "b", "c", "b"]
+    assert len(key_cache) == 2
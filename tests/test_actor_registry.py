@@ -0,0 +1,133 @@
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import httpx
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine, select
+
+from app.activitypub import actor as actor_module
+from app.models import ActorUrl, _register_actor_url, _unregister_actor_url
+from app.remote_fetch import RemoteUnavailable
+
+
+class Community(SimpleNamespace):
+    pass
+
+
+class TestActorUrlRegistry(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        ActorUrl.__table__.create(self.engine)
+
+    def registered(self):
+        with self.engine.connect() as connection:
+            return connection.execute(select(ActorUrl.__table__)).all()
+
+    def test_register_and_unregister(self):
+        community = Community(id=12, ap_profile_id='https://lemmy.example/c/cats')
+        with self.engine.begin() as connection:
+            _register_actor_url(None, connection, community)
+            _register_actor_url(None, connection, community)     # registering again replaces the entry
+        self.assertEqual(self.registered(), [('https://lemmy.example/c/cats', 'Community', 12)])
+
+        with self.engine.begin() as connection:
+            _unregister_actor_url(None, connection, community)
+        self.assertEqual(self.registered(), [])
+
+    def test_actor_without_url_is_ignored(self):
+        with self.engine.begin() as connection:
+            _register_actor_url(None, connection, Community(id=3, ap_profile_id=None))
+        self.assertEqual(self.registered(), [])
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestNegativeCache(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(ACTOR_NEGATIVE_CACHE_TTL=60, ACTOR_NEGATIVE_CACHE_SIZE=2)
+
+    def test_remembers_failures_until_they_expire(self):
+        with self.app.app_context():
+            self.assertFalse(actor_module.actor_recently_unresolvable('https://spam.example/u/a'))
+            actor_module.remember_unresolvable_actor('https://spam.example/u/a')
+            self.assertTrue(actor_module.actor_recently_unresolvable('https://spam.example/u/a'))
+            with patch.object(actor_module.time, 'time', return_value=time.time() + 61):
+                self.assertFalse(actor_module.actor_recently_unresolvable('https://spam.example/u/a'))
+
+    def test_is_bounded(self):
+        with self.app.app_context():
+            for name in ['a', 'b', 'c']:
+                actor_module.remember_unresolvable_actor(f'https://spam.example/u/{name}')
+            self.assertEqual(self.redis.zcard(actor_module.UNRESOLVABLE_ACTORS_KEY), 2)
+            self.assertFalse(actor_module.actor_recently_unresolvable('https://spam.example/u/a'))
+            self.assertTrue(actor_module.actor_recently_unresolvable('https://spam.example/u/c'))
+
+
+class TestDefinitiveFailures(unittest.TestCase):
+    """Only actors that definitely can't be resolved go in the negative cache"""
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def create(self, **get_request):
+        with patch.object(actor_module, 'get_request', **get_request), \
+                patch.object(actor_module, 'remember_unresolvable_actor') as remember:
+            self.assertIsNone(actor_module.create_actor_from_remote('https://lemmy.example/u/a'))
+        return remember.called
+
+    def test_gone(self):
+        self.assertTrue(self.create(return_value=httpx.Response(404)))
+        self.assertTrue(self.create(return_value=httpx.Response(410)))
+        self.assertTrue(self.create(return_value=httpx.Response(200, content=b'<html>')))
+
+    def test_not_an_actor(self):
+        with patch.object(actor_module, 'actor_json_to_model', return_value=None):
+            self.assertTrue(self.create(return_value=httpx.Response(200, json={'type': 'Note'})))
+
+    def test_temporary(self):
+        self.assertFalse(self.create(side_effect=RemoteUnavailable('lemmy.example is failing')))
+        self.assertFalse(self.create(side_effect=httpx.ConnectTimeout('timed out')))
+        self.assertFalse(self.create(return_value=httpx.Response(503)))
+        self.assertFalse(self.create(return_value=httpx.Response(429)))
+
+
+class TestRegistryMiss(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def find(self, registered, in_tables):
+        with patch.object(actor_module, 'db') as db, \
+                patch.object(actor_module, 'find_actor_in_tables', return_value=in_tables), \
+                patch('app.shared.tasks.maintenance.repair_actor_url') as repair:
+            db.session.get.side_effect = lambda model, key: registered.get(model)
+            actor = actor_module.find_registered_actor('https://lemmy.example/c/cats')
+        self.assertFalse(db.session.delete.called)
+        return actor, repair.delay.called
+
+    def test_found_in_tables(self):
+        community = Community(id=12, ap_profile_id='https://lemmy.example/c/cats')
+        self.assertEqual(self.find({}, community), (community, True))
+
+    def test_stale_entry(self):
+        entry = ActorUrl(url='https://lemmy.example/c/cats', actor_type='Community', actor_id=12)
+        self.assertEqual(self.find({ActorUrl: entry}, None), (None, True))
+
+    def test_unknown(self):
+        self.assertEqual(self.find({}, None), (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
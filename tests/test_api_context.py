@@ -0,0 +1,137 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from app.constants import SRC_API
+from app.models import CommunityMember, File, Instance, User, UserBlock
+from app.shared import api_context
+
+
+class FakeSession:
+    def __init__(self, new=(), deleted=()):
+        self.info = {}
+        self.new = list(new)
+        self.dirty = []
+        self.deleted = list(deleted)
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestApiContext(unittest.TestCase):
+    def setUp(self):
+        self.database = {'followed_community_ids': [1]}     # what build_context would find
+        self.builds = 0
+
+        def build(session, user_id):
+            self.builds += 1
+            return {'id': user_id, **self.database}
+        self.patches = [patch('app.db'),
+                        patch.object(api_context, 'build_context', side_effect=build)]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in reversed(self.patches):
+            p.stop()
+
+    def commit(self, session):
+        api_context.note_changes(session, None, None)
+        api_context.bump_changed(session)
+
+    def test_cached_until_changed(self):
+        self.assertEqual(api_context.api_context(5)['followed_community_ids'], [1])
+        self.assertEqual(api_context.api_context(5)['followed_community_ids'], [1])
+        self.assertEqual(self.builds, 1)
+
+        self.database['followed_community_ids'] = [1, 2]
+        self.commit(FakeSession(new=[CommunityMember(user_id=5, community_id=2)]))
+        self.assertEqual(api_context.api_context(5)['followed_community_ids'], [1, 2])
+        self.assertEqual(self.builds, 2)
+
+    def test_only_the_users_whose_rows_changed(self):
+        api_context.api_context(5)
+        api_context.api_context(6)
+        self.commit(FakeSession(deleted=[UserBlock(blocker_id=6, blocked_id=5)]))
+        api_context.api_context(5)
+        api_context.api_context(6)
+        self.assertEqual(self.builds, 3)
+
+    def test_change_committed_during_a_build_is_never_hidden(self):
+        session = FakeSession(new=[CommunityMember(user_id=5, community_id=2)])
+
+        def build_then_commit(_session, user_id):
+            context = {'id': user_id, 'followed_community_ids': [1]}    # read before the change was committed
+            self.database['followed_community_ids'] = [1, 2]
+            self.commit(session)
+            return context
+        with patch.object(api_context, 'build_context', side_effect=build_then_commit):
+            self.assertEqual(api_context.api_context(5)['followed_community_ids'], [1])
+        # the context built before the change was stored, but with the version from before the change
+        self.assertEqual(api_context.api_context(5)['followed_community_ids'], [1, 2])
+
+    def test_raw_sql_changes_and_rollback(self):
+        api_context.api_context(5)
+        session = FakeSession()
+        api_context.changed(session, 5)
+        api_context.forget_changed(session)
+        api_context.bump_changed(session)
+        api_context.api_context(5)
+        self.assertEqual(self.builds, 1)
+
+        api_context.changed(session, 5)
+        api_context.bump_changed(session)
+        api_context.api_context(5)
+        self.assertEqual(self.builds, 2)
+
+    def test_login_fields(self):
+        user = SimpleNamespace(__tablename__='user', id=5)
+        changes = {'banned': True}
+        state = SimpleNamespace(attrs={field: SimpleNamespace(history=SimpleNamespace(
+            has_changes=lambda field=field: field in changes)) for field in api_context.LOGIN_FIELDS})
+        session = FakeSession()
+        session.dirty = [user]
+        with patch.object(api_context, 'inspect', return_value=state):
+            api_context.note_changes(session, None, None)
+            self.assertEqual(session.info[api_context.CHANGED], {5})
+            changes.clear()
+            session.info.clear()
+            api_context.note_changes(session, None, None)
+            self.assertEqual(session.info, {})
+
+    def test_bulk_deletes(self):
+        engine = create_engine('sqlite://')
+        CommunityMember.__table__.create(engine)
+        with engine.begin() as connection:  # joined to each member, only their columns are needed
+            for table in (User.__table__, File.__table__, Instance.__table__):
+                connection.exec_driver_sql('CREATE TABLE "{}" ({})'.format(
+                    table.name, ', '.join(f'"{column.name}"' for column in table.columns)))
+        session = Session(engine)
+        session.add_all([CommunityMember(user_id=5, community_id=2), CommunityMember(user_id=6, community_id=2)])
+        session.commit()
+        api_context.api_context(5)
+        api_context.api_context(6)
+
+        import app.community  # NOQA - app.shared.community can only be imported after it
+        from app.shared import community
+        with Flask(__name__).app_context(), patch.object(community, 'db', SimpleNamespace(session=session)), \
+                patch.object(community, 'authorise_api_user', return_value=5), patch.object(community, 'task_selector'):
+            community.leave_community(2, SRC_API, 'token')
+        self.assertEqual(session.query(CommunityMember).count(), 1)
+        api_context.api_context(5)
+        api_context.api_context(6)
+        self.assertEqual(self.builds, 3)    # only the one who left
+        session.close()
+
+    def test_packed(self):
+        context = {'id': 5, 'upvoted_reply_ids': list(range(3000)), 'version': '3'}
+        packed = api_context.pack(context)
+        self.assertLess(len(packed), len(str(context)) / 2)
+        self.assertEqual(api_context.unpack(packed), context)
+
+
+if __name__ == '__main__':
+    unittest.main()
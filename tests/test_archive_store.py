@@ -0,0 +1,150 @@
+import gzip
+import os
+import random
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import orjson
+import pytest
+from flask import Flask
+
+from app import archive_store
+from app.archive_store import SegmentWriter, train_dictionary, make_locator, parse_locator, is_segment_locator, \
+    read_post, read_header, read_branch
+
+
+WORDS = 'the a of to and in is that for it on with as was this but be at by not are from have or'.split()
+
+
+def make_text(rng, length):
+    return ' '.join(rng.choice(WORDS) + str(rng.randint(0, 99)) for _ in range(length))
+
+
+def make_post(post_id, branches=3, depth=3):
+    rng = random.Random(post_id)
+
+    def reply(reply_id, parent_id, level):
+        children = []
+        if level < depth:
+            children = [reply(reply_id * 10 + i, reply_id, level + 1) for i in range(2)]
+        return {'id': reply_id, 'body': make_text(rng, 40), 'body_html': f'<p>{make_text(rng, 40)}</p>',
+                'parent_id': parent_id, 'depth': level, 'score': rng.randint(0, 50), 'deleted': False,
+                'author_name': f'user{rng.randint(1, 999)}', 'author_ap_domain': 'lemmy.example',
+                'author_ap_profile_id': f'https://lemmy.example/u/user{rng.randint(1, 999)}',
+                'author_created': '2023-06-01T00:00:00', 'author_bot': False, 'author_banned': False,
+                'replies': children}
+
+    return {'id': post_id, 'version': 1, 'body': make_text(rng, 100), 'body_html': f'<p>{make_text(rng, 100)}</p>',
+            'replies': [reply(post_id * 100 + i, None, 0) for i in range(branches)]}
+
+
+class TestArchiveStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.patcher = patch.object(archive_store, 'LOCAL_DIRECTORY', self.directory)
+        self.patcher.start()
+        archive_store.segment_dictionary.cache_clear()
+
+        self.posts = [make_post(post_id) for post_id in range(1, 21)]
+        writer = SegmentWriter(train_dictionary([orjson.dumps(post) for post in self.posts]))
+        self.locators = {post['id']: make_locator('test', *writer.add(post)) for post in self.posts}
+        archive_store.write_segment('test', writer.getvalue(), in_s3=False)
+        self.segment_size = os.path.getsize(archive_store.segment_path('test'))
+
+    def tearDown(self):
+        self.patcher.stop()
+        archive_store.segment_dictionary.cache_clear()
+
+    def test_locator(self):
+        locator = make_locator('20261018abc', 1234, 56, 789)
+        self.assertTrue(is_segment_locator(locator))
+        self.assertFalse(is_segment_locator('app/static/media/archived/post_1.json.gz'))
+        self.assertEqual(parse_locator(locator), ('20261018abc', 1234, 56, 789))
+        self.assertLessEqual(len(locator), 100)   # must fit in post.archived
+
+    def test_round_trip(self):
+        for post in self.posts:
+            restored = read_post(self.locators[post['id']])
+            self.assertEqual(restored['body'], post['body'])
+            self.assertEqual(restored['replies'], post['replies'])
+
+    def test_header_only(self):
+        header = read_header(self.locators[5])
+        self.assertEqual(header['body_html'], self.posts[4]['body_html'])
+        self.assertNotIn('replies', header)
+        self.assertEqual(len(header['branches']), 3)
+
+    def test_branch(self):
+        branch = read_branch(self.locators[7], 7011)     # a grandchild of the second top-level reply
+        self.assertEqual(branch['id'], 701)
+        self.assertIsNone(read_branch(self.locators[7], 123456))
+
+    def test_reads_are_partial(self):
+        reads = []
+        original = archive_store.read_range
+
+        def counting_read_range(segment_name, start, length):
+            reads.append(length)
+            return original(segment_name, start, length)
+
+        with patch.object(archive_store, 'read_range', counting_read_range):
+            read_branch(self.locators[3], 300)
+        self.assertLess(sum(reads), self.segment_size / 5)
+
+    def test_blanked_post_gone(self):
+        segment_name, offset, header_length, record_length = parse_locator(self.locators[5])
+        archive_store.blank_records(segment_name, [(offset, record_length)])
+        with open(archive_store.segment_path('test'), 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(data), self.segment_size)
+        self.assertEqual(data[offset:offset + record_length], bytes(record_length))
+        # nor is any of it left in the dictionary
+        dictionary = archive_store.segment_dictionary('test')
+        for text in (self.posts[4]['body'], self.posts[4]['replies'][0]['body_html']):
+            self.assertNotIn(text[:30].encode(), dictionary)
+        self.assertEqual(read_post(self.locators[6])['body'], self.posts[5]['body'])
+
+    def test_archived_reply_ids(self):
+        from app.utils import _archived_reply_ids
+        reply_ids = _archived_reply_ids(self.posts[6]['replies'])
+        self.assertEqual(len(reply_ids), 3 * 15)
+        self.assertIn(7011, reply_ids)
+
+    def test_smaller_than_gzip_per_post(self):
+        # the dictionary is stored once per segment (of up to 500 posts) so leave it out of the comparison
+        dictionary = archive_store.segment_dictionary('test')
+        gzip_total = sum(len(gzip.compress(orjson.dumps(post))) for post in self.posts)
+        self.assertLess(self.segment_size - len(dictionary), gzip_total)
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestArchivePosts(unittest.TestCase):
+    def test_posts_changed_while_the_segment_was_written(self):
+        from app import utils
+        before = {post_id: SimpleNamespace(id=post_id, archived=None, reply_count=0, image_id=None,
+                                           body=make_text(random.Random(post_id), 100), body_html='<p>body</p>')
+                  for post_id in (1, 2, 3)}
+        after = {1: before[1], 2: SimpleNamespace(**dict(vars(before[2]), body='edited')), 3: None}   # 3 was purged
+        session = MagicMock()
+        session.get.side_effect = lambda model, post_id, populate_existing=False: \
+            (after if populate_existing else before)[post_id]
+
+        def serialize(post):
+            return {'id': post.id, 'body': post.body, 'body_html': post.body_html, 'replies': []}
+        with Flask(__name__).app_context(), patch.object(utils, 'get_task_session', return_value=session), \
+                patch.object(utils, '_serialize_post_for_archive', side_effect=serialize), \
+                patch.object(utils, '_delete_archived_post_images') as delete_images, \
+                patch.object(utils, 'store_files_in_s3', return_value=False), \
+                patch.object(archive_store, 'write_segment'):
+            utils.archive_posts([1, 2, 3])
+
+        self.assertTrue(is_segment_locator(before[1].archived))
+        self.assertIsNone(before[1].body)
+        self.assertEqual((after[2].archived, after[2].body), (None, 'edited'))   # archived next time
+        delete_images.assert_called_once_with(session, before[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
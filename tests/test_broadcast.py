@@ -0,0 +1,82 @@
+import asyncio
+import time
+import unittest
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import httpx
+import pytest
+from flask import Flask
+
+from app.models import Broadcast, utcnow
+from app.shared import broadcast as broadcast_module
+
+
+class TestDeliver(unittest.TestCase):
+    def test_pooled_with_per_host_limit(self):
+        in_flight = Counter()
+        most = Counter()
+
+        async def fake_post(client, uri, headers=None, content=None):
+            host = httpx.URL(uri).host
+            in_flight[host] += 1
+            most[host] = max(most[host], in_flight[host])
+            await asyncio.sleep(0.01)
+            in_flight[host] -= 1
+            if host == 'slow.example':
+                raise httpx.ReadTimeout('slow')
+            return httpx.Response(410 if host == 'gone.example' else 202)
+
+        requests = [(f'https://busy.example/inbox/{i}', {}, b'{}') for i in range(10)] + \
+                   [('https://slow.example/inbox', {}, b'{}'), ('https://gone.example/inbox', {}, b'{}')]
+        with patch.object(httpx.AsyncClient, 'post', fake_post):
+            outcomes = asyncio.run(broadcast_module._deliver_all(requests, concurrency=20, host_concurrency=3,
+                                                                 timeout=5))
+        self.assertEqual(outcomes, [202] * 10 + ['timeout', 410])
+        self.assertEqual(most['busy.example'], 3)
+
+
+class TestRecordOutcomes(unittest.TestCase):
+    def test_counts_and_follow_up(self):
+        app = Flask(__name__)
+        session = MagicMock()
+        broadcast = Broadcast(id=4, actor='https://local.example/u/gone#main-key', private_key='KEY',
+                              payload={'type': 'Delete'}, sent=0, failed=0, retrying=0, failures={'timeout': 1})
+        instances = [SimpleNamespace(id=i, inbox=f'https://i{i}.example/inbox') for i in range(1, 6)]
+        with app.app_context(), patch.object(broadcast_module, 'local_actor_private_key', return_value=None):
+            broadcast_module.record_outcomes(session, broadcast, instances, [202, 'timeout', 410, 503, 429])
+
+        self.assertEqual((broadcast.sent, broadcast.failed, broadcast.retrying), (1, 4, 2))
+        self.assertEqual(broadcast.failures, {'timeout': 2, '410': 1, '503': 1, '429': 1})
+        retried = session.add_all.call_args[0][0]
+        self.assertEqual([row.destination for row in retried], ['https://i4.example/inbox', 'https://i5.example/inbox'])
+        self.assertEqual(retried[0].private_key, 'KEY')     # not a key the send queue could look up again
+        session.query.return_value.filter.return_value.update.assert_called_once()   # the 410 instance
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestResumeStalledBroadcasts(unittest.TestCase):
+    def test_resumed_or_abandoned(self):
+        app = Flask(__name__)
+        broadcasts = {1: Broadcast(id=1, created=utcnow(), private_key='KEY'),
+                      2: Broadcast(id=2, created=utcnow() - timedelta(days=2), private_key='KEY', sent=5, failed=1,
+                                   retrying=0, payload={'type': 'Delete'}),
+                      3: Broadcast(id=3, created=utcnow(), private_key='KEY')}
+        session = MagicMock()
+        session.query.return_value.get.side_effect = broadcasts.get
+        stalled = time.time() - broadcast_module.STALLED_AFTER - 1
+        self.redis.zadd(broadcast_module.BROADCASTS_KEY, {'1': stalled, '2': stalled, '3': time.time(), '4': stalled})
+        with app.app_context(), patch.object(broadcast_module, 'send_broadcast') as send:
+            broadcast_module.resume_stalled_broadcasts(session)
+
+        send.delay.assert_called_once_with(1)
+        self.assertIsNone(broadcasts[2].private_key)
+        self.assertIsNotNone(broadcasts[2].finished)
+        self.assertEqual(session.add.call_args[0][0].result, 'failure')
+        self.assertEqual(self.redis.zrange(broadcast_module.BROADCASTS_KEY, 0, -1), ['3', '1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
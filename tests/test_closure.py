@@ -0,0 +1,67 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, text
+
+from app import models
+from app.models import _add_to_closure, _move_in_closure, _remove_from_closure
+
+
+class TestClosureTable(unittest.TestCase):
+    """The closure table kept by the Topic and Feed listeners, on sqlite"""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        models.topic_closure.create(self.engine)
+        self.connection = self.engine.connect()
+        # 1 > 2 > 3 > 4, and 5
+        for node_id, parent_id in ((1, None), (2, 1), (3, 2), (4, 3), (5, None)):
+            _add_to_closure('topic_closure', node_id, parent_id, self.connection)
+
+    def tearDown(self):
+        self.connection.close()
+
+    def below(self, node_id):
+        return dict(self.connection.execute(text('SELECT descendant_id, depth FROM topic_closure '
+                                                 'WHERE ancestor_id = :node_id'), {'node_id': node_id}).all())
+
+    def test_add(self):
+        self.assertEqual(self.below(1), {1: 0, 2: 1, 3: 2, 4: 3})
+        self.assertEqual(self.below(3), {3: 0, 4: 1})
+        self.assertEqual(self.below(5), {5: 0})
+
+    def test_move_subtree(self):
+        _move_in_closure('topic_closure', 3, 5, self.connection)
+        self.assertEqual(self.below(1), {1: 0, 2: 1})
+        self.assertEqual(self.below(5), {5: 0, 3: 1, 4: 2})
+        self.assertEqual(self.below(3), {3: 0, 4: 1})
+
+        _move_in_closure('topic_closure', 3, None, self.connection)
+        self.assertEqual(self.below(5), {5: 0})
+        self.assertEqual(self.below(3), {3: 0, 4: 1})
+
+    def test_remove(self):
+        _remove_from_closure('topic_closure', 4, self.connection)
+        self.assertEqual(self.below(1), {1: 0, 2: 1, 3: 2})
+        self.assertEqual(self.connection.execute(text('SELECT COUNT(*) FROM topic_closure '
+                                                      'WHERE descendant_id = 4')).scalar(), 0)
+
+
+class TestHierarchyCache(unittest.TestCase):
+    def test_forgotten_once_committed(self):
+        session = SimpleNamespace(info={})
+        with patch.object(models, 'object_session', return_value=session), patch.object(models, 'cache') as cache:
+            models._feed_item_changed(None, None, object())
+            cache.delete_memoized.assert_not_called()   # still inside the flush
+            models._forget_hierarchy_communities(session)
+            self.assertEqual(cache.delete_memoized.call_count, 2)
+
+            models._feed_item_changed(None, None, object())
+            models._forget_hierarchy_changes(session)   # rolled back
+            models._forget_hierarchy_communities(session)
+            self.assertEqual(cache.delete_memoized.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask, g
+
+from app.community import backfill
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestBackfillPaging(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(REMOTE_HOST_CONCURRENCY=4)
+        self.community = MagicMock(id=3, ap_outbox_url='https://remote.example/c/cats/outbox', banned=False)
+        self.community.is_local.return_value = False
+        self.session = MagicMock()
+        self.session.query.return_value.get.return_value = self.community
+        self.pages = {
+            'https://remote.example/c/cats/outbox': {'type': 'OrderedCollection',
+                                                     'first': 'https://remote.example/c/cats/outbox?page=1'},
+            'https://remote.example/c/cats/outbox?page=1': {'orderedItems': [{}] * 20,
+                                                            'next': 'https://remote.example/c/cats/outbox?page=2'},
+            'https://remote.example/c/cats/outbox?page=2': {'orderedItems': [{}] * 20,
+                                                            'next': 'https://remote.example/c/cats/outbox?page=3'},
+        }
+
+    def next_page(self, created):
+        with self.app.app_context(), patch.object(backfill, 'remote_object_to_json', side_effect=self.pages.get) as fetch, \
+                patch.object(backfill, 'backfill_page', return_value=created) as backfill_page, \
+                patch.object(backfill, 'finish_backfill') as finish:
+            more = backfill._backfill_next_page(self.session, self.community.id)
+        return more, fetch, backfill_page, finish
+
+    def test_resumes_from_cursor_until_enough_posts(self):
+        self.redis.hsetnx(backfill.STATE_KEY.format(3), 'remaining', 30)
+
+        more, fetch, backfill_page, finish = self.next_page(created=20)
+        self.assertTrue(more)
+        self.assertEqual(backfill_page.call_args[0][3], 30)
+        self.assertEqual(self.redis.hgetall('community_backfill:3'),
+                         {'remaining': '10', 'cursor': 'https://remote.example/c/cats/outbox?page=2'})
+        finish.assert_not_called()
+
+        more, fetch, backfill_page, finish = self.next_page(created=10)
+        self.assertFalse(more)
+        fetch.assert_called_once_with('https://remote.example/c/cats/outbox?page=2')
+        self.assertEqual(backfill_page.call_args[0][3], 10)
+        self.assertFalse(self.redis.exists('community_backfill:3'))
+        finish.assert_called_once()
+
+    def test_stops_at_end_of_outbox(self):
+        self.pages['https://remote.example/c/cats/outbox?page=1'].pop('next')
+        self.redis.hsetnx(backfill.STATE_KEY.format(3), 'remaining', 500)
+        more, fetch, backfill_page, finish = self.next_page(created=20)
+        self.assertFalse(more)
+        self.assertFalse(self.redis.exists('community_backfill:3'))
+        finish.assert_called_once()
+
+    def test_finished_when_a_page_fails(self):
+        self.redis.hsetnx(backfill.STATE_KEY.format(3), 'remaining', 500)
+        with self.app.app_context(), patch.object(backfill, 'remote_object_to_json', side_effect=self.pages.get), \
+                patch.object(backfill, 'backfill_page', side_effect=RuntimeError('remote went away')), \
+                patch.object(backfill, 'finish_backfill') as finish, self.assertRaises(RuntimeError):
+            backfill._backfill_next_page(self.session, self.community.id)
+        finish.assert_called_once_with(self.session, self.community)
+        self.assertTrue(self.redis.exists('community_backfill:3'))     # so it can be carried on with
+
+    def test_paused_page_is_done_again(self):
+        self.redis.hset(backfill.STATE_KEY.format(3), mapping={'remaining': 500,
+                                                               'cursor': 'https://remote.example/c/cats/outbox?page=2'})
+        with self.app.app_context(), patch.object(backfill, 'remote_object_to_json', side_effect=self.pages.get), \
+                patch.object(backfill, 'backfill_page', side_effect=backfill.BackfillPaused()), \
+                patch.object(backfill, 'finish_backfill') as finish, self.assertRaises(backfill.BackfillPaused):
+            backfill._backfill_next_page(self.session, self.community.id)
+        finish.assert_not_called()
+        self.assertEqual(self.redis.hgetall('community_backfill:3'),
+                         {'remaining': '500', 'cursor': 'https://remote.example/c/cats/outbox?page=2'})
+
+    def test_nothing_created_when_requests_are_refused(self):
+        self.community.ap_profile_id = 'https://remote.example/c/cats'
+        items = [{'object': {'object': {'id': f'https://remote.example/post/{i}',
+                                        'attributedTo': 'https://remote.example/u/a',
+                                        'replies': f'https://remote.example/post/{i}/replies'}}} for i in range(3)]
+
+        def busy(urls):
+            g.remote_fetch_refused = True
+            return {}
+        with self.app.app_context(), patch.object(backfill, 'fetch_many', side_effect=busy), \
+                patch.object(backfill, 'resolve_users', return_value={}), \
+                patch.object(backfill, 'create_post') as create_post, self.assertRaises(backfill.BackfillPaused):
+            backfill.backfill_page(self.session, self.community, items, 10)
+        create_post.assert_not_called()
+
+    def test_nothing_to_do_without_state(self):
+        more, fetch, backfill_page, finish = self.next_page(created=0)
+        self.assertFalse(more)
+        fetch.assert_not_called()
+
+    def test_start_does_not_reset_a_backfill_in_progress(self):
+        self.redis.hset('community_backfill:3', mapping={'remaining': 7, 'cursor': 'https://remote.example/x'})
+        with self.app.app_context(), patch.object(backfill, 'backfill_community_page') as task:
+            self.assertFalse(backfill.start_backfill(3, 500))
+            task.delay.assert_called_once_with(3)
+            self.assertEqual(self.redis.hget('community_backfill:3', 'remaining'), '7')
+            self.assertTrue(backfill.start_backfill(3, 500, restart=True))
+            self.assertEqual(self.redis.hgetall('community_backfill:3'), {'remaining': '500'})
+
+
+class TestFetchMany(unittest.TestCase):
+    def test_one_concurrent_batch_per_call(self):
+        with patch.object(backfill, 'get_json_many', return_value={}) as get_json_many:
+            backfill.fetch_many(['https://remote.example/u/a', None, 'https://remote.example/u/a',
+                                 'http://insecure.example/u/b', 'https://remote.example/u/c'])
+        get_json_many.assert_called_once_with(['https://remote.example/u/a', 'https://remote.example/u/c'],
+                                              accept='application/activity+json')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+from app.shared import counters
+
+
+class FakePost:
+    """Stands in for a mapped object - set_committed_value is patched to work on plain attributes"""
+    __tablename__ = 'post'
+
+    def __init__(self, **columns):
+        self.__dict__.update(columns)
+
+
+def set_committed_value(obj, field, value):
+    obj.__dict__[field] = value
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestCounters(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(COUNTER_FLUSH_DELAY=5, COUNTER_FLUSH_BATCH=2)
+        self.patches = [patch.object(counters, 'set_committed_value', set_committed_value),
+                        patch.object(counters, 'flush_counters'),
+                        patch.object(counters, '_dirty_snapshot', (0.0, frozenset()))]
+        for p in self.patches:
+            p.start()
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        for p in reversed(self.patches):
+            p.stop()
+
+    def test_increments_are_added_up_and_one_flush_scheduled(self):
+        counters.increment(FakePost, 3, up_votes=1, score=1)
+        counters.increment(FakePost, 3, up_votes=1, score=1.5)
+        self.assertEqual(self.redis.hgetall('counters:post:3'), {'up_votes': '2', 'score': '2.5'})
+        self.assertEqual(self.redis.smembers(counters.DIRTY_KEY), {'post:3'})
+        counters.flush_counters.apply_async.assert_called_once_with(countdown=5)
+
+    def test_loaded_rows_include_unflushed_changes(self):
+        counters.increment(FakePost, 3, up_votes=1, score=1)
+        post = FakePost(id=3, up_votes=10, score=9, reply_count=4)
+        counters.merge_pending(post)
+        self.assertEqual((post.up_votes, post.score, post.reply_count), (11, 10, 4))
+
+    def test_recounted_totals_keep_unflushed_changes_in_step(self):
+        counters.increment(FakePost, 3, reply_count=2)
+        post = FakePost(id=3, reply_count=4)
+        counters.merge_pending(post)
+        counters.apply_totals(post, reply_count=5)
+        self.assertEqual(post.reply_count, 5)
+        self.assertEqual(self.redis.hget('counters:post:3', 'reply_count'), '1')    # 4 in the database + 1 = 5
+
+    def test_increment_each(self):
+        counters.increment_each(FakePost, 'reply_count', {3: -2, 4: 0, 5: -1})
+        self.assertEqual((self.redis.hget('counters:post:3', 'reply_count'), self.redis.exists('counters:post:4'),
+                          self.redis.hget('counters:post:5', 'reply_count')), ('-2', 0, '-1'))
+        self.assertEqual(self.redis.smembers(counters.DIRTY_KEY), {'post:3', 'post:5'})
+
+    def test_increment_on_commit(self):
+        session = SimpleNamespace(info={})
+        counters.increment_on_commit(session, FakePost, 'reply_count', {3: -1})
+        counters.increment_on_commit(session, FakePost, 'reply_count', {3: -1, 5: 2})
+        self.assertEqual(self.redis.keys('counters:*'), [])
+        counters.increment_committed(session)
+        self.assertEqual((self.redis.hget('counters:post:3', 'reply_count'),
+                          self.redis.hget('counters:post:5', 'reply_count')), ('-2', '2'))
+
+        counters.increment_on_commit(session, FakePost, 'reply_count', {3: 1})
+        counters.forget_uncommitted(session)     # rolled back
+        counters.increment_committed(session)
+        self.assertEqual(self.redis.hget('counters:post:3', 'reply_count'), '-2')
+
+    def test_update_statement(self):
+        sql, params = counters.update_statement('post_reply', {7: {'up_votes': '2.0', 'score': '2.0'},
+                                                                8: {'down_votes': '1.0', 'score': '-1.0'}})
+        self.assertTrue(str(sql).startswith('UPDATE "post_reply" AS t SET up_votes = COALESCE(t.up_votes, 0) + v.up_votes'))
+        self.assertIn('AS v(id, up_votes, down_votes, score) WHERE t.id = v.id', str(sql))
+        self.assertEqual(params['id1'], 8)
+        self.assertEqual((params['up_votes1'], params['down_votes1'], params['score1']), (0.0, 1.0, -1.0))
+
+    def test_failed_flush_puts_the_changes_back(self):
+        counters.increment(FakePost, 3, up_votes=1)
+        counters.touch(FakePost, 3)
+        session = MagicMock()
+        session.commit.side_effect = RuntimeError('database went away')
+        with self.assertRaises(RuntimeError):
+            counters.flush_batch(session, 10)
+        session.rollback.assert_called_once()
+        self.assertEqual(self.redis.smembers(counters.DIRTY_KEY), {'post:3'})
+        self.assertEqual(float(self.redis.hget('counters:post:3', 'up_votes')), 1)
+        self.assertTrue(self.redis.hexists('counters:post:3', 'last_active'))
+
+    def test_flush_batch(self):
+        for post_id in (1, 2, 3):
+            counters.increment(FakePost, post_id, score=1)
+        session = MagicMock()
+        with patch.object(counters, 'update_rankings') as rankings:
+            self.assertTrue(counters.flush_batch(session, 2))
+            self.assertFalse(counters.flush_batch(session, 2))
+        self.assertEqual(session.execute.call_count, 2)
+        first, second = [call.args[1] for call in rankings.call_args_list]
+        self.assertEqual((len(first), sorted(first + second)), (2, [1, 2, 3]))
+        self.assertEqual(self.redis.keys('counters:post:*'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
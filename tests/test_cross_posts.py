@@ -0,0 +1,71 @@
+import unittest
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+
+from app.constants import POST_STATUS_PUBLISHED, POST_STATUS_SCHEDULED
+from app.models import Post, cross_post_url_hash
+from app.shared import counters
+from app.utils import cross_posts_from_groups, dedupe_post_ids
+
+
+class TestCrossPostUrlHash(unittest.TestCase):
+    def test_equivalent_urls_share_a_group(self):
+        url = 'https://example.com/news/story'
+        self.assertEqual(cross_post_url_hash(url), cross_post_url_hash('http://example.com/news/story/'))
+        self.assertEqual(cross_post_url_hash(url), cross_post_url_hash(' https://example.com/news/story#comments'))
+        self.assertNotEqual(cross_post_url_hash(url), cross_post_url_hash('https://example.com/news/story?page=2'))
+
+    def test_bare_domains_are_not_grouped(self):
+        self.assertIsNone(cross_post_url_hash('https://example.com'))
+        self.assertIsNone(cross_post_url_hash('https://example.com/'))
+        self.assertIsNotNone(cross_post_url_hash('https://example.com/a'))
+
+    def test_hash_fits_column(self):
+        self.assertEqual(len(cross_post_url_hash('https://example.com/' + 'x' * 2000)), 32)
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestCrossPostGroup(unittest.TestCase):
+    def test_replies_are_counted_in_the_group(self):
+        app = Flask(__name__)
+        app.config['COUNTER_FLUSH_DELAY'] = 5
+        post = Post(id=5, reply_count=3, cross_post_group_id=7)
+        with app.app_context(), patch.object(counters, 'flush_counters'):
+            post.count_replies(-1)
+        self.assertEqual(post.reply_count, 2)
+        self.assertEqual((self.redis.hget('counters:post:5', 'reply_count'),
+                          self.redis.hget('counters:cross_post_group:7', 'reply_count')), ('-1', '-1'))
+
+    @patch('app.models.db')
+    def test_only_visible_posts_join_a_group(self, db):
+        for post in (Post(url='https://example.com/a', deleted=True, status=POST_STATUS_PUBLISHED),
+                     Post(url='https://example.com/a', deleted=False, status=POST_STATUS_SCHEDULED)):
+            post.calculate_cross_posts()
+            self.assertIsNone(post.cross_post_group_id)
+        db.session.execute.assert_not_called()
+
+
+class TestCrossPostsFromGroups(unittest.TestCase):
+    def test_group_members_become_cross_posts(self):
+        rows = [(1, None, 100, 5), (2, 7, 101, 8), (3, 7, 102, 12), (4, 9, 103, 6)]
+        self.assertEqual(cross_posts_from_groups(rows),
+                         [(1, None, 100, 5), (2, [3], 101, 8), (3, [2], 102, 12), (4, None, 103, 6)])
+
+    @patch('app.utils.low_value_reposters')
+    def test_dedupe_by_group(self, mock_low_value):
+        mock_low_value.return_value = {200}
+        rows = [
+            (1, None, 100, 5),
+            (2, 7, 101, 8),
+            (3, 7, 102, 12),   # most replies in group 7
+            (4, 7, 103, 6),
+            (5, 8, 200, 30),   # bot, so the non-bot post in group 8 is kept even though it has fewer replies
+            (6, 8, 201, 20),
+        ]
+        self.assertEqual(dedupe_post_ids(cross_posts_from_groups(rows)), [1, 3, 6])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import os
+import unittest
+from unittest.mock import MagicMock, patch
+
+import fakeredis
+import pytest
+from flask import Flask
+
+from app.shared import delivery
+
+with patch.dict(os.environ, {'CACHE_REDIS_URL': 'redis://localhost:6379/0'}):
+    import fastapi_server
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestSidecarOutcomes(unittest.TestCase):
+    def test_reported_per_host(self):
+        urls = ['https://ok.example/inbox', 'https://down.example/inbox', 'https://gone.example/inbox',
+                'https://slow.example/inbox']
+        hosts = [url.split('/')[2] for url in urls]
+        with patch.object(fastapi_server, 'r', fakeredis.FakeAsyncRedis(server=self.redis_server, decode_responses=True)):
+            asyncio.run(fastapi_server.record_outcomes(urls, hosts, [202, 502, 410, 'circuit open'], '{}',
+                                                       'https://here.example/c/a#main-key', retry=True))
+        self.assertEqual((self.redis.smembers('delivery:ok'), self.redis.smembers('delivery:gone')),
+                         ({'ok.example'}, {'gone.example'}))
+        self.assertEqual(self.redis.hgetall('delivery:failed'), {'down.example': '1'})
+        self.assertEqual([json.loads(item)['url'] for item in self.redis.lrange('delivery:retry', 0, -1)],
+                         ['https://down.example/inbox', 'https://slow.example/inbox'])
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestRecordDeliveryResults(unittest.TestCase):
+    def test_bulk_instance_health_and_retries(self):
+        self.redis.sadd('delivery:ok', 'ok.example', 'flaky.example')
+        self.redis.sadd('delivery:gone', 'gone.example')
+        self.redis.hset('delivery:failed', mapping={'flaky.example': '1', 'down.example': '3'})
+        self.redis.rpush('delivery:retry',
+                         json.dumps({'url': 'https://down.example/inbox', 'actor': 'https://here.example/c/a#main-key',
+                                     'data': '{}', 'reason': '502'}),
+                         json.dumps({'url': 'https://down.example/inbox', 'actor': 'https://remote.example/u/b#main-key',
+                                     'data': '{}', 'reason': '502'}))
+        session = MagicMock()
+        with Flask(__name__).app_context(), patch.object(delivery, 'local_actor_private_key',
+                             side_effect=lambda key_id, session: 'key' if 'here.example' in key_id else None):
+            delivery.record_delivery_results(session)
+
+        def domains(sql):
+            return [set(call.args[1]['domains']) for call in session.execute.call_args_list if sql in str(call.args[0])]
+        self.assertEqual(domains('SET failures = 0'), [{'ok.example', 'flaky.example'}])
+        self.assertEqual(domains('failures + 1'), [{'down.example'}])      # flaky.example also got through
+        self.assertEqual(domains('SET gone_forever = true'), [{'gone.example'}])
+        queued = [call.args[0] for call in session.add.call_args_list]
+        self.assertEqual([(row.destination, row.private_key) for row in queued], [('https://down.example/inbox', None)])
+        self.assertEqual(self.redis.keys('delivery:*'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+from unittest.mock import patch
+
+from app.community import util
+from app.models import CommunityTag
+
+
+class TestHashtagsUsedInCommunities(unittest.TestCase):
+    def test_reads_the_precomputed_ranking(self):
+        ranking = [{'id': 1, 'name': 'solarstorm', 'pc': 10}, {'id': 2, 'name': 'spoilers', 'pc': 4},
+                   {'id': 3, 'name': 'aurora', 'pc': 1}]
+        with patch.object(util, 'top_tags_in_communities', return_value=ranking) as top_tags:
+            tags = util.hashtags_used_in_communities([5, 3, 5], {'no spoilers': ['spoiler']})
+            self.assertIsNone(util.hashtags_used_in_communities([], None))
+        top_tags.assert_called_once_with((3, 5))    # the same cache entry however the ids are given
+        self.assertEqual([(tag['name'], tag['font_size']) for tag in tags], [('solarstorm', 24), ('aurora', 12)])
+        self.assertNotIn('font_size', ranking[0])     # the cached ranking is left alone
+
+    def test_counts_table(self):
+        self.assertEqual(CommunityTag.__tablename__, 'community_tag')
+        self.assertEqual([column.name for column in CommunityTag.__table__.primary_key], ['community_id', 'tag_id'])
+
+
+if __name__ == '__main__':
+    unittest.main()
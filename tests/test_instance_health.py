@@ -0,0 +1,94 @@
+import asyncio
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import httpx
+
+from app.shared.instance_health import ProbeTarget, probe_due, _probe_all
+
+
+def mock_client(handler):
+    def factory(concurrency, timeout, user_agent):
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return factory
+
+
+class TestProbeDue(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2026, 10, 18, 12, 0)
+
+    def instance(self, **kwargs):
+        defaults = dict(failures=0, most_recent_attempt=None, last_health_check=None, last_seen=None)
+        defaults.update(kwargs)
+        return SimpleNamespace(**defaults)
+
+    def test_never_checked(self):
+        self.assertTrue(probe_due(self.instance(), self.now))
+
+    def test_failing_instance_backs_off(self):
+        instance = self.instance(failures=3, most_recent_attempt=self.now - timedelta(hours=20))
+        self.assertFalse(probe_due(instance, self.now))     # 3 failures = 24h backoff
+        instance.most_recent_attempt = self.now - timedelta(hours=25)
+        self.assertTrue(probe_due(instance, self.now))
+
+    def test_busy_peers_are_probed_more_often(self):
+        checked = self.now - timedelta(hours=13)
+        busy = self.instance(last_health_check=checked, last_seen=self.now - timedelta(minutes=5))
+        quiet = self.instance(last_health_check=checked, last_seen=self.now - timedelta(days=10))
+        silent = self.instance(last_health_check=checked, last_seen=self.now - timedelta(days=90))
+        self.assertTrue(probe_due(busy, self.now))
+        self.assertFalse(probe_due(quiet, self.now))
+        self.assertFalse(probe_due(silent, self.now))
+
+
+class TestProbeInstances(unittest.TestCase):
+    def test_results(self):
+        def handler(request):
+            host = request.url.host
+            if host == 'good.example':
+                if request.url.path == '/.well-known/nodeinfo':
+                    return httpx.Response(200, json={'links': [
+                        {'rel': 'http://nodeinfo.diaspora.software/ns/schema/2.0',
+                         'href': 'https://good.example/nodeinfo/2.0'}]})
+                return httpx.Response(200, json={'software': {'name': 'PieFed', 'version': '1.6.0'}})
+            if host == 'gone.example':
+                return httpx.Response(410)
+            if host == 'empty.example':
+                return httpx.Response(200, json={'links': []})
+            raise httpx.ConnectError('nope', request=request)
+
+        targets = [ProbeTarget(1, 'good.example', None),
+                   ProbeTarget(2, 'gone.example', 'https://gone.example/nodeinfo/2.0'),
+                   ProbeTarget(3, 'empty.example', None),
+                   ProbeTarget(4, 'down.example', None)]
+        with patch('app.shared.instance_health._async_client', mock_client(handler)):
+            results = asyncio.run(_probe_all(targets, 2, 5, 'test'))
+
+        results = {result.instance_id: result for result in results}
+        self.assertEqual(results[1].status, 'ok')
+        self.assertEqual(results[1].software, 'piefed')
+        self.assertEqual(results[1].nodeinfo_href, 'https://good.example/nodeinfo/2.0')
+        self.assertEqual(results[2].status, 'http_error')
+        self.assertEqual(results[3].status, 'no_nodeinfo')
+        self.assertEqual(results[4].status, 'error')
+
+    def test_slow_host_does_not_block_others(self):
+        async def handler(request):
+            if request.url.host == 'slow.example':
+                await asyncio.sleep(5)
+            return httpx.Response(200, json={'software': {'name': 'lemmy', 'version': '0.19.9'}})
+
+        targets = [ProbeTarget(1, 'slow.example', 'https://slow.example/nodeinfo'),
+                   ProbeTarget(2, 'fast.example', 'https://fast.example/nodeinfo')]
+        with patch('app.shared.instance_health._async_client', mock_client(handler)):
+            results = asyncio.run(_probe_all(targets, 2, 0.1, 'test'))
+
+        results = {result.instance_id: result for result in results}
+        self.assertEqual(results[1].status, 'error')
+        self.assertEqual(results[2].status, 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+from app.shared import counters, purge
+
+
+def fake_ids(rows):
+    """A session whose id queries return rows[table] after the given cursor, like the real ones do"""
+    session = MagicMock()
+
+    def execute(statement, params=None):
+        sql = str(statement)
+        result = MagicMock()
+        table = next(table for table in rows if f'FROM "{table}"' in sql)
+        ids = [i for i in rows[table] if i > params['cursor']][:params['limit']]
+        result.scalars.return_value = ids
+        return result
+
+    session.execute.side_effect = execute
+    return session
+
+
+class TestPurgeNow(unittest.TestCase):
+    def test_each_phase_in_batches(self):
+        app = Flask(__name__)
+        app.config['PURGE_BATCH_SIZE'] = 2
+        session = fake_ids({'post_reply': [3, 5, 8], 'post': [4], 'user_file': []})
+        purged = []
+        purgers = {name: (lambda session, ids, soft, purge_cdn, name=name: purged.append((name, ids, soft)))
+                   for name in purge.PURGERS}
+        with app.app_context(), patch.dict(purge.PURGERS, purgers):
+            self.assertEqual(purge.purge_now('user', 9, soft=True, session=session), 4)
+        self.assertEqual(purged, [('replies', [3, 5], True), ('replies', [8], True), ('posts', [4], True)])
+        self.assertEqual(session.commit.call_count, 3)
+
+
+class TestPurgePosts(unittest.TestCase):
+    def run_purge(self, soft):
+        app = Flask(__name__)
+        app.config['PURGE_BATCH_SIZE'] = 100
+        session = MagicMock()
+        session.execute.return_value.scalars.return_value = []     # no comments
+        with app.app_context(), patch.object(purge, '_delete_files_from_disk', return_value=[70]), \
+                patch.object(purge, '_delete_post_media'):
+            purge.purge_posts(session, [1, 2], soft=soft)
+        return [str(call.args[0]) for call in session.execute.call_args_list]
+
+    def test_set_based(self):
+        statements = self.run_purge(soft=False)
+        deletes = [sql for sql in statements if sql.startswith('DELETE')]
+        self.assertIn('DELETE FROM "post_vote" WHERE post_id IN :ids', deletes)
+        self.assertIn('DELETE FROM "post_bookmark" WHERE post_id IN :ids', deletes)
+        self.assertLess(deletes.index('DELETE FROM "post_vote" WHERE post_id IN :ids'),
+                        deletes.index('DELETE FROM "post" WHERE id IN :ids'))
+        self.assertEqual(deletes[-1], 'DELETE FROM "file" WHERE id IN :ids')
+
+    def test_soft_keeps_posts(self):
+        statements = self.run_purge(soft=True)
+        self.assertIn('UPDATE "post" SET deleted = true, cross_post_group_id = NULL WHERE id IN :ids', statements)
+        self.assertNotIn('DELETE FROM "post" WHERE id IN :ids', statements)
+        self.assertNotIn('DELETE FROM "post_vote" WHERE post_id IN :ids', statements)
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestPurgeReplies(unittest.TestCase):
+    def test_reply_counts_are_taken_off_once_committed(self):
+        app = Flask(__name__)
+        app.config['COUNTER_FLUSH_DELAY'] = 5
+        session = MagicMock()
+        session.info = {}
+        session.execute.return_value = [(1, 7, 2), (2, None, 1)]    # (post, cross post group, live replies)
+        with app.app_context(), patch.object(purge, '_delete_files_from_disk', return_value=[]), \
+                patch.object(counters, 'flush_counters'):
+            purge.purge_replies(session, [10, 11, 12], soft=True)
+            self.assertEqual(self.redis.keys('counters:*'), [])
+            counters.increment_committed(session)
+        self.assertEqual((self.redis.hget('counters:post:1', 'reply_count'),
+                          self.redis.hget('counters:post:2', 'reply_count'),
+                          self.redis.hget('counters:cross_post_group:7', 'reply_count')), ('-2', '-1', '-2'))
+        self.assertEqual(session.info, {})
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestBackgroundPurge(unittest.TestCase):
+    def test_progress_is_saved_between_batches(self):
+        app = Flask(__name__)
+        app.config['PURGE_BATCH_SIZE'] = 2
+        session = fake_ids({'post_reply': [1, 2, 3], 'post': []})
+        with app.app_context(), patch.object(purge, 'queue_purge'), \
+                patch.dict(purge.PURGERS, {'replies': MagicMock(), 'posts': MagicMock()}), \
+                patch.object(purge, 'finish_purge') as finish:
+            purge.start_purge('community', 6, then='delete_community')
+            purge.start_purge('community', 6)   # already going, so ignored
+            self.assertTrue(purge.purge_next_batch(session, 'community', 6))
+            self.assertEqual(purge.purges_in_progress(),
+                             [{'kind': 'community', 'target_id': 6, 'done': 2, 'phase': 'replies'}])
+            while purge.purge_next_batch(session, 'community', 6):
+                pass
+            finish.assert_called_once_with(session, 6, 'delete_community')
+        self.assertEqual(self.redis.keys('*'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+import httpx
+import pytest
+import redis
+from flask import Flask
+
+from app import remote_fetch
+from app.remote_fetch import guarded_get, RemoteUnavailable
+
+
+class DownRedis:
+    def __getattr__(self, name):
+        def fail(*args, **kwargs):
+            raise redis.exceptions.ConnectionError('down')
+        return fail
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestGuardedGet(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(REMOTE_CIRCUIT_FAILURES=3, REMOTE_CIRCUIT_WINDOW=60, REMOTE_CIRCUIT_OPEN=300,
+                               REMOTE_HOST_CONCURRENCY=2, REMOTE_COALESCE_SECONDS=10)
+        self.patches = [patch.object(remote_fetch, 'host_gone_forever', return_value=False),
+                        patch.object(remote_fetch, '_record_instance_failure')]
+        for p in self.patches:
+            p.start()
+        self.calls = 0
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def with_context(self, function, *args):
+        with self.app.app_context():
+            return function(*args)
+
+    def fetch(self, status=200):
+        def fetch():
+            self.calls += 1
+            return httpx.Response(status, json={'type': 'Person'}, request=httpx.Request('GET', 'https://x'))
+        return fetch
+
+    def test_circuit_opens_after_repeated_failures(self):
+        with self.app.app_context():
+            for _ in range(3):
+                guarded_get('https://slow.example/u/a', '', 10, False, self.fetch(503))
+            with self.assertRaises(RemoteUnavailable):
+                guarded_get('https://slow.example/u/a', '', 10, False, self.fetch())
+            # other hosts are unaffected
+            self.assertEqual(guarded_get('https://fine.example/u/a', '', 10, False, self.fetch()).status_code, 200)
+        self.assertEqual(self.calls, 4)
+        remote_fetch._record_instance_failure.assert_called_once_with('slow.example')
+
+    def test_success_resets_failure_count(self):
+        with self.app.app_context():
+            for status in [503, 503, 200, 503, 503]:
+                guarded_get('https://flaky.example/u/a', '', 10, False, self.fetch(status))
+            self.assertFalse(remote_fetch.circuit_open('flaky.example'))
+
+    def test_concurrency_limit(self):
+        self.redis.set('remote_in_flight:busy.example', 2)
+        with self.app.app_context(), self.assertRaises(RemoteUnavailable):
+            guarded_get('https://busy.example/u/a', '', 10, False, self.fetch())
+        self.assertEqual(self.redis.get('remote_in_flight:busy.example'), '2')
+
+    def test_slot_expiry_is_not_pushed_back(self):
+        key = 'remote_in_flight:busy.example'
+        with self.app.app_context():
+            with remote_fetch.host_slot('busy.example'):
+                self.redis.expire(key, 5)
+                with remote_fetch.host_slot('busy.example'):
+                    self.assertEqual((self.redis.get(key), self.redis.ttl(key)), ('2', 5))
+                self.redis.delete(key)  # expired while the first request was still being made
+            self.assertFalse(self.redis.exists(key))    # and didn't go below 0 when it finished
+            with remote_fetch.host_slot('busy.example'):
+                self.assertEqual((self.redis.get(key), self.redis.ttl(key)), ('1', remote_fetch.SLOT_TTL))
+
+    def test_identical_gets_are_coalesced(self):
+        accept = 'application/activity+json'
+        with self.app.app_context():
+            first = guarded_get('https://busy.example/u/a', accept, 10, True, self.fetch())
+            second = guarded_get('https://busy.example/u/a', accept, 10, True, self.fetch())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(second.json(), first.json())
+
+    def test_concurrent_identical_gets_both_succeed(self):
+        accept = 'application/activity+json'
+        started, finish = threading.Event(), threading.Event()
+        fetch = self.fetch()
+
+        def slow_fetch():
+            started.set()
+            finish.wait(5)
+            return fetch()
+
+        responses = []
+        with self.app.app_context():
+            first = threading.Thread(target=lambda: responses.append(
+                self.with_context(guarded_get, 'https://busy.example/u/a', accept, 10, True, slow_fetch)))
+            first.start()
+            started.wait(5)
+            threading.Timer(0.2, finish.set).start()   # the second request is waiting for the first one by then
+            responses.append(guarded_get('https://busy.example/u/a', accept, 10, True, self.fetch()))
+            first.join()
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(self.calls, 1)
+
+    def test_own_fetch_if_the_shared_response_takes_too_long(self):
+        accept = 'application/activity+json'
+        self.redis.set(remote_fetch.coalesce_key('https://busy.example/u/a', accept) + ':lock', 1)
+        with self.app.app_context(), patch.object(remote_fetch, 'COALESCE_WAIT', 0.1):
+            response = guarded_get('https://busy.example/u/a', accept, 10, True, self.fetch())
+        self.assertEqual((response.status_code, self.calls), (200, 1))
+
+    def test_busy_host_is_remembered(self):
+        self.redis.set('remote_in_flight:busy.example', 2)
+        with self.app.app_context():
+            self.assertFalse(remote_fetch.fetch_refused())
+            with self.assertRaises(remote_fetch.RemoteBusy):
+                guarded_get('https://busy.example/u/a', '', 10, False, self.fetch())
+            self.assertTrue(remote_fetch.fetch_refused())
+            remote_fetch.reset_fetch_refused()
+            self.assertFalse(remote_fetch.fetch_refused())
+
+    def test_batches_stay_within_the_limits(self):
+        self.redis.set('remote_in_flight:busy.example', 1)
+        self.redis.set('circuit_open:down.example', 1)
+        urls = ['https://busy.example/u/a', 'https://busy.example/u/b', 'https://busy.example/u/c',
+                'https://down.example/u/a', 'https://slow.example/u/a']
+
+        def run_batch(batch_urls, slots, accept, timeout):
+            self.assertEqual(self.redis.get('remote_in_flight:busy.example'), '2')   # 1 free slot of 2
+            self.assertEqual({host: taken for host, taken in slots.items() if taken},
+                             {'busy.example': 1, 'slow.example': 1})
+            self.assertNotIn('https://down.example/u/a', batch_urls)
+            return {'https://busy.example/u/a': {'type': 'Person'}}, {'slow.example': 1}, {'busy.example'}
+        with self.app.app_context(), patch.object(remote_fetch, '_run_batch', side_effect=run_batch):
+            result = remote_fetch.get_json_many(urls, 'application/activity+json')
+        self.assertEqual(result, {'https://busy.example/u/a': {'type': 'Person'}})
+        self.assertEqual(self.redis.get('remote_in_flight:busy.example'), '1')
+        self.assertFalse(self.redis.exists('remote_in_flight:slow.example'))
+        self.assertEqual(self.redis.get('circuit_failures:slow.example'), '1')
+
+    def test_busy_host_in_a_batch_is_remembered(self):
+        self.redis.set('remote_in_flight:busy.example', 2)
+        with self.app.app_context(), patch.object(remote_fetch, '_run_batch', return_value=({}, {}, set())) as run:
+            self.assertEqual(remote_fetch.get_json_many(['https://busy.example/u/a'], 'application/activity+json'), {})
+            self.assertTrue(remote_fetch.fetch_refused())
+        self.assertEqual(run.call_args[0][0], [])
+
+    def test_works_without_redis(self):
+        with self.app.app_context(), patch('app.redis_client', DownRedis()):
+            response = guarded_get('https://any.example/u/a', 'application/activity+json', 10, True, self.fetch())
+        self.assertEqual(response.status_code, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from sqlalchemy import create_engine, text
+
+from app.post import util
+
+
+def reply(id, parent_id=None, depth=0, score=0):
+    return SimpleNamespace(id=id, parent_id=parent_id, depth=depth, score=score, ranking=0.0,
+                           posted_at=datetime(2025, 1, 1, 12, id))
+
+
+class TestPostReplyPage(unittest.TestCase):
+    def page(self, rows, limit, cursor=None, sort_by='top', parent=None):
+        """Run post_reply_page() with the database returning rows, and return the query's sql and parameters too"""
+        with patch.object(util, 'db') as db:
+            query = db.session.query.return_value.from_statement
+            query.return_value.params.return_value.all.return_value = rows
+            page, next_cursor = util.post_reply_page(SimpleNamespace(id=1), sort_by, None, cursor, limit,
+                                                     parent=parent)
+        return page, next_cursor, str(query.call_args.args[0]), query.return_value.params.call_args.kwargs
+
+    def test_threads_are_kept_whole(self):
+        rows = [reply(1, score=9), reply(4, 1, 1), reply(5, 4, 2),
+                reply(2, score=5), reply(6, 2, 1),
+                reply(3, score=2)]
+        page, next_cursor, sql, params = self.page(rows, limit=4)
+        self.assertEqual([node['comment'].id for node in page], [1])
+        self.assertEqual(page[0]['replies'][0]['replies'][0]['comment'].id, 5)
+        self.assertEqual(util.decode_reply_cursor(next_cursor, 'top'), (9, 1))
+        self.assertIn('r.path[roots.depth + 2] = roots.id', sql)
+        self.assertEqual(params['roots'], 5)
+
+        page, next_cursor, sql, params = self.page(rows, limit=5)
+        self.assertEqual([node['comment'].id for node in page], [1, 2])
+        self.assertEqual(util.decode_reply_cursor(next_cursor, 'top'), (5, 2))
+
+    def test_first_thread_even_if_too_big_and_last_page(self):
+        page, next_cursor, _, _ = self.page([reply(1), reply(2, 1, 1), reply(3, 1, 1)], limit=1)
+        self.assertEqual([len(page), len(page[0]['replies'])], [1, 2])
+        self.assertIsNone(next_cursor)
+
+    def test_replies_of_filtered_replies_are_left_out(self):
+        page, _, _, _ = self.page([reply(1), reply(3, 2, 2)], limit=10)
+        self.assertEqual(page[0]['replies'], [])
+
+    def test_cursor(self):
+        cursor = util.encode_reply_cursor(reply(7), 'new')
+        _, _, sql, params = self.page([], limit=10, cursor=cursor, sort_by='new')
+        self.assertIn('(r.posted_at, r.id) < (:after_key, :after_id)', sql)
+        self.assertEqual((params['after_key'], params['after_id']), (datetime(2025, 1, 1, 12, 7), 7))
+
+    def test_invalid_cursor(self):
+        for cursor, sort_by in (('914', 'old'),     # a reply id, from before
+                                (util.encode_reply_cursor(reply(7), 'new'), 'top'),     # a date instead of a score
+                                (util.encode_reply_cursor(reply(7), 'top'), 'new')):
+            with self.assertRaises(ValueError):
+                self.page([], limit=10, cursor=cursor, sort_by=sort_by)
+
+    def test_branch(self):
+        page, next_cursor, sql, params = self.page([reply(4, 1, 1), reply(5, 4, 2)], limit=10,
+                                                   parent=SimpleNamespace(id=4, depth=1))
+        self.assertEqual([page[0]['comment'].id, page[0]['replies'][0]['comment'].id], [4, 5])
+        self.assertEqual(params['parent_id'], 4)
+        self.assertIsNone(next_cursor)
+
+
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+
+
+@unittest.skipUnless(DATABASE_URL.startswith('postgresql'), 'needs DATABASE_URL=postgresql://...')
+class TestReplyPageQuery(unittest.TestCase):
+    """reply_page_query() run on PostgreSQL, against a temporary post_reply table with the columns it uses"""
+
+    def setUp(self):
+        self.engine = create_engine(DATABASE_URL)
+        self.connection = self.engine.connect()
+        self.connection.execute(text('CREATE TEMPORARY TABLE post_reply (id integer PRIMARY KEY, post_id integer, '
+                                     'parent_id integer, depth integer, path integer[], score integer, '
+                                     'ranking double precision, posted_at timestamp)'))
+        self.connection.execute(text('CREATE INDEX idx_post_reply_path ON post_reply USING gin (path)'))
+        # post 1: 1 > 4 > 5, 2 > 6, 3. post 2: 7
+        for id, parent_id, path, score in ((1, None, [0, 1], 9), (2, None, [0, 2], 5), (3, None, [0, 3], 2),
+                                           (4, 1, [0, 1, 4], 1), (5, 4, [0, 1, 4, 5], 1), (6, 2, [0, 2, 6], 1)):
+            self.connection.execute(text('INSERT INTO post_reply VALUES (:id, 1, :parent_id, :depth, :path, :score, '
+                                         ':score, now())'),
+                                    {'id': id, 'parent_id': parent_id, 'depth': len(path) - 2, 'path': path,
+                                     'score': score})
+        self.connection.execute(text("INSERT INTO post_reply VALUES (7, 2, NULL, 0, '{0,7}', 99, 99, now())"))
+
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
+    def rows(self, **kwargs):
+        sql, params = util.reply_page_query(SimpleNamespace(id=1), 'top', None, limit=4, **kwargs)
+        return [(row.id, row.thread, row.n) for row in self.connection.execute(text(sql), params)]
+
+    def test_threads_in_order(self):
+        self.assertEqual(self.rows(cursor=None), [(1, 1, 1), (4, 1, 2), (5, 1, 3), (2, 2, 1), (6, 2, 2), (3, 3, 1)])
+        cursor = util.encode_reply_cursor(SimpleNamespace(id=1, score=9), 'top')
+        self.assertEqual(self.rows(cursor=cursor), [(2, 1, 1), (6, 1, 2), (3, 2, 1)])
+        self.assertEqual(self.rows(cursor=None, parent=SimpleNamespace(id=4, depth=1)), [(4, 1, 1), (5, 1, 2)])
+
+    def test_replies_are_found_with_the_path_index(self):
+        sql, params = util.reply_page_query(SimpleNamespace(id=1), 'top', None, None, 4)
+        self.connection.execute(text('SET LOCAL enable_seqscan = off'))     # it would be quicker with so few rows
+        self.connection.execute(text('SET LOCAL enable_indexscan = off'))
+        plan = '\n'.join(row[0] for row in self.connection.execute(text(f'EXPLAIN {sql}'), params))
+        self.assertIn('idx_post_reply_path', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import json
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+from app.user import settings_import
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestImportStages(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(IMPORT_BATCH_SIZE=2)
+        self.key = 'import:7:abc'
+        self.redis.set(self.key, json.dumps({
+            'followed_communities': ['https://a.example/c/1', 'https://a.example/c/2', 'https://b.example/c/3'],
+            'blocked_users': [],
+            'blocked_instances': ['spam.example'],
+        }))
+        self.session = MagicMock()
+        self.imported = []
+        self.importers = {stage: (lambda session, user, batch, stage=stage: self.imported.append((stage, batch)))
+                          for stage in settings_import.STAGES}
+
+    def next_batch(self):
+        with self.app.app_context(), patch.dict(settings_import.IMPORTERS, self.importers), \
+                patch.object(settings_import, 'finish_import',
+                             side_effect=lambda session, user, key: settings_import.forget_import(key)):
+            return settings_import.import_next_batch(self.session, 7, self.key)
+
+    def test_batches_and_checkpoints(self):
+        self.assertTrue(self.next_batch())
+        self.assertEqual(self.redis.hgetall(self.key + ':progress'), {'stage': '0', 'position': '2'})
+        self.assertTrue(self.next_batch())
+        self.assertTrue(self.next_batch())     # skips the empty and missing lists
+        self.assertFalse(self.next_batch())
+        self.assertEqual(self.imported, [('followed_communities', ['https://a.example/c/1', 'https://a.example/c/2']),
+                                         ('followed_communities', ['https://b.example/c/3']),
+                                         ('blocked_instances', ['spam.example'])])
+        self.assertFalse(self.redis.exists(self.key))
+        self.assertEqual(self.session.commit.call_count, 3)
+
+    def test_resumes_after_the_last_saved_batch(self):
+        self.redis.hset(self.key + ':progress', mapping={'stage': '0', 'position': '2'})
+        self.next_batch()
+        self.assertEqual(self.imported, [('followed_communities', ['https://b.example/c/3'])])
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestResumeStalledImports(unittest.TestCase):
+    def test_only_stalled_imports_are_queued_again(self):
+        app = Flask(__name__)
+        self.redis.mset({'import:1:old': '{}', 'import:2:new': '{}'})
+        self.redis.zadd(settings_import.IMPORTS_KEY, {'import:1:old': time.time() - 3600, 'import:2:new': time.time(),
+                                                      'import:3:expired': time.time() - 3600})
+        with app.app_context(), patch.object(settings_import, 'import_settings_task') as task:
+            settings_import.resume_stalled_imports()
+        task.delay.assert_called_once_with(1, 'import:1:old')
+        self.assertIsNone(self.redis.zscore(settings_import.IMPORTS_KEY, 'import:3:expired'))
+
+
+class TestResolveObjects(unittest.TestCase):
+    def test_fetched_together_then_the_rest_one_at_a_time(self):
+        note = {'id': 'https://a.example/post/2', 'type': 'Page', 'attributedTo': 'https://a.example/u/bob'}
+        session = MagicMock()
+        session.query.return_value.filter.return_value = [('https://a.example/post/1', 1)]
+        post = settings_import.Post(id=2)
+        slow_post = settings_import.Post(id=3)
+        with patch.object(settings_import, 'instance_banned', side_effect=lambda domain: domain == 'spam.example'), \
+                patch.object(settings_import, 'fetch_many', return_value={note['id']: note}) as fetch_many, \
+                patch.object(settings_import, 'resolve_users') as resolve_users, \
+                patch.object(settings_import, 'find_community', return_value=MagicMock()), \
+                patch.object(settings_import, 'create_resolved_object', return_value=post), \
+                patch('app.api.alpha.utils.misc.get_resolve_object', return_value=slow_post) as get_resolve_object:
+            ids = settings_import.resolve_objects(session, MagicMock(id=7), [
+                'https://a.example/post/1', 'https://a.example/post/2', 'https://b.example/post/3',
+                'https://spam.example/post/4'], settings_import.Post)
+
+        self.assertEqual(ids, {1, 2, 3})
+        fetch_many.assert_called_once_with(['https://a.example/post/2', 'https://b.example/post/3'])
+        resolve_users.assert_called_once_with(session, ['https://a.example/u/bob'])
+        get_resolve_object.assert_called_once_with(None, {'q': 'https://b.example/post/3'}, user_id=7, recursive=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import unittest
+from unittest.mock import patch
+
+# fastapi_server makes its redis client when imported, which needs a real redis url (but doesn't connect)
+with patch.dict(os.environ, {'CACHE_REDIS_URL': 'redis://localhost:6379/0'}):
+    import fastapi_server
+from fastapi_server import ClientQueue
+
+
+def drain(client):
+    events = []
+    while client.pending:
+        events.append(asyncio.run(client.get(timeout=1))[0])
+    return events
+
+
+class TestClientQueue(unittest.TestCase):
+    def test_newer_notification_count_replaces_unsent_one(self):
+        client = ClientQueue(maxsize=5)
+        client.put('1-0', 'notifications', '{"num_notifs": 1}')
+        client.put('2-0', 'messages', '{"conversation": 4}')
+        client.put('3-0', 'notifications', '{"num_notifs": 2}')
+        self.assertEqual(asyncio.run(client.get(timeout=1)), ('2-0', '{"conversation": 4}'))
+        self.assertEqual(asyncio.run(client.get(timeout=1)), ('3-0', '{"num_notifs": 2}'))
+
+    def test_bounded(self):
+        client = ClientQueue(maxsize=2)
+        for i in range(1, 5):
+            client.put(f'{i}-0', 'messages', f'{{"conversation": {i}}}')
+        self.assertEqual(drain(client), ['3-0', '4-0'])
+        self.assertEqual(client.dropped, 2)
+
+    def test_replay_goes_before_live_events_and_skips_duplicates(self):
+        client = ClientQueue(maxsize=10)
+        client.put('5-0', 'messages', '{"conversation": 5}')     # arrived while the stream was being read
+        client.replay('2-0', [('3-0', 'messages', '{"conversation": 3}'),
+                              ('5-0', 'messages', '{"conversation": 5}')])
+        self.assertEqual(drain(client), ['3-0', '5-0'])
+        client.put('4-0', 'messages', '{"conversation": 4}')     # older than what has been sent
+        self.assertEqual(client.pending, {})
+
+    def test_heartbeat_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(ClientQueue().get(timeout=0.01))
+
+
+class TestDispatch(unittest.TestCase):
+    def test_only_that_users_connections(self):
+        mine, theirs = ClientQueue(), ClientQueue()
+        fastapi_server.connected_clients.update({'7': {mine}, '8': {theirs}})
+        try:
+            fastapi_server.dispatch('sse:7', '{"id": "1-0", "kind": "notifications", "data": "{\\"num_notifs\\": 3}"}')
+        finally:
+            fastapi_server.connected_clients.clear()
+        self.assertEqual(list(mine.pending.values()), [('1-0', 'notifications', '{"num_notifs": 3}')])
+        self.assertEqual(theirs.pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
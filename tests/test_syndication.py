@@ -0,0 +1,114 @@
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask, g
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+
+from app.shared import syndication
+
+
+def post(post_id, title='A post', body_html='<p>Hello</p>', url=None):
+    return SimpleNamespace(id=post_id, title=title, body_html=body_html, url=url, slug=None,
+                           profile_id=lambda: f'https://test.localhost/post/{post_id}',
+                           author=SimpleNamespace(user_name='alice'), created_at=datetime(2026, 10, 1))
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestStoredDocuments(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(SERVER_URL='https://test.localhost')
+        self.context = self.app.app_context()
+        self.context.push()
+        g.site = SimpleNamespace(name='Test')
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_built_once_with_strong_etag(self):
+        build = MagicMock(return_value=b'<rss/>')
+        body, etag = syndication.artifact('rss:community:1', build)
+        self.assertEqual(syndication.artifact('rss:community:1', build), (body, etag))
+        self.assertEqual(build.call_count, 1)
+        self.assertTrue(etag.startswith('"') and not etag.startswith('W/'))
+
+        syndication.store_artifact('rss:community:1', b'<rss>changed</rss>')
+        self.assertNotEqual(syndication.artifact('rss:community:1', build)[1], etag)
+        self.assertEqual(build.call_count, 1)
+
+    def test_conditional_request(self):
+        body, etag = syndication.store_artifact('sitemap:index', b'<urlset/>')
+        with self.app.test_request_context(headers={'If-None-Match': etag}), \
+                patch.object(syndication, 'return_304', return_value='304') as return_304:
+            self.assertEqual(syndication.artifact_response(body, etag, syndication.SITEMAP_CONTENT_TYPE), '304')
+        self.assertEqual(return_304.call_args.args, (etag, 'text/xml'))
+        with self.app.test_request_context():
+            response = syndication.artifact_response(body, etag, syndication.SITEMAP_CONTENT_TYPE)
+        self.assertEqual((response.data, response.headers['ETag']), (body, etag))
+
+    def test_invalid_posts_left_out(self):
+        posts = [post(1, url='https://test.localhost/a.jpg'), post(2, title='bad \x00 title'),
+                 post(3, url='https://test.localhost/a.jpg'), post(4, body_html=None)]
+        rss = syndication.rss_document('/c/test', 'Test community', posts).decode()
+        self.assertEqual(rss.count('<item>'), 3)
+        self.assertNotIn('/post/2<', rss)
+        self.assertEqual(rss.count('<enclosure'), 1)
+        self.assertIn('<title>Test community on Test</title>', rss)
+
+    def test_only_stored_documents_rebuilt(self):
+        syndication.store_artifact('rss:user:7', b'<rss/>')
+        self.assertEqual(syndication.stored_artifacts(['rss:community:1', 'rss:user:7']), ['rss:user:7'])
+
+
+    def test_sitemap_rebuilt_at_most_once_per_interval(self):
+        syndication.store_artifact('sitemap:index', b'<sitemapindex/>')
+        syndication.store_artifact('sitemap:1', b'<urlset/>')
+        syndication.mark_sitemap_changed(['sitemap:1', 'sitemap:2', 'sitemap:index'])
+        with patch.object(syndication, 'rebuild_sitemap_task') as task:
+            syndication.rebuild_sitemap()
+            task.delay.assert_called_once_with(['sitemap:1', 'sitemap:index'])  # sitemap:2 isn't stored
+
+            syndication.mark_sitemap_changed(['sitemap:index'])
+            syndication.rebuild_sitemap()
+            task.delay.assert_called_once()
+        self.assertEqual(self.redis.smembers(syndication.SITEMAP_CHANGED_KEY), {'sitemap:index'})   # for next time
+
+
+class TestChangedDocuments(unittest.TestCase):
+    """Which documents a changed post is in, on sqlite"""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        self.session = Session(self.engine)
+        for sql in ('CREATE TABLE community (id INTEGER, topic_id INTEGER)',
+                    'CREATE TABLE post_tag (post_id INTEGER, tag_id INTEGER)',
+                    'CREATE TABLE topic_closure (ancestor_id INTEGER, descendant_id INTEGER)',
+                    'CREATE TABLE feed_item (feed_id INTEGER, community_id INTEGER)',
+                    'CREATE TABLE feed_closure (ancestor_id INTEGER, descendant_id INTEGER)',
+                    'INSERT INTO community VALUES (1, 3), (2, NULL)',
+                    'INSERT INTO post_tag VALUES (12345, 8), (12345, 9), (5, 10)',
+                    'INSERT INTO topic_closure VALUES (3, 3), (4, 3), (4, 4)',
+                    'INSERT INTO feed_item VALUES (6, 2)',
+                    'INSERT INTO feed_closure VALUES (6, 6), (5, 6), (5, 5)'):
+            self.session.execute(text(sql))
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_names(self):
+        changed = {'post_ids': [12345], 'community': [1, 2], 'user': [7], 'domain': [], 'local': True}
+        self.assertEqual(sorted(syndication.changed_artifacts(self.session, changed)),
+                         ['rss:community:1', 'rss:community:2', 'rss:feed:5', 'rss:feed:6', 'rss:tag:8', 'rss:tag:9',
+                          'rss:topic:3', 'rss:topic:4', 'rss:user:7', 'sitemap:1', 'sitemap:index'])
+
+    def test_remote_posts_not_in_the_sitemap(self):
+        changed = {'post_ids': [5], 'community': [], 'user': [], 'domain': [3], 'local': False}
+        self.assertEqual(syndication.changed_artifacts(self.session, changed), ['rss:domain:3', 'rss:tag:10'])
+
+
+if __name__ == '__main__':
+    unittest.main()
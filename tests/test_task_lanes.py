@@ -0,0 +1,114 @@
+import unittest
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+from app import task_lanes
+from app.task_lanes import lane_for_task, celery_routes, parse_rate_limits, LaneRateLimits, vote_target, \
+    should_shed, SHED_NONE, SHED_LOW_VALUE, SHED_OVERLOAD, SHED_PAUSED, admit_activity, intake_domain, \
+    intake_stats, intake_weight
+
+
+class TestTaskLanes(unittest.TestCase):
+    def test_lane_for_task(self):
+        self.assertEqual(lane_for_task('app.activitypub.routes.process_inbox_request'), 'inbound')
+        self.assertEqual(lane_for_task('app.activitypub.signature.post_request'), 'outbound')
+        self.assertEqual(lane_for_task('app.shared.tasks.maintenance.delete_from_s3'), 'media')
+        self.assertEqual(lane_for_task('app.shared.tasks.maintenance.cleanup_old_voting_data'), 'maintenance')
+        self.assertEqual(lane_for_task('app.shared.tasks.likes.vote_for_post'), 'interactive')
+
+    def test_celery_routes(self):
+        routes = celery_routes()
+        self.assertEqual(routes['app.activitypub.routes.process_inbox_request'], {'queue': 'inbound'})
+        self.assertEqual(routes['app.admin.util.*'], {'queue': 'background'})
+        # exact names must come before the patterns that would otherwise swallow them
+        keys = list(routes)
+        self.assertLess(keys.index('app.shared.tasks.maintenance.delete_from_s3'),
+                        keys.index('app.shared.tasks.maintenance.*'))
+
+    def test_rate_limits(self):
+        self.assertEqual(parse_rate_limits('media=60/m, bogus=1/s,inbound='), {'media': '60/m'})
+        annotations = LaneRateLimits({'media': '60/m'})
+        self.assertEqual(annotations.annotate(SimpleNamespace(name='app.models.flush_cdn_cache_task')),
+                         {'rate_limit': '60/m'})
+        self.assertIsNone(annotations.annotate(SimpleNamespace(name='app.shared.tasks.likes.vote_for_post')))
+
+
+class TestLoadShedding(unittest.TestCase):
+    def test_vote_target(self):
+        like = {'type': 'Like', 'id': 'https://a.example/like/1', 'object': 'https://b.example/post/1'}
+        self.assertEqual(vote_target(like), 'https://b.example/post/1')
+        announced = {'type': 'Announce', 'object': {'type': 'Undo', 'object': dict(like, type='Dislike')}}
+        self.assertEqual(vote_target(announced), 'https://b.example/post/1')
+        create = {'type': 'Announce', 'object': {'type': 'Create', 'object': {'type': 'Note'}}}
+        self.assertIsNone(vote_target(create))
+
+    def test_should_shed(self):
+        like = {'type': 'Like', 'object': 'https://b.example/post/1'}
+        create = {'type': 'Create', 'object': {'type': 'Note', 'id': 'https://b.example/comment/2'}}
+        self.assertFalse(should_shed(like, SHED_NONE))
+        self.assertTrue(should_shed(like, SHED_OVERLOAD))
+        self.assertFalse(should_shed(create, SHED_OVERLOAD))
+        self.assertTrue(should_shed(like, SHED_PAUSED))
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestFederationIntake(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(FEDERATION_INTAKE_RATE=25, FEDERATION_INTAKE_BURST=60, FEDERATION_INTAKE_QUEUE_SHARE=0.25)
+        self.patches = [patch.object(task_lanes, 'queue_depths', return_value={'inbound': 10000})]
+        for p in self.patches:
+            p.start()
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        for p in reversed(self.patches):
+            p.stop()
+
+    def test_weight_and_domain(self):
+        self.assertEqual(intake_weight(SimpleNamespace(software='Lemmy', trusted=True)), 8.0)
+        self.assertEqual(intake_weight(SimpleNamespace(software='mastodon', trusted=False)), 0.5)
+        self.assertEqual(intake_weight(SimpleNamespace(software=None, trusted=None)), 1.0)
+        self.assertEqual(intake_domain({'actor': 'https://Lemmy.World/u/someone'}), 'lemmy.world')
+        self.assertEqual(intake_domain({'actor': {'id': 'https://forum.example/uid/1'}}), 'forum.example')
+        self.assertIsNone(intake_domain({'actor': None}))
+
+    def test_bucket_sized_by_weight(self):
+        with patch.object(task_lanes.time, 'time', return_value=600.0):
+            self.assertEqual(admit_activity('lemmy.world', 2.0, SHED_NONE), 0)
+            self.assertEqual(self.redis.hgetall('intake_bucket:lemmy.world'), {'tokens': '2999', 'ts': '600'})
+            self.assertEqual(self.redis.hget('intake_queued', 'lemmy.world'), '1')
+
+            self.redis.hset('intake_bucket:lemmy.world', 'tokens', '0.5')
+            self.assertEqual(admit_activity('lemmy.world', 2.0, SHED_NONE), 1)     # refills 50 a second
+            self.assertEqual(self.redis.hget('intake_refused:10', 'lemmy.world'), '1')
+        self.app.config['FEDERATION_INTAKE_RATE'] = 0
+        self.assertEqual(admit_activity('lemmy.world', 2.0, SHED_NONE), 0)
+
+    def test_only_the_noisy_instance_refused_when_backed_up(self):
+        self.redis.hset('intake_queued', mapping={'noisy.example': '6000', 'quiet.example': '40'})
+        self.assertEqual(admit_activity('noisy.example', 1.0, SHED_OVERLOAD), task_lanes.INTAKE_QUEUE_RETRY_AFTER)
+        self.assertEqual(admit_activity('quiet.example', 1.0, SHED_OVERLOAD), 0)
+        self.assertEqual(admit_activity('noisy.example', 1.0, SHED_NONE), 0)     # not backed up
+        self.assertEqual(admit_activity('noisy.example', 8.0, SHED_LOW_VALUE), 0)    # trusted lemmy gets all of it
+
+    def test_stats(self):
+        with patch.object(task_lanes.time, 'time', return_value=600.0):
+            minute = 10
+            self.redis.hset(f'intake_accepted:{minute}', mapping={'a.example': '30', 'b.example': '5'})
+            self.redis.hset(f'intake_accepted:{minute - 1}', mapping={'a.example': '20'})
+            self.redis.hset(f'intake_refused:{minute}', mapping={'b.example': '7'})
+            self.redis.hset('intake_queued', mapping={'c.example': '-2', 'a.example': '12'})
+            stats = intake_stats()
+        self.assertEqual([(peer['domain'], peer['accepted'], peer['refused'], peer['queued']) for peer in stats],
+                         [('a.example', 50, 0, 12), ('b.example', 5, 7, 0), ('c.example', 0, 0, 0)])
+        self.assertEqual(stats[0]['per_minute'], 10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
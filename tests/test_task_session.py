@@ -0,0 +1,116 @@
+import os
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app import db
+from app.utils import patch_db_session
+
+
+def fake_session():
+    return MagicMock(_is_asyncio=False)
+
+
+class TestPatchDbSession(unittest.TestCase):
+    def test_each_thread_sees_its_own_session(self):
+        barrier = threading.Barrier(8)
+
+        def task(task_session):
+            with patch_db_session(task_session):
+                barrier.wait()      # every thread is inside patch_db_session at the same time
+                seen = db.session()
+                db.session.remove()
+                barrier.wait()
+                return seen is task_session and db.session() is task_session
+
+        sessions = [fake_session() for _ in range(8)]
+        with ThreadPoolExecutor(8) as executor:
+            self.assertEqual(list(executor.map(task, sessions)), [True] * 8)
+        for session in sessions:
+            session.close.assert_not_called()
+
+    def test_nested_and_restored(self):
+        outer, inner = fake_session(), fake_session()
+        with patch_db_session(outer):
+            with patch_db_session(inner):
+                self.assertIs(db.session(), inner)
+                db.session.execute('SELECT 1')
+            self.assertIs(db.session(), outer)
+        self.assertEqual(inner.execute.call_args.args[0], 'SELECT 1')
+        outer.execute.assert_not_called()
+        with patch.object(db.session.registry, 'registry') as registry:
+            registry.return_value = fake_session()
+            self.assertIs(db.session(), registry.return_value)
+
+
+@pytest.mark.skipif(
+    not os.environ.get("DATABASE_URL", "").startswith("postgresql"),
+    reason="The concurrent inbox stress test needs a migrated PostgreSQL database, and redis",
+)
+class TestConcurrentInbox(unittest.TestCase):
+    """Hundreds of process_inbox_request tasks at once in a thread pool, like the threads Celery pool runs them"""
+
+    FOLLOWERS = 300
+    THREADS = 48
+
+    def setUp(self):
+        from app import create_app
+        from app.models import Community, Instance, User
+
+        self.app = create_app()
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        server = self.app.config['SERVER_NAME']
+
+        self.instance = Instance(domain='stress.example', software='lemmy')
+        db.session.add(self.instance)
+        db.session.flush()
+        self.community = Community(name='stresstest', title='Stress test', ap_id='stresstest',
+                                   ap_profile_id=f'https://{server}/c/stresstest', instance_id=1)
+        db.session.add(self.community)
+        self.users = [User(user_name=f'stress{i}', ap_id=f'stress{i}@stress.example',
+                           ap_profile_id=f'https://stress.example/u/stress{i}',
+                           ap_inbox_url=f'https://stress.example/u/stress{i}/inbox',
+                           instance_id=self.instance.id, verified=True)
+                      for i in range(self.FOLLOWERS)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        from app.models import CommunityMember
+        CommunityMember.query.filter_by(community_id=self.community.id).delete()
+        for user in self.users:
+            db.session.delete(user)
+        db.session.delete(self.community)
+        db.session.delete(self.instance)
+        db.session.commit()
+        db.session.remove()
+        self.app_context.pop()
+
+    def test_follows(self):
+        from app.activitypub.routes import process_inbox_request
+        from app.models import CommunityMember
+
+        # built here, the model objects belong to this thread's session
+        activities = [{'id': f'{user.ap_profile_id}/follow/1', 'type': 'Follow', 'actor': user.ap_profile_id,
+                       'object': self.community.ap_profile_id} for user in self.users]
+
+        def follow(activity):
+            with self.app.app_context():
+                process_inbox_request(activity, False)
+                return db.session.registry.registry.has()   # the app context session was never needed
+
+        with patch('app.activitypub.routes.send_post_request'), \
+                patch('app.activitypub.actor.schedule_actor_refresh'):
+            with ThreadPoolExecutor(self.THREADS) as executor:
+                used_app_session = list(executor.map(follow, activities))
+
+        self.assertFalse(any(used_app_session))
+        self.assertEqual(CommunityMember.query.filter_by(community_id=self.community.id).count(), self.FOLLOWERS)
+
+
+if __name__ == '__main__':
+    unittest.main()
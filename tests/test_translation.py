@@ -0,0 +1,66 @@
+import unittest
+from unittest.mock import patch
+
+import pytest
+from flask import Flask
+
+from app import translation
+from app.translation import LocalTranslator, translate_strings
+
+
+@pytest.mark.usefixtures('fake_redis')
+class TestTranslateStrings(unittest.TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config.update(TRANSLATE_ENDPOINT='local', TRANSLATE_KEY='')
+        self.backend = patch.object(LocalTranslator, 'translate_many', autospec=True,
+                                    side_effect=lambda self, q, source, target: [f'[{target}] {text}' for text in q])
+        self.translate_many = self.backend.start()
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        self.backend.stop()
+
+    def test_cached_by_text_and_language_pair(self):
+        self.assertEqual(translate_strings(['Bonjour', ''], 'fr', 'en'), ['[en] Bonjour', ''])
+        self.assertEqual(translate_strings(['Bonjour'], 'fr', 'en'), ['[en] Bonjour'])
+        self.assertEqual(self.translate_many.call_count, 1)
+        self.assertEqual(translate_strings(['Bonjour'], 'fr', 'de'), ['[de] Bonjour'])
+        self.assertEqual(self.translate_many.call_count, 2)
+
+    def test_batched_and_duplicates_translated_once(self):
+        texts = [f'texte {i % 60}' for i in range(120)]
+        self.assertEqual(translate_strings(texts, 'auto', 'en'), [f'[en] {text}' for text in texts])
+        self.assertEqual([len(call.args[1]) for call in self.translate_many.call_args_list], [50, 10])
+        self.assertEqual(self.redis.keys('translation_pending:*'), [])
+
+    def test_waits_for_a_translation_in_progress_elsewhere(self):
+        translate_strings(['Hola'], 'es', 'en')
+        [key] = self.redis.keys('translation:*')
+        self.redis.rename(key, key.replace('translation:', 'translation_pending:'))
+
+        def other_process_finishes(seconds):
+            self.redis.set(key, 'Hello')
+        with patch.object(translation.time, 'sleep', side_effect=other_process_finishes):
+            self.assertEqual(translate_strings(['Hola', 'Adiós'], 'es', 'en'), ['Hello', '[en] Adiós'])
+        self.assertEqual(self.translate_many.call_args.args[1], ['Adiós'])
+
+    def test_stops_waiting_after_a_few_seconds(self):
+        self.redis.set(translation.PENDING_KEY.format('es', 'en', translation.hashlib.sha256(b'Hola').hexdigest()), 1)
+        clock = iter(range(0, 100))
+        with patch.object(translation.time, 'sleep'), \
+                patch.object(translation.time, 'monotonic', side_effect=lambda: next(clock)):
+            self.assertEqual(translate_strings(['Hola'], 'es', 'en'), ['[en] Hola'])
+        self.assertLessEqual(next(clock), translation.MAX_WAIT + 3)
+
+    def test_failures_are_not_cached(self):
+        self.translate_many.side_effect = RuntimeError('translator is down')
+        with patch.object(self.app.logger, 'exception'):
+            self.assertEqual(translate_strings(['Hallo'], 'de', 'en'), [''])
+        self.assertEqual(self.redis.keys('*'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from flask import Flask
+from PIL import Image
+
+from app.constants import FILE_STATE_PENDING, FILE_STATE_READY
+from app.models import File
+from app.shared import upload
+
+
+class TestUploadPipeline(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        self.app.config.update(MEDIA_PROCESSES=0, S3_PUBLIC_URL='s3.example', S3_BUCKET='media')
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        shutil.rmtree(self.directory)
+
+    def stored(self, name, image):
+        path = os.path.join(self.directory, name)
+        image.save(path)
+        return {'path': path, 'ext': os.path.splitext(name)[1], 'name': os.path.splitext(name)[0],
+                'local_directory': self.directory, 'subdirectory': 'communities/ab/cd'}
+
+    def gif(self, frames=12):
+        frames = [Image.new('RGB', (600, 400), (i * 20, 0, 0)) for i in range(frames)]
+        stored = self.stored('animated.gif', frames[0])
+        frames[0].save(stored['path'], save_all=True, append_images=frames[1:], duration=50, loop=0)
+        return stored
+
+    def test_resized_converted_and_thumbnail(self):
+        stored = self.stored('photo.jpg', Image.new('RGB', (1200, 900), 'red'))
+        with patch.object(upload, 'store_files_in_s3', return_value=False):
+            plan = {'source': stored['path'], 'variants': [
+                upload.image_variant(stored, 'file', (250, 250), '.webp', 'WEBP', 90),
+                upload.image_variant(stored, 'thumbnail', (40, 40), '.jpeg', 'JPEG', 90, rgb=True, suffix='_thumbnail')]}
+        made = upload.make_variants(plan)
+
+        self.assertEqual([(width, height) for _, width, height, _ in made], [(250, 188), (40, 30)])
+        self.assertEqual(Image.open(made[0][0]).format, 'WEBP')
+        self.assertEqual(Image.open(made[1][0]).format, 'JPEG')
+        self.assertFalse(os.path.exists(stored['path']))   # replaced by its variants
+
+    def test_gif_frames_kept(self):
+        stored = self.gif()
+        width, height = upload.make_variant(stored['path'], os.path.join(self.directory, 'small.gif'), [40, 40])
+        self.assertEqual((width, height), (40, 27))
+        with Image.open(os.path.join(self.directory, 'small.gif')) as small:
+            self.assertEqual(small.n_frames, 12)
+        self.assertEqual(Image.open(stored['path']).size, (600, 400))
+
+    def test_moved_to_s3(self):
+        stored = self.stored('photo.png', Image.new('RGBA', (300, 300)))
+        with patch.object(upload, 'store_files_in_s3', return_value=True):
+            plan = {'source': stored['path'], 'variants': [upload.image_variant(stored, 'file', (250, 250), '.png')]}
+        with patch.object(upload, 's3_client') as s3_client:
+            made = upload.make_variants(plan)
+        self.assertEqual(s3_client.return_value.upload_file.call_args.args[2], 'communities/ab/cd/photo.png')
+        self.assertEqual(made[0][0], 'https://s3.example/communities/ab/cd/photo.png')
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_url_works_before_processing(self):
+        stored = self.stored('photo.jpg', Image.new('RGB', (1200, 900), 'red'))
+        with patch.object(upload, 'store_files_in_s3', return_value=False):
+            variant = upload.image_variant(stored, 'file', (250, 250), '.webp', 'WEBP', 90)
+        upload.publish_upload(stored, variant)
+        self.assertEqual(Image.open(variant['path']).format, 'JPEG')   # the upload, until it has been processed
+
+        upload.make_variants({'source': stored['path'], 'variants': [variant]})
+        with Image.open(variant['path']) as processed:
+            self.assertEqual((processed.format, processed.size), ('WEBP', (250, 188)))
+
+    def test_in_media_pool(self):
+        stored = self.stored('photo.png', Image.new('RGBA', (1200, 900)))
+        destination = os.path.join(self.directory, 'small.webp')
+        self.app.config['MEDIA_PROCESSES'] = 1
+        try:
+            size = upload.run_in_media_pool(upload.make_variant, stored['path'], destination, [250, 250], 'WEBP', 90)
+        finally:
+            upload._media_pool.shutdown()
+            upload._media_pool = None
+        self.assertEqual(size, (250, 188))
+        self.assertEqual(Image.open(destination).format, 'WEBP')
+
+    def test_only_queued_if_there_is_work(self):
+        stored = {'path': os.path.join(self.directory, 'logo.svg'), 'ext': '.svg', 'name': 'logo',
+                  'local_directory': self.directory, 'subdirectory': 'communities/ab/cd'}
+        with patch.object(upload, 'store_files_in_s3', return_value=False), patch.object(upload, 'db') as db:
+            db.session.info = {}
+            svg = File()
+            upload.process_after_commit(svg, {'source': stored['path'],
+                                              'variants': [upload.image_variant(stored, 'file', None, '.svg')]})
+            gif = File()
+            upload.process_after_commit(gif, {'source': stored['path'],
+                                              'variants': [upload.image_variant(stored, 'file', (250, 250), '.gif')]})
+        self.assertEqual([svg.state, gif.state], [FILE_STATE_READY, FILE_STATE_PENDING])
+        self.assertEqual([file for file, plan in db.session.info[upload.PROCESS_AFTER_COMMIT]], [gif])
+
+
+if __name__ == '__main__':
+    unittest.main()